@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of message_classifier against the parsing it replaced.
+
+The legacy path runs the regex filters that register_handlers used to apply
+to every message and then the re-parsing done inside handle_group_a_message
+or handle_all_group_b_messages. The new path is a single
+message_classifier.classify() call. Both run on representative Group A and
+Group B corpora, or on the texts of a recording made by update_recorder.py.
+
+Example:
+    python bench_classifier.py --messages 200000
+    python bench_classifier.py --recording updates.jsonl
+"""
+import argparse
+import json
+import random
+import re
+import time
+from typing import Callable, Dict, List
+
+import message_classifier
+
+# The filters every text message used to go through, in registration order
+_LEGACY_FILTERS = [re.compile(p) for p in (
+    r'^发图', r'^设置群聊A$', r'^设置群聊B$', r'^解散群聊$', r'^设置操作人$',
+    r'^重置群码$', r'^重置群\d+$', r'^(同意|确认)$', r'^群$', r'^\+', r'^\d+\s*群$', r'^\d+$',
+    r'^开启转发$', r'^关闭转发$', r'^转发状态$',
+)]
+
+
+def legacy_group_a(text: str):
+    """Filters plus the parsing done in handle_group_a_message."""
+    for pattern in _LEGACY_FILTERS:
+        pattern.search(text)
+    text = text.strip()
+    if text.startswith("+"):
+        return None
+    match = re.search(r'^(\d+)\s*群$', text)
+    if not match and text.isdigit():
+        return text
+    return match.group(1) if match else None
+
+
+def legacy_group_b(text: str):
+    """Filters plus the parsing done in handle_all_group_b_messages."""
+    for pattern in _LEGACY_FILTERS[:8]:
+        pattern.search(text)
+    text = text.strip()
+    zero = text == "+0" or text == "0"
+    raw_numbers = re.findall(r'\d+', text)
+    plus_numbers = [m[1:] for m in re.findall(r'\+\d+', text)]
+    command = "重置群码" in text or "设置群" in text or "设置群聊" in text or "设置操作人" in text or "解散群聊" in text
+    return zero, raw_numbers, plus_numbers, command
+
+
+def group_a_corpus(rng: random.Random, size: int) -> List[str]:
+    """Mostly amounts, some "N 群", some chatter and stray "+N"."""
+    forms = [
+        (60, lambda: str(rng.randint(100, 200))),
+        (20, lambda: f"{rng.randint(100, 200)} 群"),
+        (5, lambda: f"+{rng.randint(100, 200)}"),
+        (15, lambda: rng.choice(["好的", "谢谢老板", "在吗", "收到 马上安排", "今天还有码吗？", "ok"])),
+    ]
+    return _draw(rng, forms, size)
+
+
+def group_b_corpus(rng: random.Random, size: int) -> List[str]:
+    """Mostly "+amount" and "0" replies, some custom amounts, commands and chatter."""
+    forms = [
+        (55, lambda: f"+{rng.randint(100, 200)}"),
+        (15, lambda: rng.choice(["0", "+0"])),
+        (10, lambda: str(rng.randint(100, 200))),
+        (5, lambda: f"+{rng.randint(201, 5000)} 改一下"),
+        (5, lambda: rng.choice(["重置群码", f"重置群{rng.randint(1, 30)}", "同意", "确认"])),
+        (10, lambda: rng.choice(["稍等", "会员还没进群", "这个码用过了 换一个", "收到", "第3个群满了"])),
+    ]
+    return _draw(rng, forms, size)
+
+
+def _draw(rng: random.Random, forms, size: int) -> List[str]:
+    weights = [weight for weight, _ in forms]
+    makers = [maker for _, maker in forms]
+    return [rng.choices(makers, weights=weights)[0]() for _ in range(size)]
+
+
+def recording_corpus(path: str) -> List[str]:
+    """Texts of every message in a recording."""
+    texts = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            message = (json.loads(line)['update'].get('message') or {}) if line.strip() else {}
+            if message.get('text'):
+                texts.append(message['text'])
+    return texts
+
+
+def time_parser(parse: Callable[[str], object], corpus: List[str], repeat: int) -> float:
+    """Best-of-`repeat` nanoseconds per message."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            parse(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / max(1, len(corpus)) * 1e9
+
+
+def main():
+    """Parse arguments, time both paths on each corpus and print the comparison."""
+    parser = argparse.ArgumentParser(description="Benchmark the message classifier.")
+    parser.add_argument("--messages", type=int, default=100000, help="messages per synthetic corpus")
+    parser.add_argument("--recording", help="use the texts of an update_recorder file instead")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, best is kept")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.recording:
+        texts = recording_corpus(args.recording)
+        corpora: Dict[str, tuple] = {
+            'recording (as Group A)': (texts, legacy_group_a),
+            'recording (as Group B)': (texts, legacy_group_b),
+        }
+    else:
+        corpora = {
+            'group_a': (group_a_corpus(rng, args.messages), legacy_group_a),
+            'group_b': (group_b_corpus(rng, args.messages), legacy_group_b),
+        }
+
+    print(f"{'corpus':24} {'messages':>9} {'legacy ns':>10} {'classify ns':>12} {'speedup':>8}")
+    for name, (corpus, legacy) in corpora.items():
+        legacy_ns = time_parser(legacy, corpus, args.repeat)
+        new_ns = time_parser(message_classifier.classify, corpus, args.repeat)
+        print(f"{name:24} {len(corpus):>9} {legacy_ns:>10.0f} {new_ns:>12.0f} {legacy_ns / new_ns:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
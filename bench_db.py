@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks and query-plan checks for every public db.py function.
+
+Each function is timed against synthetic image pools of several sizes, with
+and without metadata, spread over many Group B chats. The report shows
+ops/sec and the peak memory allocated per call (tracemalloc).
+
+Before timing, the SQL issued by the hot paths (random open pick, per-group
+filter, every select_open_image strategy, status update, bulk insert,
+delete by number)
+is captured and run through EXPLAIN QUERY PLAN. A full scan of the images
+table fails the run with exit status 1.
+
+Runs in a temporary directory, so the checkout's images.db is never touched.
+With --status-bitmap every pool is mirrored in a status_bitmap.StatusBitmap,
+as with STATUS_BITMAP=1, so counts and picks can be compared with and
+without it.
+
+Example:
+    python bench_db.py --sizes 100,10000 --group-b 50 --output bench_db.json
+    python bench_db.py --plans-only
+    python bench_db.py --sizes 10000 --functions count_images_by_status select_open_image --status-bitmap
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import db
+import status_bitmap
+
+logger = logging.getLogger(__name__)
+
+GROUP_B_BASE = -1008000000000
+
+# Legacy JSON helpers that would overwrite the SQLite file, and enable_wal, set_fencing_token and
+# use_status_bitmap which would change every later measurement; not part of the benchmark
+EXCLUDED_FUNCTIONS = {'load_db', 'save_db', 'enable_wal', 'set_fencing_token', 'use_status_bitmap'}
+
+# Functions that empty the table (or retire a pool); every call gets a fresh copy of the pool
+DESTRUCTIVE_FUNCTIONS = {'clear_all_images', 'clear_images_by_group_b', 'delete_images_by_number',
+                         'delete_image_by_number', 'restore_database', 'reset_group_b'}
+
+# Images per add_images call, the most a Telegram album holds
+ALBUM_SIZE = 10
+
+# select_open_image strategies, each timed and plan-checked on its own
+SELECTION_STRATEGIES = getattr(db, 'SELECTION_STRATEGIES', ())
+
+# Plan lines that mean SQLite reads the whole images table
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?images\b(?! USING (COVERING )?INDEX)')
+
+
+class Pool:
+    """A generated database file plus the IDs needed to build realistic arguments."""
+
+    def __init__(self, path: str, size: int, group_b_ids: List[int], with_metadata: bool, rng: random.Random):
+        self.path = path
+        self.size = size
+        self.group_b_ids = group_b_ids
+        self.with_metadata = with_metadata
+        self.rng = rng
+        self._added = 0
+
+    def image_id(self) -> str:
+        return f"img_{self.rng.randrange(self.size)}"
+
+    def group_b(self) -> int:
+        return self.rng.choice(self.group_b_ids)
+
+    def number(self) -> int:
+        return self.rng.randint(1, 99)
+
+    def number_group_b(self) -> Optional[int]:
+        """Group B of a by-number lookup; images without metadata belong to none."""
+        return self.group_b() if self.with_metadata else None
+
+    def new_image_id(self) -> str:
+        self._added += 1
+        return f"new_{self._added}"
+
+    def metadata(self) -> str:
+        return json.dumps({'source_group_b_id': self.group_b()})
+
+
+def build_pool(directory: str, size: int, group_b: int, with_metadata: bool, seed: int) -> Pool:
+    """Create a database with `size` images, a third of them closed."""
+    rng = random.Random(seed)
+    path = os.path.join(directory, f"pool_{size}_{'meta' if with_metadata else 'plain'}.db")
+    group_b_ids = [GROUP_B_BASE - i for i in range(group_b)]
+
+    db.DB_FILE = path
+    db.init_db()
+    conn = sqlite3.connect(path)
+
+    def rows():
+        for i in range(size):
+            group_b_id = group_b_ids[i % group_b]
+            metadata = json.dumps({'source_group_b_id': group_b_id}) if with_metadata else None
+            yield (f"img_{i}", rng.randint(1, 99), f"file_{i}", 'closed' if i % 3 == 0 else 'open',
+                   metadata, group_b_id if with_metadata else None)
+
+    # Bulk insert directly; going through add_image would take hours at 1M rows
+    conn.executemany(
+        "INSERT INTO images (image_id, number, file_id, status, metadata, source_group_b_id) "
+        "VALUES (?, ?, ?, ?, ?, ?)", rows()
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return Pool(path, size, group_b_ids, with_metadata, rng)
+
+
+def delete_by_number_function() -> Optional[Callable]:
+    """The delete-by-number entry point, if db.py has one."""
+    return getattr(db, 'delete_images_by_number', None) or getattr(db, 'delete_image_by_number', None)
+
+
+def operations(pool: Pool) -> Dict[str, Callable[[], object]]:
+    """Map each public db function to a call with realistic arguments."""
+    ops = {
+        'init_db': lambda: db.init_db(),
+        'add_image': lambda: db.add_image(pool.new_image_id(), pool.number(), "file_new",
+                                          metadata=pool.metadata() if pool.with_metadata else None),
+        'add_images': lambda: db.add_images([
+            {'number': pool.number(), 'file_id': "file_new", 'file_unique_id': pool.new_image_id(),
+             'metadata': pool.metadata() if pool.with_metadata else None}
+            for _ in range(ALBUM_SIZE)
+        ]),
+        'get_random_open_image': lambda: db.get_random_open_image(),
+        'get_random_open_image_by_group_b': lambda: db.get_random_open_image_by_group_b(pool.group_b()),
+        'select_open_image': lambda: db.select_open_image(),
+        'set_image_status': lambda: db.set_image_status(pool.image_id(), pool.rng.choice(('open', 'closed'))),
+        'get_all_images': lambda: db.get_all_images(),
+        'get_image_by_id': lambda: db.get_image_by_id(pool.image_id()),
+        'count_images_by_status': lambda: db.count_images_by_status(),
+        'get_image_path': lambda: db.get_image_path(pool.image_id()),
+        'reset_all_image_statuses': lambda: db.reset_all_image_statuses(),
+        'update_image_metadata': lambda: db.update_image_metadata(pool.image_id(), pool.metadata()),
+        'clear_images_by_group_b': lambda: db.clear_images_by_group_b(pool.group_b()),
+        'clear_all_images': lambda: db.clear_all_images(),
+        'get_state': lambda: db.get_state('last_update_id'),
+        'set_state': lambda: db.set_state('last_update_id', pool.rng.randrange(10 ** 9)),
+        'mark_message_handled': lambda: db.mark_message_handled(pool.group_b(), pool.rng.randrange(10 ** 9), 'bench'),
+        'is_message_handled': lambda: db.is_message_handled(pool.group_b(), pool.rng.randrange(10 ** 9)),
+        'prune_handled_messages': lambda: db.prune_handled_messages(time.time() - 2 * 24 * 3600),
+        'get_shared': lambda: db.get_shared('forwarded_msgs', pool.image_id()),
+        'set_shared': lambda: db.set_shared('forwarded_msgs', pool.image_id(), '{}'),
+        'delete_shared': lambda: db.delete_shared('forwarded_msgs', pool.image_id()),
+        'get_shared_items': lambda: db.get_shared_items('forwarded_msgs'),
+        'count_shared': lambda: db.count_shared('forwarded_msgs'),
+        'get_outstanding_notifications': lambda: db.get_outstanding_notifications(),
+        'replace_shared': lambda: db.replace_shared('group_b_responses', []),
+        'acquire_lease': lambda: db.acquire_lease('bench', 'bench', 60),
+        'renew_lease': lambda: db.renew_lease('bench', 'bench', 1, 60),
+        'release_lease': lambda: db.release_lease('bench', 'bench', 1),
+        'get_lease': lambda: db.get_lease('bench'),
+        'fencing_token': lambda: db.fencing_token(),
+        'sync_status_bitmap': lambda: db.sync_status_bitmap(),
+        'set_image_content': lambda: db.set_image_content(pool.image_id(), f"{pool.rng.getrandbits(256):064x}", 'jpeg'),
+        'get_image_content': lambda: db.get_image_content(pool.image_id()),
+        'get_images_without_content': lambda: db.get_images_without_content(),
+        'update_file_id': lambda: db.update_file_id(f"{pool.rng.getrandbits(256):064x}", "file_reuploaded"),
+        'backup_database': lambda: db.backup_database(pool.path + ".backup"),
+        # Restores the pool itself over the scratch copy
+        'restore_database': lambda: db.restore_database(pool.path),
+        'import_images': lambda: db.import_images([
+            {'image_id': pool.new_image_id(), 'number': pool.number(), 'file_id': "file_imported", 'status': 'open',
+             'metadata': pool.metadata() if pool.with_metadata else None}
+            for _ in range(ALBUM_SIZE)
+        ]),
+        'get_group_generation': lambda: db.get_group_generation(pool.group_b()),
+        'reset_group_b': lambda: db.reset_group_b(pool.group_b()),
+        'get_stale_generations': lambda: db.get_stale_generations(),
+        'purge_stale_images': lambda: db.purge_stale_images(pool.group_b()),
+        'get_first_image': lambda: db.get_first_image(),
+        'get_images_by_number': lambda: db.get_images_by_number(pool.number(), pool.number_group_b()),
+        'get_images_by_number:any_group_b': lambda: db.get_images_by_number(pool.number(), limit=1),
+    }
+    for strategy in SELECTION_STRATEGIES:
+        ops[f'select_open_image:{strategy}'] = lambda strategy=strategy: db.select_open_image(strategy)
+        ops[f'select_open_image:{strategy}:group_b'] = \
+            lambda strategy=strategy: db.select_open_image(strategy, pool.group_b())
+    delete_by_number = delete_by_number_function()
+    if delete_by_number is not None:
+        ops[delete_by_number.__name__] = lambda: delete_by_number(pool.number(), pool.number_group_b())
+    return ops
+
+
+def public_functions() -> List[str]:
+    """Public functions defined in db.py, so new ones cannot be missed silently."""
+    names = []
+    for name, value in vars(db).items():
+        if name.startswith('_') or not callable(value) or isinstance(value, type):
+            continue
+        if getattr(value, '__module__', None) == db.__name__ and name not in EXCLUDED_FUNCTIONS:
+            names.append(name)
+    return sorted(names)
+
+
+# --- query plans -------------------------------------------------------
+
+def capture_sql(call: Callable[[], object]) -> List[str]:
+    """Run `call` and return the data statements it sent to SQLite."""
+    statements = []
+    original = db._connect
+
+    def traced_connect():
+        conn = original()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    db._connect = traced_connect
+    try:
+        call()
+    finally:
+        db._connect = original
+    return [sql for sql in statements if re.match(r'\s*(SELECT|UPDATE|DELETE|INSERT)\b', sql, re.I)]
+
+
+def explain(path: str, sql: str) -> List[str]:
+    """Return the detail column of EXPLAIN QUERY PLAN for `sql`."""
+    conn = sqlite3.connect(path)
+    try:
+        return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+    finally:
+        conn.close()
+
+
+def check_plans(pool: Pool) -> Tuple[List[Dict], bool]:
+    """Capture and explain the hot queries. Returns (report rows, all passed)."""
+    db.DB_FILE = pool.path
+    ops = operations(pool)
+    hot = ['get_random_open_image', 'get_random_open_image_by_group_b', 'set_image_status', 'add_images',
+           'get_first_image', 'purge_stale_images', 'get_images_by_number', 'get_images_by_number:any_group_b',
+           'get_outstanding_notifications']
+    hot += [name for name in ops if name.startswith('select_open_image:')]
+    delete_by_number = delete_by_number_function()
+
+    rows = []
+    passed = True
+    for name in hot + ['delete_by_number']:
+        if name == 'delete_by_number':
+            if delete_by_number is None:
+                rows.append({'function': name, 'status': 'missing', 'sql': None, 'plan': []})
+                logger.warning("db.py has no delete-by-number function; its plan is not checked")
+                continue
+            name = delete_by_number.__name__
+            # Run against a scratch copy, the call deletes rows
+            scratch = pool.path + ".plan"
+            shutil.copyfile(pool.path, scratch)
+            db.DB_FILE = scratch
+            statements = capture_sql(ops[name])
+            db.DB_FILE = pool.path
+        else:
+            statements = capture_sql(ops[name])
+
+        for sql in statements:
+            plan = explain(pool.path, sql)
+            scans = [line for line in plan if FULL_SCAN.match(line)]
+            status = 'FULL SCAN' if scans else 'ok'
+            passed = passed and not scans
+            rows.append({'function': name, 'status': status, 'sql': sql, 'plan': plan})
+    return rows, passed
+
+
+# --- timing --------------------------------------------------------------
+
+def time_operation(pool: Pool, name: str, call: Callable[[], object], min_time: float,
+                   max_calls: int, alloc_calls: int) -> Dict:
+    """Measure ops/sec and peak allocation per call for one function."""
+    destructive = name in DESTRUCTIVE_FUNCTIONS
+    scratch = pool.path + ".scratch"
+
+    def prepare():
+        if destructive:
+            shutil.copyfile(pool.path, scratch)
+            db.DB_FILE = scratch
+            db.sync_status_bitmap()
+
+    db.DB_FILE = pool.path
+    prepare()
+    call()  # Warm-up: schema check, page cache
+
+    elapsed = 0.0
+    calls = 0
+    limit = 3 if destructive else max_calls
+    while calls < limit and (calls == 0 or elapsed < min_time):
+        prepare()
+        start = time.perf_counter()
+        call()
+        elapsed += time.perf_counter() - start
+        calls += 1
+
+    # Allocation pass runs separately; tracemalloc itself slows calls down a lot
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(1 if destructive else alloc_calls):
+            prepare()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            call()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+        db.DB_FILE = pool.path
+        if destructive:
+            db.sync_status_bitmap()
+
+    return {
+        'calls': calls,
+        'ops_per_sec': calls / elapsed if elapsed else 0.0,
+        'mean_ms': elapsed / calls * 1000 if calls else 0.0,
+        'alloc_peak_kib_per_call': sum(peaks) / len(peaks) / 1024 if peaks else 0.0,
+    }
+
+
+def run_suite(args) -> Tuple[Dict, bool]:
+    """Build every pool variant, check plans and time each function."""
+    workdir = tempfile.mkdtemp(prefix="bench_db_")
+    os.chdir(workdir)
+    results = {'config': vars(args).copy(), 'plans': {}, 'timings': {}}
+
+    covered = set(operations(Pool("", 1, [GROUP_B_BASE], True, random.Random(0))))
+    uncovered = [name for name in public_functions() if name not in covered]
+    if uncovered:
+        logger.warning("No benchmark for db functions: %s", ", ".join(uncovered))
+    results['uncovered'] = uncovered
+
+    all_passed = True
+    for size in args.sizes:
+        for with_metadata in (True, False):
+            label = f"{size}/{'metadata' if with_metadata else 'no-metadata'}/{args.group_b}B"
+            started = time.perf_counter()
+            pool = build_pool(workdir, size, args.group_b, with_metadata, args.seed)
+            print(f"== {label} (built in {time.perf_counter() - started:.1f}s)", flush=True)
+
+            plans, passed = check_plans(pool)
+            all_passed = all_passed and passed
+            results['plans'][label] = plans
+            for row in plans:
+                print(f"  plan {row['function']:34} {row['status']}")
+                if row['status'] == 'FULL SCAN':
+                    print(f"    {row['sql']}")
+                    for line in row['plan']:
+                        print(f"      {line}")
+            if args.plans_only:
+                os.remove(pool.path)
+                continue
+
+            bitmap = None
+            if args.status_bitmap:
+                bitmap = status_bitmap.StatusBitmap.create(capacity=size + 1024,
+                                                           max_groups=min(args.group_b, status_bitmap.MAX_GROUPS))
+                db.use_status_bitmap(bitmap)
+                db.sync_status_bitmap()
+
+            timings = {}
+            for name, call in operations(pool).items():
+                if args.functions and name not in args.functions:
+                    continue
+                timings[name] = time_operation(pool, name, call, args.min_time, args.max_calls, args.alloc_calls)
+                row = timings[name]
+                print(f"  {name:34} {row['ops_per_sec']:>12.1f} ops/s {row['mean_ms']:>10.3f} ms "
+                      f"{row['alloc_peak_kib_per_call']:>10.1f} KiB/call", flush=True)
+            results['timings'][label] = timings
+            if bitmap is not None:
+                db.use_status_bitmap(None)
+                bitmap.close()
+            for suffix in ("", ".scratch", ".plan", ".backup"):
+                if os.path.exists(pool.path + suffix):
+                    os.remove(pool.path + suffix)
+
+    results['plans_passed'] = all_passed
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results, all_passed
+
+
+def main():
+    """Parse arguments, run the suite and exit non-zero on a full table scan."""
+    parser = argparse.ArgumentParser(description="Micro-benchmark db.py and check its query plans.")
+    parser.add_argument("--sizes", default="100,10000,1000000",
+                        type=lambda spec: [int(x) for x in spec.split(',')], help="pool sizes to test")
+    parser.add_argument("--group-b", type=int, default=50, help="number of Group B chats in each pool")
+    parser.add_argument("--functions", nargs='*', help="only time these functions")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to time each function")
+    parser.add_argument("--max-calls", type=int, default=2000, help="upper bound of timed calls per function")
+    parser.add_argument("--alloc-calls", type=int, default=5, help="calls measured under tracemalloc")
+    parser.add_argument("--plans-only", action="store_true", help="only run the query-plan checks")
+    parser.add_argument("--status-bitmap", action="store_true", help="mirror every pool in a status bitmap")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--log-level", default="WARNING", help="log level while benchmarking")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    results, passed = run_suite(args)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"Results written to {output}")
+
+    if not passed:
+        print("\nFAILED: a hot query does a full scan of the images table", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark for the Group A request / Group B acknowledge flow.
+
+Builds synthetic Updates and drives the real handlers against a FakeBot that
+records every Bot API call and sleeps a configurable latency. Each simulated
+request sends an amount in a Group A chat, then answers the forwarded message
+in Group B with "+amount", "0" or a custom amount that a global admin approves.
+
+Runs in a temporary directory so images.db and the JSON state files of the
+checkout are never touched.
+
+Example:
+    python bench_flow.py --requests 2000 --concurrency 8 --pool-size 200 \\
+        --group-a 3 --group-b 2 --latency-ms 5 --output bench.json
+    python bench_flow.py --baseline bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from telegram import Chat, ChatMember, Message, Update, User
+
+import bot
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Synthetic chat IDs, far away from real ones
+GROUP_A_BASE = -1009000000000
+GROUP_B_BASE = -1008000000000
+MEMBER_USER_ID = 424242
+# What FakeBot.get_file downloads: a JPEG header and some filler
+FAKE_PHOTO = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00' + bytes(1024)
+
+
+class FakeBot:
+    """Stand-in for telegram.Bot that records calls and simulates API latency."""
+
+    defaults = None
+
+    def __init__(self, latency: float = 0.0, bot_id: int = 777000):
+        self.id = bot_id
+        self.username = "bench_bot"
+        self.latency = latency
+        self.user = User(bot_id, "Bench", is_bot=True, username=self.username)
+        self.calls: Counter = Counter()
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def next_message_id(self) -> int:
+        """Allocate a message ID shared by bot and synthetic user messages."""
+        with self._lock:
+            message_id = self._next_id
+            self._next_id += 1
+        return message_id
+
+    def take_thread_calls(self) -> List:
+        """Return and clear the (method, result) calls made by the current thread."""
+        calls = getattr(self._local, 'calls', [])
+        self._local.calls = []
+        return calls
+
+    def _record(self, method: str, result):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+        if not hasattr(self._local, 'calls'):
+            self._local.calls = []
+        self._local.calls.append((method, result))
+        return result
+
+    def _message(self, chat_id, text=None, caption=None, reply_to_message_id=None) -> Message:
+        return Message(
+            self.next_message_id(), datetime.now(), make_chat(chat_id),
+            from_user=self.user, text=text, caption=caption, bot=self
+        )
+
+    def send_message(self, chat_id, text, reply_to_message_id=None, **kwargs):
+        return self._record('sendMessage', self._message(chat_id, text=text))
+
+    def send_photo(self, chat_id, photo, caption=None, reply_to_message_id=None, **kwargs):
+        return self._record('sendPhoto', self._message(chat_id, caption=caption))
+
+    def get_file(self, file_id, **kwargs):
+        # Downloads return the same few bytes for every file_id
+        return self._record('getFile', SimpleNamespace(download_as_bytearray=lambda: bytearray(FAKE_PHOTO)))
+
+    def get_chat_member(self, chat_id, user_id, **kwargs):
+        member = ChatMember(User(user_id, f"user{user_id}", is_bot=False, username=f"user{user_id}"), 'member')
+        return self._record('getChatMember', member)
+
+    def get_chat(self, chat_id, **kwargs):
+        return self._record('getChat', make_chat(chat_id))
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self._record('answerCallbackQuery', True)
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        return self._record('editMessageReplyMarkup', True)
+
+
+def make_chat(chat_id: int) -> Chat:
+    """Private chats have positive IDs, groups negative ones."""
+    return Chat(chat_id, Chat.PRIVATE if chat_id > 0 else Chat.SUPERGROUP)
+
+
+def make_text_update(fake_bot: FakeBot, chat_id: int, user_id: int, text: str,
+                     reply_to: Optional[Message] = None) -> Update:
+    """Build an Update carrying a text message from `user_id` in `chat_id`."""
+    message_id = fake_bot.next_message_id()
+    message = Message(
+        message_id, datetime.now(), make_chat(chat_id),
+        from_user=User(user_id, f"user{user_id}", is_bot=False, username=f"user{user_id}"),
+        text=text, reply_to_message=reply_to, bot=fake_bot
+    )
+    return Update(message_id, message=message)
+
+
+def setup_environment(args, rng: random.Random) -> Dict:
+    """Point the bot at a fresh temp directory, configure groups and fill the image pool."""
+    workdir = tempfile.mkdtemp(prefix="bench_flow_")
+    os.chdir(workdir)
+
+    group_a_ids = [GROUP_A_BASE - i for i in range(args.group_a)]
+    group_b_ids = [GROUP_B_BASE - i for i in range(args.group_b)]
+
+    bot.CONFIG.modify(lambda config: config._replace(
+        group_a_ids=frozenset(group_a_ids), group_b_ids=frozenset(group_b_ids), forwarding_enabled=True
+    ))
+    bot.forwarded_msgs.clear()
+    bot.group_b_responses.clear()
+    bot.pending_custom_amounts.clear()
+
+    for i in range(args.pool_size):
+        group_b_id = group_b_ids[i % len(group_b_ids)]
+        metadata = json.dumps({'source_group_b_id': group_b_id, 'target_group_a_id': group_a_ids[0]})
+        db.add_image(f"bench_{i}", rng.randint(1, 99), f"file_{i}", metadata=metadata)
+
+    return {'workdir': workdir, 'group_a_ids': group_a_ids, 'group_b_ids': group_b_ids}
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """Parse 'plus=70,zero=20,custom=10' into normalised weights."""
+    weights = {}
+    for item in spec.split(','):
+        name, value = item.split('=')
+        weights[name.strip()] = float(value)
+    unknown = set(weights) - {'plus', 'zero', 'custom'}
+    if unknown:
+        raise ValueError(f"Unknown flow kinds in mix: {sorted(unknown)}")
+    return weights
+
+
+def run_flow(fake_bot: FakeBot, env: Dict, handlers: Dict, kind: str, rng: random.Random) -> Dict:
+    """Run one request/acknowledge cycle and return its outcome."""
+    admin_id = next(iter(bot.GLOBAL_ADMINS))
+    context = SimpleNamespace(bot=fake_bot, args=[])
+    group_a_id = rng.choice(env['group_a_ids'])
+    amount = str(rng.randint(100, 200))
+
+    start = time.perf_counter()
+    fake_bot.take_thread_calls()
+    handlers['group_a'](make_text_update(fake_bot, group_a_id, MEMBER_USER_ID, amount), context)
+
+    # The forwarded notification is the message the handler sent to a Group B
+    forwarded = None
+    for method, result in fake_bot.take_thread_calls():
+        if method == 'sendMessage' and result.chat_id in bot.CONFIG.current.group_b_ids:
+            forwarded = result
+    if forwarded is None:
+        return {'kind': kind, 'served': False, 'latency': time.perf_counter() - start}
+
+    group_b_id = forwarded.chat_id
+    if kind == 'plus':
+        reply = make_text_update(fake_bot, group_b_id, MEMBER_USER_ID, f"+{amount}", reply_to=forwarded)
+        handlers['group_b'](reply, context)
+    elif kind == 'zero':
+        reply = make_text_update(fake_bot, group_b_id, MEMBER_USER_ID, "0", reply_to=forwarded)
+        handlers['group_b'](reply, context)
+    else:
+        custom = make_text_update(fake_bot, group_b_id, admin_id, f"+{int(amount) + 1000}", reply_to=forwarded)
+        handlers['group_b'](custom, context)
+        approval = make_text_update(fake_bot, group_b_id, admin_id, "同意", reply_to=custom.message)
+        handlers['approval'](approval, context)
+
+    return {'kind': kind, 'served': True, 'latency': time.perf_counter() - start}
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_benchmark(args) -> Dict:
+    """Run the configured workload and return the machine-readable results."""
+    rng = random.Random(args.seed)
+    env = setup_environment(args, rng)
+    fake_bot = FakeBot(latency=args.latency_ms / 1000.0)
+    handlers = {
+        'group_a': bot.instrument_handler(bot.handle_group_a_message),
+        'group_b': bot.instrument_handler(bot.handle_all_group_b_messages),
+        'approval': bot.instrument_handler(bot.handle_custom_amount_approval),
+    }
+
+    mix = parse_mix(args.mix)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=args.requests)
+    seeds = [rng.random() for _ in range(args.requests)]
+
+    metrics.REGISTRY.reset()
+    fake_bot.calls.clear()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        outcomes = list(pool.map(
+            lambda i: run_flow(fake_bot, env, handlers, kinds[i], random.Random(seeds[i])),
+            range(args.requests)
+        ))
+    elapsed = time.perf_counter() - started
+
+    served = [o for o in outcomes if o['served']]
+    latencies = sorted(o['latency'] for o in served)
+    rows = metrics.REGISTRY.snapshot()
+    db_calls = {row['name']: row['count'] for row in rows if row['kind'] == 'db' and row['count']}
+    handler_stats = {
+        row['name']: {
+            'count': row['count'],
+            'errors': row['errors'],
+            'p50_ms': row['p50'] * 1000,
+            'p95_ms': row['p95'] * 1000,
+            'p99_ms': row['p99'] * 1000,
+        }
+        for row in rows if row['kind'] in ('handler', 'persist') and row['count']
+    }
+
+    requests = max(1, args.requests)
+    return {
+        'config': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'pool_size': args.pool_size,
+            'group_a': args.group_a,
+            'group_b': args.group_b,
+            'latency_ms': args.latency_ms,
+            'mix': mix,
+            'seed': args.seed,
+        },
+        'served': len(served),
+        'unserved': len(outcomes) - len(served),
+        'duration_s': elapsed,
+        'throughput_rps': len(served) / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': latencies[-1] * 1000 if latencies else 0.0,
+        },
+        'db_ops_per_request': sum(db_calls.values()) / requests,
+        'bot_api_calls_per_request': sum(fake_bot.calls.values()) / requests,
+        'db_calls': db_calls,
+        'bot_api_calls': dict(fake_bot.calls),
+        'handlers': handler_stats,
+    }
+
+
+def compare(results: Dict, baseline: Dict) -> List[str]:
+    """Describe how the headline numbers moved against a baseline run."""
+    def delta(name, now, before, lower_is_better=True):
+        if not before:
+            return f"{name}: {before} -> {now:.3f}"
+        change = (now - before) / before * 100
+        better = change < 0 if lower_is_better else change > 0
+        return f"{name}: {before:.3f} -> {now:.3f} ({change:+.1f}%{' better' if better else ''})"
+
+    return [
+        delta("throughput_rps", results['throughput_rps'], baseline['throughput_rps'], lower_is_better=False),
+        delta("latency_p50_ms", results['latency_ms']['p50'], baseline['latency_ms']['p50']),
+        delta("latency_p95_ms", results['latency_ms']['p95'], baseline['latency_ms']['p95']),
+        delta("latency_p99_ms", results['latency_ms']['p99'], baseline['latency_ms']['p99']),
+        delta("db_ops_per_request", results['db_ops_per_request'], baseline['db_ops_per_request']),
+        delta("bot_api_calls_per_request", results['bot_api_calls_per_request'], baseline['bot_api_calls_per_request']),
+    ]
+
+
+def main():
+    """Parse arguments, run the benchmark and print or save the results."""
+    parser = argparse.ArgumentParser(description="Benchmark the Group A -> Group B flow with a fake bot.")
+    parser.add_argument("--requests", type=int, default=500, help="number of simulated requests")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests processed in parallel")
+    parser.add_argument("--pool-size", type=int, default=100, help="number of images in the pool")
+    parser.add_argument("--group-a", type=int, default=2, help="number of Group A chats")
+    parser.add_argument("--group-b", type=int, default=2, help="number of Group B chats")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated Bot API latency per call")
+    parser.add_argument("--mix", default="plus=70,zero=20,custom=10", help="weights of the reply kinds")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--baseline", help="compare against a previous JSON results file")
+    parser.add_argument("--log-level", default="WARNING", help="log level while benchmarking")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    results = run_benchmark(args)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"Results written to {output}")
+
+    if baseline_path:
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)
+        print("\nCompared with baseline:")
+        for line in compare(results, baseline):
+            print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Throughput of the multi-process worker mode against the number of workers.
+
+For each worker count the benchmark starts a workers.WorkerPool whose
+processes run bot.run_worker (the real dispatcher, router and handlers)
+with a FakeBot, and routes synthetic updates through WorkerPool.submit
+exactly as the intake process does. Every Group A request is answered with
+"+amount" from the Group B its notification went to, --ack-delay-ms after
+the notification (the handler stores the notification's mapping only after
+sending it, so an instant answer could overtake it); a request is complete
+when the answer is passed on to Group A. At most --concurrency requests are
+in flight, so the image pool never runs dry.
+
+Each worker count runs in a fresh temporary directory (WAL database, config
+files and image pool), so the checkout is never touched. Throughput only
+scales with the number of CPU cores the machine actually has. With
+--status-bitmap the workers share a status_bitmap.StatusBitmap, as with
+STATUS_BITMAP=1.
+
+Example:
+    python bench_workers.py --workers 1 2 4 8 --requests 2000 --output workers.json
+    python bench_workers.py --workers 2 --status-bitmap
+"""
+import argparse
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import tempfile
+import time
+from typing import Dict, List
+
+from telegram import Message
+
+import bot
+import db
+import status_bitmap
+import workers
+from bench_flow import FakeBot, MEMBER_USER_ID, make_text_update
+
+logger = logging.getLogger(__name__)
+
+GROUP_A_BASE = -1009100000000
+GROUP_B_BASE = -1008100000000
+# Message IDs sent by worker N start at (N + 1) * ID_SPACING, the driver's at 1
+ID_SPACING = 10 ** 8
+
+
+class ReportingBot(FakeBot):
+    """FakeBot that tells the driver about every message it sends."""
+
+    def __init__(self, events, latency: float, first_message_id: int):
+        super().__init__(latency)
+        self.events = events
+        self._next_id = first_message_id
+
+    def send_message(self, chat_id, text, reply_to_message_id=None, **kwargs):
+        message = super().send_message(chat_id, text, reply_to_message_id=reply_to_message_id, **kwargs)
+        self.events.put((int(chat_id), message.to_dict()))
+        return message
+
+
+def run_bench_worker(index, inbox, workdir, latency, events, bitmap_name):
+    """WorkerPool target: bot.run_worker in `workdir` with a ReportingBot."""
+    os.chdir(workdir)
+    fake_bot = ReportingBot(events, latency, (index + 1) * ID_SPACING)
+    events.put(('ready', index))
+    bot.run_worker(index, inbox, bot_factory=lambda: fake_bot, bitmap_name=bitmap_name)
+
+
+def setup_workdir(args, rng: random.Random) -> Dict:
+    """Fresh directory with the config files, a WAL database and the image pool."""
+    workdir = tempfile.mkdtemp(prefix="bench_workers_")
+    os.chdir(workdir)
+
+    group_a_ids = [GROUP_A_BASE - i for i in range(args.group_a)]
+    group_b_ids = [GROUP_B_BASE - i for i in range(args.group_b)]
+    bot.CONFIG.modify(lambda config: config._replace(
+        group_a_ids=frozenset(group_a_ids), group_b_ids=frozenset(group_b_ids), forwarding_enabled=True
+    ))
+    bot.CONFIG.save()
+
+    db.enable_wal()
+    for i in range(args.pool_size):
+        group_b_id = group_b_ids[i % len(group_b_ids)]
+        metadata = json.dumps({'source_group_b_id': group_b_id, 'target_group_a_id': group_a_ids[0]})
+        db.add_image(f"bench_{i}", rng.randint(1, 99), f"file_{i}", metadata=metadata)
+
+    return {'workdir': workdir, 'group_a_ids': group_a_ids, 'group_b_ids': set(group_b_ids)}
+
+
+def run_once(args, processes: int) -> Dict:
+    """Run the workload with `processes` workers and return its figures."""
+    rng = random.Random(args.seed)
+    env = setup_workdir(args, rng)
+    driver_bot = FakeBot()
+    events = multiprocessing.get_context("spawn").Queue()
+    bitmap = None
+    if args.status_bitmap:
+        bitmap = status_bitmap.StatusBitmap.create(capacity=args.pool_size + 1)
+        db.use_status_bitmap(bitmap)
+        db.sync_status_bitmap()
+
+    pool = workers.WorkerPool(processes, run_bench_worker, args=(env['workdir'], args.latency_ms / 1000.0, events,
+                                                                  bitmap.name if bitmap else None))
+    pool.start(supervise_interval=0)
+    for _ in range(processes):
+        events.get(timeout=60)
+
+    submitted = completed = 0
+    # (due time, sequence, update) of Group B answers not submitted yet
+    answers = []
+
+    def submit_request():
+        nonlocal submitted
+        chat_id = rng.choice(env['group_a_ids'])
+        pool.submit(make_text_update(driver_bot, chat_id, MEMBER_USER_ID, str(rng.randint(100, 200))))
+        submitted += 1
+
+    started = time.perf_counter()
+    for _ in range(min(args.concurrency, args.requests)):
+        submit_request()
+    last_progress = time.perf_counter()
+    while completed < args.requests:
+        now = time.perf_counter()
+        while answers and answers[0][0] <= now:
+            pool.submit(heapq.heappop(answers)[2])
+        if now - last_progress > args.idle_timeout:
+            logger.error("No progress for %ss, %s of %s requests completed", args.idle_timeout, completed,
+                         args.requests)
+            break
+        try:
+            chat_id, data = events.get(timeout=max(0.001, answers[0][0] - now) if answers else 0.1)
+        except queue.Empty:
+            continue
+        last_progress = time.perf_counter()
+        message = Message.de_json(data, driver_bot)
+        if chat_id in env['group_b_ids']:
+            # The notification: answer it from Group B after the ack delay
+            amount = message.text.split('：')[1].split('\n')[0]
+            answer = make_text_update(driver_bot, chat_id, MEMBER_USER_ID, f"+{amount}", reply_to=message)
+            heapq.heappush(answers, (last_progress + args.ack_delay_ms / 1000.0, answer.update_id, answer))
+        elif message.text.startswith('+'):
+            # The answer reached Group A: the request is done, start the next one
+            completed += 1
+            if submitted < args.requests:
+                submit_request()
+    pool.stop()
+    elapsed = time.perf_counter() - started
+    if bitmap is not None:
+        db.use_status_bitmap(None)
+        bitmap.close()
+
+    updates = completed * 2
+    return {
+        'workers': processes,
+        'completed': completed,
+        'lost': submitted - completed,
+        'duration_s': elapsed,
+        'requests_per_s': completed / elapsed if elapsed else 0.0,
+        'updates_per_s': updates / elapsed if elapsed else 0.0,
+    }
+
+
+def main():
+    """Parse arguments, run every worker count and print or save the results."""
+    parser = argparse.ArgumentParser(description="Benchmark worker-mode throughput against the number of workers.")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4], help="worker counts to run")
+    parser.add_argument("--requests", type=int, default=1000, help="Group A requests per run")
+    parser.add_argument("--concurrency", type=int, default=128, help="requests in flight")
+    parser.add_argument("--pool-size", type=int, default=256, help="number of images in the pool")
+    parser.add_argument("--group-a", type=int, default=32, help="number of Group A chats")
+    parser.add_argument("--group-b", type=int, default=16, help="number of Group B chats")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated Bot API latency per call")
+    parser.add_argument("--ack-delay-ms", type=float, default=500.0, help="Group B think time before answering")
+    parser.add_argument("--idle-timeout", type=float, default=30.0, help="give up after this long without progress")
+    parser.add_argument("--status-bitmap", action="store_true", help="share a status bitmap between the workers")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the driver and the workers")
+    args = parser.parse_args()
+
+    # Workers inherit the environment and read LOG_LEVEL in log_config.setup_logging
+    os.environ["LOG_LEVEL"] = args.log_level
+    logging.basicConfig(level=args.log_level)
+    logging.getLogger().setLevel(args.log_level)
+
+    runs: List[Dict] = []
+    for processes in args.workers:
+        result = run_once(args, processes)
+        runs.append(result)
+        base = runs[0]['requests_per_s'] / runs[0]['workers'] if runs[0]['requests_per_s'] else 0.0
+        efficiency = result['requests_per_s'] / (base * processes) if base else 0.0
+        result['scaling_efficiency'] = efficiency
+        print(f"{processes:3d} workers: {result['completed']} requests in {result['duration_s']:.2f}s, "
+              f"{result['requests_per_s']:.1f} req/s, {result['updates_per_s']:.1f} updates/s, "
+              f"efficiency {efficiency:.0%}")
+
+    results = {'cpu_count': os.cpu_count(), 'config': vars(args), 'runs': runs}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,43 @@
 import logging
+import multiprocessing
 import os
 import re
 import json
+import queue
+import signal
+import sys
+import threading
 import time
 from typing import Dict, Optional, List, Any
 from datetime import datetime
+from functools import wraps
 
 from telegram import Update, ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
-from telegram.error import NetworkError, TimedOut, RetryAfter
+from telegram.ext import Updater, Dispatcher, CommandHandler, Filters, CallbackContext, CallbackQueryHandler, ExtBot, TypeHandler
+from telegram.error import BadRequest, NetworkError, TimedOut, RetryAfter
+from telegram.utils.helpers import DEFAULT_NONE
+from telegram.utils.request import Request
 
+import config_store
 import db
+import handler_watchdog
+import hash_ring
+import idempotency
+import image_backup
+import image_store
+import leader_lease
+import log_config
+import message_classifier
+import metrics
+import profiling
+import routing_policy
+from router import MessageRouter
+import shared_state
+import state_snapshot
+import status_bitmap
+import update_recorder
+import wait_queue
+import workers
 
 # Enable logging
 logging.basicConfig(
@@ -19,29 +46,21 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Bot token from environment variable
-TOKEN = ""
+TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
 
-# Group IDs
-# Moving from single group to multiple groups
-GROUP_A_IDS = set()  # Set of Group A chat IDs
-GROUP_B_IDS = set()  # Set of Group B chat IDs
+# Bot API endpoint; point at fake_telegram_server.py for load tests
+TELEGRAM_BASE_URL = os.environ.get("TELEGRAM_BASE_URL")
+# File downloads (image store); derived from TELEGRAM_BASE_URL unless set
+TELEGRAM_BASE_FILE_URL = os.environ.get("TELEGRAM_BASE_FILE_URL") or (
+    re.sub(r'/bot$', '/file/bot', TELEGRAM_BASE_URL) if TELEGRAM_BASE_URL else None
+)
 
 # Legacy variables for backward compatibility
 GROUP_A_ID = -4687450746  # Using negative ID for group chats
 GROUP_B_ID = -1002648811668  # New supergroup ID from migration message
 
-# Initialize default groups if needed
-if not GROUP_A_IDS:
-    GROUP_A_IDS.add(GROUP_A_ID)
-if not GROUP_B_IDS:
-    GROUP_B_IDS.add(GROUP_B_ID)
-
 # Admin system
-GLOBAL_ADMINS = set([5962096701, 1844353808, 7997704196, 5965182828])  # Global admins with full permissions
-GROUP_ADMINS = {}  # Format: {chat_id: set(user_ids)} - Group-specific admins
-
-# Message forwarding control
-FORWARDING_ENABLED = True  # Controls if messages can be forwarded from Group B to Group A
+GLOBAL_ADMINS = frozenset([5962096701, 1844353808, 7997704196, 5965182828])  # Global admins with full permissions
 
 # Paths for persistent storage
 FORWARDED_MSGS_FILE = "forwarded_msgs.json"
@@ -51,6 +70,39 @@ GROUP_B_IDS_FILE = "group_b_ids.json"
 GROUP_ADMINS_FILE = "group_admins.json"
 PENDING_CUSTOM_AMOUNTS_FILE = "pending_custom_amounts.json"
 SETTINGS_FILE = "bot_settings.json"
+WAIT_QUEUE_FILE = "wait_queue.json"
+STATE_SNAPSHOT_FILE = os.environ.get("STATE_SNAPSHOT_FILE", "state_snapshot.bin")
+
+# Group A/B chat IDs, group-specific admins, global admins and the forwarding switch
+# (controls if messages can be forwarded from Group B to Group A) live in one immutable
+# snapshot. Read CONFIG.current without locking; change it with CONFIG.modify().
+CONFIG = config_store.ConfigStore(
+    config_store.ConfigSnapshot(
+        group_a_ids=frozenset([GROUP_A_ID]),  # Default groups until the files are loaded
+        group_b_ids=frozenset([GROUP_B_ID]),
+        group_admins=config_store.freeze_admins({}),
+        global_admins=GLOBAL_ADMINS,
+        forwarding_enabled=True,
+    ),
+    GROUP_A_IDS_FILE, GROUP_B_IDS_FILE, GROUP_ADMINS_FILE, SETTINGS_FILE
+)
+
+# Chooses the Group B pool a Group A request draws from, by current Group B load
+ROUTING = routing_policy.policy_from_env()
+
+# Which open image of the chosen pool is handed out (see db.SELECTION_STRATEGIES)
+IMAGE_SELECTION = os.environ.get("IMAGE_SELECTION", "lru")
+if IMAGE_SELECTION not in db.SELECTION_STRATEGIES:
+    raise ValueError(f"Unknown IMAGE_SELECTION {IMAGE_SELECTION!r}, expected one of {db.SELECTION_STRATEGIES}")
+
+# Highest update_id taken in, persisted so a restart resumes polling after it
+UPDATE_OFFSET = idempotency.UpdateOffset()
+
+# Active/standby election (LEADER_LEASE_TTL > 0); None when this is the only instance
+LEASE = leader_lease.lease_from_env()
+
+# Group A requests waiting for an image while the pool is exhausted (opt-in, WAIT_QUEUE_ENABLED=1)
+WAIT_QUEUE = wait_queue.queue_from_env(WAIT_QUEUE_FILE)
 
 # Message IDs mapping for forwarded messages
 forwarded_msgs: Dict[str, Dict] = {}
@@ -64,6 +116,31 @@ pending_requests: Dict[int, Dict] = {}
 # Store pending custom amount approvals from Group B
 pending_custom_amounts: Dict[int, Dict] = {}  # Format: {message_id: {img_id, amount, responder, original_msg_id}}
 
+# Worker mode (BOT_WORKERS > 1): handler processes sharded by chat ID, see workers.py
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "1"))
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "4"))
+WORKER_REFRESH_INTERVAL = float(os.environ.get("WORKER_REFRESH_INTERVAL", "5"))
+
+# True in worker processes, where the three dicts above are SharedDicts stored in SQLite
+SHARED_STATE = False
+
+# Image status bits and counts in shared memory (STATUS_BITMAP=1), so open-image checks skip SQLite
+STATUS_BITMAP = os.environ.get("STATUS_BITMAP", "0") == "1"
+STATUS_BITMAP_CAPACITY = int(os.environ.get("STATUS_BITMAP_CAPACITY", str(status_bitmap.DEFAULT_CAPACITY)))
+STATUS_BITMAP_SYNC_INTERVAL = float(os.environ.get("STATUS_BITMAP_SYNC_INTERVAL", "60"))
+
+# "重置群码" retires a Group B's images at once; a background thread purges them in batches of this size
+GENERATION_PURGE_INTERVAL = float(os.environ.get("GENERATION_PURGE_INTERVAL", "10"))
+GENERATION_PURGE_BATCH = int(os.environ.get("GENERATION_PURGE_BATCH", "500"))
+generation_purge_wakeup = threading.Event()
+
+# Each photo of an album arrives as its own message; an album is set this many seconds after its last photo
+ALBUM_COLLECT_SECONDS = float(os.environ.get("ALBUM_COLLECT_SECONDS", "1.5"))
+
+# Albums still arriving: (chat_id, media_group_id) -> {'messages': [...], 'timer': threading.Timer}
+pending_albums: Dict[tuple, Dict] = {}
+pending_albums_lock = threading.Lock()
+
 # Function to safely send messages with retry logic
 def safe_send_message(context, chat_id, text, reply_to_message_id=None, max_retries=3, retry_delay=2):
     """Send a message with retry logic to handle network errors."""
@@ -75,14 +152,14 @@ def safe_send_message(context, chat_id, text, reply_to_message_id=None, max_retr
                 reply_to_message_id=reply_to_message_id
             )
         except (NetworkError, TimedOut, RetryAfter) as e:
-            logger.warning(f"Network error on attempt {attempt+1}/{max_retries}: {e}")
+            logger.warning("Network error on attempt %s/%s: %s", attempt+1, max_retries, e)
             if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
+                logger.info("Retrying in %s seconds...", retry_delay)
                 time.sleep(retry_delay)
                 # Increase delay for next retry
                 retry_delay *= 1.5
             else:
-                logger.error(f"Failed to send message after {max_retries} attempts")
+                logger.error("Failed to send message after %s attempts", max_retries)
                 raise
 
 # Function to safely reply to a message with retry logic
@@ -92,107 +169,31 @@ def safe_reply_text(update, text, max_retries=3, retry_delay=2):
         try:
             return update.message.reply_text(text)
         except (NetworkError, TimedOut, RetryAfter) as e:
-            logger.warning(f"Network error on attempt {attempt+1}/{max_retries}: {e}")
+            logger.warning("Network error on attempt %s/%s: %s", attempt+1, max_retries, e)
             if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
+                logger.info("Retrying in %s seconds...", retry_delay)
                 time.sleep(retry_delay)
                 # Increase delay for next retry
                 retry_delay *= 1.5
             else:
-                logger.error(f"Failed to reply to message after {max_retries} attempts")
+                logger.error("Failed to reply to message after %s attempts", max_retries)
                 # Just log the error but don't crash the handler
                 return None
 
 # Function to save all configuration data
 def save_config_data():
-    """Save all configuration data to files."""
-    # Save Group A IDs
-    try:
-        with open(GROUP_A_IDS_FILE, 'w') as f:
-            json.dump(list(GROUP_A_IDS), f, indent=2)
-            logger.info(f"Saved {len(GROUP_A_IDS)} Group A IDs to file")
-    except Exception as e:
-        logger.error(f"Error saving Group A IDs: {e}")
-    
-    # Save Group B IDs
-    try:
-        with open(GROUP_B_IDS_FILE, 'w') as f:
-            json.dump(list(GROUP_B_IDS), f, indent=2)
-            logger.info(f"Saved {len(GROUP_B_IDS)} Group B IDs to file")
-    except Exception as e:
-        logger.error(f"Error saving Group B IDs: {e}")
-    
-    # Save Group Admins
-    try:
-        # Convert sets to lists for JSON serialization
-        admins_json = {str(chat_id): list(user_ids) for chat_id, user_ids in GROUP_ADMINS.items()}
-        with open(GROUP_ADMINS_FILE, 'w') as f:
-            json.dump(admins_json, f, indent=2)
-            logger.info(f"Saved group admins to file")
-    except Exception as e:
-        logger.error(f"Error saving group admins: {e}")
-    
-    # Save Bot Settings
-    try:
-        settings = {
-            "forwarding_enabled": FORWARDING_ENABLED
-        }
-        with open(SETTINGS_FILE, 'w') as f:
-            json.dump(settings, f, indent=2)
-            logger.info(f"Saved bot settings to file")
-    except Exception as e:
-        logger.error(f"Error saving bot settings: {e}")
+    """Save all configuration data to files now (changes made with CONFIG.modify are saved in the background)."""
+    CONFIG.save()
 
 # Function to load all configuration data
 def load_config_data():
     """Load all configuration data from files."""
-    global GROUP_A_IDS, GROUP_B_IDS, GROUP_ADMINS, FORWARDING_ENABLED
-    
-    # Load Group A IDs
-    if os.path.exists(GROUP_A_IDS_FILE):
-        try:
-            with open(GROUP_A_IDS_FILE, 'r') as f:
-                # Convert all IDs to integers
-                GROUP_A_IDS = set(int(x) for x in json.load(f))
-                logger.info(f"Loaded {len(GROUP_A_IDS)} Group A IDs from file")
-        except Exception as e:
-            logger.error(f"Error loading Group A IDs: {e}")
-    
-    # Load Group B IDs
-    if os.path.exists(GROUP_B_IDS_FILE):
-        try:
-            with open(GROUP_B_IDS_FILE, 'r') as f:
-                # Convert all IDs to integers
-                GROUP_B_IDS = set(int(x) for x in json.load(f))
-                logger.info(f"Loaded {len(GROUP_B_IDS)} Group B IDs from file")
-        except Exception as e:
-            logger.error(f"Error loading Group B IDs: {e}")
-    
-    # Load Group Admins
-    if os.path.exists(GROUP_ADMINS_FILE):
-        try:
-            with open(GROUP_ADMINS_FILE, 'r') as f:
-                admins_json = json.load(f)
-                # Convert keys back to integers and values back to sets
-                GROUP_ADMINS = {int(chat_id): set(user_ids) for chat_id, user_ids in admins_json.items()}
-                logger.info(f"Loaded group admins from file")
-        except Exception as e:
-            logger.error(f"Error loading group admins: {e}")
-    
-    # Load Bot Settings
-    if os.path.exists(SETTINGS_FILE):
-        try:
-            with open(SETTINGS_FILE, 'r') as f:
-                settings = json.load(f)
-                FORWARDING_ENABLED = settings.get("forwarding_enabled", True)
-                logger.info(f"Loaded bot settings: forwarding_enabled={FORWARDING_ENABLED}")
-        except Exception as e:
-            logger.error(f"Error loading bot settings: {e}")
+    CONFIG.load()
 
 # Check if user is a global admin
 def is_global_admin(user_id):
     """Check if user is a global admin."""
-    return user_id in GLOBAL_ADMINS
+    return user_id in CONFIG.current.global_admins
 
 # Check if user is a group admin for a specific chat
 def is_group_admin(user_id, chat_id):
@@ -202,17 +203,90 @@ def is_group_admin(user_id, chat_id):
         return True
     
     # Check if user is in the group admin list for this chat
-    return chat_id in GROUP_ADMINS and user_id in GROUP_ADMINS.get(chat_id, set())
+    return user_id in CONFIG.current.group_admins.get(chat_id, ())
 
 # Add group admin
 def add_group_admin(user_id, chat_id):
     """Add a user as a group admin for a specific chat."""
-    if chat_id not in GROUP_ADMINS:
-        GROUP_ADMINS[chat_id] = set()
+    def change(config):
+        admins = dict(config.group_admins)
+        admins[chat_id] = admins.get(chat_id, frozenset()) | {user_id}
+        return config._replace(group_admins=admins)
     
-    GROUP_ADMINS[chat_id].add(user_id)
-    save_config_data()
-    logger.info(f"Added user {user_id} as group admin for chat {chat_id}")
+    CONFIG.modify(change)
+    logger.info("Added user %s as group admin for chat %s", user_id, chat_id)
+
+# Resolve which kind of chat an ID belongs to (used to label metrics)
+def chat_role(chat_id):
+    """Return 'A', 'B', 'private' or 'other' for a chat ID."""
+    try:
+        chat_id = int(chat_id)
+    except (ValueError, TypeError):
+        return "other"
+    
+    config = CONFIG.current
+    if chat_id in config.group_b_ids or chat_id == GROUP_B_ID:
+        return "B"
+    if chat_id in config.group_a_ids or chat_id == GROUP_A_ID:
+        return "A"
+    # User chats have positive IDs, groups and channels negative ones
+    if chat_id > 0:
+        return "private"
+    return "other"
+
+# Wrap a handler callback so every call is timed and labelled by chat role
+def instrument_handler(callback):
+    """Return a handler callback that records latency and errors in the metrics registry."""
+    if getattr(callback, '__wrapped_metrics__', False):
+        return callback
+    
+    name = callback.__name__
+    
+    watchdog = handler_watchdog.WATCHDOG
+    
+    @wraps(callback)
+    def wrapper(update, context):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        role = chat_role(chat.id) if chat else "none"
+        watchdog.begin(name, chat.id if chat else None, getattr(update, 'update_id', None))
+        start = time.perf_counter()
+        error = True
+        try:
+            if profiling.PROFILING_ACTIVE:
+                result = profiling.profiled_call(callback, update, context)
+            else:
+                result = callback(update, context)
+            error = False
+            return result
+        finally:
+            metrics.REGISTRY.observe('handler', name, role, time.perf_counter() - start, error)
+            watchdog.end()
+    
+    wrapper.__wrapped_metrics__ = True
+    return wrapper
+
+def instrument_handlers(dispatcher):
+    """Instrument every handler currently registered on the dispatcher."""
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, MessageRouter):
+                handler.map_callbacks(instrument_handler)
+            else:
+                handler.callback = instrument_handler(handler.callback)
+
+class InstrumentedBot(ExtBot):
+    """ExtBot that records the latency of every Bot API request."""
+    
+    def _post(self, endpoint, data=None, timeout=DEFAULT_NONE, api_kwargs=None):
+        role = chat_role(data.get('chat_id')) if data and 'chat_id' in data else "none"
+        start = time.perf_counter()
+        error = True
+        try:
+            result = super()._post(endpoint, data=data, timeout=timeout, api_kwargs=api_kwargs)
+            error = False
+            return result
+        finally:
+            metrics.REGISTRY.observe('bot_api', endpoint, role, time.perf_counter() - start, error)
 
 # Load persistent data on startup
 def load_persistent_data():
@@ -223,18 +297,18 @@ def load_persistent_data():
         try:
             with open(FORWARDED_MSGS_FILE, 'r') as f:
                 forwarded_msgs = json.load(f)
-                logger.info(f"Loaded {len(forwarded_msgs)} forwarded messages from file")
+                logger.info("Loaded %s forwarded messages from file", len(forwarded_msgs))
         except Exception as e:
-            logger.error(f"Error loading forwarded messages: {e}")
+            logger.error("Error loading forwarded messages: %s", e)
     
     # Load group_b_responses
     if os.path.exists(GROUP_B_RESPONSES_FILE):
         try:
             with open(GROUP_B_RESPONSES_FILE, 'r') as f:
                 group_b_responses = json.load(f)
-                logger.info(f"Loaded {len(group_b_responses)} Group B responses from file")
+                logger.info("Loaded %s Group B responses from file", len(group_b_responses))
         except Exception as e:
-            logger.error(f"Error loading Group B responses: {e}")
+            logger.error("Error loading Group B responses: %s", e)
     
     # Load pending_custom_amounts
     if os.path.exists(PENDING_CUSTOM_AMOUNTS_FILE):
@@ -243,38 +317,179 @@ def load_persistent_data():
                 # Convert string keys back to integers
                 data = json.load(f)
                 pending_custom_amounts = {int(k): v for k, v in data.items()}
-                logger.info(f"Loaded {len(pending_custom_amounts)} pending custom amounts from file")
+                logger.info("Loaded %s pending custom amounts from file", len(pending_custom_amounts))
         except Exception as e:
-            logger.error(f"Error loading pending custom amounts: {e}")
+            logger.error("Error loading pending custom amounts: %s", e)
+    
+    # Load Group A requests that were waiting for an image
+    WAIT_QUEUE.load()
+    
+    # Worker-mode state that an unclean shutdown left in SQLite is newer than the files
+    take_back_shared_state()
     
     # Load configuration data
     load_config_data()
 
 # Save persistent data
+@metrics.timed('persist', 'save_persistent_data')
 def save_persistent_data():
+    # In worker mode every change is already committed to SQLite
+    if SHARED_STATE:
+        return
+    
+    # A standby, or a leader that lost its lease, must not overwrite the leader's files
+    if LEASE is not None and not LEASE.is_valid():
+        logger.warning("Not saving persistent data: this instance does not hold the leader lease")
+        return
+    
     # Save forwarded_msgs
     try:
         with open(FORWARDED_MSGS_FILE, 'w') as f:
             json.dump(forwarded_msgs, f, indent=2)
-            logger.info(f"Saved {len(forwarded_msgs)} forwarded messages to file")
+            logger.info("Saved %s forwarded messages to file", len(forwarded_msgs))
     except Exception as e:
-        logger.error(f"Error saving forwarded messages: {e}")
+        logger.error("Error saving forwarded messages: %s", e)
     
     # Save group_b_responses
     try:
         with open(GROUP_B_RESPONSES_FILE, 'w') as f:
             json.dump(group_b_responses, f, indent=2)
-            logger.info(f"Saved {len(group_b_responses)} Group B responses to file")
+            logger.info("Saved %s Group B responses to file", len(group_b_responses))
     except Exception as e:
-        logger.error(f"Error saving Group B responses: {e}")
+        logger.error("Error saving Group B responses: %s", e)
     
     # Save pending_custom_amounts
     try:
         with open(PENDING_CUSTOM_AMOUNTS_FILE, 'w') as f:
             json.dump(pending_custom_amounts, f, indent=2)
-            logger.info(f"Saved {len(pending_custom_amounts)} pending custom amounts to file")
+            logger.info("Saved %s pending custom amounts to file", len(pending_custom_amounts))
+    except Exception as e:
+        logger.error("Error saving pending custom amounts: %s", e)
+
+# Switch a worker process to the state shared through SQLite
+def use_shared_state():
+    """Replace forwarded_msgs, group_b_responses and pending_custom_amounts with SharedDicts."""
+    global forwarded_msgs, group_b_responses, pending_custom_amounts, SHARED_STATE
+    
+    forwarded_msgs = shared_state.SharedDict('forwarded_msgs')
+    group_b_responses = shared_state.SharedDict('group_b_responses')
+    pending_custom_amounts = shared_state.SharedDict('pending_custom_amounts', int)
+    SHARED_STATE = True
+
+# Intake process: hand the state loaded from the files to the workers
+def share_persistent_data():
+    """Copy the in-memory state into the shared SQLite tables."""
+    shared_state.SharedDict('forwarded_msgs').replace(forwarded_msgs)
+    shared_state.SharedDict('group_b_responses').replace(group_b_responses)
+    shared_state.SharedDict('pending_custom_amounts', int).replace(pending_custom_amounts)
+    logger.info("Shared %s forwarded messages with the workers", len(forwarded_msgs))
+
+# Move state from the shared SQLite tables back into memory and the JSON files
+def take_back_shared_state():
+    """Load and clear what worker mode left in SQLite; returns False if there was nothing."""
+    global forwarded_msgs, group_b_responses, pending_custom_amounts
+    
+    # Only the leader may take the state away from a running worker mode
+    if LEASE is not None and not LEASE.is_valid():
+        return False
+    
+    shared = {
+        'forwarded_msgs': shared_state.SharedDict('forwarded_msgs'),
+        'group_b_responses': shared_state.SharedDict('group_b_responses'),
+        'pending_custom_amounts': shared_state.SharedDict('pending_custom_amounts', int),
+    }
+    data = {name: mapping.to_dict() for name, mapping in shared.items()}
+    if not any(data.values()):
+        return False
+    forwarded_msgs = data['forwarded_msgs']
+    group_b_responses = data['group_b_responses']
+    pending_custom_amounts = data['pending_custom_amounts']
+    save_persistent_data()
+    for mapping in shared.values():
+        mapping.clear()
+    logger.info("Took back %s forwarded messages from worker mode", len(forwarded_msgs))
+    return True
+
+# Files the in-memory state is built from; a snapshot is only used while none of them changed
+def snapshot_sources():
+    """Return the paths fingerprinted into the state snapshot."""
+    return [db.DB_FILE, FORWARDED_MSGS_FILE, GROUP_B_RESPONSES_FILE, PENDING_CUSTOM_AMOUNTS_FILE,
+            WAIT_QUEUE_FILE, *CONFIG.files.values()]
+
+# Write the whole in-memory state to one binary file for a fast warm start
+@metrics.timed('persist', 'save_state_snapshot')
+def save_state_snapshot():
+    """Write the state snapshot; returns False if the state changed while it was copied."""
+    if LEASE is not None and not LEASE.is_valid():
+        return False
+    config = CONFIG.current
+    try:
+        state = {
+            'forwarded_msgs': dict(forwarded_msgs),
+            'group_b_responses': dict(group_b_responses),
+            'pending_custom_amounts': dict(pending_custom_amounts),
+            # MappingProxyType cannot be pickled
+            'config': config._replace(group_admins=dict(config.group_admins)),
+            'routing_load': ROUTING.load.export_state(),
+            'wait_queue': WAIT_QUEUE.export_state(),
+        }
+        size = state_snapshot.write(STATE_SNAPSHOT_FILE, state, snapshot_sources())
+    except RuntimeError as e:
+        # A handler thread resized one of the dicts while it was copied; the next attempt will do
+        logger.info("State snapshot skipped: %s", e)
+        return False
     except Exception as e:
-        logger.error(f"Error saving pending custom amounts: {e}")
+        logger.error("Error saving state snapshot: %s", e)
+        return False
+    logger.info("Saved state snapshot (%s bytes)", size)
+    return True
+
+# Load the state written by save_state_snapshot, if it still matches the files
+def restore_state_snapshot():
+    """Restore the in-memory state from the snapshot; returns False if it is missing or stale."""
+    global forwarded_msgs, group_b_responses, pending_custom_amounts
+    
+    start = time.perf_counter()
+    state = state_snapshot.read(STATE_SNAPSHOT_FILE, snapshot_sources())
+    if state is None:
+        return False
+    forwarded_msgs = state['forwarded_msgs']
+    group_b_responses = state['group_b_responses']
+    pending_custom_amounts = state['pending_custom_amounts']
+    CONFIG.restore(state['config'])
+    ROUTING.load.restore_state(state['routing_load'])
+    WAIT_QUEUE.restore_state(state['wait_queue'])
+    logger.info("Restored %s forwarded messages from state snapshot in %.1f ms",
+                len(forwarded_msgs), (time.perf_counter() - start) * 1000)
+    return True
+
+# Fingerprint of the files when a standby instance last loaded them
+_tailed_fingerprint = None
+
+# A standby keeps its state current so it can take over without a cold start
+def tail_persistent_data():
+    """Load the persistent data if any of its files changed since the last call."""
+    global _tailed_fingerprint
+    
+    current = state_snapshot.fingerprint(snapshot_sources())
+    if current == _tailed_fingerprint:
+        return
+    if _tailed_fingerprint is not None or not restore_state_snapshot():
+        load_persistent_data()
+    _tailed_fingerprint = current
+
+# Rewrite the snapshot every STATE_SNAPSHOT_INTERVAL seconds while its sources keep changing
+def start_state_snapshots(interval):
+    """Start a daemon thread that refreshes the state snapshot."""
+    def run():
+        written = None
+        while True:
+            time.sleep(interval)
+            current = state_snapshot.fingerprint(snapshot_sources())
+            if current != written and save_state_snapshot():
+                written = current
+    
+    threading.Thread(target=run, name="state-snapshot", daemon=True).start()
 
 def start(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
@@ -290,7 +505,11 @@ def start(update: Update, context: CallbackContext) -> None:
             "• 开启转发 - 开启群B到群A的消息转发\n"
             "• 关闭转发 - 关闭群B到群A的消息转发\n"
             "• 转发状态 - 切换转发状态\n"
-            "• /debug - 显示当前状态信息"
+            "• /debug - 显示当前状态信息\n"
+            "• /stats - 显示处理耗时统计\n"
+            "• /profile <秒> - 性能分析 (/profile_stop 提前结束)\n"
+            "• /memsnap, /memdiff - 内存快照与对比\n"
+            "• /slow - 慢处理堆栈采样"
         )
         welcome_message += admin_controls
     
@@ -310,6 +529,46 @@ def help_command(update: Update, context: CallbackContext) -> None:
     )
     update.message.reply_text(help_text)
 
+def store_image_copy(bot, image_id, file_id) -> bool:
+    """Download an image's photo into the image store and record the copy; False if that failed."""
+    if not image_store.enabled():
+        return False
+    try:
+        content_sha256, content_type = image_store.put(image_store.download(bot, file_id))
+    except Exception as e:
+        logger.error("Could not store a copy of image %s: %s", image_id, e)
+        return False
+    return db.set_image_content(image_id, content_sha256, content_type)
+
+def store_missing_image_copies(bot):
+    """Store copies of the images set before the image store existed."""
+    missing = db.get_images_without_content()
+    if missing:
+        stored = sum(store_image_copy(bot, image_id, file_id) for image_id, file_id in missing)
+        logger.info("Stored copies of %s of %s images that had none", stored, len(missing))
+
+def send_image(send, image, **kwargs):
+    """Send an image's photo with `send` (bot.send_photo or message.reply_photo).
+    
+    If Telegram rejects the file_id (e.g. after a bot token change), the stored
+    copy is uploaded instead and the new file_id is cached for the next send.
+    """
+    try:
+        return send(photo=image['file_id'], **kwargs)
+    except BadRequest as e:
+        if not image_store.is_invalid_file_id(e):
+            raise
+        content = db.get_image_content(image['image_id']) or {}
+        data = image_store.get(content['content_sha256']) if content.get('content_sha256') else None
+        if data is None:
+            logger.error("file_id of image %s was rejected and there is no stored copy to upload", image['image_id'])
+            raise
+        logger.warning("file_id of image %s was rejected (%s), uploading the stored copy", image['image_id'], e)
+        sent_msg = send(photo=data, **kwargs)
+        image['file_id'] = sent_msg.photo[-1].file_id
+        db.update_file_id(content['content_sha256'], image['file_id'])
+        return sent_msg
+
 def set_image(update: Update, context: CallbackContext) -> None:
     """Set an image with a number."""
     # Check if admin (can be customized)
@@ -333,11 +592,16 @@ def set_image(update: Update, context: CallbackContext) -> None:
         return
     
     # Get the file_id of the image
-    file_id = update.message.reply_to_message.photo[-1].file_id
-    image_id = f"img_{len(db.get_all_images()) + 1}"
+    photo = update.message.reply_to_message.photo[-1]
+    file_id = photo.file_id
     
-    if db.add_image(image_id, number, file_id):
+    result = db.add_images([{'number': number, 'file_id': file_id, 'file_unique_id': photo.file_unique_id}])
+    image_id, added = result[0] if result else (None, False)
+    if added:
         update.message.reply_text(f"Image set with number {number} and status 'open'.")
+        store_image_copy(context.bot, image_id, file_id)
+    elif image_id:
+        update.message.reply_text(f"This image is already set as {image_id}.")
     else:
         update.message.reply_text("Failed to set image. It might already exist.")
 
@@ -380,6 +644,7 @@ def list_images(update: Update, context: CallbackContext) -> None:
 # Define a helper function for consistent Group B mapping
 def get_group_b_for_image(image_id, metadata=None):
     """Get the consistent Group B ID for an image."""
+    group_b_ids = CONFIG.current.group_b_ids
     # If metadata has a source_group_b_id and it's valid, use it
     if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
         try:
@@ -387,197 +652,139 @@ def get_group_b_for_image(image_id, metadata=None):
             source_group_b_id = int(metadata['source_group_b_id'])
             
             # Check if source_group_b_id is valid - all Group B IDs are already integers
-            if source_group_b_id in GROUP_B_IDS or source_group_b_id == GROUP_B_ID:
-                logger.info(f"Using existing Group B mapping for image {image_id}: {source_group_b_id}")
+            if source_group_b_id in group_b_ids or source_group_b_id == GROUP_B_ID:
+                logger.info("Using existing Group B mapping for image %s: %s", image_id, source_group_b_id)
                 return source_group_b_id
             else:
-                logger.warning(f"Source Group B ID {source_group_b_id} is not in valid Group B IDs: {GROUP_B_IDS}")
+                logger.warning("Source Group B ID %s is not in valid Group B IDs: %s", source_group_b_id, group_b_ids)
         except (ValueError, TypeError) as e:
-            logger.error(f"Error converting source_group_b_id to int: {e}. Metadata: {metadata}")
-    
-    # Create a deterministic mapping
-    # Use a hash of the image ID to ensure the same image always goes to the same Group B
-    image_hash = hash(image_id)
+            logger.error("Error converting source_group_b_id to int: %s. Metadata: %s", e, metadata)
     
-    # Get available Group B IDs
-    available_group_bs = list(GROUP_B_IDS) if GROUP_B_IDS else [GROUP_B_ID]
-    
-    # Deterministically select a Group B based on image hash
-    if available_group_bs:
-        selected_index = abs(image_hash) % len(available_group_bs)
-        target_group_b_id = available_group_bs[selected_index]  # Already an integer
-        
-        logger.info(f"Created deterministic mapping for image {image_id} to Group B {target_group_b_id}")
-        
-        # Save this mapping for future use
-        updated_metadata = metadata.copy() if isinstance(metadata, dict) else {}
-        updated_metadata['source_group_b_id'] = target_group_b_id
-        db.update_image_metadata(image_id, json.dumps(updated_metadata))
-        logger.info(f"Saved Group B mapping to image metadata: {updated_metadata}")
-        
-        return target_group_b_id
-    else:
-        logger.error("No available Group B IDs!")
-        # Default to GROUP_B_ID if no other options
-        return GROUP_B_ID
+    # Otherwise place the image on the consistent-hash ring of the current Group Bs
+    # (or the default Group B). The answer is reproducible, so nothing is written back.
+    target_group_b_id = hash_ring.ring_for(group_b_ids or (GROUP_B_ID,)).get(image_id)
+    logger.debug("Hash ring maps image %s to Group B %s", image_id, target_group_b_id)
+    return target_group_b_id
 
 def handle_group_a_message(update: Update, context: CallbackContext) -> None:
     """Handle messages in Group A."""
+    config = CONFIG.current
     # Add debug logging
     chat_id = update.effective_chat.id
-    logger.info(f"Received message in chat ID: {chat_id}")
+    logger.debug("Received message in chat ID: %s", chat_id)
     
     # Check if this chat is a Group A - ensure we're comparing integers
-    if int(chat_id) not in GROUP_A_IDS and int(chat_id) != GROUP_A_ID:
-        logger.info(f"Message received in non-Group A chat: {chat_id}")
+    if int(chat_id) not in config.group_a_ids and int(chat_id) != GROUP_A_ID:
+        logger.info("Message received in non-Group A chat: %s", chat_id)
         return
     
-    # Get message text
-    text = update.message.text.strip()
-    logger.info(f"Received message: {text}")
-    
-    # Skip messages that start with "+"
-    if text.startswith("+"):
-        logger.info("Message starts with '+', skipping")
-        return
-    
-    # Try to match "{number} 群" format first
-    match = re.search(r'^(\d+)\s*群$', text)
-    
-    # If no match, check if it's just a pure number
-    if not match and text.isdigit():
-        logger.info(f"Pure number format detected: {text}")
-        amount = text
-    elif match:
-        logger.info(f"'{number} 群' format detected")
-        amount = match.group(1)
-    else:
-        logger.info("Message doesn't match any accepted format")
+    # Pure number or "{number} 群"; "+N" and anything else has no amount
+    parsed = get_classification(update, context)
+    logger.info("Received message: %s", parsed.text)
+    amount = parsed.amount
+    if amount is None:
+        logger.debug("Message doesn't match any accepted format")
         return
     
-    logger.info(f"Matched amount: {amount}")
+    logger.debug("Matched amount: %s (%s)", amount, parsed.kind)
     
     # Check if the number is between 100 and 200 (inclusive)
     try:
         amount_int = int(amount)
         if amount_int < 100 or amount_int > 200:
-            logger.info(f"Number {amount} is outside the allowed range (100-200).")
+            logger.debug("Number %s is outside the allowed range (100-200).", amount)
             return
     except ValueError:
-        logger.info(f"Invalid number format: {amount}")
+        logger.debug("Invalid number format: %s", amount)
         return
     
+    # Count open and closed images
+    open_count, closed_count = db.count_images_by_status()
+    logger.debug("Images: %s, Open: %s, Closed: %s", open_count + closed_count, open_count, closed_count)
+    
     # Check if we have any images
-    images = db.get_all_images()
-    if not images:
+    if open_count + closed_count == 0:
         logger.info("No images found in database - remaining silent")
         # Removed the reply message to remain silent when no images are set
         return
-        
-    # Count open and closed images
-    open_count, closed_count = db.count_images_by_status()
-    logger.info(f"Images: {len(images)}, Open: {open_count}, Closed: {closed_count}")
     
-    # If all images are closed, remain silent
+    # If all images are closed, wait for one (WAIT_QUEUE_ENABLED) or remain silent
     if open_count == 0 and closed_count > 0:
-        logger.info("All images are closed - remaining silent")
+        logger.info("All images are closed - %s", "queueing request" if WAIT_QUEUE.enabled else "remaining silent")
+        if WAIT_QUEUE.enabled:
+            enqueue_group_a_request(update, context, amount)
         return
-
-    # Fix the image selection logic for Group A
-    # Try up to 5 times to get an image for the correct Group B
-    max_attempts = 5
-    image = None
     
-    # Check if there are any Group B specific images for this request
-    target_group_b = None
-    # If there are multiple Group B chats, try to determine if there's a specific one we should use
-    if len(GROUP_B_IDS) > 1:
-        # Check message content to see if it contains info about target Group B
-        # This is a simplified approach - you might want to implement something more robust
-        logger.info(f"Multiple Group B chats detected: {GROUP_B_IDS}")
+    # Requests that are already waiting go first
+    if WAIT_QUEUE.enabled:
+        serve_waiting_requests(context)
+        if len(WAIT_QUEUE):
+            enqueue_group_a_request(update, context, amount)
+            return
     
-    for attempt in range(max_attempts):
-        # Get a random open image
-        random_image = db.get_random_open_image()
-        if not random_image:
+    if not serve_group_a_request(context, chat_id, amount, update.message.message_id, update.message.from_user.id):
+        # Another request took the last open image in the meantime
+        if WAIT_QUEUE.enabled:
+            enqueue_group_a_request(update, context, amount)
+        else:
             update.message.reply_text("No open images available.")
-            return
-        
-        # Get metadata and check if this image is from a specific Group B
-        metadata = random_image.get('metadata', {})
-        logger.info(f"Checking image {random_image['image_id']} metadata: {metadata}")
-        
-        if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-            try:
-                source_group_b_id = int(metadata['source_group_b_id'])
-                
-                # For each attempt, be more lenient in our criteria
-                if attempt == 0:
-                    # First attempt: Try to match exact Group B if we have a target
-                    if target_group_b and source_group_b_id == target_group_b:
-                        image = random_image
-                        logger.info(f"Found exact matching image {image['image_id']} for Group B {source_group_b_id}")
-                        break
-                elif attempt < 3:
-                    # Later attempts: Accept any image from a valid Group B
-                    if source_group_b_id in GROUP_B_IDS or source_group_b_id == GROUP_B_ID:
-                        image = random_image
-                        logger.info(f"Found image {image['image_id']} from valid Group B {source_group_b_id}")
-                        break
-                else:
-                    # Last attempts: Accept any image with metadata
-                    image = random_image
-                    logger.info(f"Accepting any image with metadata: {image['image_id']}")
-                    break
-            except (ValueError, TypeError) as e:
-                logger.error(f"Error processing metadata for image {random_image['image_id']}: {e}")
-        
-        # If this was the last attempt, use this image regardless
-        if attempt == max_attempts - 1:
-            image = random_image
-            logger.info(f"Using last attempted image: {image['image_id']}")
+
+def serve_group_a_request(context: CallbackContext, chat_id, amount, message_id, user_id) -> bool:
+    """Send an image for a Group A request and notify its Group B. False if no image was open."""
+    config = CONFIG.current
+    
+    # Take the image from the pool of the Group B the routing policy prefers
+    image = None
+    for group_b_id in ROUTING.rank(config.group_b_ids or (GROUP_B_ID,)):
+        image = db.select_open_image(IMAGE_SELECTION, group_b_id, claim=True)
+        if image:
+            logger.debug("Routing (%s) chose Group B %s", ROUTING.strategy, group_b_id)
+            break
     
-    # If still no image found, use the last random one we got
+    # Any open image if no preferred pool has one (or the strategy is random)
     if not image:
-        image = random_image
-        logger.info(f"No suitable image found after {max_attempts} attempts, using random image: {image['image_id']}")
+        image = db.select_open_image(IMAGE_SELECTION, claim=True)
+    if not image:
+        return False
     
-    logger.info(f"Selected image: {image['image_id']}")
+    # The image is already closed by the claim; it is reopened below if sending fails
+    logger.info("Selected image: %s", image['image_id'])
     
     # Send the image
     try:
-        sent_msg = update.message.reply_photo(
-            photo=image['file_id'],
-            caption=f"🌟 群: {image['number']} 🌟"
+        sent_msg = send_image(
+            context.bot.send_photo, image,
+            chat_id=chat_id,
+            caption=f"🌟 群: {image['number']} 🌟",
+            reply_to_message_id=message_id
         )
-        logger.info(f"Image sent successfully with message_id: {sent_msg.message_id}")
+        logger.debug("Image sent successfully with message_id: %s", sent_msg.message_id)
         
         # Forward the content to the appropriate Group B chat
         try:
             # Get metadata if available
             metadata = image.get('metadata', {})
-            logger.info(f"Image metadata: {metadata}")
             
             # Get the proper Group B ID for this image - this is the critical part
             target_group_b_id = get_group_b_for_image(image['image_id'], metadata)
-            logger.info(f"Target Group B ID for forwarding: {target_group_b_id}")
+            logger.info("Target Group B ID for forwarding: %s", target_group_b_id)
             
             # Make EXTRA sure this is a valid Group B ID
             valid_group_b = False
             try:
                 target_group_b_id_int = int(target_group_b_id)
-                if target_group_b_id_int in [int(gid) for gid in GROUP_B_IDS] or target_group_b_id_int == int(GROUP_B_ID):
+                if target_group_b_id_int in [int(gid) for gid in config.group_b_ids] or target_group_b_id_int == int(GROUP_B_ID):
                     valid_group_b = True
                 else:
-                    logger.error(f"Target Group B ID {target_group_b_id_int} is not valid! Valid IDs: GROUP_B_IDS={GROUP_B_IDS}, GROUP_B_ID={GROUP_B_ID}")
+                    logger.error("Target Group B ID %s is not valid! Valid IDs: group_b_ids=%s, GROUP_B_ID=%s", target_group_b_id_int, config.group_b_ids, GROUP_B_ID)
                     # Fall back to main GROUP_B_ID
                     target_group_b_id = GROUP_B_ID
-                    logger.info(f"Falling back to main GROUP_B_ID: {GROUP_B_ID}")
+                    logger.info("Falling back to main GROUP_B_ID: %s", GROUP_B_ID)
             except (ValueError, TypeError) as e:
-                logger.error(f"Error validating target_group_b_id: {e}")
+                logger.error("Error validating target_group_b_id: %s", e)
                 # Fall back to main GROUP_B_ID
                 target_group_b_id = GROUP_B_ID
-                logger.info(f"Falling back to main GROUP_B_ID due to error: {GROUP_B_ID}")
+                logger.info("Falling back to main GROUP_B_ID due to error: %s", GROUP_B_ID)
             
             # Now we have a consistent target_group_b_id
             forwarded = context.bot.send_message(
@@ -591,27 +798,61 @@ def handle_group_a_message(update: Update, context: CallbackContext) -> None:
                 'group_a_chat_id': chat_id,  # Use the actual Group A chat ID that received this message
                 'group_b_msg_id': forwarded.message_id,
                 'group_b_chat_id': target_group_b_id,
+                'forwarded_at': time.time(),  # For routing_policy ack latency
                 'image_id': image['image_id'],
                 'amount': amount,  # Store the original amount
                 'number': str(image['number']),  # Store the image number as string
-                'original_user_id': update.message.from_user.id,  # Store original user for more robust tracking
-                'original_message_id': update.message.message_id  # Store the original message ID to reply to
+                'original_user_id': user_id,  # Store original user for more robust tracking
+                'original_message_id': message_id  # Store the original message ID to reply to
             }
+            ROUTING.load.dispatched(target_group_b_id, image['image_id'])
             
-            logger.info(f"Stored message mapping: {forwarded_msgs[image['image_id']]}")
+            logger.debug("Stored message mapping for image %s (%d total)", image['image_id'], len(forwarded_msgs))
             
             # Save persistent data
             save_persistent_data()
-            
-            # Set image status to closed
-            db.set_image_status(image['image_id'], "closed")
-            logger.info(f"Image {image['image_id']} status set to closed")
         except Exception as e:
-            logger.error(f"Error forwarding to Group B: {e}")
-            update.message.reply_text(f"发送至Group B失败: {e}")
+            logger.error("Error forwarding to Group B: %s", e)
+            db.set_image_status(image['image_id'], "open")
+            context.bot.send_message(chat_id=chat_id, text=f"发送至Group B失败: {e}", reply_to_message_id=message_id)
     except Exception as e:
-        logger.error(f"Error sending image: {e}")
-        update.message.reply_text(f"发送图片错误: {e}")
+        logger.error("Error sending image: %s", e)
+        db.set_image_status(image['image_id'], "open")
+        context.bot.send_message(chat_id=chat_id, text=f"发送图片错误: {e}", reply_to_message_id=message_id)
+    return True
+
+def enqueue_group_a_request(update: Update, context: CallbackContext, amount) -> None:
+    """Queue a Group A request until an image is reopened, telling the member their position."""
+    request = wait_queue.WaitingRequest(
+        update.effective_chat.id, update.message.message_id, update.message.from_user.id, amount, time.time()
+    )
+    position = WAIT_QUEUE.push(request)
+    if position is None:
+        logger.info("Wait queue for chat %s is full - dropping request", request.chat_id)
+        return
+    logger.info("Queued request %s in chat %s at position %s", request.message_id, request.chat_id, position)
+    if WAIT_QUEUE.notify_position:
+        update.message.reply_text(f"⏳ 群码已满，您排在第 {position} 位，有空位后会自动发送")
+
+def serve_waiting_requests(context: CallbackContext) -> None:
+    """Serve queued Group A requests, oldest first, while images are open."""
+    if not WAIT_QUEUE.enabled:
+        return
+    while True:
+        request, expired = WAIT_QUEUE.pop_oldest()
+        for old in expired:
+            logger.info("Request %s in chat %s waited too long - dropped", old.message_id, old.chat_id)
+            try:
+                safe_send_message(context, old.chat_id, "⌛ 等待超时，请重新发送金额", reply_to_message_id=old.message_id)
+            except Exception as e:
+                logger.error("Error sending wait timeout notice: %s", e)
+        if request is None:
+            return
+        if not serve_group_a_request(context, request.chat_id, request.amount, request.message_id, request.user_id):
+            WAIT_QUEUE.push_front(request)
+            return
+        logger.info("Served queued request %s in chat %s after %.1fs",
+                    request.message_id, request.chat_id, time.time() - request.queued_at)
 
 def handle_approval(update: Update, context: CallbackContext) -> None:
     """Handle approval messages (reply with '1')."""
@@ -637,38 +878,36 @@ def handle_approval(update: Update, context: CallbackContext) -> None:
         request = pending_requests[request_msg_id]
         amount = request['amount']
         
-        logger.info(f"Found pending request: {request}")
+        logger.debug("Found pending request for message %s", request_msg_id)
         
-        # Get a random open image
-        image = db.get_random_open_image()
+        # Claim an open image, so no concurrent request can be given the same one
+        image = db.select_open_image(IMAGE_SELECTION, claim=True)
         if not image:
             update.message.reply_text("No open images available.")
             return
         
-        logger.info(f"Selected image: {image['image_id']}")
+        logger.info("Selected image: %s", image['image_id'])
         
         # Send the image
         try:
-            # Get the image and its metadata
-            image = db.get_image_by_id(image['image_id'])
-            metadata = image.get('metadata', {}) if image else {}
+            metadata = image.get('metadata', {})
             
             # Get the proper Group B ID for this image
             target_group_b_id = get_group_b_for_image(image['image_id'], metadata)
             
             # First send the image to Group A
-            sent_msg = update.message.reply_photo(
-                photo=image['file_id'],
+            sent_msg = send_image(
+                update.message.reply_photo, image,
                 caption=f"🌟 群: {image['number']} 🌟"
             )
-            logger.info(f"Image sent to Group A with message_id: {sent_msg.message_id}")
+            logger.info("Image sent to Group A with message_id: %s", sent_msg.message_id)
             
             # Then forward to Group B
             forwarded = context.bot.send_message(
                 chat_id=target_group_b_id,
                 text=f"💰 金额：{amount}\n🔢 群：{image['number']}\n\n❌ 如果会员10分钟没进群请回复0"
             )
-            logger.info(f"Message forwarded to Group B with message_id: {forwarded.message_id}")
+            logger.info("Message forwarded to Group B with message_id: %s", forwarded.message_id)
             
             # Store mapping between original and forwarded message
             forwarded_msgs[image['image_id']] = {
@@ -676,68 +915,69 @@ def handle_approval(update: Update, context: CallbackContext) -> None:
                 'group_a_chat_id': update.effective_chat.id,
                 'group_b_msg_id': forwarded.message_id,
                 'group_b_chat_id': target_group_b_id,
+                'forwarded_at': time.time(),  # For routing_policy ack latency
                 'image_id': image['image_id'],
                 'amount': amount,  # Store the original amount
                 'number': str(image['number']),  # Store the image number as string
                 'original_user_id': request['user_id'],  # Store original user for more robust tracking
                 'original_message_id': request['original_message_id']  # Store the original message ID to reply to
             }
+            ROUTING.load.dispatched(target_group_b_id, image['image_id'])
             
-            logger.info(f"Stored message mapping: {forwarded_msgs[image['image_id']]}")
+            logger.debug("Stored message mapping for image %s (%d total)", image['image_id'], len(forwarded_msgs))
             
             # Save persistent data
             save_persistent_data()
             
-            # Set image status to closed
-            db.set_image_status(image['image_id'], "closed")
-            logger.info(f"Image {image['image_id']} status set to closed")
-            
             # Remove the pending request
             del pending_requests[request_msg_id]
         except Exception as e:
-            logger.error(f"Error forwarding to Group B: {e}")
+            logger.error("Error forwarding to Group B: %s", e)
+            # The claim closed the image; hand it out again
+            db.set_image_status(image['image_id'], "open")
             update.message.reply_text(f"发送至Group B失败: {e}")
     else:
-        logger.info(f"No pending request found for message ID: {request_msg_id}")
+        logger.info("No pending request found for message ID: %s", request_msg_id)
 
 def handle_all_group_b_messages(update: Update, context: CallbackContext) -> None:
     """Single handler for ALL messages in Group B"""
-    global FORWARDING_ENABLED
     chat_id = update.effective_chat.id
     message_id = update.message.message_id
-    text = update.message.text.strip()
+    parsed = get_classification(update, context)
+    text = parsed.text
     user = update.effective_user.username or update.effective_user.first_name
     user_id = update.effective_user.id
     
-    logger.info(f"Group B message: '{text}' from {user} (msg_id: {message_id})")
+    logger.info("Group B message: '%s' from %s (msg_id: %s)", text, user, message_id)
     
     # Skip empty messages
     if not text:
         return
     
     # Special case for "+0" or "0" responses - handle image status but don't send confirmation
-    if (text == "+0" or text == "0") and update.message.reply_to_message:
+    if parsed.kind == message_classifier.ZERO and update.message.reply_to_message:
         reply_msg_id = update.message.reply_to_message.message_id
-        logger.info(f"Received {text} reply to message {reply_msg_id}")
+        logger.debug("Received %s reply to message %s", text, reply_msg_id)
         
         # Find if any known message matches this reply ID
         for img_id, data in forwarded_msgs.items():
             if data.get('group_b_msg_id') == reply_msg_id:
-                logger.info(f"Found matching image {img_id} for {text} reply")
+                logger.info("Found matching image %s for %s reply", img_id, text)
                 
                 # Save the Group B response
                 group_b_responses[img_id] = "+0"
-                logger.info(f"Stored Group B response: +0")
+                logger.debug("Stored Group B response: +0")
                 
                 # Save responses
                 save_persistent_data()
                 
                 # Mark the image as open
                 db.set_image_status(img_id, "open")
-                logger.info(f"Set image {img_id} status to open")
+                ROUTING.load.acknowledged(img_id)
+                logger.debug("Set image %s status to open", img_id)
                 
                 # Send response to Group A only if forwarding is enabled
-                if FORWARDING_ENABLED:
+                if CONFIG.current.forwarding_enabled:
                     if 'group_a_chat_id' in data and 'group_a_msg_id' in data:
                         try:
                             # Get the original message ID if available
@@ -751,120 +991,116 @@ def handle_all_group_b_messages(update: Update, context: CallbackContext) -> Non
                                 text="会员没进群呢哥哥~ 😢",
                                 reply_to_message_id=reply_to_message_id
                             )
-                            logger.info(f"Sent +0 response to Group A (translated to '会员没进群呢哥哥~ 😢')")
+                            logger.info("Sent +0 response to Group A (translated to '会员没进群呢哥哥~ 😢')")
                         except Exception as e:
-                            logger.error(f"Error sending +0 response to Group A: {e}")
+                            logger.error("Error sending +0 response to Group A: %s", e)
                     else:
                         logger.info("Group A chat ID or message ID not found in data")
                 else:
                     logger.info("Forwarding to Group A is currently disabled by admin - not sending +0 response")
                 
+                # The reopened image can go to a waiting Group A request
+                serve_waiting_requests(context)
                 return
     
-    # Extract all numbers from the message (with or without + prefix)
-    raw_numbers = re.findall(r'\d+', text)
-    plus_numbers = [m[1:] for m in re.findall(r'\+\d+', text)]
+    # All numbers in the message (with or without + prefix), extracted by the classifier
+    raw_numbers = parsed.numbers
+    plus_numbers = parsed.plus_numbers
     
     # Log what we found
     if raw_numbers:
-        logger.info(f"Found raw numbers: {raw_numbers}")
+        logger.debug("Found raw numbers: %s", raw_numbers)
     if plus_numbers:
-        logger.info(f"Found numbers with + prefix: {plus_numbers}")
+        logger.debug("Found numbers with + prefix: %s", plus_numbers)
     
     # Regular handling for other messages
     # CASE 1: Check if replying to a message
     if update.message.reply_to_message:
         reply_msg_id = update.message.reply_to_message.message_id
-        logger.info(f"This is a reply to message {reply_msg_id}")
+        logger.debug("This is a reply to message %s", reply_msg_id)
         
         # Find if any known message matches this reply ID
         for img_id, data in forwarded_msgs.items():
             if data.get('group_b_msg_id') == reply_msg_id:
-                logger.info(f"Found matching image {img_id} for this reply")
+                logger.info("Found matching image %s for this reply", img_id)
                 stored_amount = data.get('amount')
                 stored_number = data.get('number')
-                logger.info(f"Expected amount: {stored_amount}, group number: {stored_number}")
+                logger.debug("Expected amount: %s, group number: %s", stored_amount, stored_number)
                 
                 # If there's a number in the reply with + prefix
                 if plus_numbers:
                     number = plus_numbers[0]  # Use the first +number
-                    logger.info(f"User provided number: +{number}")
+                    logger.debug("User provided number: +%s", number)
                     
                     # Verify the number matches the expected amount
                     if number == stored_amount:
-                        logger.info(f"Provided number matches the expected amount: {stored_amount}")
+                        logger.debug("Provided number matches the expected amount: %s", stored_amount)
                         process_group_b_response(update, context, img_id, data, number, f"+{number}", "reply_valid_amount")
                         return
                     elif number == stored_number:
                         # Number matches group number but not amount - silently ignore
-                        logger.info(f"Number {number} matches group number but NOT the expected amount {stored_amount}")
+                        logger.debug("Number %s matches group number but NOT the expected amount %s", number, stored_amount)
                         return
                     else:
                         # Number doesn't match either amount or group number - CUSTOM AMOUNT
-                        logger.info(f"Number {number} is a custom amount, different from {stored_amount}")
+                        logger.debug("Number %s is a custom amount, different from %s", number, stored_amount)
                         # Check if user is a group admin to allow custom amounts
                         if is_group_admin(user_id, chat_id) or is_global_admin(user_id):
                             # Handle custom amount that needs approval
                             handle_custom_amount(update, context, img_id, data, number)
                             return
                         else:
-                            logger.info(f"User {user_id} is not an admin, silently ignoring custom amount")
+                            logger.info("User %s is not an admin, silently ignoring custom amount", user_id)
                             return
                 
                 # If there's a raw number (without +)
                 elif raw_numbers:
                     number = raw_numbers[0]  # Use the first raw number
-                    logger.info(f"User provided raw number: {number}")
+                    logger.debug("User provided raw number: %s", number)
                     
                     # Verify the number matches the expected amount
                     if number == stored_amount:
-                        logger.info(f"Provided number matches the expected amount: {stored_amount}")
+                        logger.debug("Provided number matches the expected amount: %s", stored_amount)
                         process_group_b_response(update, context, img_id, data, number, f"+{number}", "reply_valid_amount_raw")
                         return
                     elif number == stored_number:
                         # Number matches group number but not amount - silently ignore
-                        logger.info(f"Number {number} matches group number but NOT the expected amount {stored_amount}")
+                        logger.debug("Number %s matches group number but NOT the expected amount %s", number, stored_amount)
                         return
                     else:
                         # Number doesn't match either amount or group number - CUSTOM AMOUNT
-                        logger.info(f"Number {number} is a custom amount, different from {stored_amount}")
+                        logger.debug("Number %s is a custom amount, different from %s", number, stored_amount)
                         # Check if user is a group admin to allow custom amounts
                         if is_group_admin(user_id, chat_id) or is_global_admin(user_id):
                             # Handle custom amount that needs approval
                             handle_custom_amount(update, context, img_id, data, number)
                             return
                         else:
-                            logger.info(f"User {user_id} is not an admin, silently ignoring custom amount")
+                            logger.info("User %s is not an admin, silently ignoring custom amount", user_id)
                             return
                 
                 # No numbers in reply - silently ignore
                 else:
-                    logger.info("Reply without any numbers detected")
+                    logger.debug("Reply without any numbers detected")
                     return
         
         # If replying to a message that's not from our bot
-        logger.info("Reply to a message that's not recognized as one of our bot's messages")
-        return
-    
-    # At this point, the message is not a reply - only proceed for Group B admins and specific commands
-    if "重置群码" in text or "设置群" in text or "设置群聊" in text or "设置操作人" in text or "解散群聊" in text:
-        # These are handled by other message handlers, so let them through
-        logger.info(f"Passing command message to other handlers: {text}")
+        logger.debug("Reply to a message that's not recognized as one of our bot's messages")
         return
     
+    # At this point, the message is not a reply; commands were routed to their own handlers
     # For standalone "+number" messages - we now silently ignore them
     if plus_numbers or (raw_numbers and len(text) <= 10):  # Simple number messages
-        logger.info(f"Received standalone number message: {text}")
+        logger.debug("Received standalone number message: %s", text)
         # Silently ignore standalone number messages
-        logger.info("Silently ignoring standalone number message")
+        logger.debug("Silently ignoring standalone number message")
         return
     
     # For any other messages, just log and take no action
-    logger.info("No action taken for this message")
+    logger.debug("No action taken for this message")
 
 def process_group_b_response(update, context, img_id, msg_data, number, original_text, match_type):
     """Process a response from Group B and update status."""
-    global FORWARDING_ENABLED
     responder = update.effective_user.username or update.effective_user.first_name
     
     # Simplified response format - just the +number or custom message for +0
@@ -876,23 +1112,24 @@ def process_group_b_response(update, context, img_id, msg_data, number, original
         else:
             response_text = f"+{number}"  # Add + if missing
     
-    logger.info(f"Processing Group B response for image {img_id} (match type: {match_type})")
+    logger.info("Processing Group B response for image %s (match type: %s)", img_id, match_type)
     
     # Save the Group B response for this image
     group_b_responses[img_id] = response_text
-    logger.info(f"Stored Group B response: {response_text}")
+    logger.debug("Stored Group B response: %s", response_text)
     
     # Save responses
     save_persistent_data()
     
     # Set status to open
     db.set_image_status(img_id, "open")
-    logger.info(f"Set image {img_id} status to open")
+    ROUTING.load.acknowledged(img_id)
+    logger.debug("Set image %s status to open", img_id)
     
     # Send the response to Group A chat
     if 'group_a_chat_id' in msg_data and 'group_a_msg_id' in msg_data:
-        if FORWARDING_ENABLED:
-            logger.info(f"Sending response to Group A: {msg_data['group_a_chat_id']}")
+        if CONFIG.current.forwarding_enabled:
+            logger.debug("Sending response to Group A: %s", msg_data['group_a_chat_id'])
             try:
                 # Get the original message ID if available
                 original_message_id = msg_data.get('original_message_id')
@@ -905,9 +1142,9 @@ def process_group_b_response(update, context, img_id, msg_data, number, original
                     text=response_text,
                     reply_to_message_id=reply_to_message_id
                 )
-                logger.info(f"Successfully sent response to Group A {msg_data['group_a_chat_id']}: {response_text}")
+                logger.info("Successfully sent response to Group A %s: %s", msg_data['group_a_chat_id'], response_text)
             except Exception as e:
-                logger.error(f"Error sending response to Group A: {e}")
+                logger.error("Error sending response to Group A: %s", e)
                 # No error messages to user
                 logger.error("Could not notify user about Group A send failure")
         else:
@@ -915,13 +1152,16 @@ def process_group_b_response(update, context, img_id, msg_data, number, original
             # No notification message when forwarding is disabled
     
     # No confirmation message to Group B
-    logger.info(f"No confirmation sent to Group B for: {response_text}")
+    logger.debug("No confirmation sent to Group B for: %s", response_text)
+    
+    # The reopened image can go to a waiting Group A request
+    serve_waiting_requests(context)
 
 # Add handler for replies to bot messages in Group A
 def handle_group_a_reply(update: Update, context: CallbackContext) -> None:
     """Handle replies to bot messages in Group A silently (no auto-replies)."""
     # Completely silent handler - no processing, no responses
-    logger.info(f"Reply received in Group A - ignoring silently")
+    logger.debug("Reply received in Group A - ignoring silently")
     return
     
     # All the processing below has been commented out to ensure complete silence
@@ -930,7 +1170,7 @@ def handle_group_a_reply(update: Update, context: CallbackContext) -> None:
     message_id = update.message.message_id
     reply_to_message_id = update.message.reply_to_message.message_id if update.message.reply_to_message else None
     
-    logger.info(f"Reply received in chat {chat_id} to message {reply_to_message_id}")
+    logger.info("Reply received in chat %s to message %s", chat_id, reply_to_message_id)
     
     # Check if replying to a message
     if not update.message.reply_to_message:
@@ -943,36 +1183,35 @@ def handle_group_a_reply(update: Update, context: CallbackContext) -> None:
         return
     
     logger.info("Reply to photo message detected in Group A")
-    logger.info(f"Current forwarded_msgs: {forwarded_msgs}")
+    logger.info("Current forwarded_msgs: %s", forwarded_msgs)
     
     # Find the image ID for this message - just log information, don't reply
     found = False
     for img_id, msg_data in forwarded_msgs.items():
         group_a_msg_id = msg_data.get('group_a_msg_id')
-        logger.info(f"Checking image {img_id} with group_a_msg_id: {group_a_msg_id}")
+        logger.info("Checking image %s with group_a_msg_id: %s", img_id, group_a_msg_id)
         
         # Check if the message IDs match
         if group_a_msg_id and str(group_a_msg_id) == str(reply_to_message_id):
-            logger.info(f"Found matching image: {img_id}")
+            logger.info("Found matching image: %s", img_id)
             found = True
             
             # Check if there's a response from Group B - just log it
             if img_id in group_b_responses:
                 response = group_b_responses[img_id]
-                logger.info(f"Group B response for image {img_id}: {response}")
+                logger.info("Group B response for image %s: %s", img_id, response)
             else:
-                logger.info(f"No Group B response found for image {img_id}")
+                logger.info("No Group B response found for image %s", img_id)
             
             break
     
     if not found:
-        logger.info(f"No matching image found for reply to message {reply_to_message_id}")
+        logger.info("No matching image found for reply to message %s", reply_to_message_id)
         # No response if no match
     """
 
 def button_callback(update: Update, context: CallbackContext) -> None:
     """Handle button callbacks."""
-    global FORWARDING_ENABLED
     query = update.callback_query
     query.answer()
     
@@ -1006,7 +1245,7 @@ def button_callback(update: Update, context: CallbackContext) -> None:
                 
                 query.message.reply_text(f"请确认金额: +{original_amount} 或 +0（如果会员未进群）")
             except (NetworkError, TimedOut) as e:
-                logger.error(f"Network error in button callback: {e}")
+                logger.error("Network error in button callback: %s", e)
     
     elif data.startswith('verify_'):
         # Format: verify_image_id_amount
@@ -1027,18 +1266,19 @@ def button_callback(update: Update, context: CallbackContext) -> None:
             
             # Store the response for Group A
             group_b_responses[image_id] = response_text
-            logger.info(f"Stored Group B button response for image {image_id}: {response_text}")
+            logger.info("Stored Group B button response for image %s: %s", image_id, response_text)
             
             # Save updated responses
             save_persistent_data()
             
             try:
                 # Set status to open
+                ROUTING.load.acknowledged(image_id)
                 if db.set_image_status(image_id, "open"):
                     query.edit_message_reply_markup(None)
                     
                 # Only send response to Group A if forwarding is enabled
-                if FORWARDING_ENABLED:
+                if CONFIG.current.forwarding_enabled:
                     if msg_data and 'group_a_chat_id' in msg_data and 'group_a_msg_id' in msg_data:
                         try:
                             # Get the original message ID if available
@@ -1052,16 +1292,19 @@ def button_callback(update: Update, context: CallbackContext) -> None:
                                 text=response_text,
                                 reply_to_message_id=reply_to_message_id
                             )
-                            logger.info(f"Directly sent Group B button response to Group A: {response_text}")
+                            logger.info("Directly sent Group B button response to Group A: %s", response_text)
                         except Exception as e:
-                            logger.error(f"Error sending button response to Group A: {e}")
+                            logger.error("Error sending button response to Group A: %s", e)
                             query.message.reply_text(f"回复已保存，但发送到需方群失败: {e}")
                 else:
                     logger.info("Forwarding to Group A is currently disabled by admin - not sending button response")
                     # Remove the notification message
                     # query.message.reply_text("回复已保存，但转发到需方群功能当前已关闭。")
+                
+                # The reopened image can go to a waiting Group A request
+                serve_waiting_requests(context)
             except (NetworkError, TimedOut) as e:
-                logger.error(f"Network error in verify callback: {e}")
+                logger.error("Network error in verify callback: %s", e)
 
 def debug_command(update: Update, context: CallbackContext) -> None:
     """Debug command to display current state."""
@@ -1071,17 +1314,148 @@ def debug_command(update: Update, context: CallbackContext) -> None:
         return
     
     debug_info = [
-        f"🔹 Group A IDs: {GROUP_A_IDS}",
-        f"🔸 Group B IDs: {GROUP_B_IDS}",
-        f"👥 Group Admins: {GROUP_ADMINS}",
+        f"🔹 Group A IDs: {CONFIG.current.group_a_ids}",
+        f"🔸 Group B IDs: {CONFIG.current.group_b_ids}",
+        f"👥 Group Admins: {CONFIG.current.group_admins}",
         f"📨 Forwarded Messages: {len(forwarded_msgs)}",
         f"📝 Group B Responses: {len(group_b_responses)}",
         f"🖼️ Images: {len(db.get_all_images())}",
-        f"⚙️ Forwarding Enabled: {FORWARDING_ENABLED}"
+        f"⚙️ Forwarding Enabled: {CONFIG.current.forwarding_enabled}"
     ]
     
     update.message.reply_text("\n".join(debug_info))
 
+def stats_command(update: Update, context: CallbackContext) -> None:
+    """Show handler, DB and Bot API latency statistics."""
+    # Only allow in private chats from admin
+    if update.effective_chat.type != "private" or not is_global_admin(update.effective_user.id):
+        update.message.reply_text("Only global admins can use this command in private chat.")
+        return
+    
+    # Optional filter: /stats handler db
+    kinds = context.args or None
+    summary = metrics.REGISTRY.render_summary(kinds)
+    if not summary:
+        update.message.reply_text("No metrics recorded yet.")
+        return
+    
+    message = "📈 Stats:\n" + summary
+    
+    # If message is too long, split it
+    if len(message) > 4000:
+        chunks = [message[i:i+4000] for i in range(0, len(message), 4000)]
+        for chunk in chunks:
+            update.message.reply_text(chunk)
+    else:
+        update.message.reply_text(message)
+
+def log_level_command(update: Update, context: CallbackContext) -> None:
+    """Show or change logger levels at runtime: /loglevel [logger] [LEVEL]."""
+    # Only allow in private chats from admin
+    if update.effective_chat.type != "private" or not is_global_admin(update.effective_user.id):
+        update.message.reply_text("Only global admins can use this command in private chat.")
+        return
+    
+    if context.args and len(context.args) == 2:
+        name, level = context.args
+        if not log_config.set_level(name, level):
+            update.message.reply_text(f"Unknown level: {level}")
+            return
+        logger.info("Log level of %s set to %s by user %s", name, level.upper(), update.effective_user.id)
+    elif context.args:
+        update.message.reply_text("Usage: /loglevel [logger] [DEBUG|INFO|WARNING|ERROR]")
+        return
+    
+    levels = log_config.get_levels()
+    update.message.reply_text("📝 Log levels:\n" + "\n".join(f"{name}: {level}" for name, level in levels.items()))
+
+def profile_command(update: Update, context: CallbackContext) -> None:
+    """Profile all handler threads for N seconds: /profile [seconds]."""
+    # Only allow in private chats from admin
+    if update.effective_chat.type != "private" or not is_global_admin(update.effective_user.id):
+        update.message.reply_text("Only global admins can use this command in private chat.")
+        return
+    
+    try:
+        seconds = float(context.args[0]) if context.args else 30.0
+    except ValueError:
+        update.message.reply_text("Usage: /profile [seconds]")
+        return
+    seconds = max(1.0, min(seconds, 600.0))
+    
+    chat_id = update.effective_chat.id
+    
+    def send_report(path, summary):
+        try:
+            context.bot.send_message(chat_id=chat_id, text=f"📄 {path}\n{summary}"[:4000])
+        except Exception as e:
+            logger.error("Error sending profile report: %s", e)
+    
+    if not profiling.start_profile(seconds, on_done=send_report):
+        update.message.reply_text("A profiling session is already running. Use /profile_stop to end it.")
+        return
+    
+    update.message.reply_text(f"⏱ Profiling handlers for {seconds:.0f} seconds...")
+
+def profile_stop_command(update: Update, context: CallbackContext) -> None:
+    """Stop the running profiling session early and report."""
+    # Only allow in private chats from admin
+    if update.effective_chat.type != "private" or not is_global_admin(update.effective_user.id):
+        update.message.reply_text("Only global admins can use this command in private chat.")
+        return
+    
+    result = profiling.stop_profile()
+    if not result:
+        update.message.reply_text("No profiling session is running.")
+        return
+    
+    path, summary = result
+    update.message.reply_text(f"📄 {path}\n{summary}"[:4000])
+
+def memory_snapshot_command(update: Update, context: CallbackContext) -> None:
+    """Take a tracemalloc snapshot: /memsnap, or /memsnap stop to stop tracing."""
+    # Only allow in private chats from admin
+    if update.effective_chat.type != "private" or not is_global_admin(update.effective_user.id):
+        update.message.reply_text("Only global admins can use this command in private chat.")
+        return
+    
+    if context.args and context.args[0] == "stop":
+        profiling.stop_tracing()
+        update.message.reply_text("🧠 Memory tracing stopped.")
+        return
+    
+    path, summary = profiling.take_snapshot()
+    update.message.reply_text(f"📄 {path}\n{summary}"[:4000])
+
+def memory_diff_command(update: Update, context: CallbackContext) -> None:
+    """Compare a new tracemalloc snapshot with the previous one."""
+    # Only allow in private chats from admin
+    if update.effective_chat.type != "private" or not is_global_admin(update.effective_user.id):
+        update.message.reply_text("Only global admins can use this command in private chat.")
+        return
+    
+    result = profiling.diff_snapshot()
+    if not result:
+        update.message.reply_text("No baseline snapshot. Use /memsnap first.")
+        return
+    
+    path, summary = result
+    update.message.reply_text(f"📄 {path}\n{summary}"[:4000])
+
+def slow_command(update: Update, context: CallbackContext) -> None:
+    """Show stacks sampled from slow handlers: /slow, or /slow reset."""
+    # Only allow in private chats from admin
+    if update.effective_chat.type != "private" or not is_global_admin(update.effective_user.id):
+        update.message.reply_text("Only global admins can use this command in private chat.")
+        return
+    
+    if context.args and context.args[0] == "reset":
+        handler_watchdog.WATCHDOG.reset()
+        update.message.reply_text("🐢 Slow handler samples cleared.")
+        return
+    
+    update.message.reply_text(handler_watchdog.WATCHDOG.report()[:4000])
+
 def register_admin_command(update: Update, context: CallbackContext) -> None:
     """Register a user as group admin by user ID."""
     chat_id = update.effective_chat.id
@@ -1105,7 +1479,7 @@ def register_admin_command(update: Update, context: CallbackContext) -> None:
         add_group_admin(target_user_id, chat_id)
         
         update.message.reply_text(f"👤 用户 {target_user_id} A已设置为此群的操作人。")
-        logger.info(f"User {target_user_id} manually added as group admin in chat {chat_id} by admin {user_id}")
+        logger.info("User %s manually added as group admin in chat %s by admin %s", target_user_id, chat_id, user_id)
     except ValueError:
         update.message.reply_text("用户 ID 必须是数字。")
 
@@ -1128,12 +1502,10 @@ def get_id_command(update: Update, context: CallbackContext) -> None:
 def debug_reset_command(update: Update, context: CallbackContext) -> None:
     """Reset the forwarded_msgs and group_b_responses."""
     # Only allow in private chats from admin
-    if update.effective_chat.type != "private" or update.effective_user.id not in GLOBAL_ADMINS:
+    if update.effective_chat.type != "private" or update.effective_user.id not in CONFIG.current.global_admins:
         update.message.reply_text("Only admins can use this command in private chat.")
         return
     
-    global forwarded_msgs, group_b_responses
-    
     # Backup current data
     if os.path.exists(FORWARDED_MSGS_FILE):
         os.rename(FORWARDED_MSGS_FILE, f"{FORWARDED_MSGS_FILE}.bak")
@@ -1141,9 +1513,9 @@ def debug_reset_command(update: Update, context: CallbackContext) -> None:
     if os.path.exists(GROUP_B_RESPONSES_FILE):
         os.rename(GROUP_B_RESPONSES_FILE, f"{GROUP_B_RESPONSES_FILE}.bak")
     
-    # Reset dictionaries
-    forwarded_msgs = {}
-    group_b_responses = {}
+    # Reset dictionaries in place (they are shared with other modules and, in worker mode, stored in SQLite)
+    forwarded_msgs.clear()
+    group_b_responses.clear()
     
     # Save empty data
     save_persistent_data()
@@ -1155,8 +1527,8 @@ def handle_admin_reply(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
     # Check if user is an admin
-    if user_id not in GLOBAL_ADMINS:
-        logger.info(f"User {user_id} is not an admin")
+    if user_id not in CONFIG.current.global_admins:
+        logger.info("User %s is not an admin", user_id)
         return
     
     # Check if message contains the word '群'
@@ -1167,38 +1539,37 @@ def handle_admin_reply(update: Update, context: CallbackContext) -> None:
     if not update.message.reply_to_message:
         return
     
-    logger.info(f"Admin reply detected from user {user_id} with text: {update.message.text}")
+    logger.info("Admin reply detected from user %s with text: %s", user_id, update.message.text)
     
     # Get the original message and user
     original_message = update.message.reply_to_message
     original_user_id = original_message.from_user.id
     original_message_id = original_message.message_id
     
-    logger.info(f"Original message from user {original_user_id}: {original_message.text}")
+    logger.info("Original message from user %s: %s", original_user_id, original_message.text)
+    
+    # Count open and closed images
+    open_count, closed_count = db.count_images_by_status()
+    logger.info("Images: %s, Open: %s, Closed: %s", open_count + closed_count, open_count, closed_count)
     
     # Check if we have any images
-    images = db.get_all_images()
-    if not images:
+    if open_count + closed_count == 0:
         logger.info("No images found in database")
         update.message.reply_text("No images available. Please ask admin to set images.")
         return
-        
-    # Count open and closed images
-    open_count, closed_count = db.count_images_by_status()
-    logger.info(f"Images: {len(images)}, Open: {open_count}, Closed: {closed_count}")
     
     # If all images are closed, remain silent
-    if open_count == 0 and closed_count > 0:
+    if open_count == 0:
         logger.info("All images are closed - remaining silent")
         return
     
-    # Get a random open image
-    image = db.get_random_open_image()
+    # Claim an open image, so no concurrent request can be given the same one
+    image = db.select_open_image(IMAGE_SELECTION, claim=True)
     if not image:
         update.message.reply_text("No open images available.")
         return
     
-    logger.info(f"Selected image: {image['image_id']}")
+    logger.info("Selected image: %s", image['image_id'])
     
     # Get amount from original message if it's numeric
     amount = ""
@@ -1212,25 +1583,25 @@ def handle_admin_reply(update: Update, context: CallbackContext) -> None:
         else:
             amount = "0"  # Default amount if no number found
     
-    logger.info(f"Extracted amount: {amount}")
+    logger.info("Extracted amount: %s", amount)
     
     # Send the image as a reply to the original message
     try:
-        sent_msg = original_message.reply_photo(
-            photo=image['file_id'],
+        sent_msg = send_image(
+            original_message.reply_photo, image,
             caption=f"Number: {image['number']}"
         )
-        logger.info(f"Image sent successfully to Group A with message_id: {sent_msg.message_id}")
+        logger.info("Image sent successfully to Group A with message_id: %s", sent_msg.message_id)
         
         # Forward the content to Group B
         try:
             if GROUP_B_ID:
-                logger.info(f"Forwarding to Group B: {GROUP_B_ID}")
+                logger.info("Forwarding to Group B: %s", GROUP_B_ID)
                 forwarded = context.bot.send_message(
                     chat_id=GROUP_B_ID,
                     text=f"💰 金额：{amount}\n🔢 群：{image['number']}\n\n❌ 如果会员10分钟没进群请回复0"
                 )
-                logger.info(f"Message forwarded to Group B with message_id: {forwarded.message_id}")
+                logger.info("Message forwarded to Group B with message_id: %s", forwarded.message_id)
                 
                 # Store mapping between original and forwarded message
                 forwarded_msgs[image['image_id']] = {
@@ -1238,26 +1609,26 @@ def handle_admin_reply(update: Update, context: CallbackContext) -> None:
                     'group_a_chat_id': update.effective_chat.id,
                     'group_b_msg_id': forwarded.message_id,
                     'group_b_chat_id': GROUP_B_ID,
+                    'forwarded_at': time.time(),  # For routing_policy ack latency
                     'image_id': image['image_id'],
                     'amount': amount,  # Store the original amount
                     'number': str(image['number']),  # Store the image number as string
                     'original_user_id': original_user_id,  # Store original user for more robust tracking
                     'original_message_id': original_message_id  # Store the original message ID to reply to
                 }
+                ROUTING.load.dispatched(GROUP_B_ID, image['image_id'])
                 
-                logger.info(f"Stored message mapping: {forwarded_msgs[image['image_id']]}")
+                logger.debug("Stored message mapping for image %s (%d total)", image['image_id'], len(forwarded_msgs))
                 
                 # Save the updated mappings
                 save_persistent_data()
-                
-                # Set image status to closed
-                db.set_image_status(image['image_id'], "closed")
-                logger.info(f"Image {image['image_id']} status set to closed")
         except Exception as e:
-            logger.error(f"Error forwarding to Group B: {e}")
+            logger.error("Error forwarding to Group B: %s", e)
+            db.set_image_status(image['image_id'], "open")
             update.message.reply_text(f"Error forwarding to Group B: {e}")
     except Exception as e:
-        logger.error(f"Error sending image: {e}")
+        logger.error("Error sending image: %s", e)
+        db.set_image_status(image['image_id'], "open")
         update.message.reply_text(f"Error sending image: {e}")
 
 def handle_general_group_b_message(update: Update, context: CallbackContext) -> None:
@@ -1267,7 +1638,7 @@ def handle_general_group_b_message(update: Update, context: CallbackContext) ->
     text = update.message.text.strip()
     user = update.effective_user.username or update.effective_user.first_name
     
-    logger.info(f"General handler received: '{text}' from {user} (msg_id: {message_id})")
+    logger.info("General handler received: '%s' from %s (msg_id: %s)", text, user, message_id)
     
     # Extract numbers from text
     numbers = re.findall(r'\d+', text)
@@ -1275,19 +1646,19 @@ def handle_general_group_b_message(update: Update, context: CallbackContext) ->
         logger.info("No numbers found in message, ignoring")
         return
     
-    logger.info(f"Extracted numbers: {numbers}")
+    logger.info("Extracted numbers: %s", numbers)
     
     # Try with each extracted number
     for number in numbers:
         # 1. FIRST APPROACH: Try to find match by reply
         if update.message.reply_to_message:
             reply_msg_id = update.message.reply_to_message.message_id
-            logger.info(f"Message is a reply to message_id: {reply_msg_id}")
+            logger.info("Message is a reply to message_id: %s", reply_msg_id)
             
             # Look for the image that corresponds to this reply
             for img_id, msg_data in forwarded_msgs.items():
                 if msg_data.get('group_b_msg_id') == reply_msg_id:
-                    logger.info(f"Found matching image by reply: {img_id}")
+                    logger.info("Found matching image by reply: %s", img_id)
                     
                     # Create appropriate text with + if needed
                     response_text = f"+{number}" if "+" not in text else text
@@ -1301,10 +1672,10 @@ def handle_general_group_b_message(update: Update, context: CallbackContext) ->
             amount = msg_data.get('amount')
             group_num = msg_data.get('number')
             
-            logger.info(f"Checking image {img_id}: amount={amount}, number={group_num}")
+            logger.debug("Checking image %s: amount=%s, number=%s", img_id, amount, group_num)
             
             if number == amount:
-                logger.info(f"Found match by amount: {img_id}")
+                logger.info("Found match by amount: %s", img_id)
                 
                 # Create appropriate text with + if needed
                 response_text = f"+{number}" if "+" not in text else text
@@ -1313,7 +1684,7 @@ def handle_general_group_b_message(update: Update, context: CallbackContext) ->
                 return
             
             if number == group_num:
-                logger.info(f"Found match by group number: {img_id}")
+                logger.info("Found match by group number: %s", img_id)
                 
                 # Create appropriate text with + if needed
                 response_text = f"+{number}" if "+" not in text else text
@@ -1332,7 +1703,7 @@ def handle_general_group_b_message(update: Update, context: CallbackContext) ->
         
         if recent_msgs:
             img_id, msg_data = recent_msgs[0]
-            logger.info(f"No match found, using most recent message: {img_id}")
+            logger.info("No match found, using most recent message: %s", img_id)
             
             # Create appropriate text with + if needed
             response_text = f"+{number}" if "+" not in text else text
@@ -1349,7 +1720,7 @@ def forward_message_to_group_b(update: Update, context: CallbackContext, img_id,
     chat_id = update.effective_chat.id
     message_id = update.message.message_id
     
-    logger.info(f"Forwarding to Group B - img_id: {img_id}, amount: {amount}, number: {number}")
+    logger.info("Forwarding to Group B - img_id: %s, amount: %s, number: %s", img_id, amount, number)
     
     # Check if it's in the format we're expecting
     if not all([img_id, amount, number]):
@@ -1360,7 +1731,7 @@ def forward_message_to_group_b(update: Update, context: CallbackContext, img_id,
         # Get image from database
         image = db.get_image_by_id(img_id)
         if not image:
-            logger.error(f"No image found for ID {img_id}")
+            logger.error("No image found for ID %s", img_id)
             return
         
         # Get the metadata
@@ -1378,13 +1749,14 @@ def forward_message_to_group_b(update: Update, context: CallbackContext, img_id,
             text=message_text
         )
         
-        logger.info(f"Forwarded message for image {img_id} to Group B {target_group_b_id}")
+        logger.info("Forwarded message for image %s to Group B %s", img_id, target_group_b_id)
         
         # Store the mapping
         forwarded_msgs[img_id] = {
             'group_a_chat_id': chat_id,
             'group_a_msg_id': message_id,
             'group_b_chat_id': target_group_b_id,
+            'forwarded_at': time.time(),  # For routing_policy ack latency
             'group_b_msg_id': forwarded.message_id,
             'image_id': img_id,
             'amount': amount,
@@ -1392,62 +1764,51 @@ def forward_message_to_group_b(update: Update, context: CallbackContext, img_id,
             'original_user_id': update.effective_user.id,
             'original_message_id': message_id
         }
+        ROUTING.load.dispatched(target_group_b_id, img_id)
         
         # Save the mapping
         save_persistent_data()
         
         # Mark the image as closed
         db.set_image_status(img_id, "closed")
-        logger.info(f"Image {img_id} status set to closed")
+        logger.info("Image %s status set to closed", img_id)
         
     except Exception as e:
-        logger.error(f"Error forwarding to Group B: {e}")
+        logger.error("Error forwarding to Group B: %s", e)
         update.message.reply_text(f"Error forwarding to Group B: {e}")
 
 def handle_set_group_a(update: Update, context: CallbackContext) -> None:
     """Handle setting a group as Group A."""
-    global dispatcher
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
     # Check if user is a global admin
     if not is_global_admin(user_id):
-        logger.info(f"User {user_id} tried to set group as Group A but is not a global admin")
+        logger.info("User %s tried to set group as Group A but is not a global admin", user_id)
         update.message.reply_text("只有全局管理员可以设置群聊类型。")
         return
     
     # Add this chat to Group A - ensure we're storing as integer
-    GROUP_A_IDS.add(int(chat_id))
-    save_config_data()
-    
-    # Reload handlers to pick up the new group
-    if dispatcher:
-        register_handlers(dispatcher)
+    CONFIG.modify(lambda config: config._replace(group_a_ids=config.group_a_ids | {int(chat_id)}))
     
-    logger.info(f"Group {chat_id} set as Group A by user {user_id}")
+    logger.info("Group %s set as Group A by user %s", chat_id, user_id)
     # Notification removed
 
 def handle_set_group_b(update: Update, context: CallbackContext) -> None:
     """Handle setting a group as Group B."""
-    global dispatcher
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
     # Check if user is a global admin
     if not is_global_admin(user_id):
-        logger.info(f"User {user_id} tried to set group as Group B but is not a global admin")
+        logger.info("User %s tried to set group as Group B but is not a global admin", user_id)
         update.message.reply_text("只有全局管理员可以设置群聊类型。")
         return
     
     # Add this chat to Group B - ensure we're storing as integer
-    GROUP_B_IDS.add(int(chat_id))
-    save_config_data()
-    
-    # Reload handlers to pick up the new group
-    if dispatcher:
-        register_handlers(dispatcher)
+    CONFIG.modify(lambda config: config._replace(group_b_ids=config.group_b_ids | {int(chat_id)}))
     
-    logger.info(f"Group {chat_id} set as Group B by user {user_id}")
+    logger.info("Group %s set as Group B by user %s", chat_id, user_id)
     # Notification removed
 
 def handle_promote_group_admin(update: Update, context: CallbackContext) -> None:
@@ -1457,7 +1818,7 @@ def handle_promote_group_admin(update: Update, context: CallbackContext) -> None
     
     # Check if user is a global admin
     if not is_global_admin(user_id):
-        logger.info(f"User {user_id} tried to promote a group admin but is not a global admin")
+        logger.info("User %s tried to promote a group admin but is not a global admin", user_id)
         return
     
     # Check if replying to a user
@@ -1473,87 +1834,92 @@ def handle_promote_group_admin(update: Update, context: CallbackContext) -> None
     add_group_admin(target_user_id, chat_id)
     
     update.message.reply_text(f"👑 已将用户 {target_user_name} 设置为群操作人。")
-    logger.info(f"User {target_user_id} promoted to group admin in chat {chat_id} by user {user_id}")
+    logger.info("User %s promoted to group admin in chat %s by user %s", target_user_id, chat_id, user_id)
 
 def handle_set_group_image(update: Update, context: CallbackContext) -> None:
     """Handle setting an image for a specific group number."""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
-    logger.info(f"Image setting attempt in chat {chat_id} by user {user_id}")
+    # Photos of an album are set together once the whole album has arrived
+    if update.message.media_group_id:
+        collect_album_photo(update, context)
+        return
+    
+    logger.info("Image setting attempt in chat %s by user %s", chat_id, user_id)
     
     # Debug registered Group B chats
-    logger.info(f"Current Group B chats: {GROUP_B_IDS}")
+    logger.debug("Current Group B chats: %s", CONFIG.current.group_b_ids)
     
     # Check if this is a Group B chat
-    if chat_id not in GROUP_B_IDS:
-        logger.warning(f"User tried to set image in non-Group B chat: {chat_id}")
+    if chat_id not in CONFIG.current.group_b_ids:
+        logger.warning("User tried to set image in non-Group B chat: %s", chat_id)
         update.message.reply_text("此群聊未设置为需方群 (Group B)，请联系全局管理员设置。")
         return
     
     # Debug admin status
     is_admin = is_group_admin(user_id, chat_id)
     is_global = is_global_admin(user_id)
-    logger.info(f"User {user_id} is group admin: {is_admin}, is global admin: {is_global}")
+    logger.info("User %s is group admin: %s, is global admin: %s", user_id, is_admin, is_global)
     
     # Debug group admins for this chat
-    if chat_id in GROUP_ADMINS:
-        logger.info(f"Group admins for chat {chat_id}: {GROUP_ADMINS[chat_id]}")
+    if chat_id in CONFIG.current.group_admins:
+        logger.info("Group admins for chat %s: %s", chat_id, CONFIG.current.group_admins[chat_id])
     else:
-        logger.info(f"No group admins registered for chat {chat_id}")
+        logger.info("No group admins registered for chat %s", chat_id)
     
     # For testing, allow all users to set images temporarily
     allow_all_users = False  # Set to True for debugging
     
     # Check if user is a group admin or global admin
     if not allow_all_users and not is_group_admin(user_id, chat_id) and not is_global_admin(user_id):
-        logger.warning(f"User {user_id} tried to set image but is not an admin")
+        logger.warning("User %s tried to set image but is not an admin", user_id)
         update.message.reply_text("只有群操作人可以设置图片。请联系管理员。")
         return
     
     # Check if message has a photo
     if not update.message.photo:
-        logger.warning(f"No photo in message")
+        logger.warning("No photo in message")
         update.message.reply_text("请发送一张图片并备注'设置群 {number}'。")
         return
     
     # Debug caption
     caption = update.message.caption or ""
-    logger.info(f"Caption: '{caption}'")
+    logger.info("Caption: '%s'", caption)
     
     # Extract group number from message text
     match = re.search(r'设置群\s*(\d+)', caption)
     if not match:
-        logger.warning(f"Caption doesn't match pattern: '{caption}'")
+        logger.warning("Caption doesn't match pattern: '%s'", caption)
         update.message.reply_text("请使用正确的格式：设置群 {number}")
         return
     
     group_number = match.group(1)
-    logger.info(f"Setting image for group {group_number}")
+    logger.info("Setting image for group %s", group_number)
     
     # Get the file_id of the image
-    file_id = update.message.photo[-1].file_id
-    image_id = f"img_{int(time.time())}"  # Use timestamp for unique ID
+    photo = update.message.photo[-1]
+    file_id = photo.file_id
     
     # Store which Group B chat this image came from
     source_group_b_id = int(chat_id)  # Explicitly convert to int to ensure consistent type
-    logger.info(f"Setting image source Group B ID: {source_group_b_id}")
+    logger.info("Setting image source Group B ID: %s", source_group_b_id)
     
     # Find a target Group A for this Group B
     target_group_a_id = None
     
     # First, check if we have a specific Group A that corresponds to this Group B
     # For simplicity, we'll use the first Group A in the list
-    if GROUP_A_IDS:
-        target_group_a_id = next(iter(GROUP_A_IDS))
+    if CONFIG.current.group_a_ids:
+        target_group_a_id = next(iter(CONFIG.current.group_a_ids))
     else:
         target_group_a_id = GROUP_A_ID
     
-    logger.info(f"Setting image target Group A ID: {target_group_a_id}")
+    logger.info("Setting image target Group A ID: %s", target_group_a_id)
     
     # Debug image data
-    logger.info(f"Image data - ID: {image_id}, file_id: {file_id}, group: {group_number}")
-    logger.info(f"Source Group B: {source_group_b_id}, Target Group A: {target_group_a_id}")
+    logger.info("Image data - file_id: %s, group: %s", file_id, group_number)
+    logger.info("Source Group B: %s, Target Group A: %s", source_group_b_id, target_group_a_id)
     
     # Save the image with additional metadata
     try:
@@ -1566,24 +1932,111 @@ def handle_set_group_image(update: Update, context: CallbackContext) -> None:
         # Convert to JSON string
         metadata = json.dumps(metadata_dict)
         
-        logger.info(f"Saving image with metadata: {metadata}")
+        logger.info("Saving image with metadata: %s", metadata)
         
-        success = db.add_image(image_id, int(group_number), file_id, metadata=metadata)
-        if success:
+        result = db.add_images([{'number': int(group_number), 'file_id': file_id,
+                                 'file_unique_id': photo.file_unique_id, 'metadata': metadata}])
+        image_id, added = result[0] if result else (None, False)
+        if added:
             # Double check that the image was set correctly
             saved_image = db.get_image_by_id(image_id)
             if saved_image and 'metadata' in saved_image:
-                logger.info(f"Verified image metadata: {saved_image['metadata']}")
+                logger.info("Verified image metadata: %s", saved_image['metadata'])
             
-            logger.info(f"Successfully added image {image_id} for group {group_number}")
+            logger.info("Successfully added image %s for group %s", image_id, group_number)
             update.message.reply_text(f"✅ 已设置群聊为{group_number}群")
+            
+            # Keep a local copy in case the file_id stops working
+            store_image_copy(context.bot, image_id, file_id)
+        elif image_id:
+            logger.warning("Photo for group %s is already set as image %s", group_number, image_id)
+            update.message.reply_text(f"该图片已设置过（{image_id}），无需重复设置。")
         else:
-            logger.error(f"Failed to add image {image_id} for group {group_number}")
+            logger.error("Failed to add image for group %s", group_number)
             update.message.reply_text("设置图片失败，该图片可能已存在。请重试。")
     except Exception as e:
-        logger.error(f"Exception when adding image: {e}")
+        logger.error("Exception when adding image: %s", e)
         update.message.reply_text(f"设置图片时出错: {str(e)}")
 
+def collect_album_photo(update: Update, context: CallbackContext) -> None:
+    """Hold a photo of an album until ALBUM_COLLECT_SECONDS after the album's last photo, then set the album."""
+    message = update.message
+    key = (message.chat_id, message.media_group_id)
+    with pending_albums_lock:
+        album = pending_albums.setdefault(key, {'messages': []})
+        album['messages'].append(message)
+        if 'timer' in album:
+            album['timer'].cancel()
+        album['timer'] = threading.Timer(ALBUM_COLLECT_SECONDS, set_album_images, args=(context.bot, key))
+        album['timer'].daemon = True
+        album['timer'].start()
+
+def set_album_images(bot, key) -> None:
+    """Set every photo of a complete album if one carries "设置群 N" (all N) or "设置群 N-M" (one number each)."""
+    with pending_albums_lock:
+        album = pending_albums.pop(key, None)
+    if album is None:
+        return
+    chat_id, media_group_id = key
+    messages = sorted(album['messages'], key=lambda m: m.message_id)
+    captioned = next((m for m in messages if m.caption and SET_GROUP_IMAGE_RE.search(m.caption)), None)
+    if captioned is None:
+        logger.debug("Album %s in chat %s has no set-image caption", media_group_id, chat_id)
+        return
+    
+    def reply(text):
+        bot.send_message(chat_id, text, reply_to_message_id=captioned.message_id)
+    
+    try:
+        user_id = captioned.from_user.id
+        logger.info("Album of %s photos in chat %s by user %s: '%s'", len(messages), chat_id, user_id,
+                    captioned.caption)
+        if chat_id not in CONFIG.current.group_b_ids:
+            reply("此群聊未设置为需方群 (Group B)，请联系全局管理员设置。")
+            return
+        if not is_group_admin(user_id, chat_id) and not is_global_admin(user_id):
+            reply("只有群操作人可以设置图片。请联系管理员。")
+            return
+        
+        match = SET_GROUP_IMAGE_RANGE_RE.search(captioned.caption)
+        first = int(match.group(1))
+        if match.group(2) is None:
+            label = str(first)
+            numbers = [first] * len(messages)
+        else:
+            label = f"{first}-{match.group(2)}"
+            numbers = list(range(first, int(match.group(2)) + 1))
+            if len(numbers) != len(messages):
+                reply(f"相册有{len(messages)}张图片，但群号{label}对应{len(numbers)}个群，请重新发送。")
+                return
+        
+        metadata = group_image_metadata(chat_id)
+        photos = [m.photo[-1] for m in messages]
+        result = db.add_images([
+            {'number': number, 'file_id': photo.file_id, 'file_unique_id': photo.file_unique_id, 'metadata': metadata}
+            for number, photo in zip(numbers, photos)
+        ])
+        if result is None:
+            reply("设置图片失败，请重试。")
+            return
+        added = [(image_id, photo) for (image_id, new), photo in zip(result, photos) if new]
+        text = f"✅ 已设置{len(added)}张图片为{label}群"
+        if len(added) < len(result):
+            text += f"（{len(result) - len(added)}张已设置过，已跳过）"
+        reply(text)
+        
+        # Keep local copies in case the file_ids stop working
+        for image_id, photo in added:
+            store_image_copy(bot, image_id, photo.file_id)
+    except Exception as e:
+        logger.error("Error setting album %s in chat %s: %s", media_group_id, chat_id, e)
+
+def group_image_metadata(chat_id) -> str:
+    """Metadata JSON for an image set in Group B `chat_id`: its source and the Group A it serves."""
+    # For simplicity, images serve the first Group A in the list
+    target_group_a_id = next(iter(CONFIG.current.group_a_ids)) if CONFIG.current.group_a_ids else GROUP_A_ID
+    return json.dumps({'source_group_b_id': int(chat_id), 'target_group_a_id': target_group_a_id})
+
 def handle_custom_amount(update: Update, context: CallbackContext, img_id, msg_data, number) -> None:
     """Handle custom amount that needs approval."""
     chat_id = update.effective_chat.id
@@ -1593,7 +2046,7 @@ def handle_custom_amount(update: Update, context: CallbackContext, img_id, msg_d
     message_id = update.message.message_id
     reply_to_message_id = update.message.reply_to_message.message_id if update.message.reply_to_message else None
     
-    logger.info(f"Custom amount detected: {number}")
+    logger.info("Custom amount detected: %s", number)
     
     # Store the custom amount approval with more detailed info
     pending_custom_amounts[message_id] = {
@@ -1612,14 +2065,14 @@ def handle_custom_amount(update: Update, context: CallbackContext, img_id, msg_d
     
     # Create mention tags for global admins
     admin_mentions = ""
-    for admin_id in GLOBAL_ADMINS:
+    for admin_id in CONFIG.current.global_admins:
         try:
             # Get admin chat member info to get username or first name
             admin_user = context.bot.get_chat_member(chat_id, admin_id).user
             admin_name = admin_user.username or admin_user.first_name
             admin_mentions += f"@{admin_name} "
         except Exception as e:
-            logger.error(f"Error getting admin info for ID {admin_id}: {e}")
+            logger.error("Error getting admin info for ID %s: %s", admin_id, e)
     
     # Send notification in Group B about pending approval, including admin mentions
     notification_text = f"👤 用户 {user_name} 提交的自定义金额 +{number} 需要全局管理员确认 {admin_mentions}"
@@ -1628,7 +2081,7 @@ def handle_custom_amount(update: Update, context: CallbackContext, img_id, msg_d
     # No longer sending confirmation to user
     
     # Notify all global admins about the pending approval
-    for admin_id in GLOBAL_ADMINS:
+    for admin_id in CONFIG.current.global_admins:
         try:
             # Try to send private message to global admin
             original_amount = msg_data.get('amount')
@@ -1650,9 +2103,9 @@ def handle_custom_amount(update: Update, context: CallbackContext, img_id, msg_d
                 chat_id=admin_id,
                 text=notification_text
             )
-            logger.info(f"Sent approval notification to admin {admin_id}")
+            logger.info("Sent approval notification to admin %s", admin_id)
         except Exception as e:
-            logger.error(f"Failed to notify admin {admin_id}: {e}")
+            logger.error("Failed to notify admin %s: %s", admin_id, e)
 
 # Add this new function to handle global admin approvals
 def handle_custom_amount_approval(update: Update, context: CallbackContext) -> None:
@@ -1662,14 +2115,15 @@ def handle_custom_amount_approval(update: Update, context: CallbackContext) -> N
     
     # Check if user is a global admin
     if not is_global_admin(user_id):
-        logger.info(f"User {user_id} tried to approve custom amount but is not a global admin")
+        logger.info("User %s tried to approve custom amount but is not a global admin", user_id)
         return
     
-    # Check if this is a reply and contains "同意" or "确认"
-    if not update.message.reply_to_message or not any(word in update.message.text for word in ["同意", "确认"]):
+    # Check if this is a reply saying "同意" or "确认"
+    parsed = get_classification(update, context)
+    if not update.message.reply_to_message or parsed.kind != message_classifier.APPROVAL:
         return
     
-    logger.info(f"Global admin {user_id} approval attempt detected")
+    logger.info("Global admin %s approval attempt detected", user_id)
     
     # If we're in a private chat, this is likely a reply to the notification
     # So we need to find the latest pending custom amount
@@ -1685,7 +2139,7 @@ def handle_custom_amount_approval(update: Update, context: CallbackContext) -> N
         most_recent_msg_id = max(pending_custom_amounts.keys())
         approval_data = pending_custom_amounts[most_recent_msg_id]
         
-        logger.info(f"Found most recent pending custom amount: {approval_data}")
+        logger.info("Found most recent pending custom amount: %s", most_recent_msg_id)
         
         # Process the approval
         process_custom_amount_approval(update, context, most_recent_msg_id, approval_data)
@@ -1693,29 +2147,26 @@ def handle_custom_amount_approval(update: Update, context: CallbackContext) -> N
     
     # If we're in a group chat, check if this is a reply to a custom amount message
     reply_msg_id = update.message.reply_to_message.message_id
-    logger.info(f"Checking if message {reply_msg_id} has a pending approval")
+    logger.info("Checking if message %s has a pending approval", reply_msg_id)
     
-    # Debug all pending custom amounts to check what's stored
-    logger.info(f"All pending custom amounts: {pending_custom_amounts}")
+    logger.debug("%d pending custom amounts", len(pending_custom_amounts))
     
     # First, check if the message being replied to is directly in pending_custom_amounts
     if reply_msg_id in pending_custom_amounts:
-        logger.info(f"Found direct match for message {reply_msg_id}")
+        logger.info("Found direct match for message %s", reply_msg_id)
         approval_data = pending_custom_amounts[reply_msg_id]
         process_custom_amount_approval(update, context, reply_msg_id, approval_data)
         return
     
     # If not, search through all pending approvals
     for msg_id, data in pending_custom_amounts.items():
-        logger.info(f"Checking pending approval {msg_id} with data {data}")
-        
         # Check if any of the stored message IDs match
         if (data.get('original_msg_id') == reply_msg_id or 
             str(data.get('original_msg_id')) == str(reply_msg_id) or
             data.get('reply_to_msg_id') == reply_msg_id or
             str(data.get('reply_to_msg_id')) == str(reply_msg_id)):
             
-            logger.info(f"Found matching pending approval through message ID comparison: {msg_id}")
+            logger.info("Found matching pending approval through message ID comparison: %s", msg_id)
             process_custom_amount_approval(update, context, msg_id, data)
             return
     
@@ -1724,53 +2175,51 @@ def handle_custom_amount_approval(update: Update, context: CallbackContext) -> N
     for msg_id, data in pending_custom_amounts.items():
         custom_amount = data.get('amount')
         if f"+{custom_amount}" in reply_message_text:
-            logger.info(f"Found matching pending approval through message content: {msg_id}")
+            logger.info("Found matching pending approval through message content: %s", msg_id)
             process_custom_amount_approval(update, context, msg_id, data)
             return
     
-    logger.info(f"No pending approval found for message ID: {reply_msg_id}")
+    logger.info("No pending approval found for message ID: %s", reply_msg_id)
     update.message.reply_text("⚠️ 没有找到此消息的待审批记录。请检查是否回复了正确的消息。")
 
 def process_custom_amount_approval(update, context, msg_id, approval_data):
     """Process a custom amount approval."""
-    global FORWARDING_ENABLED
     img_id = approval_data['img_id']
     custom_amount = approval_data['amount']
     approver_id = update.effective_user.id
     approver_name = update.effective_user.username or update.effective_user.first_name
     
-    logger.info(f"Processing approval for image {img_id} with custom amount {custom_amount}")
-    logger.info(f"Approval by {approver_name} (ID: {approver_id})")
-    logger.info(f"Full approval data: {approval_data}")
+    logger.info("Processing approval for image %s with custom amount %s", img_id, custom_amount)
+    logger.info("Approval by %s (ID: %s)", approver_name, approver_id)
     
     # Get the corresponding forwarded message data
     if img_id in forwarded_msgs:
         msg_data = forwarded_msgs[img_id]
-        logger.info(f"Found forwarded message data: {msg_data}")
         
         # Process the custom amount like a regular response
         response_text = f"+{custom_amount}"
         
         # Save the response
         group_b_responses[img_id] = response_text
-        logger.info(f"Stored custom amount response: {response_text}")
+        logger.info("Stored custom amount response: %s", response_text)
         
         # Save responses
         save_persistent_data()
         
         # Mark the image as open
         db.set_image_status(img_id, "open")
-        logger.info(f"Set image {img_id} status to open after custom amount approval")
+        ROUTING.load.acknowledged(img_id)
+        logger.info("Set image %s status to open after custom amount approval", img_id)
         
         # Send response to Group A only if forwarding is enabled
-        if FORWARDING_ENABLED:
+        if CONFIG.current.forwarding_enabled:
             if 'group_a_chat_id' in msg_data and 'group_a_msg_id' in msg_data:
                 try:
                     # Get the original message ID if available
                     original_message_id = msg_data.get('original_message_id')
                     reply_to_message_id = original_message_id if original_message_id else msg_data['group_a_msg_id']
                     
-                    logger.info(f"Sending response to Group A - chat_id: {msg_data['group_a_chat_id']}, reply_to: {reply_to_message_id}")
+                    logger.info("Sending response to Group A - chat_id: %s, reply_to: %s", msg_data['group_a_chat_id'], reply_to_message_id)
                     
                     # Send response back to Group A
                     sent_msg = safe_send_message(
@@ -1781,15 +2230,15 @@ def process_custom_amount_approval(update, context, msg_id, approval_data):
                     )
                     
                     if sent_msg:
-                        logger.info(f"Successfully sent custom amount response to Group A: {response_text}")
+                        logger.info("Successfully sent custom amount response to Group A: %s", response_text)
                     else:
                         logger.warning("safe_send_message completed but did not return a message object")
                 except Exception as e:
-                    logger.error(f"Error sending custom amount response to Group A: {e}")
+                    logger.error("Error sending custom amount response to Group A: %s", e)
                     update.message.reply_text(f"金额已批准，但发送到需方群失败: {e}")
                     return
             else:
-                logger.error(f"Missing group_a_chat_id or group_a_msg_id in msg_data: {msg_data}")
+                logger.error("Missing group_a_chat_id or group_a_msg_id in msg_data: %s", msg_data)
                 update.message.reply_text("金额已批准，但找不到需方群的消息信息，无法发送回复。")
                 return
         else:
@@ -1807,13 +2256,16 @@ def process_custom_amount_approval(update, context, msg_id, approval_data):
                         text=f"✅ 金额确认修改：+{custom_amount} (由管理员 {approver_name} 批准)",
                         reply_to_message_id=approval_data.get('reply_to_msg_id')
                     )
-                    logger.info(f"Sent confirmation message in Group B about approved amount {custom_amount}")
+                    logger.info("Sent confirmation message in Group B about approved amount %s", custom_amount)
                 except Exception as e:
-                    logger.error(f"Error sending confirmation to Group B: {e}")
+                    logger.error("Error sending confirmation to Group B: %s", e)
         else:
             # If approved in group chat (Group B), send confirmation in the same chat
             update.message.reply_text(f"✅ 金额确认修改：+{custom_amount}")
-            logger.info(f"Sent confirmation message in Group B about approved amount {custom_amount}")
+            logger.info("Sent confirmation message in Group B about approved amount %s", custom_amount)
+        
+        # The reopened image can go to a waiting Group A request
+        serve_waiting_requests(context)
         
         # Remove the admin confirmation message
         # No longer sending "自定义金额 X 已批准，并已发送到群A"
@@ -1821,13 +2273,13 @@ def process_custom_amount_approval(update, context, msg_id, approval_data):
         # Delete the pending approval
         if msg_id in pending_custom_amounts:
             del pending_custom_amounts[msg_id]
-            logger.info(f"Deleted pending approval with ID {msg_id}")
+            logger.info("Deleted pending approval with ID %s", msg_id)
             save_persistent_data()
         else:
-            logger.warning(f"Tried to delete non-existent pending approval with ID {msg_id}")
+            logger.warning("Tried to delete non-existent pending approval with ID %s", msg_id)
         
     else:
-        logger.error(f"Image {img_id} not found in forwarded_msgs")
+        logger.error("Image %s not found in forwarded_msgs", img_id)
         update.message.reply_text("无法找到相关图片信息，批准失败。")
 
 # Add this function to display global admins
@@ -1842,7 +2294,7 @@ def admin_list_command(update: Update, context: CallbackContext) -> None:
     
     # Format the list of global admins
     admin_list = []
-    for admin_id in GLOBAL_ADMINS:
+    for admin_id in CONFIG.current.global_admins:
         try:
             # Try to get admin's username
             chat = context.bot.get_chat(admin_id)
@@ -1861,125 +2313,33 @@ def handle_group_b_reset_images(update: Update, context: CallbackContext) -> Non
     """Handle the command to reset all images in Group B."""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    message_text = update.message.text.strip()
+    parsed = get_classification(update, context)
     
     # Check if this is Group B
-    if chat_id not in GROUP_B_IDS and chat_id != GROUP_B_ID:
-        logger.info(f"Reset images command used in non-Group B chat: {chat_id}")
+    if chat_id not in CONFIG.current.group_b_ids and chat_id != GROUP_B_ID:
+        logger.info("Reset images command used in non-Group B chat: %s", chat_id)
         return
     
     # Check if the message is exactly "重置群码"
-    if message_text != "重置群码":
+    if parsed.kind != message_classifier.RESET_ALL:
         return
     
     # Check if user is a group admin or global admin
     if not is_group_admin(user_id, chat_id) and not is_global_admin(user_id):
-        logger.info(f"User {user_id} tried to reset images but is not an admin")
+        logger.info("User %s tried to reset images but is not an admin", user_id)
         update.message.reply_text("只有群操作人或全局管理员可以重置群码。")
         return
     
-    logger.info(f"Admin {user_id} is resetting images in Group B: {chat_id}")
-    
-    # Get current image count for this specific Group B for reporting
-    all_images = db.get_all_images()
-    logger.info(f"Total images in database before reset: {len(all_images)}")
-    
-    # Count images associated with this Group B
-    group_b_images = []
-    if all_images:
-        for img in all_images:
-            metadata = img.get('metadata', {})
-            if isinstance(metadata, str):
-                try:
-                    metadata = json.loads(metadata)
-                except:
-                    metadata = {}
-                    
-            if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-                try:
-                    if int(metadata['source_group_b_id']) == int(chat_id):
-                        group_b_images.append(img)
-                except (ValueError, TypeError) as e:
-                    logger.error(f"Error comparing Group B IDs: {e}")
-    
-    image_count = len(group_b_images)
-    logger.info(f"Found {image_count} images associated with Group B {chat_id}")
+    logger.info("Admin %s is resetting images in Group B: %s", user_id, chat_id)
     
-    # Backup the existing images before deleting
-    backup_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_file = f"images_backup_{backup_time}.json"
-    
-    try:
-        with open(backup_file, 'w') as f:
-            json.dump(group_b_images, f, indent=2)
-        logger.info(f"Backed up {image_count} images for Group B {chat_id} to {backup_file}")
-    except Exception as e:
-        logger.error(f"Error backing up images: {e}")
-    
-    # Delete only images from this Group B
-    try:
-        # Use our new function to delete only images from this Group B
-        success = db.clear_images_by_group_b(chat_id)
-        
-        # Also clear related message mappings for this Group B
-        global forwarded_msgs, group_b_responses
-        
-        # Filter out messages related to this Group B
-        if forwarded_msgs:
-            # Create a new dict to avoid changing size during iteration
-            new_forwarded_msgs = {}
-            for msg_id, data in forwarded_msgs.items():
-                # If the message was sent to this Group B, remove it
-                if 'group_b_chat_id' in data and int(data['group_b_chat_id']) != int(chat_id):
-                    new_forwarded_msgs[msg_id] = data
-                else:
-                    logger.info(f"Removing forwarded message mapping for {msg_id}")
-            
-            forwarded_msgs = new_forwarded_msgs
-        
-        # Same for group_b_responses
-        if group_b_responses:
-            new_group_b_responses = {}
-            for msg_id, data in group_b_responses.items():
-                if 'chat_id' in data and int(data['chat_id']) != int(chat_id):
-                    new_group_b_responses[msg_id] = data
-            group_b_responses = new_group_b_responses
-        
-        save_persistent_data()
-        
-        # Check if all images for this Group B were actually deleted
-        remaining_images = db.get_all_images()
-        remaining_for_group_b = []
-        
-        for img in remaining_images:
-            metadata = img.get('metadata', {})
-            if isinstance(metadata, str):
-                try:
-                    metadata = json.loads(metadata)
-                except:
-                    metadata = {}
-                    
-            if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-                try:
-                    if int(metadata['source_group_b_id']) == int(chat_id):
-                        remaining_for_group_b.append(img)
-                except (ValueError, TypeError) as e:
-                    logger.error(f"Error comparing Group B IDs: {e}")
-        
-        if success:
-            if not remaining_for_group_b:
-                logger.info(f"Successfully cleared {image_count} images for Group B: {chat_id}")
-                update.message.reply_text(f"🔄 已重置所有群码! 共清除了 {image_count} 个图片。")
-            else:
-                # Some images still exist for this Group B
-                logger.warning(f"Reset didn't clear all images. {len(remaining_for_group_b)} images still remain for Group B {chat_id}")
-                update.message.reply_text(f"⚠️ 群码重置部分完成。已清除 {image_count - len(remaining_for_group_b)} 个图片，但还有 {len(remaining_for_group_b)} 个图片未能清除。")
-        else:
-            logger.error(f"Failed to clear images for Group B: {chat_id}")
-            update.message.reply_text("重置群码时出错，请查看日志。")
-    except Exception as e:
-        logger.error(f"Error clearing images: {e}")
-        update.message.reply_text(f"重置群码时出错: {e}")
+    # A new generation hides the pool at once; the purge thread backs it up and deletes it
+    generation = db.reset_group_b(chat_id)
+    if generation is None:
+        logger.error("Failed to reset images for Group B: %s", chat_id)
+        update.message.reply_text("重置群码时出错，请查看日志。")
+        return
+    generation_purge_wakeup.set()
+    update.message.reply_text("🔄 已重置所有群码! 旧图片已失效，将在后台备份并清理。")
 
 def set_image_group_b(update: Update, context: CallbackContext) -> None:
     """Set which Group B an image should be associated with."""
@@ -2084,17 +2444,85 @@ dispatcher = None
 # Define error handler at global scope
 def error_handler(update, context):
     """Log errors caused by updates."""
-    logger.error(f"Update {update} caused error: {context.error}")
+    logger.error("Update %s caused error: %s", update, context.error)
     # If it's a network error, just log it
     if isinstance(context.error, (NetworkError, TimedOut, RetryAfter)):
-        logger.error(f"Network error: {context.error}")
+        logger.error("Network error: %s", context.error)
 
-def register_handlers(dispatcher):
-    """Register all message handlers. Called at startup and when groups change."""
+# Message patterns used by classify_message
+ADMIN_SEND_IMAGE_RE = re.compile(r'^发图')
+SET_GROUP_IMAGE_RE = re.compile(r'设置群\s*\d+')
+# Album captions may give a range, one group number per photo
+SET_GROUP_IMAGE_RANGE_RE = re.compile(r'设置群\s*(\d+)(?:\s*-\s*(\d+))?')
+SETTING_COMMANDS = {
+    '设置群聊A': 'set_group_a',
+    '设置群聊B': 'set_group_b',
+    '解散群聊': 'dissolve_group',
+}
+FORWARDING_COMMANDS = {'开启转发', '关闭转发', '转发状态'}
+
+def classify_message(update: Update) -> Optional[tuple]:
+    """Return (route key, classification) for a message, checking rules in the old handler order."""
+    message = update.effective_message
+    text = message.text
+    if not text:
+        if message.photo and message.caption and SET_GROUP_IMAGE_RE.search(message.caption):
+            return 'set_group_image', None
+        # Album photos after the first carry no caption; the album's caption is looked for once it is complete
+        if message.photo and message.media_group_id and message.chat_id in CONFIG.current.group_b_ids:
+            return 'set_group_image', None
+        return None
+    
+    parsed = message_classifier.classify(text)
+    route = None
+    
+    # Admin setup commands work in any chat
+    is_reply = message.reply_to_message is not None
+    if ADMIN_SEND_IMAGE_RE.match(parsed.text):
+        route = 'admin_send_image'
+    elif parsed.text in SETTING_COMMANDS:
+        route = SETTING_COMMANDS[parsed.text]
+    elif parsed.text == '设置操作人' and is_reply:
+        route = 'promote_group_admin'
+    else:
+        # Role comes from the live group sets, so changes apply immediately
+        role = chat_role(message.chat_id)
+        if role == "B" and parsed.kind == message_classifier.RESET_ALL:
+            route = 'group_b_reset_images'
+        elif role == "B" and parsed.kind == message_classifier.RESET_ONE:
+            route = 'reset_specific_image'
+        elif parsed.kind == message_classifier.APPROVAL and is_reply:
+            route = 'custom_amount_approval'
+        elif role == "B":
+            route = 'group_b_message'
+        elif is_reply and parsed.text == '群':
+            route = 'admin_reply'
+        elif is_reply and role == "A":
+            route = 'group_a_reply'
+        elif role == "A" and parsed.amount is not None:
+            route = 'group_a_message'
+        elif parsed.text in FORWARDING_COMMANDS:
+            route = 'toggle_forwarding'
+    
+    return (route, parsed) if route else None
+
+def get_classification(update: Update, context: CallbackContext):
+    """The router's classification of this message, or a fresh one when called directly."""
+    parsed = getattr(context, 'classification', None)
+    if parsed is None:
+        parsed = message_classifier.classify(update.message.text)
+    return parsed
+
+def register_handlers(dispatcher, track_offset=True):
+    """Register all handlers. Called once at startup; group changes need no re-registration."""
     # Clear existing handlers first - use proper way to clear handlers
     for group in list(dispatcher.handlers.keys()):
         dispatcher.handlers[group].clear()
     
+    # Record raw updates for replay.py before any handler sees them
+    if update_recorder.RECORDER is not None:
+        dispatcher.add_handler(TypeHandler(Update, update_recorder.RECORDER.record), group=-1)
+    
     # Add command handlers
     dispatcher.add_handler(CommandHandler("start", start))
     dispatcher.add_handler(CommandHandler("help", help_command))
@@ -2102,205 +2530,385 @@ def register_handlers(dispatcher):
     dispatcher.add_handler(CommandHandler("images", list_images))
     dispatcher.add_handler(CommandHandler("debug", debug_command))
     dispatcher.add_handler(CommandHandler("debug_metadata", debug_metadata))
+    dispatcher.add_handler(CommandHandler("stats", stats_command))
+    dispatcher.add_handler(CommandHandler("loglevel", log_level_command))
+    dispatcher.add_handler(CommandHandler("profile", profile_command))
+    dispatcher.add_handler(CommandHandler("profile_stop", profile_stop_command))
+    dispatcher.add_handler(CommandHandler("memsnap", memory_snapshot_command))
+    dispatcher.add_handler(CommandHandler("memdiff", memory_diff_command))
+    dispatcher.add_handler(CommandHandler("slow", slow_command))
     dispatcher.add_handler(CommandHandler("dreset", debug_reset_command))
     dispatcher.add_handler(CommandHandler("admin", register_admin_command))
     dispatcher.add_handler(CommandHandler("id", get_id_command))
     dispatcher.add_handler(CommandHandler("adminlist", admin_list_command))
     dispatcher.add_handler(CommandHandler("setimagegroup", set_image_group_b))
     
-    # Handler for admin image sending
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.regex(r'^发图'),
-        handle_admin_send_image,
-        run_async=True
-    ))
-    
-    # Handler for setting groups
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.regex(r'^设置群聊A$'),
-        handle_set_group_a,
-        run_async=True
-    ))
-    
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.regex(r'^设置群聊B$'),
-        handle_set_group_b,
-        run_async=True
-    ))
-    
-    # Handler for dissolving group settings
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.regex(r'^解散群聊$'),
-        handle_dissolve_group,
-        run_async=True
-    ))
-    
-    # Handler for promoting group admins
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.regex(r'^设置操作人$') & Filters.reply,
-        handle_promote_group_admin,
-        run_async=True
-    ))
-    
-    # Handler for setting images in Group B
-    dispatcher.add_handler(MessageHandler(
-        Filters.photo & Filters.caption_regex(r'设置群\s*\d+'),
-        handle_set_group_image,
-        run_async=True
-    ))
-    
-    # 1. Handle button callbacks (highest priority)
+    # 1. Handle button callbacks
     dispatcher.add_handler(CallbackQueryHandler(button_callback))
     
-    # 2. Add handler for resetting all images in Group B - moved to higher priority
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.regex(r'^重置群码$') & (Filters.chat(GROUP_B_ID) | Filters.chat(list(GROUP_B_IDS))),
-        handle_group_b_reset_images,
-        run_async=True
-    ))
-    
-    # 3. Add handler for resetting a specific image by number
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.regex(r'^重置群\d+$') & (Filters.chat(GROUP_B_ID) | Filters.chat(list(GROUP_B_IDS))),
-        handle_reset_specific_image,
-        run_async=True
-    ))
-    
-    # 4. Add handler for custom amount approval
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.regex(r'^(同意|确认)$') & Filters.reply,
-        handle_custom_amount_approval,
-        run_async=True
-    ))
-    
-    # 5. Group B message handling - single handler for everything
-    # Updated to support multiple Group B chats
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & (Filters.chat(GROUP_B_ID) | Filters.chat(list(GROUP_B_IDS))),
-        handle_all_group_b_messages,
-        run_async=True
-    ))
-    
-    # 6. Group A message handling
-    # First admin replies with '群'
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.reply & Filters.regex(r'^群$'),
-        handle_admin_reply,
-        run_async=True
-    ))
-    
-    # Then replies to bot messages in Group A
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.reply & (Filters.chat(GROUP_A_ID) | Filters.chat(list(GROUP_A_IDS))),
-        handle_group_a_reply,
-        run_async=True
-    ))
-    
-    # Simple number messages in Group A (Updated to support both "{number} 群" and pure number formats)
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & 
-        ~Filters.regex(r'^\+') &  # Exclude messages starting with +
-        ((Filters.regex(r'^\d+\s*群$') | Filters.regex(r'^\d+$')) &  # Match either number+群 or pure number 
-         (Filters.chat(GROUP_A_ID) | Filters.chat(list(GROUP_A_IDS)))),
-        handle_group_a_message,
-        run_async=True
-    ))
+    # Commands for forwarding control in private chat
+    dispatcher.add_handler(CommandHandler("forwarding_on", handle_toggle_forwarding, Filters.chat_type.private))
+    dispatcher.add_handler(CommandHandler("forwarding_off", handle_toggle_forwarding, Filters.chat_type.private))
+    dispatcher.add_handler(CommandHandler("forwarding_status", handle_toggle_forwarding, Filters.chat_type.private))
+    
+    # 2. Every other message goes through one router; see classify_message for the order
+    router = MessageRouter(classify_message, {
+        'admin_send_image': (handle_admin_send_image, True),
+        'set_group_a': (handle_set_group_a, True),
+        'set_group_b': (handle_set_group_b, True),
+        'dissolve_group': (handle_dissolve_group, True),
+        'promote_group_admin': (handle_promote_group_admin, True),
+        'set_group_image': (handle_set_group_image, True),
+        'group_b_reset_images': (handle_group_b_reset_images, True),
+        'reset_specific_image': (handle_reset_specific_image, True),
+        'custom_amount_approval': (handle_custom_amount_approval, True),
+        'group_b_message': (handle_all_group_b_messages, True),
+        'admin_reply': (handle_admin_reply, True),
+        'group_a_reply': (handle_group_a_reply, True),
+        'group_a_message': (handle_group_a_message, True),
+        'toggle_forwarding': (handle_toggle_forwarding, True),
+    }, run_async=UPDATE_OFFSET.run_async if track_offset else None)
+    # Routed handlers close images and send notifications; never run one twice for the same message
+    router.map_callbacks(idempotency.once)
+    dispatcher.add_handler(router)
+    
+    # Note the update_id once every handler group has seen the update; routed handlers hold it back until they
+    # return (the intake process notes it on hand-off in worker mode)
+    if track_offset:
+        dispatcher.add_handler(TypeHandler(Update, UPDATE_OFFSET.seen), group=1)
     
     # Add error handler
     dispatcher.add_error_handler(error_handler)
     
-    logger.info(f"Handlers registered with Group A IDs: {GROUP_A_IDS}, Group B IDs: {GROUP_B_IDS}")
+    logger.info("Handlers registered with Group A IDs: %s, Group B IDs: %s", CONFIG.current.group_a_ids, CONFIG.current.group_b_ids)
     
-    # Handler for toggling forwarding status - works in any chat for global admins
-    dispatcher.add_handler(MessageHandler(
-        Filters.text & (Filters.regex(r'^开启转发$') | Filters.regex(r'^关闭转发$') | Filters.regex(r'^转发状态$')),
-        handle_toggle_forwarding,
-        run_async=True
-    ))
+    # Time every handler registered above
+    instrument_handlers(dispatcher)
+
+def make_bot():
+    """Create the instrumented bot with generous timeouts."""
+    request_kwargs = {
+        'read_timeout': 60,        # Increased from 30
+        'connect_timeout': 60,     # Increased from 30
+        'con_pool_size': int(os.environ.get("CON_POOL_SIZE", "10")),  # Default is 1, increasing for better parallelism
+    }
+    # Use an instrumented bot so every Bot API call is timed
+    bot_kwargs = {'base_url': TELEGRAM_BASE_URL} if TELEGRAM_BASE_URL else {}
+    if TELEGRAM_BASE_FILE_URL:
+        bot_kwargs['base_file_url'] = TELEGRAM_BASE_FILE_URL
+    bot = InstrumentedBot(TOKEN, request=Request(**request_kwargs), **bot_kwargs)
+    if TELEGRAM_BASE_URL:
+        logger.warning("Using Bot API at %s", TELEGRAM_BASE_URL)
+    return bot
+
+def start_status_bitmap():
+    """Create the shared status bitmap, fill it from the database and re-sync it periodically."""
+    bitmap = status_bitmap.StatusBitmap.create(capacity=STATUS_BITMAP_CAPACITY)
+    db.use_status_bitmap(bitmap)
+    db.sync_status_bitmap()
+    
+    # Writes by other programs (distribute_images.py, an older bot) do not reach the bitmap
+    def sync():
+        while True:
+            time.sleep(STATUS_BITMAP_SYNC_INTERVAL)
+            if not db.sync_status_bitmap():
+                logger.warning("Status bitmap could not be rebuilt; reading image status from SQLite")
+    
+    if STATUS_BITMAP_SYNC_INTERVAL > 0:
+        threading.Thread(target=sync, name="status-bitmap", daemon=True).start()
+    return bitmap
+
+def purge_stale_generations():
+    """Back up and delete the images earlier resets retired, with their message mappings."""
+    stale = db.get_stale_generations()
+    if not stale:
+        return
+    # Resets invalidate the status bitmap instead of dropping each image from it
+    db.sync_status_bitmap()
     
-    # Add commands for forwarding control in private chat
-    dispatcher.add_handler(CommandHandler("forwarding_on", handle_toggle_forwarding, Filters.chat_type.private))
-    dispatcher.add_handler(CommandHandler("forwarding_off", handle_toggle_forwarding, Filters.chat_type.private))
-    dispatcher.add_handler(CommandHandler("forwarding_status", handle_toggle_forwarding, Filters.chat_type.private))
+    # In worker mode the mappings live in SQLite while the workers run
+    mappings = [forwarded_msgs, group_b_responses]
+    worker_mode = BOT_WORKERS > 1 and not SHARED_STATE
+    if worker_mode:
+        mappings = [shared_state.SharedDict('forwarded_msgs'), shared_state.SharedDict('group_b_responses')]
+    
+    # One snapshot, taken after the generations were read, holds every image older than them
+    source = image_backup.temporary_snapshot()
+    if source is None:
+        logger.error("Not purging retired images: the database snapshot failed")
+        return
+    try:
+        for group_b_id, generation in stale:
+            # Never delete images that did not make it into a backup
+            path, count = image_backup.export(group_b_id=group_b_id, source=source, stale=True)
+            if path is None:
+                logger.error("Not purging Group B %s: the backup of its retired images failed", group_b_id)
+                continue
+            logger.info("Backed up %s retired images of Group B %s to %s", count, group_b_id, path)
+            purged = 0
+            while True:
+                image_ids = db.purge_stale_images(group_b_id, GENERATION_PURGE_BATCH, before=generation)
+                if not image_ids:
+                    break
+                for image_id in image_ids:
+                    for mapping in mappings:
+                        mapping.pop(image_id, None)
+                    # A reset pool's notifications will never be answered; do not route around the group for them
+                    ROUTING.load.forget(image_id)
+                purged += len(image_ids)
+            logger.info("Purged %s images of Group B %s older than generation %s", purged, group_b_id, generation)
+    finally:
+        os.unlink(source)
+    image_backup.prune(image_backup.BACKUP_KEEP)
+    if not worker_mode:
+        save_persistent_data()
+
+def start_generation_purge():
+    """Purge retired images in the background, soon after each reset and every GENERATION_PURGE_INTERVAL."""
+    def run():
+        while True:
+            try:
+                purge_stale_generations()
+            except Exception as e:
+                logger.error("Error purging retired images: %s", e)
+            generation_purge_wakeup.wait(GENERATION_PURGE_INTERVAL)
+            generation_purge_wakeup.clear()
+    
+    if GENERATION_PURGE_INTERVAL > 0:
+        threading.Thread(target=run, name="generation-purge", daemon=True).start()
+
+def setup_worker(index):
+    """Prepare a worker process: shared state, config and its own wait queue file."""
+    use_shared_state()
+    db.enable_wal()
+    load_config_data()
+    CONFIG.start_watching(float(os.environ.get("CONFIG_WATCH_INTERVAL", "5")))
+    
+    # Each worker queues the requests of its own Group A chats
+    WAIT_QUEUE.path = f"wait_queue.{index}.json"
+    WAIT_QUEUE.load()
+
+def refresh_worker_state(dispatcher):
+    """Re-read what other workers changed: the Group B load, and images they reopened for queued requests."""
+    # Only the notifications still waiting for an answer, not the whole image pool
+    ROUTING.load.set_outstanding(db.get_outstanding_notifications())
+    if len(WAIT_QUEUE):
+        serve_waiting_requests(CallbackContext(dispatcher))
+
+def run_worker(index, inbox, bot_factory=make_bot, fence=None, bitmap_name=None, purge_wakeup=None):
+    """Worker process: run the handlers for the chats the intake process routes here."""
+    global dispatcher, generation_purge_wakeup
+    
+    # Ctrl+C reaches the whole process group; workers stop when the intake process tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_config.setup_logging()
+    
+    # Write under the intake process's leader lease, if any
+    if fence is not None:
+        db.set_fencing_token(*fence)
+    bitmap = None
+    if bitmap_name is not None:
+        bitmap = status_bitmap.StatusBitmap.attach(bitmap_name)
+        db.use_status_bitmap(bitmap)
+    # A reset here wakes the purge thread of the intake process
+    if purge_wakeup is not None:
+        generation_purge_wakeup = purge_wakeup
+    setup_worker(index)
+    dispatcher = Dispatcher(bot_factory(), queue.Queue(), workers=WORKER_THREADS)
+    register_handlers(dispatcher, track_offset=False)
+    
+    # Acknowledgements for this worker's notifications are handled by other workers
+    def refresh():
+        while True:
+            try:
+                refresh_worker_state(dispatcher)
+            except Exception as e:
+                logger.error("Error refreshing worker state: %s", e)
+            time.sleep(WORKER_REFRESH_INTERVAL)
+    
+    threading.Thread(target=refresh, name="worker-refresh", daemon=True).start()
+    logger.info("Worker %s ready", index)
+    workers.serve(inbox, dispatcher)
+    
+    # multiprocessing skips atexit handlers in child processes
+    if bitmap is not None:
+        db.use_status_bitmap(None)
+        bitmap.close()
+    CONFIG.flush()
+    log_config.stop_logging()
+
+def exit_if_lease_lost():
+    """Exit with status 1 if another instance took over; its state is newer than ours."""
+    if LEASE is not None and LEASE.lost.is_set():
+        logger.critical("Another instance holds the leader lease now - exiting without saving")
+        sys.exit(1)
 
 def main() -> None:
     """Start the bot."""
-    global dispatcher
+    global dispatcher, generation_purge_wakeup
+    
+    # Move log formatting and writing off the handler threads
+    log_config.setup_logging()
     
     if not TOKEN:
         logger.error("No token provided. Set TELEGRAM_BOT_TOKEN environment variable.")
         return
     
-    # Load persistent data
-    load_persistent_data()
-    load_config_data()  # Make sure to load configuration data as well
-    
-    # Create the Updater and pass it your bot's token with more generous timeouts
-    request_kwargs = {
-        'read_timeout': 60,        # Increased from 30
-        'connect_timeout': 60,     # Increased from 30
-        'con_pool_size': 10,       # Default is 1, increasing for better parallelism
-    }
-    updater = Updater(TOKEN, request_kwargs=request_kwargs)
+    # Active/standby: only the holder of the leader lease polls Telegram
+    if LEASE is not None:
+        LEASE.wait_for_leadership(tail_persistent_data)
+        # Updater.idle() stops polling on SIGTERM
+        LEASE.start_heartbeat(lambda: os.kill(os.getpid(), signal.SIGTERM))
+    
+    bitmap = start_status_bitmap() if STATUS_BITMAP else None
+    
+    pool = None
+    if BOT_WORKERS > 1:
+        # Worker mode: this process only polls and routes; the state moves into SQLite
+        load_persistent_data()
+        logger.info("Database journal mode: %s", db.enable_wal())
+        share_persistent_data()
+        # The purge thread runs here, but the workers handle "重置群码"
+        generation_purge_wakeup = multiprocessing.get_context("spawn").Event()
+        pool = workers.WorkerPool(BOT_WORKERS, run_worker,
+                                  args=(make_bot, db.fencing_token(), bitmap.name if bitmap else None,
+                                        generation_purge_wakeup))
+        pool.start()
+    elif LEASE is not None:
+        # The standby kept its state loaded; catch up with the previous leader's last changes
+        tail_persistent_data()
+        ROUTING.load.rebuild(forwarded_msgs, [img['image_id'] for img in db.get_all_images() if img['status'] == 'closed'])
+    elif not restore_state_snapshot():
+        # Warm start from the state snapshot; otherwise load the JSON files and the database
+        load_persistent_data()
+        
+        # Notifications still waiting for a Group B answer count towards that group's load
+        ROUTING.load.rebuild(forwarded_msgs, [img['image_id'] for img in db.get_all_images() if img['status'] == 'closed'])
+    logger.info("Group B routing strategy: %s", ROUTING.strategy)
+    
+    # Pick up hand edits of the config JSON files without a restart
+    CONFIG.start_watching(float(os.environ.get("CONFIG_WATCH_INTERVAL", "5")))
+    
+    # Delete what "重置群码" retired, in this process whichever mode the handlers run in
+    start_generation_purge()
+    
+    updater = Updater(bot=make_bot())
+    
+    # Resume after the last update handled before the restart
+    last_update_id = UPDATE_OFFSET.load()
+    if last_update_id is not None:
+        updater.last_update_id = last_update_id + 1
+        logger.info("Resuming polling after update %s", last_update_id)
+    
+    # Expose metrics over HTTP if a port is configured
+    metrics_port = os.environ.get("METRICS_PORT")
+    if metrics_port:
+        metrics.start_http_server(int(metrics_port))
+    
+    # Sample stacks of handlers that exceed the latency budget
+    handler_watchdog.WATCHDOG.start()
+    
+    # Keep local copies of images set before the image store existed
+    if image_store.enabled():
+        threading.Thread(target=store_missing_image_copies, args=(updater.bot,), name="image-store",
+                         daemon=True).start()
+    
+    # Optionally record incoming updates (UPDATE_RECORD_FILE) for replay.py
+    update_recorder.RECORDER = update_recorder.recorder_from_env()
     
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
     
+    if pool is not None:
+        # Route every update to the worker for its chat
+        if update_recorder.RECORDER is not None:
+            dispatcher.add_handler(TypeHandler(Update, update_recorder.RECORDER.record), group=-1)
+        dispatcher.add_handler(TypeHandler(Update, pool.submit))
+        dispatcher.add_handler(TypeHandler(Update, UPDATE_OFFSET.seen), group=1)
+        logger.info("Routing updates to %s worker processes", len(pool))
+        
+        updater.start_polling()
+        updater.idle()
+        
+        # Workers finish their queued updates, then the state goes back to the JSON files
+        pool.stop()
+        exit_if_lease_lost()
+        UPDATE_OFFSET.flush()
+        take_back_shared_state()
+        CONFIG.flush()
+        if bitmap is not None:
+            db.use_status_bitmap(None)
+            bitmap.close()
+        if LEASE is not None:
+            LEASE.release()
+        return
+    
     # Register all handlers
     register_handlers(dispatcher)
     
+    # Keep the state snapshot reasonably fresh in case the process is killed
+    snapshot_interval = float(os.environ.get("STATE_SNAPSHOT_INTERVAL", "60"))
+    if snapshot_interval > 0:
+        start_state_snapshots(snapshot_interval)
+    
     # Start the Bot
     updater.start_polling()
     updater.idle()
+    
+    # Write every file the snapshot is fingerprinted against first, then the snapshot itself
+    exit_if_lease_lost()
+    save_persistent_data()
+    CONFIG.flush()
+    UPDATE_OFFSET.flush()
+    save_state_snapshot()
+    if bitmap is not None:
+        db.use_status_bitmap(None)
+        bitmap.close()
+    
+    # Let a standby take over right away
+    if LEASE is not None:
+        LEASE.release()
 
 def handle_dissolve_group(update: Update, context: CallbackContext) -> None:
     """Handle clearing settings for the current group only."""
-    global dispatcher
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
     # Check if user is a global admin
     if not is_global_admin(user_id):
-        logger.info(f"User {user_id} tried to dissolve group {chat_id} but is not a global admin")
+        logger.info("User %s tried to dissolve group %s but is not a global admin", user_id, chat_id)
         update.message.reply_text("只有全局管理员可以解散群聊设置。")
         return
     
     # Check if this chat is in either Group A or Group B
-    in_group_a = int(chat_id) in GROUP_A_IDS
-    in_group_b = int(chat_id) in GROUP_B_IDS
+    config = CONFIG.current
+    in_group_a = int(chat_id) in config.group_a_ids
+    in_group_b = int(chat_id) in config.group_b_ids
     
     if not (in_group_a or in_group_b):
-        logger.info(f"Group {chat_id} is not configured as Group A or Group B")
+        logger.info("Group %s is not configured as Group A or Group B", chat_id)
         update.message.reply_text("此群聊未设置为任何群组类型。")
         return
     
     # Remove only this specific chat from the appropriate group
     if in_group_a:
-        GROUP_A_IDS.discard(int(chat_id))
+        CONFIG.modify(lambda config: config._replace(group_a_ids=config.group_a_ids - {int(chat_id)}))
         group_type = "供方群 (Group A)"
     elif in_group_b:
-        GROUP_B_IDS.discard(int(chat_id))
+        CONFIG.modify(lambda config: config._replace(group_b_ids=config.group_b_ids - {int(chat_id)}))
         group_type = "需方群 (Group B)"
     
-    # Save the configuration
-    save_config_data()
-    
-    # Reload handlers to reflect changes
-    if dispatcher:
-        register_handlers(dispatcher)
-    
-    logger.info(f"Group {chat_id} removed from {group_type} by user {user_id}")
+    logger.info("Group %s removed from %s by user %s", chat_id, group_type, user_id)
     update.message.reply_text(f"✅ 此群聊已从{group_type}中移除。其他群聊不受影响。")
 
 def handle_toggle_forwarding(update: Update, context: CallbackContext) -> None:
     """Toggle the forwarding status between Group B and Group A."""
-    global FORWARDING_ENABLED
     user_id = update.effective_user.id
     chat_type = update.effective_chat.type
     
     # Check if user is a global admin
     if not is_global_admin(user_id):
-        logger.info(f"User {user_id} tried to toggle forwarding but is not a global admin")
+        logger.info("User %s tried to toggle forwarding but is not a global admin", user_id)
         update.message.reply_text("只有全局管理员可以切换转发状态。")
         return
     
@@ -2309,20 +2917,17 @@ def handle_toggle_forwarding(update: Update, context: CallbackContext) -> None:
     
     # Determine whether to open or close forwarding
     if "开启转发" in text:
-        FORWARDING_ENABLED = True
+        config = CONFIG.modify(lambda config: config._replace(forwarding_enabled=True))
         status_message = "✅ 群转发功能已开启 - 消息将从群B转发到群A"
     elif "关闭转发" in text:
-        FORWARDING_ENABLED = False
+        config = CONFIG.modify(lambda config: config._replace(forwarding_enabled=False))
         status_message = "🚫 群转发功能已关闭 - 消息将不会从群B转发到群A"
     else:
         # Toggle current state if just "转发状态"
-        FORWARDING_ENABLED = not FORWARDING_ENABLED
-        status_message = "✅ 群转发功能已开启" if FORWARDING_ENABLED else "🚫 群转发功能已关闭"
+        config = CONFIG.modify(lambda config: config._replace(forwarding_enabled=not config.forwarding_enabled))
+        status_message = "✅ 群转发功能已开启" if config.forwarding_enabled else "🚫 群转发功能已关闭"
     
-    # Save configuration
-    save_config_data()
-    
-    logger.info(f"Forwarding status set to {FORWARDING_ENABLED} by user {user_id} in {chat_type} chat")
+    logger.info("Forwarding status set to %s by user %s in %s chat", config.forwarding_enabled, user_id, chat_type)
     update.message.reply_text(status_message)
 
 def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
@@ -2332,10 +2937,10 @@ def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
     
     # Check if user is a global admin
     if not is_global_admin(user_id):
-        logger.info(f"User {user_id} tried to use admin send image feature but is not a global admin")
+        logger.info("User %s tried to use admin send image feature but is not a global admin", user_id)
         return
     
-    logger.info(f"Global admin {user_id} is using send image feature")
+    logger.info("Global admin %s is using send image feature", user_id)
     
     # Get message text (remove the command part)
     full_text = update.message.text.strip()
@@ -2344,26 +2949,18 @@ def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
     number_match = re.search(r'群(\d+)', full_text)
     number = number_match.group(1) if number_match else None
     
-    # Check if we have images in database
-    images = db.get_all_images()
-    if not images:
-        logger.info("No images found in database")
-        update.message.reply_text("没有可用的图片。")
-        return
-    
     # Get an image - if number specified, try to match it
     image = None
     if number:
-        # Try to find image with matching number
-        for img in images:
-            if str(img.get('number')) == number:
-                image = img
-                logger.info(f"Found image with number {number}: {img['image_id']}")
-                break
+        # Any Group B's image, also of one that was dissolved since
+        matches = db.get_images_by_number(int(number), limit=1)
+        if matches:
+            image = matches[0]
+            logger.info("Found image with number %s: %s", number, image['image_id'])
         
         # If no match found, inform admin
         if not image:
-            logger.info(f"No image found with number {number}")
+            logger.info("No image found with number %s", number)
             update.message.reply_text(f"没有找到群号为 {number} 的图片。")
             return
     else:
@@ -2371,25 +2968,29 @@ def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
         image = db.get_random_open_image()
         if not image:
             # If no open images, just get any image
-            image = images[0]
-            logger.info(f"No open images, using first available: {image['image_id']}")
+            image = db.get_first_image()
+            if not image:
+                logger.info("No images found in database")
+                update.message.reply_text("没有可用的图片。")
+                return
+            logger.info("No open images, using first available: %s", image['image_id'])
         else:
-            logger.info(f"Using random open image: {image['image_id']}")
+            logger.info("Using random open image: %s", image['image_id'])
     
     # Send the image
     try:
         # If replying to someone, send as reply
         reply_to_id = update.message.reply_to_message.message_id if update.message.reply_to_message else None
         
-        sent_msg = context.bot.send_photo(
+        sent_msg = send_image(
+            context.bot.send_photo, image,
             chat_id=chat_id,
-            photo=image['file_id'],
             caption=f"🌟 群: {image['number']} 🌟",
             reply_to_message_id=reply_to_id
         )
-        logger.info(f"Admin manually sent image {image['image_id']} with number {image['number']}")
+        logger.info("Admin manually sent image %s with number %s", image['image_id'], image['number'])
     except Exception as e:
-        logger.error(f"Error sending image: {e}")
+        logger.error("Error sending image: %s", e)
         update.message.reply_text(f"发送图片错误: {e}")
         return
     
@@ -2397,8 +2998,8 @@ def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
     if "转发" in full_text:
         try:
             # Get a target Group B
-            if GROUP_B_IDS:
-                target_group_b = list(GROUP_B_IDS)[0]  # Use first Group B
+            if CONFIG.current.group_b_ids:
+                target_group_b = list(CONFIG.current.group_b_ids)[0]  # Use first Group B
                 
                 # Extract amount from message if present
                 amount_match = re.search(r'金额(\d+)', full_text) 
@@ -2416,98 +3017,76 @@ def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
                     'group_a_chat_id': chat_id,
                     'group_b_msg_id': forwarded.message_id,
                     'group_b_chat_id': target_group_b,
+                    'forwarded_at': time.time(),  # For routing_policy ack latency
                     'image_id': image['image_id'],
                     'amount': amount,
                     'number': str(image['number']),
                     'original_user_id': user_id,
                     'original_message_id': update.message.message_id
                 }
+                ROUTING.load.dispatched(target_group_b, image['image_id'])
                 
                 save_persistent_data()
-                logger.info(f"Admin forwarded image {image['image_id']} to Group B {target_group_b}")
+                logger.info("Admin forwarded image %s to Group B %s", image['image_id'], target_group_b)
                 
                 # Only set image to closed if explicitly requested to avoid confusion
                 if "关闭" in full_text:
                     db.set_image_status(image['image_id'], "closed")
-                    logger.info(f"Admin closed image {image['image_id']}")
+                    logger.info("Admin closed image %s", image['image_id'])
             else:
                 update.message.reply_text("没有设置群B，无法转发。")
         except Exception as e:
-            logger.error(f"Error forwarding to Group B: {e}")
+            logger.error("Error forwarding to Group B: %s", e)
             update.message.reply_text(f"转发至群B失败: {e}")
 
 def handle_reset_specific_image(update: Update, context: CallbackContext) -> None:
     """Handle command to reset a specific image by its number."""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    message_text = update.message.text.strip()
+    parsed = get_classification(update, context)
     
     # Check if this is Group B
-    if chat_id not in GROUP_B_IDS and chat_id != GROUP_B_ID:
-        logger.info(f"Reset specific image command used in non-Group B chat: {chat_id}")
+    if chat_id not in CONFIG.current.group_b_ids and chat_id != GROUP_B_ID:
+        logger.info("Reset specific image command used in non-Group B chat: %s", chat_id)
         return
     
-    # Extract the image number from the command "重置群{number}"
-    match = re.search(r'^重置群(\d+)$', message_text)
-    if not match:
+    # The image number from the command "重置群{number}"
+    if parsed.kind != message_classifier.RESET_ONE:
         return
     
-    image_number = int(match.group(1))
-    logger.info(f"Reset command for image number {image_number} detected in Group B {chat_id}")
+    image_number = int(parsed.numbers[0])
+    logger.info("Reset command for image number %s detected in Group B %s", image_number, chat_id)
     
     # Check if user is a group admin or global admin
     if not is_group_admin(user_id, chat_id) and not is_global_admin(user_id):
-        logger.info(f"User {user_id} tried to reset image but is not an admin")
+        logger.info("User %s tried to reset image but is not an admin", user_id)
         update.message.reply_text("只有群操作人或全局管理员可以重置群码。")
         return
     
-    logger.info(f"Admin {user_id} is resetting image number {image_number} in Group B: {chat_id}")
+    logger.info("Admin %s is resetting image number %s in Group B: %s", user_id, image_number, chat_id)
     
-    # Get image count before deletion
-    all_images = db.get_all_images()
-    before_count = len(all_images)
-    logger.info(f"Total images in database before reset: {before_count}")
+    # Delete the images with this number; the call returns them, so nothing has to be counted
+    deleted = db.delete_images_by_number(image_number, chat_id)
+    if deleted is None:
+        update.message.reply_text(f"❌ 重置群码 {image_number} 失败，请查看日志。")
+        logger.error("Failed to reset image number %s", image_number)
+        return
     
-    # Delete the specific image by its number
-    success = db.delete_image_by_number(image_number, chat_id)
+    if not deleted:
+        update.message.reply_text(f"⚠️ 未找到群号为 {image_number} 的图片。")
+        logger.warning("No images with number %s were deleted", image_number)
+        return
     
-    if success:
-        # Also clear related message mappings for this image
-        global forwarded_msgs, group_b_responses
-        
-        # Find any message mappings related to this image
-        mappings_to_remove = []
-        for img_id, data in forwarded_msgs.items():
-            if data.get('number') == str(image_number) and data.get('group_b_chat_id') == chat_id:
-                mappings_to_remove.append(img_id)
-                logger.info(f"Found matching mapping for image {img_id} with number {image_number}")
-        
-        # Remove the found mappings
-        for img_id in mappings_to_remove:
-            if img_id in forwarded_msgs:
-                logger.info(f"Removing forwarded message mapping for {img_id}")
-                del forwarded_msgs[img_id]
-            if img_id in group_b_responses:
-                logger.info(f"Removing group B response for {img_id}")
-                del group_b_responses[img_id]
-        
-        save_persistent_data()
-        
-        # Get image count after deletion
-        remaining_images = db.get_all_images()
-        after_count = len(remaining_images)
-        deleted_count = before_count - after_count
-        
-        # Provide feedback to the user
-        if deleted_count > 0:
-            update.message.reply_text(f"✅ 已重置群码 {image_number}，删除了 {deleted_count} 张图片。")
-            logger.info(f"Successfully reset image number {image_number}")
-        else:
-            update.message.reply_text(f"⚠️ 未找到群号为 {image_number} 的图片，或者删除操作失败。")
-            logger.warning(f"No images with number {image_number} were deleted")
-    else:
-        update.message.reply_text(f"❌ 重置群码 {image_number} 失败。未找到匹配的图片。")
-        logger.error(f"Failed to reset image number {image_number}")
+    # Also clear the message mappings of the deleted images; their notifications will never be answered
+    for image in deleted:
+        if forwarded_msgs.pop(image['image_id'], None) is not None:
+            logger.info("Removed forwarded message mapping for %s", image['image_id'])
+        group_b_responses.pop(image['image_id'], None)
+        ROUTING.load.forget(image['image_id'])
+    save_persistent_data()
+    
+    update.message.reply_text(f"✅ 已重置群码 {image_number}，删除了 {len(deleted)} 张图片。")
+    logger.info("Successfully reset image number %s", image_number)
 
 if __name__ == '__main__':
     main() 
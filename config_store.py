@@ -0,0 +1,239 @@
+"""
+Copy-on-write store for the bot's group and admin configuration.
+
+Readers take `store.current`, an immutable ConfigSnapshot, and never lock:
+replacing the reference is atomic, so a reader always sees one consistent
+configuration. Writers go through `modify()`, which builds a new snapshot
+under a lock and wakes a background thread that writes the JSON files.
+The same thread polls the files' mtimes and reloads them when they are
+edited by hand or by another process. Changes not saved yet are replayed
+on top of whatever the files hold by then, so neither side is lost.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from types import MappingProxyType
+from typing import Callable, Dict, FrozenSet, List, Mapping, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigSnapshot(NamedTuple):
+    """One immutable version of the configuration."""
+    group_a_ids: FrozenSet[int]
+    group_b_ids: FrozenSet[int]
+    group_admins: Mapping[int, FrozenSet[int]]  # chat_id -> admin user IDs
+    global_admins: FrozenSet[int]
+    forwarding_enabled: bool
+    version: int = 0
+
+
+def freeze_admins(admins: Mapping) -> Mapping[int, FrozenSet[int]]:
+    """Return a read-only {chat_id: frozenset(user_ids)} copy."""
+    return MappingProxyType({int(chat_id): frozenset(int(u) for u in users) for chat_id, users in admins.items()})
+
+
+class ConfigStore:
+    """Holds the current snapshot and persists it to four JSON files."""
+
+    def __init__(self, initial: ConfigSnapshot, group_a_file: str, group_b_file: str,
+                 group_admins_file: str, settings_file: str):
+        self.current = initial
+        self.files = {
+            'group_a_ids': group_a_file,
+            'group_b_ids': group_b_file,
+            'group_admins': group_admins_file,
+            'settings': settings_file,
+        }
+        self.watch_interval: Optional[float] = None
+
+        self._write_lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._dirty = False
+        # Changes applied with modify() since the last save, replayed on top of reloaded files
+        self._pending: List[Callable[[ConfigSnapshot], ConfigSnapshot]] = []
+        self._thread: Optional[threading.Thread] = None
+        self._mtimes: Dict[str, Optional[Tuple[int, int, int]]] = {}
+
+    # --- writers ---------------------------------------------------------
+
+    def modify(self, change: Callable[[ConfigSnapshot], ConfigSnapshot]) -> ConfigSnapshot:
+        """Apply `change` to the current snapshot, swap it in and schedule a save."""
+        with self._write_lock:
+            snapshot = self._apply(change, self.current)
+            self.current = snapshot
+            self._pending.append(change)
+            self._dirty = True
+        self._ensure_thread()
+        self._wake.set()
+        return snapshot
+
+    def load(self) -> ConfigSnapshot:
+        """Read every existing file and swap in the result; missing files keep current values.
+        
+        Changes made with modify() and not saved yet are applied again on top.
+        """
+        with self._file_lock:
+            loaded = self._read_files()
+            self._mtimes = self._stat_files()
+        if loaded:
+            with self._write_lock:
+                self.current = self._rebase(loaded)
+        return self.current
+
+    def restore(self, snapshot: ConfigSnapshot) -> ConfigSnapshot:
+        """Swap in a snapshot saved elsewhere (state_snapshot) as if it had just been loaded from the files.
+        
+        Global admins are not read from any file, so the current ones (set in
+        code) win over the snapshot's: a user removed from the code must not
+        get their permissions back from an old snapshot.
+        """
+        with self._file_lock:
+            self._mtimes = self._stat_files()
+        with self._write_lock:
+            self.current = snapshot._replace(
+                group_admins=freeze_admins(snapshot.group_admins), global_admins=self.current.global_admins,
+                version=self.current.version + 1
+            )
+        return self.current
+
+    def save(self) -> None:
+        """Write the current snapshot now, on the calling thread.
+        
+        Files changed on disk since they were last read (by hand or by another
+        worker process) are read first and the unsaved changes applied on top.
+        """
+        with self._file_lock:
+            loaded = self._read_files() if self._stat_files() != self._mtimes else None
+            with self._write_lock:
+                if loaded:
+                    self.current = self._rebase(loaded)
+                self._pending = []
+                self._dirty = False
+                snapshot = self.current
+            self._write_files(snapshot)
+            self._mtimes = self._stat_files()
+
+    def flush(self) -> None:
+        """Write pending changes, if any (used at exit)."""
+        if self._dirty:
+            self.save()
+
+    def _apply(self, change: Callable[[ConfigSnapshot], ConfigSnapshot], base: ConfigSnapshot) -> ConfigSnapshot:
+        snapshot = change(base)
+        snapshot = snapshot._replace(
+            group_a_ids=frozenset(snapshot.group_a_ids),
+            group_b_ids=frozenset(snapshot.group_b_ids),
+            global_admins=frozenset(snapshot.global_admins),
+            version=base.version + 1,
+        )
+        if not isinstance(snapshot.group_admins, MappingProxyType):
+            snapshot = snapshot._replace(group_admins=freeze_admins(snapshot.group_admins))
+        return snapshot
+
+    def _rebase(self, loaded: Dict) -> ConfigSnapshot:
+        # Called with the write lock held
+        snapshot = self.current._replace(version=self.current.version + 1, **loaded)
+        for change in self._pending:
+            snapshot = self._apply(change, snapshot)
+        if self._pending:
+            logger.info("Applied %s unsaved configuration changes on top of the files", len(self._pending))
+        return snapshot
+
+    # --- background thread ------------------------------------------------
+
+    def start_watching(self, interval: float = 5.0) -> None:
+        """Also reload the files when their mtime changes, checking every `interval` seconds."""
+        self.watch_interval = interval
+        self._mtimes = self._stat_files()
+        self._ensure_thread()
+        self._wake.set()
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="config-store", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.watch_interval)
+            self._wake.clear()
+            try:
+                if self._dirty:
+                    self.save()
+                elif self.watch_interval:
+                    self.check_external_changes()
+            except Exception as e:
+                logger.error("Config store error: %s", e)
+
+    def check_external_changes(self) -> bool:
+        """Reload the files if any of them changed on disk since the last read or write."""
+        if self._stat_files() == self._mtimes:
+            return False
+        logger.info("Configuration files changed on disk, reloading")
+        self.load()
+        return True
+
+    # --- files ------------------------------------------------------------
+
+    def _stat_files(self) -> Dict[str, Optional[Tuple[int, int, int]]]:
+        mtimes = {}
+        for path in self.files.values():
+            try:
+                stat = os.stat(path)
+                # Every write renames a new file into place, so the inode changes even within one mtime tick
+                mtimes[path] = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def _read_files(self) -> Dict:
+        loaded = {}
+        readers = {
+            'group_a_ids': lambda data: frozenset(int(x) for x in data),
+            'group_b_ids': lambda data: frozenset(int(x) for x in data),
+            'group_admins': freeze_admins,
+            'settings': lambda data: bool(data.get("forwarding_enabled", True)),
+        }
+        for key, path in self.files.items():
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r') as f:
+                    value = readers[key](json.load(f))
+            except Exception as e:
+                logger.error("Error loading %s: %s", path, e)
+                continue
+            loaded['forwarding_enabled' if key == 'settings' else key] = value
+        logger.info(
+            "Loaded configuration: %s Group A, %s Group B, %s chats with admins",
+            len(loaded.get('group_a_ids', ())), len(loaded.get('group_b_ids', ())), len(loaded.get('group_admins', {}))
+        )
+        return loaded
+
+    def _write_files(self, snapshot: ConfigSnapshot) -> None:
+        contents = {
+            'group_a_ids': sorted(snapshot.group_a_ids),
+            'group_b_ids': sorted(snapshot.group_b_ids),
+            'group_admins': {str(chat_id): sorted(users) for chat_id, users in snapshot.group_admins.items()},
+            'settings': {"forwarding_enabled": snapshot.forwarding_enabled},
+        }
+        for key, path in self.files.items():
+            try:
+                # Write a temp file and rename it so readers never see half a file
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(contents[key], f, indent=2)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.error("Error saving %s: %s", path, e)
+        logger.debug("Saved configuration version %s", snapshot.version)
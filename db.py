@@ -4,6 +4,12 @@ from typing import Dict, List, Optional, Tuple
 import random
 import logging
 import sqlite3
+import sys
+import threading
+import time
+
+import image_store
+import metrics
 
 # Configure logging
 logging.basicConfig(
@@ -32,148 +38,552 @@ def save_db(db: Dict) -> None:
     with open(DB_FILE, "w") as f:
         json.dump(db, f, indent=2)
 
-def init_db():
-    """Initialize the database if it doesn't exist."""
+# Absolute paths of databases whose schema is known to be current
+_initialized_dbs = set()
+_init_lock = threading.Lock()
+
+# Set by enable_wal(); WAL only needs a sync at checkpoints, not at every commit
+_wal = False
+
+# (lease name, fencing token) every write is checked against, set by leader_lease; None when HA is off
+_fence: Optional[Tuple[str, int]] = None
+
+class StaleFencingToken(Exception):
+    """A write was refused because another instance holds a newer leader lease."""
+
+def set_fencing_token(name: Optional[str], token: Optional[int] = None) -> None:
+    """Check every later write against lease `name` and `token`; None switches the check off."""
+    global _fence
+    _fence = (name, int(token)) if name is not None and token is not None else None
+
+def fencing_token() -> Optional[Tuple[str, int]]:
+    """The (lease name, token) writes are checked against, if any."""
+    return _fence
+
+def _begin_write(conn: sqlite3.Connection) -> None:
+    """Start a write transaction; with a fencing token, refuse it unless the token is still the current one."""
+    fence = _fence
+    if fence is None:
+        return
+    # BEGIN IMMEDIATE takes the write lock, so the lease cannot change before this transaction commits
+    conn.execute("BEGIN IMMEDIATE")
+    row = conn.execute("SELECT token FROM leader_lease WHERE name = ?", (fence[0],)).fetchone()
+    if row is None or row[0] != fence[1]:
+        conn.rollback()
+        conn.close()
+        raise StaleFencingToken(f"lease {fence[0]!r} token {fence[1]} is no longer current")
+
+# Shared-memory status bitmap (status_bitmap.StatusBitmap) kept in step with the images table; None when off
+_bitmap = None
+
+def use_status_bitmap(bitmap) -> None:
+    """Apply every image write to `bitmap` too and answer counts and picks from it; None switches it off."""
+    global _bitmap
+    _bitmap = bitmap
+
+def _readable_bitmap():
+    """The status bitmap if readers may use it."""
+    bitmap = _bitmap
+    return bitmap if bitmap is not None and bitmap.valid else None
+
+# An image is live while its generation is the current one of its Group B; reset_group_b starts a new one
+LIVE_CONDITION = ("images.generation = COALESCE((SELECT generation FROM group_generations "
+                  "WHERE group_b_id = images.source_group_b_id), 0)")
+# The generation a new image of the Group B bound to `?` belongs to
+_CURRENT_GENERATION = "COALESCE((SELECT generation FROM group_generations WHERE group_b_id = ?), 0)"
+
+def _bitmap_update(cursor, where: str, params) -> None:
+    """Copy status and Group B of the matching images to the bitmap; call inside the write transaction."""
+    if _bitmap is None:
+        return
+    cursor.execute(f"SELECT rowid, status, source_group_b_id, {LIVE_CONDITION} FROM images WHERE {where}", params)
+    for rowid, status, group_b_id, live in cursor.fetchall():
+        if live:
+            _bitmap.set(rowid, status == 'open', group_b_id)
+        else:
+            _bitmap.remove(rowid)
+
+def _bitmap_rebuild(cursor) -> None:
+    """Rebuild the bitmap from the live images; call inside the write transaction."""
+    if _bitmap is not None:
+        cursor.execute(f"SELECT rowid, status, source_group_b_id FROM images WHERE {LIVE_CONDITION}")
+        _bitmap.rebuild(cursor.fetchall())
+
+def _commit_images(conn: sqlite3.Connection) -> None:
+    """Commit a write to the images table; if that fails, the bitmap is ahead of the database."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Create images table if it doesn't exist
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS images (
-            image_id TEXT PRIMARY KEY,
-            number INTEGER,
-            file_id TEXT,
-            status TEXT DEFAULT 'open'
-        )
-        ''')
-        
         conn.commit()
-        conn.close()
-        logger.info("Database initialized successfully")
-    except Exception as e:
-        logger.error(f"Error initializing database: {e}")
+    except Exception:
+        if _bitmap is not None:
+            _bitmap.invalidate("commit failed")
+        raise
+
+def _connect() -> sqlite3.Connection:
+    """Open a connection to the image database."""
+    conn = sqlite3.connect(DB_FILE)
+    if _wal:
+        conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
-def add_image(image_id: str, number: int, file_id: str, status='open', metadata=None) -> bool:
+def _group_b_of(metadata) -> Optional[int]:
+    """Extract source_group_b_id from a metadata JSON string or dict."""
+    if not metadata:
+        return None
+    try:
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+        if isinstance(metadata, dict) and metadata.get('source_group_b_id') is not None:
+            return int(metadata['source_group_b_id'])
+    except (ValueError, TypeError):
+        pass
+    return None
+
+def init_db():
+    """Initialize the database if it doesn't exist, once per database file."""
+    path = os.path.abspath(DB_FILE)
+    if path in _initialized_dbs and os.path.exists(path):
+        return
+    with _init_lock:
+        if path in _initialized_dbs and os.path.exists(path):
+            return
+        try:
+            conn = _connect()
+            cursor = conn.cursor()
+            
+            # Create images table if it doesn't exist
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS images (
+                image_id TEXT PRIMARY KEY,
+                number INTEGER,
+                file_id TEXT,
+                status TEXT DEFAULT 'open',
+                metadata TEXT,
+                source_group_b_id INTEGER,
+                last_used_at REAL NOT NULL DEFAULT 0,
+                use_count INTEGER NOT NULL DEFAULT 0,
+                file_unique_id TEXT,
+                content_sha256 TEXT,
+                content_type TEXT,
+                generation INTEGER NOT NULL DEFAULT 0
+            )
+            ''')
+            
+            # Older databases lack the metadata and Group B columns
+            cursor.execute("PRAGMA table_info(images)")
+            columns = [col[1] for col in cursor.fetchall()]
+            if 'metadata' not in columns:
+                cursor.execute("ALTER TABLE images ADD COLUMN metadata TEXT")
+                logger.info("Added metadata column to images table")
+            if 'source_group_b_id' not in columns:
+                cursor.execute("ALTER TABLE images ADD COLUMN source_group_b_id INTEGER")
+                # Backfill from the metadata JSON so group queries can use the index
+                cursor.execute("SELECT image_id, metadata FROM images WHERE metadata IS NOT NULL")
+                backfill = [(_group_b_of(metadata), image_id) for image_id, metadata in cursor.fetchall()]
+                backfill = [row for row in backfill if row[0] is not None]
+                cursor.executemany("UPDATE images SET source_group_b_id = ? WHERE image_id = ?", backfill)
+                logger.info("Added source_group_b_id column, backfilled %s images", len(backfill))
+            if 'last_used_at' not in columns:
+                cursor.execute("ALTER TABLE images ADD COLUMN last_used_at REAL NOT NULL DEFAULT 0")
+                cursor.execute("ALTER TABLE images ADD COLUMN use_count INTEGER NOT NULL DEFAULT 0")
+                logger.info("Added last_used_at and use_count columns to images table")
+            if 'content_sha256' not in columns:
+                cursor.execute("ALTER TABLE images ADD COLUMN file_unique_id TEXT")
+                cursor.execute("ALTER TABLE images ADD COLUMN content_sha256 TEXT")
+                cursor.execute("ALTER TABLE images ADD COLUMN content_type TEXT")
+                logger.info("Added file_unique_id and content columns to images table")
+            if 'generation' not in columns:
+                cursor.execute("ALTER TABLE images ADD COLUMN generation INTEGER NOT NULL DEFAULT 0")
+                logger.info("Added generation column to images table")
+            
+            # Status indexes also order rows by rowid, which round_robin and random walk
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_status ON images(status)")
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_images_group_b_status ON images(source_group_b_id, status)"
+            )
+            # Ordered indexes for the lru and least_used selection strategies
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_status_lru ON images(status, last_used_at)")
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_images_status_uses ON images(status, use_count, last_used_at)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_images_group_b_lru "
+                "ON images(source_group_b_id, status, last_used_at)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_images_group_b_uses "
+                "ON images(source_group_b_id, status, use_count, last_used_at)"
+            )
+            # Images of one number in one Group B, for get_images_by_number and delete_images_by_number
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_images_group_b_number ON images(source_group_b_id, number)"
+            )
+            # Images of one number in any Group B, dissolved ones included (get_images_by_number)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_number ON images(number)")
+            # Stale generations of a Group B, for purge_stale_images
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_images_group_generation ON images(source_group_b_id, generation)"
+            )
+            # Images sharing a stored copy get a reuploaded file_id together (image_store.py)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_content ON images(content_sha256)")
+            # One row per photo (add_images); older databases may hold the same photo more than once
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_images_file_unique_id'")
+            if cursor.fetchone() is None:
+                cursor.execute(
+                    "UPDATE images SET file_unique_id = NULL WHERE file_unique_id IS NOT NULL AND rowid NOT IN "
+                    "(SELECT MIN(rowid) FROM images WHERE file_unique_id IS NOT NULL GROUP BY file_unique_id)"
+                )
+                if cursor.rowcount:
+                    logger.warning("Cleared file_unique_id of %s duplicate images", cursor.rowcount)
+                cursor.execute("CREATE UNIQUE INDEX idx_images_file_unique_id ON images(file_unique_id)")
+            
+            # Current generation of each Group B's pool; groups without a row are at generation 0
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS group_generations (group_b_id INTEGER PRIMARY KEY, generation INTEGER NOT NULL)"
+            )
+            # Small key/value store for bot state such as the last handled update_id
+            cursor.execute("CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, value TEXT)")
+            # Messages whose handler already ran, so a redelivered update is not handled twice
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS handled_messages (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                handler TEXT,
+                handled_at REAL NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            ) WITHOUT ROWID
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_handled_messages_at ON handled_messages(handled_at)")
+            # Leader election for active/standby instances (leader_lease.py)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leader_lease (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                token INTEGER NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            ''')
+            
+            # Handler state shared by the worker processes (see shared_state.py), values are JSON
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shared_state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (namespace, key)
+            ) WITHOUT ROWID
+            ''')
+            
+            conn.commit()
+            conn.close()
+            _initialized_dbs.add(path)
+            logger.debug("Database initialized successfully")
+        except Exception as e:
+            logger.error("Error initializing database: %s", e)
+
+def _release_stale_photos(cursor, file_unique_ids: List[str]) -> None:
+    """Let images of earlier generations give up these file_unique_ids so the photos can be set again."""
+    for start in range(0, len(file_unique_ids), 500):
+        chunk = file_unique_ids[start:start + 500]
+        cursor.execute(
+            "UPDATE images INDEXED BY idx_images_file_unique_id SET file_unique_id = NULL "
+            f"WHERE file_unique_id IN ({','.join('?' * len(chunk))}) "
+            f"AND NOT ({LIVE_CONDITION})",
+            chunk
+        )
+
+def add_image(image_id: str, number: int, file_id: str, status='open', metadata=None,
+              file_unique_id: Optional[str] = None) -> bool:
     """Add an image to the database."""
-    logger.info(f"Adding image: ID={image_id}, number={number}, file_id={file_id}")
+    logger.debug("Adding image: ID=%s, number=%s", image_id, number)
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
+        _begin_write(conn)
         cursor = conn.cursor()
         
         # Check if image_id already exists
         cursor.execute("SELECT image_id FROM images WHERE image_id = ?", (image_id,))
         if cursor.fetchone():
-            logger.warning(f"Image ID {image_id} already exists")
+            logger.warning("Image ID %s already exists", image_id)
             conn.close()
             return False
         
-        # Check if table has metadata column
-        cursor.execute("PRAGMA table_info(images)")
-        has_metadata = any(col[1] == 'metadata' for col in cursor.fetchall())
-        
-        # Add metadata column if it doesn't exist
-        if not has_metadata:
-            cursor.execute("ALTER TABLE images ADD COLUMN metadata TEXT")
-            conn.commit()
-            logger.info("Added metadata column to images table")
+        if file_unique_id:
+            _release_stale_photos(cursor, [file_unique_id])
         
-        # Insert new image with metadata
+        # Insert new image with metadata, in its Group B's current generation
+        group_b_id = _group_b_of(metadata)
         cursor.execute(
-            "INSERT INTO images (image_id, number, file_id, status, metadata) VALUES (?, ?, ?, ?, ?)",
-            (image_id, number, file_id, status, metadata)
+            "INSERT INTO images (image_id, number, file_id, status, metadata, source_group_b_id, file_unique_id, "
+            f"generation) VALUES (?, ?, ?, ?, ?, ?, ?, {_CURRENT_GENERATION})",
+            (image_id, number, file_id, status, metadata, group_b_id, file_unique_id, group_b_id)
         )
+        _bitmap_update(cursor, "image_id = ?", (image_id,))
         
-        conn.commit()
+        _commit_images(conn)
         conn.close()
-        logger.info(f"Added image {image_id} for group {number} with status '{status}'")
+        logger.info("Added image %s for group %s with status '%s'", image_id, number, status)
         return True
     except sqlite3.IntegrityError as e:
-        logger.error(f"Integrity error adding image: {e}")
+        logger.error("Integrity error adding image: %s", e)
         return False
     except Exception as e:
-        logger.error(f"Error adding image: {e}")
+        logger.error("Error adding image: %s", e)
         return False
 
-def get_random_open_image() -> Optional[Dict]:
-    """Get a random open image from the database."""
+# bot_state key of the last image ID handed out by _allocate_image_ids
+IMAGE_ID_SEQUENCE = "image_id_seq"
+
+def _allocate_image_ids(cursor, count: int) -> List[str]:
+    """Reserve `count` new, increasing image IDs; call inside the write transaction."""
+    cursor.execute(
+        "UPDATE bot_state SET value = CAST(value AS INTEGER) + ? WHERE key = ?", (count, IMAGE_ID_SEQUENCE)
+    )
+    if cursor.rowcount:
+        cursor.execute("SELECT value FROM bot_state WHERE key = ?", (IMAGE_ID_SEQUENCE,))
+        last = int(cursor.fetchone()[0])
+    else:
+        # First allocation: continue after the highest img_N handed out before the counter existed
+        cursor.execute(
+            "SELECT MAX(CAST(SUBSTR(image_id, 5) AS INTEGER)) FROM images WHERE image_id GLOB 'img_[0-9]*'"
+        )
+        last = (cursor.fetchone()[0] or 0) + count
+        cursor.execute("INSERT INTO bot_state (key, value) VALUES (?, ?)", (IMAGE_ID_SEQUENCE, str(last)))
+    return [f"img_{n}" for n in range(last - count + 1, last + 1)]
+
+def add_images(images: List[Dict], status='open') -> Optional[List[Tuple[str, bool]]]:
+    """
+    Add images (dicts with number, file_id and optionally file_unique_id and metadata) in one transaction.
+    Returns (image_id, added) for each in order; a photo already stored keeps the ID it has and is not added again.
+    """
+    if not images:
+        return []
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
+        _begin_write(conn)
+        if not conn.in_transaction:
+            # The duplicate check and the inserts must see the same table
+            conn.execute("BEGIN IMMEDIATE")
         cursor = conn.cursor()
         
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
+        # file_unique_id -> image_id of the photos that are already stored
+        unique_ids = list({image['file_unique_id'] for image in images if image.get('file_unique_id')})
+        _release_stale_photos(cursor, unique_ids)
+        stored = {}
+        for start in range(0, len(unique_ids), 500):
+            chunk = unique_ids[start:start + 500]
+            # Pinned to the index: statistics gathered while most rows had no file_unique_id make it look useless
+            cursor.execute(
+                "SELECT file_unique_id, image_id FROM images INDEXED BY idx_images_file_unique_id "
+                f"WHERE file_unique_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            stored.update(cursor.fetchall())
         
-        if 'metadata' in columns:
-            cursor.execute("SELECT image_id, number, file_id, status, metadata FROM images WHERE status = 'open'")
-        else:
-            cursor.execute("SELECT image_id, number, file_id, status FROM images WHERE status = 'open'")
+        # Indexes of the images to insert; a photo repeated within the batch is inserted once
+        new = []
+        first_in_batch = {}
+        for index, image in enumerate(images):
+            unique_id = image.get('file_unique_id')
+            if unique_id and (unique_id in stored or unique_id in first_in_batch):
+                continue
+            if unique_id:
+                first_in_batch[unique_id] = index
+            new.append(index)
+        new_ids = dict(zip(new, _allocate_image_ids(cursor, len(new)))) if new else {}
+        for unique_id, index in first_in_batch.items():
+            stored[unique_id] = new_ids[index]
         
-        rows = cursor.fetchall()
+        if new:
+            # New rows get rowids above the current maximum, which tells the bitmap which rows to copy
+            cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM images")
+            last_rowid = cursor.fetchone()[0]
+            rows = []
+            for index in new:
+                image = images[index]
+                metadata = image.get('metadata')
+                group_b_id = _group_b_of(metadata)
+                rows.append((new_ids[index], int(image['number']), image['file_id'], status, metadata,
+                             group_b_id, image.get('file_unique_id'), group_b_id))
+            cursor.executemany(
+                "INSERT INTO images (image_id, number, file_id, status, metadata, source_group_b_id, file_unique_id, "
+                f"generation) VALUES (?, ?, ?, ?, ?, ?, ?, {_CURRENT_GENERATION})",
+                rows
+            )
+            _bitmap_update(cursor, "rowid > ?", (last_rowid,))
         
-        if not rows:
-            logger.info("No open images available")
-            conn.close()
+        _commit_images(conn)
+        conn.close()
+        logger.info("Added %s images with status '%s', %s already stored", len(new), status, len(images) - len(new))
+        return [(new_ids[index], True) if index in new_ids else (stored[image['file_unique_id']], False)
+                for index, image in enumerate(images)]
+    except Exception as e:
+        logger.error("Error adding images: %s", e)
+        return None
+
+def get_random_open_image() -> Optional[Dict]:
+    """Get a random open image from the database, with one index seek (select_open_image's 'random')."""
+    return select_open_image('random')
+
+# Strategies accepted by select_open_image()
+SELECTION_STRATEGIES = ('random', 'round_robin', 'lru', 'least_used')
+
+# Last rowid handed out by round_robin, per Group B (None for the whole pool)
+_round_robin_cursor: Dict[Optional[int], int] = {}
+
+def select_open_image(strategy: str = 'lru', group_b_id: Optional[int] = None, claim: bool = False) -> Optional[Dict]:
+    """Pick an open image (of one Group B, if given) with one of SELECTION_STRATEGIES.
+    
+    Every strategy is a single seek into an ordered index:
+    - random: first open image at or after a random rowid (uniform while rowids are dense)
+    - round_robin: next open image after the last one handed out, wrapping around
+    - lru: least recently claimed image
+    - least_used: least often claimed image, least recently claimed first
+    
+    With `claim`, the image is closed in the same call, so concurrent requests
+    never receive the same image (lru and least_used would otherwise hand the
+    same head of the index to every request in flight).
+    """
+    if strategy not in SELECTION_STRATEGIES:
+        raise ValueError(f"Unknown selection strategy {strategy!r}, expected one of {SELECTION_STRATEGIES}")
+    try:
+        # Nothing open: the bitmap answers without a database round trip
+        bitmap = _readable_bitmap()
+        if bitmap is not None and bitmap.open_count(group_b_id) == 0:
+            logger.info("No open images available (strategy %s, Group B %s)", strategy, group_b_id)
             return None
         
-        # Pick a random image
-        row = random.choice(rows)
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        cursor = conn.cursor()
+        
+        where = f"status = 'open' AND {LIVE_CONDITION}"
+        params: List = []
+        if group_b_id is not None:
+            where += " AND source_group_b_id = ?"
+            params.append(int(group_b_id))
+        select = f"SELECT rowid, image_id, number, file_id, status, metadata, source_group_b_id FROM images WHERE {where}"
+        
+        row = None
+        for _ in range(5):
+            if claim:
+                _begin_write(conn)
+            row = _seek_open_image(cursor, strategy, select, params, group_b_id, bitmap)
+            if row is None or not claim:
+                break
+            # Close it only if no other request got there first; otherwise seek again
+            cursor.execute(
+                "UPDATE images SET status = 'closed', last_used_at = ?, use_count = use_count + 1 "
+                "WHERE rowid = ? AND status = 'open'",
+                (time.time(), row[0])
+            )
+            claimed = cursor.rowcount == 1
+            if claimed and _bitmap is not None:
+                _bitmap.set(row[0], False, row[6])
+            _commit_images(conn)
+            if claimed:
+                break
+            row = None
+        conn.close()
+        
+        if row is None:
+            logger.info("No open images available (strategy %s, Group B %s)", strategy, group_b_id)
+            return None
         
         image = {
-            'image_id': row[0],
-            'number': row[1],
-            'file_id': row[2],
-            'status': row[3]
+            'image_id': row[1],
+            'number': row[2],
+            'file_id': row[3],
+            'status': 'closed' if claim else row[4]
         }
-        
-        # Add metadata if available
-        if 'metadata' in columns and len(row) > 4 and row[4]:
+        if row[5]:
             try:
-                image['metadata'] = json.loads(row[4])
+                image['metadata'] = json.loads(row[5])
             except (ValueError, TypeError, json.JSONDecodeError) as e:
-                logger.error(f"Error parsing metadata for image {row[0]}: {e}")
+                logger.error("Error parsing metadata for image %s: %s", row[1], e)
                 image['metadata'] = {}
-        
-        conn.close()
         return image
     except Exception as e:
-        logger.error(f"Error getting random open image: {e}")
+        logger.error("Error selecting open image: %s", e)
         return None
 
+def _seek_open_image(cursor, strategy: str, select: str, params: List, group_b_id: Optional[int], bitmap=None):
+    """Run the index seek of one selection strategy; returns the row or None."""
+    if strategy in ('random', 'round_robin'):
+        if strategy == 'random':
+            if bitmap is not None:
+                high = bitmap.high_rowid
+            else:
+                cursor.execute("SELECT max(rowid) FROM images")
+                high = cursor.fetchone()[0] or 0
+            start = random.randint(0, high)
+        else:
+            start = _round_robin_cursor.get(group_b_id, 0) + 1
+        # The bitmap names the rowid, so the seek becomes a primary key lookup
+        if bitmap is not None:
+            rowid = bitmap.pick(start, group_b_id)
+            if rowid is not None:
+                cursor.execute(f"{select} AND rowid = ?", params + [rowid])
+                row = cursor.fetchone()
+                if row is not None:
+                    if strategy == 'round_robin':
+                        _round_robin_cursor[group_b_id] = row[0]
+                    return row
+        cursor.execute(f"{select} AND rowid >= ? ORDER BY rowid LIMIT 1", params + [start])
+        row = cursor.fetchone()
+        if row is None and start > 0:
+            # Wrap around to the lowest rowid
+            cursor.execute(f"{select} ORDER BY rowid LIMIT 1", params)
+            row = cursor.fetchone()
+        if row is not None and strategy == 'round_robin':
+            _round_robin_cursor[group_b_id] = row[0]
+        return row
+    order = "last_used_at" if strategy == 'lru' else "use_count, last_used_at"
+    cursor.execute(f"{select} ORDER BY {order} LIMIT 1", params)
+    return cursor.fetchone()
+
 def set_image_status(image_id: str, status: str) -> bool:
     """Set the status of an image."""
-    logger.info(f"Setting image {image_id} status to '{status}'")
+    logger.debug("Setting image %s status to '%s'", image_id, status)
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
+        _begin_write(conn)
         cursor = conn.cursor()
         
-        # Check if image exists
-        cursor.execute("SELECT image_id FROM images WHERE image_id = ?", (image_id,))
+        # Check if image exists; images of a reset Group B pool are gone as far as callers are concerned
+        cursor.execute(f"SELECT image_id FROM images WHERE image_id = ? AND {LIVE_CONDITION}", (image_id,))
         if not cursor.fetchone():
-            logger.warning(f"Image ID {image_id} not found")
+            logger.warning("Image ID %s not found", image_id)
             conn.close()
             return False
         
-        # Update status
-        cursor.execute("UPDATE images SET status = ? WHERE image_id = ?", (status, image_id))
+        # Update status; closing an open image is a claim, which the selection strategies track
+        if status == 'closed':
+            cursor.execute(
+                "UPDATE images SET status = ?, "
+                "last_used_at = CASE WHEN status = 'closed' THEN last_used_at ELSE ? END, "
+                "use_count = use_count + (status != 'closed') WHERE image_id = ?",
+                (status, time.time(), image_id)
+            )
+        else:
+            cursor.execute("UPDATE images SET status = ? WHERE image_id = ?", (status, image_id))
+        _bitmap_update(cursor, "image_id = ?", (image_id,))
         
-        conn.commit()
+        _commit_images(conn)
         conn.close()
-        logger.info(f"Updated image {image_id} status to '{status}'")
+        logger.info("Updated image %s status to '%s'", image_id, status)
         return True
     except Exception as e:
-        logger.error(f"Error setting image status: {e}")
+        logger.error("Error setting image status: %s", e)
         return False
 
 def get_all_images() -> List[Dict]:
     """Get all images from the database."""
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         
         # Check if metadata column exists
@@ -181,9 +591,9 @@ def get_all_images() -> List[Dict]:
         columns = [col[1] for col in cursor.fetchall()]
         
         if 'metadata' in columns:
-            cursor.execute("SELECT image_id, number, file_id, status, metadata FROM images")
+            cursor.execute(f"SELECT image_id, number, file_id, status, metadata FROM images WHERE {LIVE_CONDITION}")
         else:
-            cursor.execute("SELECT image_id, number, file_id, status FROM images")
+            cursor.execute(f"SELECT image_id, number, file_id, status FROM images WHERE {LIVE_CONDITION}")
         
         images = []
         for row in cursor.fetchall():
@@ -206,14 +616,14 @@ def get_all_images() -> List[Dict]:
         conn.close()
         return images
     except Exception as e:
-        logger.error(f"Error getting all images: {e}")
+        logger.error("Error getting all images: %s", e)
         return []
 
 def get_image_by_id(image_id: str) -> Optional[Dict]:
     """Get an image by ID."""
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         
         # Check if metadata column exists
@@ -221,14 +631,14 @@ def get_image_by_id(image_id: str) -> Optional[Dict]:
         columns = [col[1] for col in cursor.fetchall()]
         
         if 'metadata' in columns:
-            cursor.execute("SELECT image_id, number, file_id, status, metadata FROM images WHERE image_id = ?", (image_id,))
+            cursor.execute(f"SELECT image_id, number, file_id, status, metadata FROM images WHERE image_id = ? AND {LIVE_CONDITION}", (image_id,))
         else:
-            cursor.execute("SELECT image_id, number, file_id, status FROM images WHERE image_id = ?", (image_id,))
+            cursor.execute(f"SELECT image_id, number, file_id, status FROM images WHERE image_id = ? AND {LIVE_CONDITION}", (image_id,))
         
         row = cursor.fetchone()
         
         if not row:
-            logger.warning(f"Image ID {image_id} not found")
+            logger.warning("Image ID %s not found", image_id)
             conn.close()
             return None
         
@@ -243,255 +653,827 @@ def get_image_by_id(image_id: str) -> Optional[Dict]:
         if 'metadata' in columns and len(row) > 4 and row[4]:
             try:
                 image['metadata'] = json.loads(row[4])
-                logger.info(f"Retrieved metadata for image {image_id}: {image['metadata']}")
             except (ValueError, TypeError, json.JSONDecodeError) as e:
-                logger.error(f"Error parsing metadata for image {row[0]}: {e}")
+                logger.error("Error parsing metadata for image %s: %s", row[0], e)
                 image['metadata'] = {}
         
         conn.close()
         return image
     except Exception as e:
-        logger.error(f"Error getting image by ID: {e}")
+        logger.error("Error getting image by ID: %s", e)
+        return None
+
+def get_first_image() -> Optional[Dict]:
+    """The oldest image whatever its status, for when none is open."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        cursor = conn.cursor()
+        # A seek along the rowid that stops at the first live image, as select_open_image's wrap-around does
+        cursor.execute(
+            "SELECT image_id, number, file_id, status, metadata FROM images "
+            f"WHERE rowid > 0 AND {LIVE_CONDITION} ORDER BY rowid LIMIT 1"
+        )
+        images = _number_rows_to_images(cursor.fetchall())
+        conn.close()
+        return images[0] if images else None
+    except Exception as e:
+        logger.error("Error getting the first image: %s", e)
         return None
 
 def count_images_by_status() -> Tuple[int, int]:
     """Count the number of open and closed images."""
+    bitmap = _readable_bitmap()
+    counts = bitmap.counts() if bitmap is not None else None
+    if counts is not None:
+        return counts
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         
-        cursor.execute("SELECT COUNT(*) FROM images WHERE status = 'open'")
+        cursor.execute(f"SELECT COUNT(*) FROM images WHERE status = 'open' AND {LIVE_CONDITION}")
         open_count = cursor.fetchone()[0]
         
-        cursor.execute("SELECT COUNT(*) FROM images WHERE status = 'closed'")
+        cursor.execute(f"SELECT COUNT(*) FROM images WHERE status = 'closed' AND {LIVE_CONDITION}")
         closed_count = cursor.fetchone()[0]
         
         conn.close()
         return open_count, closed_count
     except Exception as e:
-        logger.error(f"Error counting images by status: {e}")
+        logger.error("Error counting images by status: %s", e)
         return 0, 0
 
 def get_image_path(image_id: str) -> Optional[str]:
-    """Get the path to an image file (for backward compatibility)."""
+    """Get the path of the stored copy of an image's photo (image_store.py), or None if there is none."""
     try:
-        image = get_image_by_id(image_id)
-        if not image:
+        content = get_image_content(image_id)
+        if not content or not content['content_sha256']:
             return None
-        
-        # This is a placeholder since we're now using file_id
-        # In a real system with local files, this would return the actual file path
-        return f"images/{image_id}.jpg"
+        return image_store.path_of(content['content_sha256'])
     except Exception as e:
-        logger.error(f"Error getting image path: {e}")
+        logger.error("Error getting image path: %s", e)
         return None
 
 def reset_all_image_statuses() -> bool:
     """Reset all image statuses to open."""
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
+        _begin_write(conn)
         cursor = conn.cursor()
         
         cursor.execute("UPDATE images SET status = 'open'")
+        _bitmap_rebuild(cursor)
         
-        conn.commit()
+        _commit_images(conn)
         conn.close()
         logger.info("Reset all image statuses to 'open'")
         return True
     except Exception as e:
-        logger.error(f"Error resetting image statuses: {e}")
+        logger.error("Error resetting image statuses: %s", e)
         return False
 
 def clear_all_images():
     """Delete all images from the database."""
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
+        _begin_write(conn)
         cursor = conn.cursor()
         
         cursor.execute("DELETE FROM images")
+        _bitmap_rebuild(cursor)
         
-        conn.commit()
+        _commit_images(conn)
         conn.close()
         logger.info("All images deleted from database")
         return True
     except Exception as e:
-        logger.error(f"Database error in clear_all_images: {e}")
+        logger.error("Database error in clear_all_images: %s", e)
         return False
 
 def update_image_metadata(image_id: str, metadata: str) -> bool:
     """Update an image's metadata."""
-    logger.info(f"Updating metadata for image {image_id}: {metadata}")
+    logger.debug("Updating metadata for image %s", image_id)
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
+        _begin_write(conn)
         cursor = conn.cursor()
         
         # Check if image exists
-        cursor.execute("SELECT image_id FROM images WHERE image_id = ?", (image_id,))
+        cursor.execute(f"SELECT image_id FROM images WHERE image_id = ? AND {LIVE_CONDITION}", (image_id,))
         if not cursor.fetchone():
-            logger.warning(f"Image ID {image_id} not found")
+            logger.warning("Image ID %s not found", image_id)
             conn.close()
             return False
         
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        has_metadata = any(col[1] == 'metadata' for col in cursor.fetchall())
+        # Update metadata and the indexed Group B column derived from it; a moved image joins its new pool
+        group_b_id = _group_b_of(metadata)
+        cursor.execute(
+            f"UPDATE images SET metadata = ?, source_group_b_id = ?, generation = {_CURRENT_GENERATION} "
+            "WHERE image_id = ?",
+            (metadata, group_b_id, group_b_id, image_id)
+        )
+        _bitmap_update(cursor, "image_id = ?", (image_id,))
         
-        # Add metadata column if it doesn't exist
-        if not has_metadata:
-            cursor.execute("ALTER TABLE images ADD COLUMN metadata TEXT")
-            conn.commit()
-            logger.info("Added metadata column to images table")
+        _commit_images(conn)
+        conn.close()
+        logger.info("Updated metadata for image %s", image_id)
+        return True
+    except Exception as e:
+        logger.error("Error updating image metadata: %s", e)
+        return False
+
+def set_image_content(image_id: str, content_sha256: str, content_type: Optional[str]) -> bool:
+    """Record the stored copy (image_store.py) of an image's photo."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        cursor = conn.cursor()
         
-        # Update metadata
-        cursor.execute("UPDATE images SET metadata = ? WHERE image_id = ?", (metadata, image_id))
+        cursor.execute(
+            "UPDATE images SET content_sha256 = ?, content_type = ? WHERE image_id = ?",
+            (content_sha256, content_type, image_id)
+        )
+        updated = cursor.rowcount == 1
         
         conn.commit()
         conn.close()
-        logger.info(f"Updated metadata for image {image_id}")
-        return True
+        if not updated:
+            logger.warning("Image ID %s not found", image_id)
+        return updated
     except Exception as e:
-        logger.error(f"Error updating image metadata: {e}")
+        logger.error("Error setting image content: %s", e)
         return False
 
-def get_random_open_image_by_group_b(group_b_id: int) -> Optional[Dict]:
-    """Get a random open image that belongs to a specific Group B."""
+def get_image_content(image_id: str) -> Optional[Dict]:
+    """file_unique_id, content_sha256 and content_type of an image; None if it does not exist."""
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        if 'metadata' not in columns:
-            logger.warning("Cannot filter by group_b_id as metadata column does not exist")
-            conn.close()
-            return get_random_open_image()  # Fall back to regular random selection
+        cursor.execute(
+            "SELECT file_unique_id, content_sha256, content_type FROM images WHERE image_id = ?", (image_id,)
+        )
+        row = cursor.fetchone()
         
-        # Get all open images first
-        cursor.execute("SELECT image_id, number, file_id, status, metadata FROM images WHERE status = 'open'")
+        conn.close()
+        if row is None:
+            return None
+        return {'file_unique_id': row[0], 'content_sha256': row[1], 'content_type': row[2]}
+    except Exception as e:
+        logger.error("Error getting image content: %s", e)
+        return None
+
+def get_images_without_content() -> List[Tuple[str, str]]:
+    """(image_id, file_id) of every image with no stored copy yet."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        cursor = conn.cursor()
         
+        cursor.execute(f"SELECT image_id, file_id FROM images WHERE content_sha256 IS NULL AND {LIVE_CONDITION}")
         rows = cursor.fetchall()
         
-        if not rows:
-            logger.info("No open images available")
-            conn.close()
-            return None
+        conn.close()
+        return rows
+    except Exception as e:
+        logger.error("Error getting images without content: %s", e)
+        return []
+
+def update_file_id(content_sha256: str, file_id: str) -> int:
+    """Point every image with this stored copy at a new file_id; returns the number of images updated."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        cursor = conn.cursor()
         
-        # Filter images by Group B ID
-        filtered_rows = []
-        for row in rows:
-            if row[4]:  # If metadata exists
-                try:
-                    metadata = json.loads(row[4])
-                    if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-                        if int(metadata['source_group_b_id']) == int(group_b_id):
-                            filtered_rows.append(row)
-                except (ValueError, TypeError, json.JSONDecodeError) as e:
-                    logger.error(f"Error processing metadata for image {row[0]}: {e}")
-        
-        # If we found matching images, pick a random one
-        if filtered_rows:
-            logger.info(f"Found {len(filtered_rows)} open images for Group B ID {group_b_id}")
-            row = random.choice(filtered_rows)
-            
-            image = {
-                'image_id': row[0],
-                'number': row[1],
-                'file_id': row[2],
-                'status': row[3]
-            }
-            
-            if row[4]:
-                try:
-                    image['metadata'] = json.loads(row[4])
-                except (ValueError, TypeError, json.JSONDecodeError) as e:
-                    logger.error(f"Error parsing metadata for image {row[0]}: {e}")
-                    image['metadata'] = {}
-            
-            conn.close()
-            return image
-        else:
-            # If no matching images, fall back to any open image
-            logger.info(f"No open images found for Group B ID {group_b_id}, falling back to any open image")
-            conn.close()
-            return get_random_open_image() 
+        cursor.execute("UPDATE images SET file_id = ? WHERE content_sha256 = ?", (file_id, content_sha256))
+        updated = cursor.rowcount
+        
+        conn.commit()
+        conn.close()
+        logger.info("Updated file_id of %s images with content %s", updated, content_sha256[:12])
+        return updated
     except Exception as e:
-        logger.error(f"Error in get_random_open_image_by_group_b: {e}")
-        return get_random_open_image()  # Fall back to any open image on error 
+        logger.error("Error updating file_id: %s", e)
+        return 0
 
-def clear_images_by_group_b(group_b_id: int):
-    """Delete images associated with a specific Group B from the database."""
+# Columns of an image kept in backups (image_backup.py); source_group_b_id is derived from metadata
+BACKUP_COLUMNS = ('image_id', 'number', 'file_id', 'status', 'metadata', 'last_used_at', 'use_count',
+                  'file_unique_id', 'content_sha256', 'content_type')
+
+def backup_database(path: str) -> bool:
+    """Copy the whole database to `path` with SQLite's online backup API, a consistent snapshot even while others write."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        target = sqlite3.connect(path)
+        conn.backup(target)
+        target.close()
+        conn.close()
+        logger.info("Backed up %s to %s", DB_FILE, path)
+        return True
+    except Exception as e:
+        logger.error("Error backing up the database to %s: %s", path, e)
+        return False
+
+def restore_database(path: str) -> bool:
+    """Replace the whole database, leases and bot state included, with a snapshot made by backup_database."""
+    try:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        source = sqlite3.connect(path)
+        conn = _connect()
+        if _fence is not None:
+            # Only the current leader may overwrite the database
+            _begin_write(conn)
+            conn.rollback()
+        source.backup(conn)
+        source.close()
+        conn.close()
+        # The snapshot may come from an older schema
+        _initialized_dbs.discard(os.path.abspath(DB_FILE))
+        init_db()
+        if _bitmap is not None:
+            sync_status_bitmap()
+        logger.info("Restored %s from %s", DB_FILE, path)
+        return True
+    except Exception as e:
+        logger.error("Error restoring the database from %s: %s", path, e)
+        return False
+
+def import_images(images: List[Dict], overwrite: bool = False) -> Optional[int]:
+    """
+    Write backed-up images (dicts with BACKUP_COLUMNS) in one transaction; returns how many were written.
+    An image whose image_id or photo is already stored is skipped, unless `overwrite` updates the one with its image_id.
+    """
+    if not images:
+        return 0
     try:
         init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
+        _begin_write(conn)
         cursor = conn.cursor()
         
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
+        rows = []
+        for image in images:
+            metadata = image.get('metadata')
+            if isinstance(metadata, dict):
+                metadata = json.dumps(metadata)
+            rows.append((str(image['image_id']), image.get('number'), image.get('file_id'), image.get('status') or 'open',
+                         metadata, _group_b_of(metadata), image.get('last_used_at') or 0, image.get('use_count') or 0,
+                         image.get('file_unique_id'), image.get('content_sha256'), image.get('content_type')))
         
-        if 'metadata' not in columns:
-            logger.warning("Cannot filter by group_b_id as metadata column does not exist")
-            conn.close()
-            return False
+        # Images of earlier generations make way for the restored ones
+        for start in range(0, len(rows), 500):
+            image_ids = [row[0] for row in rows[start:start + 500]]
+            cursor.execute(
+                f"DELETE FROM images WHERE image_id IN ({','.join('?' * len(image_ids))}) AND NOT ({LIVE_CONDITION})",
+                image_ids
+            )
+        _release_stale_photos(cursor, [row[8] for row in rows if row[8]])
         
-        # First count total images
-        cursor.execute("SELECT COUNT(*) FROM images")
-        total_count = cursor.fetchone()[0]
-        logger.info(f"Total images in database before deletion: {total_count}")
+        written = 0
+        if overwrite:
+            # A moved image joins its new group's current generation, so the next reset there retires it too
+            cursor.executemany(
+                "UPDATE images SET number = ?, file_id = ?, status = ?, metadata = ?, source_group_b_id = ?, "
+                f"last_used_at = ?, use_count = ?, generation = {_CURRENT_GENERATION} WHERE image_id = ?",
+                [row[1:8] + (row[5], row[0]) for row in rows]
+            )
+            written += cursor.rowcount
+        cursor.executemany(
+            "INSERT OR IGNORE INTO images (image_id, number, file_id, status, metadata, source_group_b_id, "
+            "last_used_at, use_count, file_unique_id, content_sha256, content_type, generation) "
+            f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, {_CURRENT_GENERATION})",
+            [row + (row[5],) for row in rows]
+        )
+        written += cursor.rowcount
+        for start in range(0, len(rows), 500):
+            image_ids = [row[0] for row in rows[start:start + 500]]
+            _bitmap_update(cursor, f"image_id IN ({','.join('?' * len(image_ids))})", image_ids)
         
-        # Get all images first
-        cursor.execute("SELECT image_id, metadata FROM images")
-        rows = cursor.fetchall()
+        # Later allocations must not hand out an imported img_N again
+        numbered = [int(row[0][4:]) for row in rows if row[0].startswith('img_') and row[0][4:].isdigit()]
+        if numbered:
+            cursor.execute(
+                "UPDATE bot_state SET value = MAX(CAST(value AS INTEGER), ?) WHERE key = ?",
+                (max(numbered), IMAGE_ID_SEQUENCE)
+            )
         
-        if not rows:
-            logger.info("No images available to clear")
-            conn.close()
-            return True
+        _commit_images(conn)
+        conn.close()
+        logger.info("Imported %s of %s images", written, len(rows))
+        return written
+    except Exception as e:
+        logger.error("Error importing images: %s", e)
+        return None
+
+def get_random_open_image_by_group_b(group_b_id: int, fallback: bool = True) -> Optional[Dict]:
+    """Get a random open image that belongs to a specific Group B (or any open image if `fallback`)."""
+    image = select_open_image('random', int(group_b_id))
+    if image is None and fallback:
+        # If no matching images, fall back to any open image
+        logger.info("No open images found for Group B ID %s, falling back to any open image", group_b_id)
+        return get_random_open_image()
+    return image
+
+def clear_images_by_group_b(group_b_id: int):
+    """Delete images associated with a specific Group B from the database."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        cursor = conn.cursor()
         
-        # Find images to delete by checking their metadata
-        images_to_delete = []
-        for row in rows:
-            image_id, metadata_str = row
-            if metadata_str:
-                try:
-                    metadata = json.loads(metadata_str)
-                    if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-                        source_id = int(metadata['source_group_b_id'])
-                        target_id = int(group_b_id)
-                        logger.info(f"Comparing metadata Group B ID {source_id} with target {target_id}")
-                        if source_id == target_id:
-                            images_to_delete.append(image_id)
-                            logger.info(f"Will delete image {image_id}")
-                except (ValueError, TypeError, json.JSONDecodeError) as e:
-                    logger.error(f"Error processing metadata for image {image_id}: {e}")
-            else:
-                logger.info(f"Image {image_id} has no metadata")
+        if _bitmap is not None:
+            # Take the write lock before reading the rowids the bitmap has to drop
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT rowid FROM images WHERE source_group_b_id = ?", (int(group_b_id),))
+            for (rowid,) in cursor.fetchall():
+                _bitmap.remove(rowid)
+        cursor.execute("DELETE FROM images WHERE source_group_b_id = ?", (int(group_b_id),))
+        deleted_count = cursor.rowcount
+        _commit_images(conn)
         
-        # Delete the matching images
-        if images_to_delete:
-            placeholders = ', '.join(['?'] * len(images_to_delete))
-            cursor.execute(f"DELETE FROM images WHERE image_id IN ({placeholders})", images_to_delete)
-            conn.commit()
-            
-            # Verify deletion by counting remaining images
-            cursor.execute("SELECT COUNT(*) FROM images")
-            remaining_count = cursor.fetchone()[0]
-            deleted_count = total_count - remaining_count
-            
-            logger.info(f"Database had {total_count} images, deleted {deleted_count}, {remaining_count} remaining")
-            logger.info(f"Deleted {len(images_to_delete)} images for Group B ID {group_b_id}")
+        if deleted_count:
+            logger.info("Deleted %s images for Group B ID %s", deleted_count, group_b_id)
         else:
-            logger.info(f"No images found for Group B ID {group_b_id}")
+            logger.info("No images found for Group B ID %s", group_b_id)
+        
+        conn.close()
+        return True
+    except Exception as e:
+        logger.error("Database error in clear_images_by_group_b: %s", e)
+        return False
+
+def _number_rows_to_images(rows) -> List[Dict]:
+    """Image dicts from (image_id, number, file_id, status, metadata) rows."""
+    images = []
+    for image_id, number, file_id, status, metadata in rows:
+        image = {'image_id': image_id, 'number': number, 'file_id': file_id, 'status': status}
+        if metadata:
+            try:
+                image['metadata'] = json.loads(metadata)
+            except (ValueError, TypeError) as e:
+                logger.error("Error parsing metadata for image %s: %s", image_id, e)
+                image['metadata'] = {}
+        images.append(image)
+    return images
+
+# get_images_by_number() with this instead of a Group B matches images of every Group B
+ANY_GROUP_B = object()
+
+def get_images_by_number(number: int, group_b_id=ANY_GROUP_B, limit: Optional[int] = None) -> List[Dict]:
+    """The images with this number in a Group B (None: images of no Group B; ANY_GROUP_B: any), oldest first."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        cursor = conn.cursor()
+        
+        if group_b_id is ANY_GROUP_B:
+            # Also finds images of Group Bs that were dissolved since, through idx_images_number
+            where = "number = ?"
+            params = [int(number)]
+        else:
+            # "IS ?" matches NULL too, so both cases are one seek into idx_images_group_b_number
+            where = "source_group_b_id IS ? AND number = ?"
+            params = [None if group_b_id is None else int(group_b_id), int(number)]
+        sql = f"SELECT image_id, number, file_id, status, metadata FROM images WHERE {where} AND {LIVE_CONDITION} ORDER BY rowid"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        cursor.execute(sql, params)
+        images = _number_rows_to_images(cursor.fetchall())
+        conn.close()
+        return images
+    except Exception as e:
+        logger.error("Error getting images with number %s: %s", number, e)
+        return []
+
+def delete_images_by_number(number: int, group_b_id: Optional[int]) -> Optional[List[Dict]]:
+    """Delete the images with this number in a Group B (None: images of no Group B); returns them."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.cursor()
+        
+        # Images of a reset pool are left to purge_stale_images
+        cursor.execute(
+            f"DELETE FROM images WHERE source_group_b_id IS ? AND number = ? AND {LIVE_CONDITION} "
+            "RETURNING rowid, image_id, number, file_id, status, metadata",
+            (None if group_b_id is None else int(group_b_id), int(number))
+        )
+        rows = cursor.fetchall()
+        if _bitmap is not None:
+            for row in rows:
+                _bitmap.remove(row[0])
+        _commit_images(conn)
+        conn.close()
+        logger.info("Deleted %s images with number %s from Group B %s", len(rows), number, group_b_id)
+        return _number_rows_to_images(row[1:] for row in rows)
+    except Exception as e:
+        logger.error("Error deleting images with number %s: %s", number, e)
+        return None
+
+def get_group_generation(group_b_id: int) -> int:
+    """The current generation of a Group B's image pool (0 until its first reset)."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        row = conn.execute("SELECT generation FROM group_generations WHERE group_b_id = ?", (int(group_b_id),)).fetchone()
+        conn.close()
+        return row[0] if row else 0
+    except Exception as e:
+        logger.error("Error getting generation of Group B %s: %s", group_b_id, e)
+        return 0
+
+def reset_group_b(group_b_id: int) -> Optional[int]:
+    """Retire a Group B's whole image pool at once by starting a new generation; returns it.
+    
+    The images stay in the table until purge_stale_images deletes them, but
+    every reader already skips them, so the reset costs the same however
+    many images or earlier generations the pool has.
+    """
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            "INSERT INTO group_generations (group_b_id, generation) VALUES (?, 1) "
+            "ON CONFLICT(group_b_id) DO UPDATE SET generation = generation + 1",
+            (int(group_b_id),)
+        )
+        cursor.execute("SELECT generation FROM group_generations WHERE group_b_id = ?", (int(group_b_id),))
+        generation = cursor.fetchone()[0]
+        # Dropping the pool's rowids one by one would cost what the generation saves; the purge rebuilds it
+        if _bitmap is not None:
+            cursor.execute("SELECT 1 FROM images WHERE source_group_b_id = ? LIMIT 1", (int(group_b_id),))
+            if cursor.fetchone():
+                _bitmap.invalidate(f"Group B {group_b_id} was reset")
+        _commit_images(conn)
+        conn.close()
+        logger.info("Reset Group B %s to generation %s", group_b_id, generation)
+        return generation
+    except Exception as e:
+        logger.error("Error resetting Group B %s: %s", group_b_id, e)
+        return None
+
+def get_stale_generations() -> List[Tuple[int, int]]:
+    """(Group B ID, current generation) of every Group B that still has images of earlier generations."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT group_b_id, generation FROM group_generations WHERE EXISTS "
+            "(SELECT 1 FROM images WHERE source_group_b_id = group_b_id AND images.generation < group_generations.generation)"
+        )
+        stale = cursor.fetchall()
+        conn.close()
+        return stale
+    except Exception as e:
+        logger.error("Error getting stale generations: %s", e)
+        return []
+
+def purge_stale_images(group_b_id: int, limit: int = 500, before: Optional[int] = None) -> Optional[List[str]]:
+    """Delete up to `limit` images of a Group B's earlier generations (older than `before` if given); returns their image IDs."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.cursor()
         
+        params = [int(group_b_id), int(group_b_id)]
+        condition = ""
+        if before is not None:
+            # Images retired by a later reset were not in the caller's backup
+            condition = "AND generation < ? "
+            params.append(int(before))
+        cursor.execute(
+            f"SELECT rowid, image_id FROM images WHERE source_group_b_id = ? AND generation < {_CURRENT_GENERATION} "
+            f"{condition}LIMIT ?",
+            params + [int(limit)]
+        )
+        rows = cursor.fetchall()
+        cursor.executemany("DELETE FROM images WHERE rowid = ?", [(rowid,) for rowid, _ in rows])
+        if _bitmap is not None:
+            for rowid, _ in rows:
+                _bitmap.remove(rowid)
+        _commit_images(conn)
+        conn.close()
+        if rows:
+            logger.info("Purged %s stale images of Group B %s", len(rows), group_b_id)
+        return [image_id for _, image_id in rows]
+    except Exception as e:
+        logger.error("Error purging stale images of Group B %s: %s", group_b_id, e)
+        return None
+
+def get_state(key: str, default: Optional[str] = None) -> Optional[str]:
+    """Read a value from the bot_state table."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        row = conn.execute("SELECT value FROM bot_state WHERE key = ?", (key,)).fetchone()
+        conn.close()
+        return row[0] if row else default
+    except Exception as e:
+        logger.error("Error reading state %s: %s", key, e)
+        return default
+
+def set_state(key: str, value) -> bool:
+    """Write a value to the bot_state table."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        conn.execute("INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)", (key, str(value)))
+        conn.commit()
         conn.close()
         return True
     except Exception as e:
-        logger.error(f"Database error in clear_images_by_group_b: {e}")
-        return False 
\ No newline at end of file
+        logger.error("Error writing state %s: %s", key, e)
+        return False
+
+def is_message_handled(chat_id: int, message_id: int) -> bool:
+    """True if mark_message_handled recorded this message before."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        row = conn.execute(
+            "SELECT 1 FROM handled_messages WHERE chat_id = ? AND message_id = ?", (int(chat_id), int(message_id))
+        ).fetchone()
+        conn.close()
+        return row is not None
+    except Exception as e:
+        # Handling the message twice is better than not handling it at all
+        logger.error("Error checking handled message %s/%s: %s", chat_id, message_id, e)
+        return False
+
+def mark_message_handled(chat_id: int, message_id: int, handler: str) -> bool:
+    """Record that a message was handled. False if it was recorded before."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO handled_messages (chat_id, message_id, handler, handled_at) VALUES (?, ?, ?, ?)",
+            (int(chat_id), int(message_id), handler, time.time())
+        )
+        first = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        return first
+    except StaleFencingToken as e:
+        # Another instance is the leader now and records its own messages
+        logger.error("Not recording message %s/%s: %s", chat_id, message_id, e)
+        return False
+    except Exception as e:
+        # Handling the message twice is better than not handling it at all
+        logger.error("Error recording handled message %s/%s: %s", chat_id, message_id, e)
+        return True
+
+def prune_handled_messages(older_than: float) -> int:
+    """Forget handled messages recorded before the `older_than` timestamp."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        cursor = conn.execute("DELETE FROM handled_messages WHERE handled_at < ?", (older_than,))
+        deleted = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return deleted
+    except Exception as e:
+        logger.error("Error pruning handled messages: %s", e)
+        return 0
+
+def enable_wal() -> str:
+    """Switch the database to write-ahead logging so readers and the writer of other processes do not block each other."""
+    global _wal
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        conn.close()
+        _wal = mode == "wal"
+        return mode
+    except Exception as e:
+        logger.error("Error enabling WAL: %s", e)
+        return ""
+
+def sync_status_bitmap() -> bool:
+    """Rebuild the status bitmap from the images table, under the write lock so no change slips between."""
+    if _bitmap is None:
+        return False
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        _bitmap_rebuild(conn.cursor())
+        conn.rollback()
+        conn.close()
+        return _bitmap.valid
+    except Exception as e:
+        logger.error("Error rebuilding the status bitmap: %s", e)
+        return False
+
+def get_shared(namespace: str, key: str) -> Optional[str]:
+    """Read one value from the shared_state table."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        row = conn.execute(
+            "SELECT value FROM shared_state WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        conn.close()
+        return row[0] if row else None
+    except Exception as e:
+        logger.error("Error reading shared %s/%s: %s", namespace, key, e)
+        return None
+
+def set_shared(namespace: str, key: str, value: str) -> bool:
+    """Write one value to the shared_state table."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO shared_state (namespace, key, value) VALUES (?, ?, ?)", (namespace, key, value)
+        )
+        conn.commit()
+        conn.close()
+        return True
+    except Exception as e:
+        logger.error("Error writing shared %s/%s: %s", namespace, key, e)
+        return False
+
+def delete_shared(namespace: str, key: str) -> bool:
+    """Delete one value from the shared_state table. False if it was not there."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        cursor = conn.execute("DELETE FROM shared_state WHERE namespace = ? AND key = ?", (namespace, key))
+        deleted = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        return deleted
+    except Exception as e:
+        logger.error("Error deleting shared %s/%s: %s", namespace, key, e)
+        return False
+
+def get_shared_items(namespace: str) -> List[Tuple[str, str]]:
+    """All (key, value) rows of one namespace of the shared_state table."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        rows = conn.execute("SELECT key, value FROM shared_state WHERE namespace = ?", (namespace,)).fetchall()
+        conn.close()
+        return rows
+    except Exception as e:
+        logger.error("Error reading shared %s: %s", namespace, e)
+        return []
+
+def get_outstanding_notifications() -> List[Tuple[str, Optional[int], Optional[float]]]:
+    """(image_id, group_b_chat_id, forwarded_at) of each shared forwarded_msgs entry whose image is still closed.
+    
+    Walks the forwarded_msgs namespace and looks each image up by its
+    primary key, so the cost follows the number of notifications, not the
+    size of the image pool.
+    """
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        rows = conn.execute(
+            "SELECT shared_state.key, json_extract(shared_state.value, '$.group_b_chat_id'), "
+            "json_extract(shared_state.value, '$.forwarded_at') "
+            "FROM shared_state JOIN images ON images.image_id = shared_state.key "
+            f"WHERE shared_state.namespace = 'forwarded_msgs' AND images.status = 'closed' AND {LIVE_CONDITION}"
+        ).fetchall()
+        conn.close()
+        return rows
+    except Exception as e:
+        logger.error("Error reading outstanding notifications: %s", e)
+        return []
+
+def count_shared(namespace: str) -> int:
+    """Number of rows in one namespace of the shared_state table."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        count = conn.execute("SELECT COUNT(*) FROM shared_state WHERE namespace = ?", (namespace,)).fetchone()[0]
+        conn.close()
+        return count
+    except Exception as e:
+        logger.error("Error counting shared %s: %s", namespace, e)
+        return 0
+
+def replace_shared(namespace: str, items: List[Tuple[str, str]]) -> bool:
+    """Replace one namespace of the shared_state table with `items` in a single transaction."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        _begin_write(conn)
+        with conn:
+            conn.execute("DELETE FROM shared_state WHERE namespace = ?", (namespace,))
+            conn.executemany(
+                "INSERT INTO shared_state (namespace, key, value) VALUES (?, ?, ?)",
+                [(namespace, key, value) for key, value in items]
+            )
+        conn.close()
+        return True
+    except Exception as e:
+        logger.error("Error replacing shared %s: %s", namespace, e)
+        return False
+
+def acquire_lease(name: str, holder: str, ttl: float) -> Optional[int]:
+    """Take lease `name` for `ttl` seconds unless another holder's lease is still running.
+    
+    Returns the fencing token, which grows by one whenever the lease changes hands
+    (or is taken again after it lapsed), or None if someone else holds it.
+    """
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT holder, token, expires_at FROM leader_lease WHERE name = ?", (name,)).fetchone()
+        now = time.time()
+        if row is not None and row[0] != holder and row[2] > now:
+            conn.rollback()
+            conn.close()
+            return None
+        token = row[1] if row is not None and row[0] == holder and row[2] > now else (row[1] if row else 0) + 1
+        conn.execute(
+            "INSERT OR REPLACE INTO leader_lease (name, holder, token, expires_at) VALUES (?, ?, ?, ?)",
+            (name, holder, token, now + ttl)
+        )
+        conn.commit()
+        conn.close()
+        return token
+    except Exception as e:
+        logger.error("Error acquiring lease %s: %s", name, e)
+        return None
+
+def renew_lease(name: str, holder: str, token: int, ttl: float) -> bool:
+    """Extend lease `name` by `ttl` seconds. False if it has changed hands since `token` was issued."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        cursor = conn.execute(
+            "UPDATE leader_lease SET expires_at = ? WHERE name = ? AND holder = ? AND token = ?",
+            (time.time() + ttl, name, holder, token)
+        )
+        renewed = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        return renewed
+    except Exception as e:
+        logger.error("Error renewing lease %s: %s", name, e)
+        return False
+
+def release_lease(name: str, holder: str, token: int) -> bool:
+    """Let lease `name` expire now so a standby can take it at once."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        cursor = conn.execute(
+            "UPDATE leader_lease SET expires_at = 0 WHERE name = ? AND holder = ? AND token = ?",
+            (name, holder, token)
+        )
+        released = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        return released
+    except Exception as e:
+        logger.error("Error releasing lease %s: %s", name, e)
+        return False
+
+def get_lease(name: str) -> Optional[Dict]:
+    """Current holder, token and expiry of lease `name`."""
+    try:
+        init_db()  # Make sure the database exists
+        conn = _connect()
+        row = conn.execute("SELECT holder, token, expires_at FROM leader_lease WHERE name = ?", (name,)).fetchone()
+        conn.close()
+        return {'holder': row[0], 'token': row[1], 'expires_at': row[2]} if row else None
+    except Exception as e:
+        logger.error("Error reading lease %s: %s", name, e)
+        return None
+
+# Record call counts and latency for every public function above
+metrics.instrument_module(sys.modules[__name__], 'db')
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Telegram Bot API, for load testing without the network.
+
+Implements getUpdates (long polling), sendMessage, sendPhoto (by file_id or
+upload), getFile and file downloads, getChatMember, getChat,
+answerCallbackQuery and editMessageReplyMarkup, plus getMe and deleteWebhook
+which the Updater calls on startup. Every call can be delayed, answered with
+429 RetryAfter or dropped after a hold to simulate timeouts. With
+--reject-file-ids, file_ids issued by an earlier run of the server are
+refused, as after a bot token change.
+
+The server also scripts traffic: admins seed each Group B with "设置群 N"
+photos (or "设置群 N-M" albums with --album-size), members send amounts in
+Group A at a fixed rate, and every "💰 金额" notification the bot sends to a
+Group B is answered with "+amount" or "0" after a think time. Response latencies are reported on GET /stats
+and on shutdown.
+
+Point the bot at it with:
+    TELEGRAM_BOT_TOKEN=123:fake TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot python bot.py
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Polling and startup calls are always answered promptly
+_UNFAULTED_METHODS = ('getUpdates', 'getMe', 'deleteWebhook')
+
+BOT_USER = {'id': 777000, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class FakeTelegram:
+    """State of the fake API: pending updates, sent messages and statistics."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.group_a_ids: List[int] = args.group_a
+        self.group_b_ids: List[int] = args.group_b
+        self.admin_id = args.admin_id
+
+        self._lock = threading.Condition()
+        self._updates: List[Dict] = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+
+        # (chat_id, message_id) -> time the update carrying it was handed to the bot
+        self._delivered_at: Dict[tuple, float] = {}
+        self.latencies: Dict[str, List[float]] = {'group_a_reply': [], 'group_b_notify': [], 'ack_to_group_a': []}
+        self.calls: Counter = Counter()
+        self.injected: Counter = Counter()
+        self._stop = threading.Event()
+        # file_ids carry the server start time, so those of an earlier run can be told apart
+        self.file_id_prefix = f"fake_photo_{int(time.time())}_"
+
+    # --- update stream -------------------------------------------------
+
+    def _message_id(self) -> int:
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        return message_id
+
+    def _chat(self, chat_id: int) -> Dict:
+        if chat_id > 0:
+            return {'id': chat_id, 'type': 'private', 'first_name': f"user{chat_id}", 'username': f"user{chat_id}"}
+        return {'id': chat_id, 'type': 'supergroup', 'title': f"chat{chat_id}"}
+
+    def _user(self, user_id: int) -> Dict:
+        return {'id': user_id, 'is_bot': user_id == BOT_USER['id'], 'first_name': f"user{user_id}", 'username': f"user{user_id}"}
+
+    def push_message(self, chat_id: int, user_id: int, text: str = None, reply_to: Dict = None,
+                     photo: bool = False, caption: str = None, media_group_id: str = None) -> Dict:
+        """Queue an update carrying a new message and return the message."""
+        message = {
+            'message_id': self._message_id(),
+            'date': int(time.time()),
+            'chat': self._chat(chat_id),
+            'from': self._user(user_id),
+        }
+        if text is not None:
+            message['text'] = text
+        if reply_to:
+            message['reply_to_message'] = reply_to
+        if photo:
+            message['photo'] = [self._photo_size(f"{self.file_id_prefix}{message['message_id']}")]
+            message['caption'] = caption
+        if media_group_id:
+            message['media_group_id'] = media_group_id
+        with self._lock:
+            self._updates.append({'update_id': self._next_update_id, 'message': message})
+            self._next_update_id += 1
+            self._lock.notify_all()
+        return message
+
+    def get_updates(self, offset: int, limit: int, timeout: float) -> List[Dict]:
+        """Long-poll for updates with update_id >= offset."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            # Updates below the offset are confirmed and can be dropped
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            batch = self._updates[:limit]
+        now = time.monotonic()
+        for update in batch:
+            message = update['message']
+            self._delivered_at.setdefault((message['chat']['id'], message['message_id']), now)
+        return batch
+
+    # --- bot calls -----------------------------------------------------
+
+    def _sent_message(self, chat_id: int, **fields) -> Dict:
+        message = {
+            'message_id': self._message_id(),
+            'date': int(time.time()),
+            'chat': self._chat(chat_id),
+            'from': BOT_USER,
+        }
+        message.update({k: v for k, v in fields.items() if v is not None})
+        return message
+
+    def _observe_reply(self, kind: str, chat_id: int, reply_to_message_id) -> None:
+        if reply_to_message_id is None:
+            return
+        delivered = self._delivered_at.get((chat_id, int(reply_to_message_id)))
+        if delivered is not None:
+            self.latencies[kind].append(time.monotonic() - delivered)
+
+    def send_message(self, data: Dict) -> Dict:
+        chat_id = int(data['chat_id'])
+        text = data.get('text', '')
+        message = self._sent_message(chat_id, text=text)
+        reply_to = data.get('reply_to_message_id')
+
+        if chat_id in self.group_b_ids and "金额" in text:
+            # Notification for a Group A request: time it against the newest Group A update
+            with self._lock:
+                last_a = max((t for (c, _), t in self._delivered_at.items() if c in self.group_a_ids), default=None)
+            if last_a is not None:
+                self.latencies['group_b_notify'].append(time.monotonic() - last_a)
+            self._schedule_group_b_answer(message)
+        elif chat_id in self.group_a_ids:
+            self._observe_reply('ack_to_group_a', chat_id, reply_to)
+        return message
+
+    def _photo_size(self, file_id: str) -> Dict:
+        return {'file_id': file_id, 'file_unique_id': hashlib.md5(file_id.encode()).hexdigest()[:16], 'width': 800, 'height': 600}
+
+    def file_content(self, file_id: str) -> bytes:
+        """Bytes of a photo: a JPEG header and filler derived from the file_id."""
+        return b'\xff\xd8\xff\xe0\x00\x10JFIF\x00' + hashlib.sha256(file_id.encode()).digest() * 64
+
+    def send_photo(self, data: Dict) -> Dict:
+        chat_id = int(data['chat_id'])
+        photo = data.get('photo')
+        if isinstance(photo, bytes):
+            self.calls['photo_upload'] += 1
+            file_id = f"{self.file_id_prefix}{self._next_message_id}"
+        elif self.args.reject_file_ids and not str(photo).startswith(self.file_id_prefix):
+            raise ValueError("wrong file identifier/HTTP URL specified")
+        else:
+            file_id = photo
+        message = self._sent_message(chat_id, caption=data.get('caption'), photo=[self._photo_size(file_id)])
+        if chat_id in self.group_a_ids:
+            self._observe_reply('group_a_reply', chat_id, data.get('reply_to_message_id'))
+        return message
+
+    def _schedule_group_b_answer(self, notification: Dict) -> None:
+        match = re.search(r'金额：(\d+)', notification.get('text', ''))
+        if not match:
+            return
+        answer = "0" if self.rng.random() < self.args.zero_ratio else f"+{match.group(1)}"
+        chat_id = notification['chat']['id']
+        member = self.rng.randint(100000, 199999)
+        timer = threading.Timer(
+            self.args.ack_delay,
+            lambda: self.push_message(chat_id, member, text=answer, reply_to=notification)
+        )
+        timer.daemon = True
+        timer.start()
+
+    def call(self, method: str, data: Dict):
+        """Dispatch one Bot API method and return its `result`."""
+        if method == 'getUpdates':
+            return self.get_updates(int(data.get('offset') or 0), int(data.get('limit') or 100),
+                                    float(data.get('timeout') or 0))
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('deleteWebhook', 'answerCallbackQuery'):
+            return True
+        if method == 'sendMessage':
+            return self.send_message(data)
+        if method == 'sendPhoto':
+            return self.send_photo(data)
+        if method == 'getFile':
+            file_id = data['file_id']
+            return {'file_id': file_id, 'file_unique_id': hashlib.md5(file_id.encode()).hexdigest()[:16],
+                    'file_size': len(self.file_content(file_id)), 'file_path': f"photos/{file_id}.jpg"}
+        if method == 'getChatMember':
+            return {'user': self._user(int(data['user_id'])), 'status': 'member'}
+        if method == 'getChat':
+            return self._chat(int(data['chat_id']))
+        if method == 'editMessageReplyMarkup':
+            return self._sent_message(int(data.get('chat_id') or 0))
+        raise KeyError(method)
+
+    # --- traffic generators --------------------------------------------
+
+    def seed_images(self) -> None:
+        """Have an admin upload `images_per_group_b` photos to every Group B, singly or as albums."""
+        album_size = self.args.album_size
+        for group_b_id in self.group_b_ids:
+            if album_size <= 1:
+                for number in range(1, self.args.images_per_group_b + 1):
+                    self.push_message(group_b_id, self.admin_id, photo=True, caption=f"设置群 {number}")
+                continue
+            # One album per `album_size` numbers, captioned "设置群 first-last" on its first photo
+            for first in range(1, self.args.images_per_group_b + 1, album_size):
+                last = min(first + album_size - 1, self.args.images_per_group_b)
+                media_group_id = f"album_{group_b_id}_{first}"
+                for number in range(first, last + 1):
+                    caption = f"设置群 {first}-{last}" if number == first else None
+                    self.push_message(group_b_id, self.admin_id, photo=True, caption=caption,
+                                      media_group_id=media_group_id)
+
+    def run_group_a_traffic(self) -> None:
+        """Send amounts in random Group A chats at `rate` messages per second."""
+        interval = 1.0 / self.args.rate if self.args.rate > 0 else None
+        deadline = time.monotonic() + self.args.duration
+        while interval and not self._stop.is_set() and time.monotonic() < deadline:
+            chat_id = self.rng.choice(self.group_a_ids)
+            amount = self.rng.randint(100, 200)
+            text = f"{amount} 群" if self.rng.random() < 0.3 else str(amount)
+            self.push_message(chat_id, self.rng.randint(200000, 299999), text=text)
+            self._stop.wait(interval)
+        logger.info("Group A traffic finished")
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._lock:
+            self._lock.notify_all()
+
+    def stats(self) -> Dict:
+        """Summarise calls, injected faults and response latencies."""
+        latencies = {}
+        for name, values in self.latencies.items():
+            ordered = sorted(values)
+            latencies[name] = {
+                'count': len(ordered),
+                'p50_ms': percentile(ordered, 50) * 1000,
+                'p95_ms': percentile(ordered, 95) * 1000,
+                'p99_ms': percentile(ordered, 99) * 1000,
+            }
+        return {'calls': dict(self.calls), 'injected': dict(self.injected), 'latency': latencies}
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """HTTP front end: /bot<token>/<method> plus GET /stats."""
+
+    api: FakeTelegram = None
+
+    def _reply(self, status: int, payload: Dict) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_data(self) -> Dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if not raw:
+            return {}
+        content_type = self.headers.get('Content-Type') or ''
+        if 'json' in content_type:
+            return json.loads(raw)
+        if 'multipart/form-data' in content_type:
+            # Uploads: file parts stay bytes, the other fields are text
+            form = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + raw)
+            data = {}
+            for part in form.iter_parts():
+                payload = part.get_payload(decode=True)
+                name = part.get_param('name', header='content-disposition')
+                data[name] = payload if part.get_filename() else payload.decode()
+            return data
+        return {}
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.api.stats())
+            return
+        match = re.match(r'^/file/bot[^/]+/photos/(\w+)\.jpg$', self.path)
+        if match:
+            self.api.calls['download'] += 1
+            body = self.api.file_content(match.group(1))
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.do_POST()
+
+    def do_POST(self):
+        match = re.match(r'^/bot[^/]+/(\w+)', self.path)
+        if not match:
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        method = match.group(1)
+        data = self._read_data()
+        api = self.api
+        args = api.args
+        api.calls[method] += 1
+
+        if method not in _UNFAULTED_METHODS:
+            # Fault injection applies to the bot's working calls, not polling or startup
+            if args.latency_ms:
+                time.sleep(api.rng.uniform(0, 2 * args.latency_ms) / 1000.0)
+            roll = api.rng.random()
+            if roll < args.retry_after_rate:
+                api.injected['429'] += 1
+                self._reply(429, {
+                    'ok': False, 'error_code': 429,
+                    'description': f"Too Many Requests: retry after {args.retry_after}",
+                    'parameters': {'retry_after': args.retry_after},
+                })
+                return
+            if roll < args.retry_after_rate + args.timeout_rate:
+                api.injected['timeout'] += 1
+                time.sleep(args.timeout_hold)
+                self.close_connection = True
+                return
+
+        try:
+            result = api.call(method, data)
+        except KeyError:
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': f"Method {method} not found"})
+            return
+        except Exception as e:
+            self._reply(400, {'ok': False, 'error_code': 400, 'description': f"Bad Request: {e}"})
+            return
+        self._reply(200, {'ok': True, 'result': result})
+
+    def log_message(self, format, *args):
+        return
+
+
+def _load_ids(path: str) -> List[int]:
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return [int(x) for x in json.load(f)]
+    return []
+
+
+def main():
+    """Run the fake API server and its traffic generators until interrupted."""
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server for load tests.")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--group-a", type=int, nargs='*', help="Group A chat IDs (default: group_a_ids.json)")
+    parser.add_argument("--group-b", type=int, nargs='*', help="Group B chat IDs (default: group_b_ids.json)")
+    parser.add_argument("--admin-id", type=int, default=5962096701, help="global admin that seeds images")
+    parser.add_argument("--images-per-group-b", type=int, default=20, help="photos seeded per Group B")
+    parser.add_argument("--album-size", type=int, default=1,
+                        help="seed photos as albums of this many (one '设置群 N-M' caption each)")
+    parser.add_argument("--rate", type=float, default=5.0, help="Group A requests per second")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds of Group A traffic")
+    parser.add_argument("--ack-delay", type=float, default=0.5, help="Group B think time before answering")
+    parser.add_argument("--zero-ratio", type=float, default=0.2, help="share of Group B answers that are '0'")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="mean injected latency per bot call")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in 429 answers")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="share of calls dropped after a hold")
+    parser.add_argument("--timeout-hold", type=float, default=5.0, help="seconds to hold a dropped call")
+    parser.add_argument("--reject-file-ids", action="store_true",
+                        help="refuse file_ids from earlier runs, like after a bot token change")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    args.group_a = args.group_a or _load_ids("group_a_ids.json")
+    args.group_b = args.group_b or _load_ids("group_b_ids.json")
+    if not args.group_a or not args.group_b:
+        parser.error("need at least one Group A and one Group B chat ID")
+
+    api = FakeTelegram(args)
+    handler = type('BoundFakeApiHandler', (FakeApiHandler,), {'api': api})
+    httpd = ThreadingHTTPServer(('127.0.0.1', args.port), handler)
+    httpd.daemon_threads = True
+    logger.info("Fake Bot API listening on http://127.0.0.1:%s/bot", args.port)
+
+    api.seed_images()
+    traffic = threading.Thread(target=api.run_group_a_traffic, name="group-a-traffic", daemon=True)
+    traffic.start()
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.stop()
+        httpd.server_close()
+        print(json.dumps(api.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Slow-handler watchdog.
+
+Handlers register themselves as in-flight on their worker thread. A background
+thread checks the in-flight table and, for every handler running longer than
+the latency budget, samples that thread's stack with sys._current_frames().
+Identical stacks are aggregated so the report shows where time is spent
+(e.g. time.sleep in a retry loop vs. a SQLite lock wait).
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Number of innermost frames kept per sampled stack
+STACK_DEPTH = 12
+
+
+class _InFlight:
+    __slots__ = ('handler', 'chat_id', 'update_id', 'started', 'next_sample')
+
+    def __init__(self, handler, chat_id, update_id, started, next_sample):
+        self.handler = handler
+        self.chat_id = chat_id
+        self.update_id = update_id
+        self.started = started
+        self.next_sample = next_sample
+
+
+class _StackStats:
+    __slots__ = ('count', 'max_elapsed', 'handlers', 'last_chat_id')
+
+    def __init__(self):
+        self.count = 0
+        self.max_elapsed = 0.0
+        self.handlers = set()
+        self.last_chat_id = None
+
+
+class Watchdog:
+    """Tracks in-flight handler calls and samples the stacks of slow ones."""
+
+    def __init__(self, budget: float = 2.0, interval: float = None):
+        self.budget = budget
+        self.interval = interval or max(0.05, budget / 4)
+        self._inflight: Dict[int, _InFlight] = {}
+        self._stacks: Dict[Tuple, _StackStats] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def begin(self, handler: str, chat_id=None, update_id=None) -> None:
+        """Mark the current thread as running `handler`."""
+        now = time.monotonic()
+        self._inflight[threading.get_ident()] = _InFlight(handler, chat_id, update_id, now, now + self.budget)
+
+    def end(self) -> None:
+        """Mark the current thread's handler as finished."""
+        self._inflight.pop(threading.get_ident(), None)
+
+    def start(self) -> None:
+        """Start the sampling thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="slow-handler-watchdog", daemon=True)
+        self._thread.start()
+        logger.info("Slow-handler watchdog started with a %.1fs budget", self.budget)
+
+    def stop(self) -> None:
+        """Stop the sampling thread."""
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error("Watchdog check failed: %s", e)
+
+    def check(self) -> int:
+        """Sample every handler over budget once per budget period. Returns the number sampled."""
+        now = time.monotonic()
+        overdue = [(ident, entry) for ident, entry in list(self._inflight.items()) if now >= entry.next_sample]
+        if not overdue:
+            return 0
+
+        frames = sys._current_frames()
+        sampled = 0
+        for ident, entry in overdue:
+            frame = frames.get(ident)
+            if frame is None or self._inflight.get(ident) is not entry:
+                continue
+            elapsed = now - entry.started
+            entry.next_sample = now + self.budget
+
+            stack = tuple(
+                (os.path.basename(f.filename), f.lineno, f.name)
+                for f in traceback.extract_stack(frame)[-STACK_DEPTH:]
+            )
+            with self._lock:
+                stats = self._stacks.get(stack)
+                if stats is None:
+                    stats = self._stacks[stack] = _StackStats()
+                stats.count += 1
+                stats.max_elapsed = max(stats.max_elapsed, elapsed)
+                stats.handlers.add(entry.handler)
+                stats.last_chat_id = entry.chat_id
+            sampled += 1
+
+            leaf = stack[-1] if stack else ("?", 0, "?")
+            logger.warning(
+                "Slow handler %s (chat %s, update %s) running for %.1fs, at %s:%s in %s",
+                entry.handler, entry.chat_id, entry.update_id, elapsed, leaf[0], leaf[1], leaf[2]
+            )
+        return sampled
+
+    def report(self, top: int = 5, frames: int = 6) -> str:
+        """Summarise the most frequently sampled slow stacks."""
+        with self._lock:
+            items = sorted(self._stacks.items(), key=lambda item: item[1].count, reverse=True)[:top]
+            in_flight = len(self._inflight)
+        if not items:
+            return f"No slow handlers over {self.budget:.1f}s recorded ({in_flight} in flight)."
+
+        lines = [f"🐢 Slow stacks over {self.budget:.1f}s ({in_flight} in flight):"]
+        for stack, stats in items:
+            lines.append(
+                f"\n{stats.count} samples, max {stats.max_elapsed:.1f}s, "
+                f"handlers: {', '.join(sorted(stats.handlers))}, last chat: {stats.last_chat_id}"
+            )
+            for filename, lineno, name in stack[-frames:]:
+                lines.append(f"  {filename}:{lineno} {name}")
+        return "\n".join(lines)
+
+    def reset(self) -> None:
+        """Forget all aggregated stacks."""
+        with self._lock:
+            self._stacks = {}
+
+
+# Shared watchdog used by the handler instrumentation
+WATCHDOG = Watchdog(budget=float(os.environ.get("SLOW_HANDLER_BUDGET", "2.0")))
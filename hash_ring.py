@@ -0,0 +1,62 @@
+"""
+Consistent-hash ring for assigning images to Group B chats.
+
+Each Group B is placed on the ring at `vnodes` points derived from a stable
+hash (blake2b, not Python's per-process randomized hash()), and a key maps
+to the first point clockwise from its own hash. Adding or removing one of N
+Group Bs therefore only moves about 1/N of the keys, and the mapping is the
+same in every process. Lookups are a bisect over the sorted points.
+"""
+import bisect
+import hashlib
+from typing import Hashable, Iterable, List, Optional, Tuple
+
+DEFAULT_VNODES = 160
+
+
+def stable_hash(key: str) -> int:
+    """64-bit hash of `key` that does not depend on PYTHONHASHSEED."""
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Immutable ring over a set of nodes; build a new one when the set changes."""
+
+    def __init__(self, nodes: Iterable[Hashable], vnodes: int = DEFAULT_VNODES):
+        self.nodes = frozenset(nodes)
+        self.vnodes = vnodes
+        points: List[Tuple[int, Hashable]] = []
+        # Sort the nodes so equal hashes break ties the same way everywhere
+        for node in sorted(self.nodes, key=str):
+            for i in range(vnodes):
+                points.append((stable_hash(f"{node}#{i}"), node))
+        points.sort(key=lambda point: (point[0], str(point[1])))
+        self._hashes = [h for h, _ in points]
+        self._owners = [node for _, node in points]
+
+    def get(self, key: str) -> Optional[Hashable]:
+        """Node that owns `key`, or None for an empty ring."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, stable_hash(str(key)))
+        if index == len(self._hashes):
+            index = 0
+        return self._owners[index]
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+# Last ring built by ring_for(); replaced as a whole, so readers need no lock
+_cached: Optional[HashRing] = None
+
+
+def ring_for(nodes: Iterable[Hashable], vnodes: int = DEFAULT_VNODES) -> HashRing:
+    """Ring for `nodes`, reusing the previous one while the node set is unchanged."""
+    global _cached
+    nodes = frozenset(nodes)
+    ring = _cached
+    if ring is None or ring.nodes != nodes or ring.vnodes != vnodes:
+        ring = HashRing(nodes, vnodes)
+        _cached = ring
+    return ring
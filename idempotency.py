@@ -0,0 +1,164 @@
+"""
+Duplicate-free restarts: the persisted update offset and once-per-message handlers.
+
+UpdateOffset stores the highest update_id whose handlers have all finished
+in db's bot_state table (at most every `interval` seconds, and at exit).
+Routed handlers run on the dispatcher's thread pool (UpdateOffset.run_async),
+so the stored offset stays below the oldest update that is still being
+handled. main() starts polling from the stored offset + 1: an update whose
+handler was cut short by a crash is fetched again.
+
+Telegram can also redeliver the last batch if the bot stops before it has
+confirmed it, so `once(callback)` records (chat_id, message_id) in the
+handled_messages table when the callback returns and skips messages that
+are already there (or that another thread is handling right now).
+
+A handler's Bot API calls cannot share a transaction with that record, so
+a crash between a handler's first side effect and the record runs the
+handler again after the restart: at least once, and once in every other
+case. The intake process of worker mode notes the offset when it hands an
+update to a worker; an update being handled by a worker that crashes is
+lost, the others wait in the worker's queue for its replacement.
+"""
+import atexit
+import logging
+import threading
+import time
+from functools import wraps
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from telegram import Update
+
+import db
+
+logger = logging.getLogger(__name__)
+
+OFFSET_KEY = "last_update_id"
+# Telegram keeps undelivered updates for 24 hours; handled_messages only needs to cover that
+HANDLED_RETENTION = 2 * 24 * 3600.0
+
+
+class UpdateOffset:
+    """Tracks and persists the highest update_id the dispatcher has finished with."""
+
+    def __init__(self, interval: float = 1.0, prune_interval: float = 3600.0):
+        self.interval = interval
+        self.prune_interval = prune_interval
+        self.last_update_id: Optional[int] = None
+        self._saved: Optional[int] = None
+        self._saved_at = 0.0
+        self._pruned_at = 0.0
+        # update_id -> routed handlers of that update still running
+        self._running: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def load(self) -> Optional[int]:
+        """The update_id stored by the previous run, if any."""
+        value = db.get_state(OFFSET_KEY)
+        self.last_update_id = self._saved = int(value) if value is not None else None
+        return self.last_update_id
+
+    def seen(self, update: object, context=None) -> None:
+        """TypeHandler callback after every handler group: note the update and save the offset if it is due."""
+        update_id = getattr(update, 'update_id', None)
+        if update_id is None:
+            return
+        with self._lock:
+            if self.last_update_id is None or update_id > self.last_update_id:
+                self.last_update_id = update_id
+            due = time.time() - self._saved_at >= self.interval
+        if due:
+            self.flush()
+
+    def run_async(self, dispatcher, callback: Callable, update, context):
+        """dispatcher.run_async(callback), keeping the saved offset below `update` until it returns."""
+        update_id = getattr(update, 'update_id', None)
+        if update_id is None:
+            return dispatcher.run_async(callback, update, context, update=update)
+        with self._lock:
+            self._running[update_id] = self._running.get(update_id, 0) + 1
+
+        def run(update, context):
+            try:
+                return callback(update, context)
+            finally:
+                self._finished(update_id)
+
+        try:
+            return dispatcher.run_async(run, update, context, update=update)
+        except Exception:
+            self._finished(update_id)
+            raise
+
+    def _finished(self, update_id: int) -> None:
+        with self._lock:
+            remaining = self._running[update_id] - 1
+            if remaining:
+                self._running[update_id] = remaining
+            else:
+                del self._running[update_id]
+            due = time.time() - self._saved_at >= self.interval
+        # The offset may have been held back by this update
+        if due:
+            self.flush()
+
+    def completed(self) -> Optional[int]:
+        """The highest update_id up to which every update is finished."""
+        with self._lock:
+            update_id = self.last_update_id
+            if update_id is not None and self._running:
+                update_id = min(update_id, min(self._running) - 1)
+            return update_id
+
+    def flush(self) -> None:
+        """Save the offset now if it changed, and prune old handled messages once in a while."""
+        update_id = self.completed()
+        with self._lock:
+            if update_id is None or update_id == self._saved:
+                return
+            self._saved = update_id
+            now = self._saved_at = time.time()
+            prune = now - self._pruned_at >= self.prune_interval
+            if prune:
+                self._pruned_at = now
+        db.set_state(OFFSET_KEY, update_id)
+        if prune:
+            deleted = db.prune_handled_messages(now - HANDLED_RETENTION)
+            if deleted:
+                logger.info("Pruned %s handled message records", deleted)
+
+
+# (chat_id, message_id) of messages whose handler is running in this process
+_handling: Set[Tuple[int, int]] = set()
+_handling_lock = threading.Lock()
+
+
+def once(callback: Callable) -> Callable:
+    """Wrap a message handler so each (chat_id, message_id) is handled once, recorded when the handler returns."""
+    name = getattr(callback, '__name__', 'handler')
+
+    @wraps(callback)
+    def wrapper(update, context):
+        message = update.effective_message if isinstance(update, Update) else None
+        if message is None:
+            return callback(update, context)
+        key = (message.chat_id, message.message_id)
+        # All updates of a chat reach the same process, so a copy being handled right now is in _handling
+        with _handling_lock:
+            duplicate = key in _handling
+            if not duplicate:
+                _handling.add(key)
+        if duplicate or db.is_message_handled(*key):
+            if not duplicate:
+                with _handling_lock:
+                    _handling.discard(key)
+            logger.info("Skipping message %s in chat %s: already handled", message.message_id, message.chat_id)
+            return None
+        try:
+            return callback(update, context)
+        finally:
+            db.mark_message_handled(message.chat_id, message.message_id, name)
+            with _handling_lock:
+                _handling.discard(key)
+    return wrapper
@@ -0,0 +1,314 @@
+"""
+Backups of the image inventory: snapshots, compressed JSONL exports, restore and merge.
+
+A snapshot is a copy of the whole images.db made with SQLite's online
+backup API (db.backup_database), consistent even while the bot writes. An
+export streams the live images of a snapshot, optionally those of one Group
+B, to gzip-compressed JSONL, one image (db.BACKUP_COLUMNS) per line. Before
+the bot purges the images a "重置群码" retired, it exports them from a
+snapshot (export with `stale=True`), which they stay in until then. Restore
+and merge read exports, plain JSONL and the JSON arrays the bot used to
+write on "重置群码" (images_backup_*.json) item by item and write them in
+batches of BATCH_SIZE with db.import_images, so memory use does not grow
+with the size of a backup. Merge only adds images that are missing;
+restore also overwrites images with the same image_id. Restoring a .db
+snapshot replaces the whole database and should be done with the bot
+stopped.
+
+Backups are written to BACKUP_DIR as images_backup_<time>[_<group>].<ext>;
+after each purge backup the bot keeps the newest BACKUP_KEEP of them.
+
+Examples:
+    python image_backup.py snapshot
+    python image_backup.py export --group-b -1002648811668
+    python image_backup.py merge images_backup_20250419_212917.json
+    python image_backup.py restore backups/images_backup_20260101_120000_000000.jsonl.gz
+    python image_backup.py prune --keep 10
+"""
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "20"))
+
+# Images written per transaction by restore and merge
+BATCH_SIZE = 500
+
+# Snapshots, exports and the legacy JSON files all start with this
+BACKUP_PREFIX = "images_backup_"
+BACKUP_EXTENSIONS = (".db", ".jsonl.gz", ".jsonl", ".json")
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+def backup_path(extension: str, group_b_id: Optional[int] = None, directory: Optional[str] = None) -> str:
+    """A new, time-stamped backup file name in `directory` (BACKUP_DIR by default)."""
+    directory = directory or BACKUP_DIR
+    os.makedirs(directory, exist_ok=True)
+    name = BACKUP_PREFIX + datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    if group_b_id is not None:
+        name += f"_{group_b_id}"
+    return os.path.join(directory, name + extension)
+
+
+def snapshot(path: Optional[str] = None) -> Optional[str]:
+    """Copy the whole database to `path` (a new file in BACKUP_DIR by default); returns the path."""
+    path = path or backup_path(".db")
+    return path if db.backup_database(path) else None
+
+
+def temporary_snapshot(directory: Optional[str] = None) -> Optional[str]:
+    """Copy the whole database to a hidden file in `directory`, which the caller deletes; returns the path."""
+    directory = directory or BACKUP_DIR
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, prefix=".snapshot-", suffix=".db")
+    os.close(fd)
+    if not db.backup_database(path):
+        os.unlink(path)
+        return None
+    return path
+
+
+def iter_snapshot(path: str, group_b_id: Optional[int] = None, stale: bool = False) -> Iterator[Dict]:
+    """The live images of a snapshot (of one Group B if given), one at a time in insertion order.
+    
+    With `stale`, the images of earlier generations that a reset retired instead.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(images)")}
+        # Snapshots of older databases lack some columns
+        selected = [column for column in db.BACKUP_COLUMNS if column in columns]
+        conditions = []
+        params = []
+        if group_b_id is not None:
+            conditions.append("source_group_b_id = ?")
+            params.append(int(group_b_id))
+        # Snapshots from before generations hold live images only
+        if 'generation' in columns:
+            conditions.append(f"NOT ({db.LIVE_CONDITION})" if stale else db.LIVE_CONDITION)
+        elif stale:
+            return
+        sql = f"SELECT {', '.join(selected)} FROM images"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        for row in conn.execute(sql + " ORDER BY rowid", params):
+            image = dict(zip(selected, row))
+            # Metadata is written as an object, as in the legacy backups
+            try:
+                image['metadata'] = json.loads(image['metadata']) if image.get('metadata') else None
+            except ValueError:
+                pass
+            yield image
+    finally:
+        conn.close()
+
+
+def export(path: Optional[str] = None, group_b_id: Optional[int] = None,
+           source: Optional[str] = None, stale: bool = False) -> Tuple[Optional[str], int]:
+    """Write the images of snapshot `source` (a fresh one by default) to gzip JSONL; returns (path, images).
+    
+    With `stale`, export the retired images of earlier generations instead.
+    The export reads only the snapshot, so the bot never waits on it.
+    """
+    path = path or backup_path(".jsonl.gz", group_b_id)
+    own_snapshot = source is None
+    if own_snapshot:
+        source = temporary_snapshot(os.path.dirname(path) or ".")
+        if source is None:
+            return None, 0
+    # Write under a temporary name so an interrupted export never looks like a complete one
+    tmp_path = path + ".tmp"
+    count = 0
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            for image in iter_snapshot(source, group_b_id, stale):
+                f.write(json.dumps(image, ensure_ascii=False) + "\n")
+                count += 1
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.error("Error exporting images to %s: %s", path, e)
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return None, 0
+    finally:
+        if own_snapshot:
+            os.unlink(source)
+    logger.info("Exported %s images to %s", count, path)
+    return path, count
+
+
+def _iter_json_array(f, chunk_size: int = 1 << 16) -> Iterator:
+    """The items of the JSON array in text file `f`, decoded one at a time from chunks."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def more() -> None:
+        nonlocal buffer, position, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        # Drop what has been decoded so the buffer stays about one chunk long
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def next_char() -> str:
+        """Skip whitespace and return the next character."""
+        nonlocal position
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position < len(buffer):
+                return buffer[position]
+            if eof:
+                raise ValueError("truncated JSON array")
+            more()
+
+    if next_char() != '[':
+        raise ValueError("not a JSON array")
+    position += 1
+    first = True
+    while True:
+        char = next_char()
+        if char == ']':
+            return
+        if not first:
+            if char != ',':
+                raise ValueError(f"expected ',' in JSON array, found {char!r}")
+            position += 1
+            next_char()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                # A number cut off at the end of the buffer decodes too; trust it once a delimiter follows
+                after = _WHITESPACE.match(buffer, end).end()
+                if (after < len(buffer) and buffer[after] in ',]') or eof:
+                    break
+            except ValueError:
+                if eof:
+                    raise
+            more()
+        yield item
+        position = end
+        first = False
+
+
+def iter_backup(path: str) -> Iterator[Dict]:
+    """The images in an export (.jsonl.gz), a JSONL file or a legacy JSON array, one at a time."""
+    if path.endswith(".gz"):
+        f = gzip.open(path, 'rt', encoding='utf-8')
+    else:
+        f = open(path, 'r', encoding='utf-8')
+    with f:
+        if path.endswith(".json"):
+            yield from _iter_json_array(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load(paths: Iterable[str], overwrite: bool = False) -> Optional[int]:
+    """Write the images of the given exports or JSON backups to the database; returns how many were written."""
+    written = 0
+    for path in paths:
+        batch: List[Dict] = []
+        for image in iter_backup(path):
+            batch.append(image)
+            if len(batch) >= BATCH_SIZE:
+                result = db.import_images(batch, overwrite)
+                if result is None:
+                    return None
+                written += result
+                batch = []
+        result = db.import_images(batch, overwrite)
+        if result is None:
+            return None
+        written += result
+        logger.info("Loaded %s", path)
+    return written
+
+
+def list_backups(directory: Optional[str] = None) -> List[str]:
+    """Backup files in `directory` (BACKUP_DIR by default), oldest first."""
+    directory = directory or BACKUP_DIR
+    paths = [path for path in glob.glob(os.path.join(directory, BACKUP_PREFIX + "*"))
+             if path.endswith(BACKUP_EXTENSIONS)]
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+
+def prune(keep: int, directory: Optional[str] = None) -> List[str]:
+    """Delete all but the newest `keep` backups in `directory`; returns the deleted paths."""
+    backups = list_backups(directory)
+    deleted = backups[:max(0, len(backups) - keep)]
+    for path in deleted:
+        os.unlink(path)
+    if deleted:
+        logger.info("Pruned %s old backups", len(deleted))
+    return deleted
+
+
+def main():
+    """Parse arguments and run one backup command."""
+    parser = argparse.ArgumentParser(description="Back up, export, restore and merge the image inventory.")
+    parser.add_argument("--db", default=db.DB_FILE, help="database file")
+    parser.add_argument("--dir", default=BACKUP_DIR, help="backup directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    snapshot_parser = commands.add_parser("snapshot", help="copy the whole database with the online backup API")
+    snapshot_parser.add_argument("--output", help="snapshot file (default: new file in --dir)")
+    export_parser = commands.add_parser("export", help="write the images to gzip-compressed JSONL")
+    export_parser.add_argument("--group-b", type=int, help="only the images of this Group B")
+    export_parser.add_argument("--output", help="export file (default: new file in --dir)")
+    export_parser.add_argument("--source", help="export this snapshot instead of a fresh one")
+    export_parser.add_argument("--stale", action="store_true", help="the images retired by a reset, not yet purged")
+    restore_parser = commands.add_parser("restore", help="restore images, overwriting those with the same ID")
+    restore_parser.add_argument("paths", nargs='+', help=".db snapshot (whole database) or exports/JSON backups")
+    merge_parser = commands.add_parser("merge", help="add the images that are missing")
+    merge_parser.add_argument("paths", nargs='+', help="exports, JSONL files or legacy images_backup_*.json")
+    prune_parser = commands.add_parser("prune", help="delete all but the newest backups")
+    prune_parser.add_argument("--keep", type=int, default=BACKUP_KEEP, help="backups to keep")
+    commands.add_parser("list", help="list the backups, oldest first")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db.DB_FILE = args.db
+
+    if args.command == "snapshot":
+        path = snapshot(args.output or backup_path(".db", directory=args.dir))
+        print(path or "Snapshot failed")
+    elif args.command == "export":
+        path, count = export(args.output or backup_path(".jsonl.gz", args.group_b, args.dir), args.group_b,
+                             args.source, args.stale)
+        print(f"Exported {count} images to {path}" if path else "Export failed")
+    elif args.command in ("restore", "merge"):
+        snapshots = [path for path in args.paths if path.endswith(".db")]
+        if snapshots:
+            if len(args.paths) > 1 or args.command == "merge":
+                parser.error("a .db snapshot can only be restored on its own")
+            print("Restored" if db.restore_database(snapshots[0]) else "Restore failed")
+            return
+        written = load(args.paths, overwrite=args.command == "restore")
+        print(f"Wrote {written} images" if written is not None else "Import failed")
+    elif args.command == "prune":
+        for path in prune(args.keep, args.dir):
+            print(f"Deleted {path}")
+    elif args.command == "list":
+        for path in list_backups(args.dir):
+            print(f"{path}  {os.path.getsize(path)} bytes")
+
+
+if __name__ == "__main__":
+    main()
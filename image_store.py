@@ -0,0 +1,93 @@
+"""
+Local, content-addressed copies of the image photos.
+
+Images are kept as Telegram file_ids, which only work with the bot token
+that received them: a new token invalidates every file_id, and each image
+would have to be set again with "设置群 N". The bot therefore downloads each
+photo once and stores it under IMAGE_STORE_DIR, named by the SHA-256 of its
+bytes (`ab/abcdef...`), so identical photos are stored once. The images
+table records the photo's file_unique_id (the same for every bot), the
+content hash and the detected type next to the current file_id
+(db.set_image_content).
+
+When Telegram rejects a file_id (is_invalid_file_id), the bot uploads the
+stored copy instead and caches the file_id Telegram returns for every
+image with the same content (db.update_file_id).
+
+IMAGE_STORE_DIR="" switches the store off.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Optional, Tuple
+
+from telegram.error import BadRequest
+
+import imghdr
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = os.environ.get("IMAGE_STORE_DIR", "image_store")
+
+# Bot API error descriptions for a file_id this bot cannot use (lower case)
+_INVALID_FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference",
+                           "invalid file_id", "file_id_invalid")
+
+
+def enabled() -> bool:
+    return bool(STORE_DIR)
+
+
+def path_of(content_sha256: str) -> str:
+    """Where the copy with this SHA-256 is (or would be) stored."""
+    return os.path.join(STORE_DIR, content_sha256[:2], content_sha256)
+
+
+def put(data: bytes) -> Tuple[str, Optional[str]]:
+    """Store `data` unless an identical copy exists; returns (sha256, image type or None)."""
+    content_sha256 = hashlib.sha256(data).hexdigest()
+    path = path_of(content_sha256)
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write under a temporary name so a crash never leaves a truncated copy behind
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        logger.info("Stored image copy %s (%s bytes)", content_sha256[:12], len(data))
+    return content_sha256, imghdr.what(None, data)
+
+
+def get(content_sha256: str) -> Optional[bytes]:
+    """The stored copy with this SHA-256, or None if there is none."""
+    try:
+        with open(path_of(content_sha256), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # A copy that no longer matches its name is useless for reuploading
+    if hashlib.sha256(data).hexdigest() != content_sha256:
+        logger.error("Stored image copy %s is corrupt", content_sha256[:12])
+        return None
+    return data
+
+
+def download(bot, file_id: str) -> bytes:
+    """Fetch a photo's bytes from Telegram."""
+    return bytes(bot.get_file(file_id).download_as_bytearray())
+
+
+def is_invalid_file_id(error: Exception) -> bool:
+    """True if Telegram refused a request because of the file_id it was given."""
+    if not isinstance(error, BadRequest):
+        return False
+    message = str(error).lower()
+    return any(text in message for text in _INVALID_FILE_ID_ERRORS)
@@ -1,11 +1,60 @@
-"""
-Simple imghdr replacement module.
-This is a minimal implementation to make python-telegram-bot work without the standard library imghdr.
-"""
-
-def what(file, h=None):
-    """
-    Simplified version of imghdr.what that returns 'jpeg' as a fallback.
-    """
-    # Just return a common image type to make the telegram library work
-    return 'jpeg' 
\ No newline at end of file
+"""
+Simple imghdr replacement module.
+This is a minimal implementation to make python-telegram-bot work without the standard library imghdr.
+It recognises image types by their leading bytes, like the standard library module did.
+"""
+
+# Enough of the header for every signature below
+HEADER_SIZE = 32
+
+def what(file, h=None):
+    """
+    Return the image type of a file ('jpeg', 'png', ...) from its header, or None if it is not a known image.
+    `file` is a path or a binary file object; if `h` (the leading bytes) is given, `file` is not read.
+    """
+    if h is None:
+        if isinstance(file, (str, bytes)) or hasattr(file, '__fspath__'):
+            with open(file, 'rb') as f:
+                h = f.read(HEADER_SIZE)
+        else:
+            position = file.tell()
+            h = file.read(HEADER_SIZE)
+            file.seek(position)
+    h = bytes(h[:HEADER_SIZE])
+    for test in tests:
+        kind = test(h)
+        if kind:
+            return kind
+    return None
+
+def test_jpeg(h):
+    """JPEG: SOI marker followed by another marker (JFIF, Exif or a bare table)."""
+    if h[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+
+def test_png(h):
+    if h[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+
+def test_gif(h):
+    if h[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+
+def test_webp(h):
+    if h[:4] == b'RIFF' and h[8:12] == b'WEBP':
+        return 'webp'
+
+def test_tiff(h):
+    if h[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+
+def test_bmp(h):
+    if h[:2] == b'BM':
+        return 'bmp'
+
+def test_heic(h):
+    """HEIF/HEIC, as sent by iPhones as documents: an ISO-BMFF 'ftyp' box with a HEIF brand."""
+    if h[4:8] == b'ftyp' and h[8:12] in (b'heic', b'heix', b'hevc', b'hevx', b'mif1', b'msf1'):
+        return 'heic'
+
+tests = [test_jpeg, test_png, test_gif, test_webp, test_tiff, test_bmp, test_heic]
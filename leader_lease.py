@@ -0,0 +1,131 @@
+"""
+Active/standby leader election through a lease row in SQLite.
+
+Telegram allows one getUpdates consumer per bot, so only one instance may
+poll. Every instance started with LEADER_LEASE_TTL > 0 competes for the
+lease row in images.db (db.acquire_lease): the holder is the leader and
+renews the lease every `ttl / 3` seconds; the others stay on standby, keep
+their state loaded as it changes and try to take the lease at the same
+interval. If the leader dies (or stops renewing), a standby takes over
+within about `ttl` seconds; a leader that shuts down cleanly releases the
+lease so a standby takes over at once.
+
+Each acquisition hands out a fencing token one higher than the last. The
+leader registers it with db.set_fencing_token, after which every database
+write first checks, under the write lock, that the token is still current,
+and fails with db.StaleFencingToken otherwise. A leader that was paused or
+cut off and comes back after a standby has taken over can therefore no
+longer change anything; it notices on its next heartbeat and exits.
+
+The lease uses wall-clock time, so instances on different hosts sharing a
+volume need synchronized clocks.
+
+Try it with two local processes against fake_telegram_server.py:
+    LEADER_LEASE_TTL=3 TELEGRAM_BOT_TOKEN=123:fake TELEGRAM_BASE_URL=... python bot.py   # leader
+    LEADER_LEASE_TTL=3 TELEGRAM_BOT_TOKEN=123:fake TELEGRAM_BASE_URL=... python bot.py   # standby
+    kill -9 <leader pid>    # the standby starts polling a few seconds later
+    python leader_lease.py  # shows the current holder and token
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Optional
+
+import db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NAME = "bot"
+
+
+class Lease:
+    """This instance's view of one leader lease."""
+
+    def __init__(self, ttl: float, name: str = DEFAULT_NAME, holder: Optional[str] = None):
+        self.ttl = ttl
+        self.name = name
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+        self.interval = ttl / 3.0
+        self.token: Optional[int] = None
+        self.lost = threading.Event()
+        self._renewed_at = 0.0
+
+    def try_acquire(self) -> bool:
+        """Take the lease if it is free or expired; fences this process's writes with the new token."""
+        token = db.acquire_lease(self.name, self.holder, self.ttl)
+        if token is None:
+            return False
+        self.token = token
+        self._renewed_at = time.time()
+        db.set_fencing_token(self.name, token)
+        return True
+
+    def wait_for_leadership(self, on_standby: Optional[Callable[[], None]] = None) -> None:
+        """Block until this instance holds the lease, calling `on_standby` between attempts."""
+        announced = False
+        while not self.try_acquire():
+            if not announced:
+                current = db.get_lease(self.name) or {}
+                logger.info("Standing by: lease %r is held by %s (token %s)",
+                            self.name, current.get('holder'), current.get('token'))
+                announced = True
+            if on_standby is not None:
+                try:
+                    on_standby()
+                except Exception as e:
+                    logger.error("Error while standing by: %s", e)
+            time.sleep(self.interval)
+        logger.warning("Acquired lease %r as %s with fencing token %s", self.name, self.holder, self.token)
+
+    def start_heartbeat(self, on_lost: Callable[[], None]) -> None:
+        """Renew the lease in a daemon thread; calls `on_lost` once if it cannot be renewed in time."""
+        def run():
+            while not self.lost.wait(self.interval):
+                if db.renew_lease(self.name, self.holder, self.token, self.ttl):
+                    self._renewed_at = time.time()
+                    continue
+                # A failed renewal is only fatal once the lease may have expired or changed hands
+                current = db.get_lease(self.name)
+                changed = current is not None and (current['holder'] != self.holder or current['token'] != self.token)
+                if changed or time.time() - self._renewed_at >= self.ttl:
+                    logger.critical("Lost lease %r (now %s)", self.name, current)
+                    self.lost.set()
+                    on_lost()
+                    return
+
+        threading.Thread(target=run, name="lease-heartbeat", daemon=True).start()
+
+    def is_valid(self) -> bool:
+        """True while this instance holds the lease, as far as it can tell without asking the database."""
+        return self.token is not None and not self.lost.is_set() and time.time() - self._renewed_at < self.ttl
+
+    def release(self) -> None:
+        """Give the lease up so a standby takes over immediately."""
+        if self.token is not None and not self.lost.is_set():
+            db.release_lease(self.name, self.holder, self.token)
+            logger.info("Released lease %r", self.name)
+
+
+def lease_from_env() -> Optional[Lease]:
+    """Lease configured by LEADER_LEASE_TTL (seconds, 0 = no election), LEADER_LEASE_NAME and INSTANCE_ID."""
+    ttl = float(os.environ.get("LEADER_LEASE_TTL", "0"))
+    if ttl <= 0:
+        return None
+    return Lease(ttl, os.environ.get("LEADER_LEASE_NAME", DEFAULT_NAME), os.environ.get("INSTANCE_ID"))
+
+
+if __name__ == "__main__":
+    lease = db.get_lease(os.environ.get("LEADER_LEASE_NAME", DEFAULT_NAME))
+    if lease is None:
+        print("No lease has been taken yet")
+    else:
+        remaining = lease['expires_at'] - time.time()
+        if not lease['expires_at']:
+            state = "released"
+        elif remaining > 0:
+            state = f"expires in {remaining:.1f}s"
+        else:
+            state = f"expired {-remaining:.1f}s ago"
+        print(f"Held by {lease['holder']} with fencing token {lease['token']}, {state}")
@@ -0,0 +1,159 @@
+"""
+Logging pipeline for the bot.
+
+Handler threads only put records on a queue; formatting and writing happen on a
+background QueueListener thread. Repetitive DEBUG events are sampled, and
+per-module levels can be changed while the bot is running.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from typing import Dict, Optional
+
+# Argument types that are safe to format later on the listener thread
+_IMMUTABLE_ARG_TYPES = (str, int, float, bool, type(None), bytes)
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+_STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread."""
+
+    def prepare(self, record):
+        # Only format eagerly when an argument could change before the listener gets to it
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(isinstance(a, _IMMUTABLE_ARG_TYPES) for a in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as text or JSON, appending any `extra=` fields as key=value pairs."""
+
+    def __init__(self, as_json: bool = False):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = {k: v for k, v in vars(record).items() if k not in _STANDARD_RECORD_ATTRS}
+        if self.as_json:
+            payload = {
+                'ts': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'msg': record.getMessage(),
+            }
+            payload.update(fields)
+            if record.exc_info:
+                payload['exc'] = self.formatException(record.exc_info)
+            return json.dumps(payload, ensure_ascii=False, default=str)
+
+        line = super().format(record)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """Pass the first record of each DEBUG call site, then only every `rate`-th one."""
+
+    def __init__(self, rate: int = 100):
+        super().__init__()
+        self.rate = max(1, rate)
+        self._seen: Dict[tuple, int] = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate == 1:
+            return True
+
+        key = (record.name, record.msg)
+        if len(self._seen) > 10000:
+            # Messages built with f-strings never repeat; don't let them pile up
+            self._seen.clear()
+        count = self._seen.get(key, 0) + 1
+        self._seen[key] = count
+        if count % self.rate == 1:
+            if count > 1:
+                record.sampled = self.rate
+            return True
+        return False
+
+
+def _parse_levels(spec: str) -> Dict[str, int]:
+    """Parse 'db=WARNING,bot=DEBUG' into a {logger: level} mapping."""
+    levels = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        levels[name.strip()] = logging.getLevelName(level.strip().upper())
+    return levels
+
+
+def setup_logging(level: str = None, as_json: bool = None, sample_rate: int = None) -> None:
+    """Install the queue-based pipeline on the root logger (safe to call twice)."""
+    global _listener
+
+    level = level or os.environ.get("LOG_LEVEL", "INFO")
+    if as_json is None:
+        as_json = os.environ.get("LOG_FORMAT", "").lower() == "json"
+    if sample_rate is None:
+        sample_rate = int(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "100"))
+
+    if _listener is not None:
+        _listener.stop()
+
+    # Writer side: runs on the listener thread
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(StructuredFormatter(as_json=as_json))
+
+    # Producer side: cheap enqueue on the calling thread
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(logging.getLevelName(level.upper()))
+
+    for name, module_level in _parse_levels(os.environ.get("LOG_LEVELS", "")).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def set_level(name: str, level: str) -> bool:
+    """Change the level of one logger at runtime. Returns False for an unknown level."""
+    value = logging.getLevelName(level.upper())
+    if not isinstance(value, int):
+        return False
+    logging.getLogger(None if name in ('', 'root') else name).setLevel(value)
+    return True
+
+
+def get_levels() -> Dict[str, str]:
+    """Return the explicitly configured level of the root and every named logger."""
+    levels = {'root': logging.getLevelName(logging.getLogger().level)}
+    for name, log in sorted(logging.Logger.manager.loggerDict.items()):
+        if isinstance(log, logging.Logger) and log.level != logging.NOTSET:
+            levels[name] = logging.getLevelName(log.level)
+    return levels
@@ -0,0 +1,71 @@
+"""
+Single-pass classifier for Group A/B message text.
+
+`classify(text)` strips the text once, matches it against one compiled
+alternation for the whole-message forms, and collects every number in one
+finditer pass. The router classifies each message once and the handlers read
+the result from `context.classification` instead of parsing the text again.
+"""
+import re
+from typing import NamedTuple, Optional, Tuple
+
+# Kinds of message
+NUMBER = 'number'              # "150"
+NUMBER_GROUP = 'number_group'  # "150 群"
+PLUS = 'plus'                  # "+150"
+ZERO = 'zero'                  # "0" or "+0"
+RESET_ALL = 'reset_all'        # "重置群码"
+RESET_ONE = 'reset_one'        # "重置群5"
+APPROVAL = 'approval'          # "同意" or "确认"
+OTHER = 'other'
+
+# Whole-message forms; the order of the alternatives decides ties ("0" is ZERO, not NUMBER)
+_FORMS = re.compile(
+    r'(?P<zero>\+?0)'
+    r'|(?P<number>\d+)'
+    r'|\+(?P<plus>\d+)'
+    r'|(?P<number_group>\d+)\s*群'
+    r'|重置群(?P<reset_one>\d+)'
+    r'|(?P<reset_all>重置群码)'
+    r'|(?P<approval>同意|确认)'
+)
+
+# Every run of digits, with the '+' in front of it if there is one
+_NUMBERS = re.compile(r'(\+?)(\d+)')
+
+
+class Classification(NamedTuple):
+    """Result of classify(); numbers are kept as strings like the rest of the bot."""
+    kind: str
+    text: str                       # Stripped message text
+    amount: Optional[str]           # Group A amount for NUMBER, NUMBER_GROUP and "0"
+    numbers: Tuple[str, ...]        # Every digit run, as re.findall(r'\d+') would return
+    plus_numbers: Tuple[str, ...]   # Digit runs preceded by '+'
+
+
+_new = tuple.__new__
+
+
+def classify(text: Optional[str]) -> Classification:
+    """Classify a message text in one pass."""
+    text = (text or "").strip()
+
+    found = _NUMBERS.findall(text) if text else ()
+    if found:
+        numbers = tuple([digits for _, digits in found])
+        plus_numbers = tuple([digits for sign, digits in found if sign]) if '+' in text else ()
+    else:
+        numbers = plus_numbers = ()
+
+    kind = OTHER
+    amount = None
+    match = _FORMS.fullmatch(text)
+    if match:
+        kind = match.lastgroup
+        if kind == NUMBER or kind == NUMBER_GROUP:
+            amount = match.group(kind)
+        elif kind == ZERO and text == "0":
+            amount = text
+
+    # tuple.__new__ skips the keyword handling of the generated NamedTuple constructor
+    return _new(Classification, (kind, text, amount, numbers, plus_numbers))
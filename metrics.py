@@ -0,0 +1,217 @@
+"""
+Lightweight in-process metrics for the bot.
+
+Every observation is a counter bump plus a bucket increment in a fixed
+log-spaced latency histogram, so recording costs about a microsecond and the
+memory per series is constant. Percentiles are estimated from the buckets.
+"""
+import bisect
+import logging
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds: 10us to ~100s, factor sqrt(2) apart
+BUCKETS: Tuple[float, ...] = tuple(1e-5 * (2 ** (i / 2)) for i in range(47))
+
+
+class Histogram:
+    """Latency histogram with call and error counters for one label set."""
+
+    __slots__ = ('counts', 'count', 'errors', 'total', '_lock')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # Last slot is +Inf
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, error: bool = False) -> None:
+        """Record one event that took `seconds`."""
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if error:
+                self.errors += 1
+
+    def percentile(self, q: float) -> float:
+        """Estimate the q-th percentile (0-100) in seconds."""
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return 0.0
+
+        rank = q / 100.0 * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = BUCKETS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else BUCKETS[-1]
+                # Interpolate linearly inside the bucket
+                return lower + (upper - lower) * ((rank - seen) / bucket_count)
+            seen += bucket_count
+        return BUCKETS[-1]
+
+
+class Registry:
+    """Collection of histograms keyed by (kind, name, role)."""
+
+    def __init__(self):
+        self._series: Dict[Tuple[str, str, str], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, kind: str, name: str, role: str = "") -> Histogram:
+        """Get or create the histogram for a label set."""
+        key = (kind, name, role)
+        hist = self._series.get(key)
+        if hist is None:
+            with self._lock:
+                hist = self._series.setdefault(key, Histogram())
+        return hist
+
+    def observe(self, kind: str, name: str, role: str, seconds: float, error: bool = False) -> None:
+        """Record one event for a label set."""
+        self.histogram(kind, name, role).observe(seconds, error)
+
+    def reset(self) -> None:
+        """Zero every series in place (decorated functions keep their histograms)."""
+        with self._lock:
+            for hist in self._series.values():
+                with hist._lock:
+                    hist.counts = [0] * (len(BUCKETS) + 1)
+                    hist.count = 0
+                    hist.errors = 0
+                    hist.total = 0.0
+
+    def snapshot(self) -> List[Dict]:
+        """Return a list of plain dicts describing every series."""
+        rows = []
+        for (kind, name, role), hist in sorted(self._series.items()):
+            rows.append({
+                'kind': kind,
+                'name': name,
+                'role': role,
+                'count': hist.count,
+                'errors': hist.errors,
+                'total': hist.total,
+                'p50': hist.percentile(50),
+                'p95': hist.percentile(95),
+                'p99': hist.percentile(99),
+            })
+        return rows
+
+    def render_prometheus(self) -> str:
+        """Render all series in the Prometheus text exposition format."""
+        lines = [
+            "# TYPE tlg_latency_seconds histogram",
+        ]
+        quantile_lines = ["# TYPE tlg_latency_quantile_seconds gauge"]
+        error_lines = ["# TYPE tlg_errors_total counter"]
+        for (kind, name, role), hist in sorted(self._series.items()):
+            labels = f'kind="{kind}",name="{name}",role="{role}"'
+            with hist._lock:
+                counts = list(hist.counts)
+                count = hist.count
+                total = hist.total
+                errors = hist.errors
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, counts):
+                cumulative += bucket_count
+                lines.append(f'tlg_latency_seconds_bucket{{{labels},le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'tlg_latency_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'tlg_latency_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'tlg_latency_seconds_count{{{labels}}} {count}')
+            for q in (50, 95, 99):
+                quantile_lines.append(
+                    f'tlg_latency_quantile_seconds{{{labels},quantile="0.{q}"}} {hist.percentile(q):.6f}'
+                )
+            error_lines.append(f'tlg_errors_total{{{labels}}} {errors}')
+        return "\n".join(lines + quantile_lines + error_lines) + "\n"
+
+    def render_summary(self, kinds: Optional[List[str]] = None) -> str:
+        """Render a compact human readable table for chat output."""
+        lines = []
+        for row in self.snapshot():
+            if not row['count'] or (kinds and row['kind'] not in kinds):
+                continue
+            role = f"[{row['role']}]" if row['role'] else ""
+            lines.append(
+                f"{row['kind']}:{row['name']}{role} n={row['count']} err={row['errors']} "
+                f"p50={row['p50'] * 1000:.1f}ms p95={row['p95'] * 1000:.1f}ms p99={row['p99'] * 1000:.1f}ms"
+            )
+        return "\n".join(lines)
+
+
+# Default registry used by the bot
+REGISTRY = Registry()
+
+
+def timed(kind: str, name: str, role: str = "", registry: Registry = REGISTRY) -> Callable:
+    """Decorator recording latency and errors of every call to the wrapped function."""
+    def decorator(func):
+        hist = registry.histogram(kind, name, role)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                hist.observe(time.perf_counter() - start, error)
+
+        wrapper.__wrapped_metrics__ = True
+        return wrapper
+    return decorator
+
+
+def instrument_module(module, kind: str, registry: Registry = REGISTRY) -> None:
+    """Wrap every public function defined in `module` with `timed`."""
+    for attr, value in list(vars(module).items()):
+        if attr.startswith('_') or not callable(value) or isinstance(value, type):
+            continue
+        if getattr(value, '__module__', None) != module.__name__:
+            continue
+        if getattr(value, '__wrapped_metrics__', False):
+            continue
+        setattr(module, attr, timed(kind, attr, registry=registry)(value))
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent, keep them out of the bot log
+        return
+
+
+def start_http_server(port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """Serve `/metrics` on a daemon thread and return the server."""
+    handler = type('MetricsRequestHandler', (_MetricsRequestHandler,), {'registry': registry})
+    httpd = ThreadingHTTPServer(('', port), handler)
+    thread = threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info(f"Metrics endpoint listening on port {port}")
+    return httpd
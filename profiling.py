@@ -0,0 +1,177 @@
+"""
+On-demand CPU profiling and memory snapshots for the running bot.
+
+cProfile only sees the thread it is enabled in, so a session keeps one profiler
+per dispatcher thread: `profiled_call` enables that thread's profiler around each
+handler call and `stop_profile` merges them all into a single report.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Where profile dumps and memory snapshots are written
+PROFILE_DIR = "profiles"
+
+# Checked on every handler call; only the session functions below change it
+PROFILING_ACTIVE = False
+
+_lock = threading.Lock()
+_profiles: List[cProfile.Profile] = []
+_local = threading.local()
+_timer: Optional[threading.Timer] = None
+_started_at: Optional[datetime] = None
+
+_last_snapshot: Optional[tracemalloc.Snapshot] = None
+
+
+def _output_path(prefix: str, suffix: str) -> str:
+    """Return a timestamped path inside PROFILE_DIR."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{suffix}")
+
+
+def profiled_call(func: Callable, *args, **kwargs):
+    """Call `func` with this thread's profiler enabled when a session is active."""
+    if not PROFILING_ACTIVE or getattr(_local, 'depth', 0):
+        return func(*args, **kwargs)
+
+    profile = getattr(_local, 'profile', None)
+    if profile is None or getattr(_local, 'session', None) is not _started_at:
+        profile = cProfile.Profile()
+        with _lock:
+            if not PROFILING_ACTIVE:
+                return func(*args, **kwargs)
+            _profiles.append(profile)
+        _local.profile = profile
+        _local.session = _started_at
+
+    _local.depth = 1
+    profile.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.disable()
+        _local.depth = 0
+
+
+def start_profile(seconds: float, on_done: Callable[[str, str], None] = None) -> bool:
+    """Start a session that stops itself after `seconds`. Returns False if one is running."""
+    global PROFILING_ACTIVE, _timer, _started_at, _profiles
+    with _lock:
+        if PROFILING_ACTIVE:
+            return False
+        _profiles = []
+        _started_at = datetime.now()
+        PROFILING_ACTIVE = True
+
+    def finish():
+        result = stop_profile()
+        if result and on_done:
+            on_done(*result)
+
+    _timer = threading.Timer(seconds, finish)
+    _timer.daemon = True
+    _timer.start()
+    logger.info("Profiling started for %s seconds", seconds)
+    return True
+
+
+def stop_profile(top: int = 15) -> Optional[Tuple[str, str]]:
+    """Stop the session, write the merged stats file and return (path, summary)."""
+    global PROFILING_ACTIVE, _timer
+    with _lock:
+        if not PROFILING_ACTIVE:
+            return None
+        PROFILING_ACTIVE = False
+        profiles = list(_profiles)
+        started_at = _started_at
+    if _timer is not None and _timer is not threading.current_thread():
+        _timer.cancel()
+    _timer = None
+
+    # Profiles that never ran a handler have no data and can't be loaded
+    stats = None
+    for profile in profiles:
+        profile.create_stats()
+        if not profile.stats:
+            continue
+        if stats is None:
+            stats = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+
+    elapsed = (datetime.now() - started_at).total_seconds()
+    if stats is None:
+        logger.info("Profiling stopped after %.1fs with no handler calls", elapsed)
+        return "", f"No handler calls during {elapsed:.1f}s of profiling."
+
+    path = _output_path("profile", "prof")
+    stats.dump_stats(path)
+    logger.info("Profiling stopped after %.1fs, %d threads, written to %s", elapsed, len(profiles), path)
+
+    stats.sort_stats('cumulative')
+    lines = [f"⏱ {elapsed:.1f}s, {len(profiles)} threads, {stats.total_calls} calls"]
+    for func in stats.fcn_list[:top]:
+        calls, _, total_time, cumulative_time, _ = stats.stats[func]
+        filename, line, name = func
+        lines.append(
+            f"{cumulative_time * 1000:.0f}ms cum {total_time * 1000:.0f}ms own "
+            f"x{calls} {name} ({os.path.basename(filename)}:{line})"
+        )
+    return path, "\n".join(lines)
+
+
+def take_snapshot(top: int = 15) -> Tuple[str, str]:
+    """Take a tracemalloc snapshot, write it to disk and summarise the largest allocators."""
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(25)
+        logger.info("tracemalloc started")
+
+    snapshot = tracemalloc.take_snapshot()
+    path = _output_path("memsnap", "snap")
+    snapshot.dump(path)
+    _last_snapshot = snapshot
+
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"🧠 traced {current / 1024:.0f} KiB (peak {peak / 1024:.0f} KiB)"]
+    for stat in snapshot.statistics('lineno')[:top]:
+        lines.append(_format_stat(stat.traceback, stat.size, stat.count))
+    return path, "\n".join(lines)
+
+
+def diff_snapshot(top: int = 15) -> Optional[Tuple[str, str]]:
+    """Compare a new snapshot against the previous one. Returns None without a baseline."""
+    if _last_snapshot is None or not tracemalloc.is_tracing():
+        return None
+
+    baseline = _last_snapshot
+    # take_snapshot() makes the new snapshot the next baseline
+    path, _ = take_snapshot(top)
+    current = _last_snapshot
+    lines = ["🧠 growth since last snapshot:"]
+    for stat in current.compare_to(baseline, 'lineno')[:top]:
+        lines.append(_format_stat(stat.traceback, stat.size_diff, stat.count_diff, signed=True))
+    return path, "\n".join(lines)
+
+
+def stop_tracing() -> None:
+    """Stop tracemalloc and forget the baseline snapshot."""
+    global _last_snapshot
+    _last_snapshot = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+        logger.info("tracemalloc stopped")
+
+
+def _format_stat(traceback, size, count, signed=False) -> str:
+    frame = traceback[0]
+    sign = "+" if signed and size > 0 else ""
+    return f"{sign}{size / 1024:.1f} KiB {sign}{count} blocks {os.path.basename(frame.filename)}:{frame.lineno}"
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Replay updates recorded by update_recorder.py through the real dispatcher.
+
+The recording is fed to a telegram.ext.Dispatcher that runs the bot's own
+register_handlers() against the FakeBot from bench_flow.py. It can run at the
+recorded pace or faster. Runs in a temporary directory. When --state-dir is
+given, it starts from a copy of that directory's images.db and JSON state,
+ideally a snapshot taken when the recording started.
+
+The production bot's message IDs do not exist in the replay. A recorded
+reply to one of the bot's messages is re-pointed at the oldest message the
+replayed bot sent to the same chat with the same text or caption. Replies
+that cannot be matched are counted in the results.
+
+Example:
+    python replay.py updates.jsonl --state-dir /srv/bot --speed 10 --output replay.json
+    python replay.py updates.jsonl --state-dir /srv/bot --speed 0 --baseline replay.json
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from functools import wraps
+from queue import Queue
+from typing import Dict, List, Optional
+
+from telegram import Message, Update
+from telegram.ext import Dispatcher
+
+import bot
+import metrics
+from bench_flow import FakeBot, compare as compare_flow
+
+logger = logging.getLogger(__name__)
+
+# State files copied from --state-dir; the same names bot.py and db.py use
+STATE_FILES = (
+    "images.db",
+    bot.FORWARDED_MSGS_FILE,
+    bot.GROUP_B_RESPONSES_FILE,
+    bot.GROUP_A_IDS_FILE,
+    bot.GROUP_B_IDS_FILE,
+    bot.GROUP_ADMINS_FILE,
+    bot.PENDING_CUSTOM_AMOUNTS_FILE,
+    bot.SETTINGS_FILE,
+    bot.WAIT_QUEUE_FILE,
+)
+
+
+class ReplayBot(FakeBot):
+    """FakeBot that remembers what it sent so recorded replies can be re-pointed."""
+
+    def __init__(self, latency: float = 0.0, bot_id: int = 777000):
+        super().__init__(latency=latency, bot_id=bot_id)
+        self._sent: Dict[tuple, deque] = defaultdict(deque)
+
+    def _record(self, method: str, result):
+        if isinstance(result, Message):
+            key = (result.chat_id, result.text or result.caption or "")
+            with self._lock:
+                self._sent[key].append(result)
+        return super()._record(method, result)
+
+    def take_sent(self, chat_id: int, text: str) -> Optional[Message]:
+        """Pop the oldest unanswered message sent to `chat_id` with `text`."""
+        with self._lock:
+            queue = self._sent.get((chat_id, text or ""))
+            return queue.popleft() if queue else None
+
+
+def load_recording(paths: List[str]) -> List[Dict]:
+    """Read one or more JSON-lines recordings (e.g. rotated files) sorted by arrival."""
+    entries = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry['ts'])
+    return entries
+
+
+def recorded_bot_id(entries: List[Dict]) -> Optional[int]:
+    """Find the production bot's user ID from replies to its messages."""
+    for entry in entries:
+        message = entry['update'].get('message') or {}
+        sender = (message.get('reply_to_message') or {}).get('from') or {}
+        if sender.get('is_bot'):
+            return sender['id']
+    return None
+
+
+def setup_environment(state_dir: Optional[str]) -> str:
+    """Switch to a temp directory seeded from `state_dir` and load the bot's state."""
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    if state_dir:
+        for name in STATE_FILES:
+            source = os.path.join(state_dir, name)
+            if os.path.exists(source):
+                shutil.copy2(source, os.path.join(workdir, name))
+    os.chdir(workdir)
+    bot.load_persistent_data()
+    return workdir
+
+
+def repoint_reply(data: Dict, replay_bot: ReplayBot, recorded_id: Optional[int]) -> Optional[bool]:
+    """Swap a recorded reply-to-bot message for the replayed one. None if not a reply to the bot."""
+    message = data.get('message')
+    reply_to = (message or {}).get('reply_to_message')
+    if not reply_to or (reply_to.get('from') or {}).get('id') != recorded_id:
+        return None
+    sent = replay_bot.take_sent(reply_to['chat']['id'], reply_to.get('text') or reply_to.get('caption'))
+    if sent is None:
+        return False
+    message['reply_to_message'] = sent.to_dict()
+    return True
+
+
+def track_completion(dispatcher) -> List[float]:
+    """Wrap every handler so the returned one-element list holds the last completion time."""
+    last_done = [0.0]
+
+    def wrap(callback):
+        @wraps(callback)
+        def wrapper(update, context):
+            try:
+                return callback(update, context)
+            finally:
+                last_done[0] = max(last_done[0], time.perf_counter())
+        return wrapper
+
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = wrap(handler.callback)
+    return last_done
+
+
+def run_replay(args) -> Dict:
+    """Replay the recording and return the machine-readable results."""
+    entries = load_recording(args.recording)
+    if args.limit:
+        entries = entries[:args.limit]
+    recorded_id = recorded_bot_id(entries)
+
+    workdir = setup_environment(args.state_dir)
+    replay_bot = ReplayBot(latency=args.latency_ms / 1000.0, bot_id=recorded_id or 777000)
+    dispatcher = Dispatcher(replay_bot, Queue(), workers=args.workers)
+    bot.dispatcher = dispatcher
+    bot.register_handlers(dispatcher)
+    last_done = track_completion(dispatcher)
+
+    metrics.REGISTRY.reset()
+    kinds = Counter()
+    matched = Counter()
+
+    # Run the dispatcher the way Updater does: its own thread fed through update_queue
+    thread = threading.Thread(target=dispatcher.start, name="replay-dispatcher", daemon=True)
+    thread.start()
+
+    started = time.perf_counter()
+    first_ts = entries[0]['ts'] if entries else 0.0
+    for entry in entries:
+        if args.speed > 0:
+            # Keep the recorded spacing, compressed by the speed factor
+            due = started + (entry['ts'] - first_ts) / args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        data = entry['update']
+        outcome = repoint_reply(data, replay_bot, recorded_id)
+        if outcome is not None:
+            matched['matched' if outcome else 'unmatched'] += 1
+        kinds['callback_query' if 'callback_query' in data else 'message' if 'message' in data else 'other'] += 1
+        dispatcher.update_queue.put(Update.de_json(data, replay_bot))
+
+    # Stopping drains the update and async queues before the threads exit
+    dispatcher.update_queue.join()
+    dispatcher.stop()
+    thread.join()
+    elapsed = max(last_done[0], started) - started
+
+    rows = metrics.REGISTRY.snapshot()
+    handler_rows = [row for row in rows if row['kind'] == 'handler' and row['count']]
+    handler_calls = sum(row['count'] for row in handler_rows)
+    db_calls = {row['name']: row['count'] for row in rows if row['kind'] == 'db' and row['count']}
+    updates = max(1, len(entries))
+
+    # Per-call latencies are only kept as histograms; merge their percentiles weighted by calls
+    def weighted(key):
+        if not handler_calls:
+            return 0.0
+        return sum(row[key] * row['count'] for row in handler_rows) / handler_calls * 1000
+
+    return {
+        'config': {
+            'recording': args.recording,
+            'updates': len(entries),
+            'speed': args.speed,
+            'workers': args.workers,
+            'latency_ms': args.latency_ms,
+            'state_dir': args.state_dir,
+        },
+        'workdir': workdir,
+        'update_kinds': dict(kinds),
+        'replies_to_bot': dict(matched),
+        'recorded_span_s': (entries[-1]['ts'] - first_ts) if entries else 0.0,
+        'duration_s': elapsed,
+        'throughput_rps': len(entries) / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'p50': weighted('p50'),
+            'p95': weighted('p95'),
+            'p99': weighted('p99'),
+            'max_p99': max((row['p99'] for row in handler_rows), default=0.0) * 1000,
+        },
+        'db_ops_per_request': sum(db_calls.values()) / updates,
+        'bot_api_calls_per_request': sum(replay_bot.calls.values()) / updates,
+        'db_calls': db_calls,
+        'bot_api_calls': dict(replay_bot.calls),
+        'handlers': {
+            row['name']: {
+                'count': row['count'],
+                'errors': row['errors'],
+                'p50_ms': row['p50'] * 1000,
+                'p95_ms': row['p95'] * 1000,
+                'p99_ms': row['p99'] * 1000,
+            }
+            for row in handler_rows
+        },
+    }
+
+
+def compare(results: Dict, baseline: Dict) -> List[str]:
+    """Headline deltas as in bench_flow, plus per-handler p95 changes."""
+    lines = compare_flow(results, baseline)
+    for name, stats in sorted(results['handlers'].items()):
+        before = baseline.get('handlers', {}).get(name)
+        if not before or not before['p95_ms']:
+            continue
+        change = (stats['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+        lines.append(f"{name} p95_ms: {before['p95_ms']:.3f} -> {stats['p95_ms']:.3f} ({change:+.1f}%)")
+    return lines
+
+
+def main():
+    """Parse arguments, replay the recording and print or save the results."""
+    parser = argparse.ArgumentParser(description="Replay recorded updates against a fake bot.")
+    parser.add_argument("recording", nargs='+', help="JSON-lines files written by update_recorder")
+    parser.add_argument("--state-dir", help="directory with images.db and JSON state to start from")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 for as fast as possible")
+    parser.add_argument("--workers", type=int, default=4, help="dispatcher worker threads (Updater default: 4)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated Bot API latency per call")
+    parser.add_argument("--limit", type=int, help="replay only the first N updates")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--baseline", help="compare against a previous JSON results file")
+    parser.add_argument("--log-level", default="WARNING", help="log level while replaying")
+    args = parser.parse_args()
+
+    args.recording = [os.path.abspath(path) for path in args.recording]
+    args.state_dir = os.path.abspath(args.state_dir) if args.state_dir else None
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    results = run_replay(args)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"Results written to {output}")
+
+    if baseline_path:
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)
+        print("\nCompared with baseline:")
+        for line in compare(results, baseline):
+            print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
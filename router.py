@@ -0,0 +1,63 @@
+"""
+Single front handler for message updates.
+
+Instead of one MessageHandler per command word, each with its own filter
+chain and a snapshot of the configured chats, MessageRouter classifies a
+message once and looks the result up in a route table. The classifier reads
+the live group sets, so adding or removing a group takes effect on the next
+update without re-registering anything.
+
+`classify(update)` returns None or a (route key, classification) pair; the
+classification is handed to the callback as `context.classification`.
+Routes marked run_async go through `run_async(dispatcher, callback, update,
+context)` if given (idempotency.UpdateOffset.run_async), otherwise straight
+to dispatcher.run_async.
+"""
+import logging
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Handler
+
+logger = logging.getLogger(__name__)
+
+# Route key -> (callback, run_async)
+RouteTable = Dict[str, Tuple[Callable, bool]]
+
+
+class MessageRouter(Handler):
+    """Handles every message update whose `classify(update)` result has a route."""
+
+    def __init__(self, classify: Callable[[Update], Optional[Tuple[str, Any]]], routes: RouteTable,
+                 run_async: Optional[Callable] = None):
+        # The callback is chosen per update in handle_update
+        super().__init__(None)
+        self.classify = classify
+        self.routes = routes
+        self.run_async = run_async
+
+    def check_update(self, update: object) -> Optional[Tuple[str, Any]]:
+        # Same update types a MessageHandler accepts by default
+        if not isinstance(update, Update):
+            return None
+        if not (update.message or update.edited_message or update.channel_post or update.edited_channel_post):
+            return None
+        result = self.classify(update)
+        if result is None or result[0] not in self.routes:
+            return None
+        return result
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        key, classification = check_result
+        callback, run_async = self.routes[key]
+        if context is not None:
+            context.classification = classification
+        if run_async:
+            if self.run_async is not None:
+                return self.run_async(dispatcher, callback, update, context)
+            return dispatcher.run_async(callback, update, context, update=update)
+        return callback(update, context)
+
+    def map_callbacks(self, wrap: Callable[[Callable], Callable]) -> None:
+        """Replace every routed callback with `wrap(callback)`."""
+        self.routes = {key: (wrap(callback), run_async) for key, (callback, run_async) in self.routes.items()}
@@ -0,0 +1,200 @@
+"""
+Load-aware choice of the Group B pool a Group A request draws from.
+
+GroupBLoad follows every notification the bot forwards to a Group B until
+that group answers it ("+amount", "0" or an approved custom amount), so it
+knows how many requests each group has outstanding and keeps an EWMA of
+how long the group takes to answer. A strategy turns those numbers into a
+preference order of Group Bs; handle_group_a_message takes an open image
+from the first group in that order that has one.
+
+Strategies (ROUTING_STRATEGY):
+    least_outstanding  fewest unanswered notifications first (default)
+    ewma_latency       lowest expected wait, (outstanding + 1) * EWMA ack time
+    weighted_capacity  lowest outstanding / weight (ROUTING_WEIGHTS="chat_id:weight,...")
+    random             no preference; any open image, as before
+"""
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STRATEGY = "least_outstanding"
+DEFAULT_EWMA_ALPHA = 0.2
+# Members are asked to answer "0" within 10 minutes; anything much older was never answered
+DEFAULT_STALE_AFTER = 1800.0
+
+
+class GroupStats(NamedTuple):
+    """Load figures for one Group B at the time of a routing decision."""
+    outstanding: int
+    ewma_ack_s: Optional[float]  # None until the group has answered once
+    weight: float
+
+
+class GroupBLoad:
+    """Outstanding notifications and answer latency per Group B."""
+
+    def __init__(self, alpha: float = DEFAULT_EWMA_ALPHA, stale_after: float = DEFAULT_STALE_AFTER,
+                 weights: Optional[Mapping[int, float]] = None):
+        self.alpha = alpha
+        self.stale_after = stale_after
+        self.weights = dict(weights or {})
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Tuple[int, float]] = {}  # image_id -> (group_b_id, forwarded_at)
+        self._outstanding: Dict[int, int] = {}
+        self._ewma: Dict[int, float] = {}
+
+    def dispatched(self, group_b_id, image_id: str, at: Optional[float] = None) -> None:
+        """A notification for `image_id` was sent to `group_b_id`."""
+        group_b_id = int(group_b_id)
+        with self._lock:
+            self._forget(image_id)
+            self._pending[image_id] = (group_b_id, time.time() if at is None else at)
+            self._outstanding[group_b_id] = self._outstanding.get(group_b_id, 0) + 1
+
+    def acknowledged(self, image_id: str, at: Optional[float] = None) -> Optional[float]:
+        """The Group B answered the notification for `image_id`; returns the ack latency."""
+        with self._lock:
+            entry = self._forget(image_id)
+            if entry is None:
+                return None
+            group_b_id, forwarded_at = entry
+            latency = max(0.0, (time.time() if at is None else at) - forwarded_at)
+            previous = self._ewma.get(group_b_id)
+            self._ewma[group_b_id] = latency if previous is None else previous + self.alpha * (latency - previous)
+            return latency
+
+    def forget(self, image_id: str) -> bool:
+        """Stop counting the notification for `image_id` without an answer, e.g. because the image was deleted."""
+        with self._lock:
+            return self._forget(image_id) is not None
+
+    def rebuild(self, forwarded_msgs: Mapping[str, Dict], closed_ids: Iterable[str]) -> None:
+        """Start from the persisted forwarded_msgs: every closed image there is still outstanding."""
+        closed_ids = set(closed_ids)
+        self.set_outstanding(
+            (image_id, data.get('group_b_chat_id'), data.get('forwarded_at'))
+            for image_id, data in forwarded_msgs.items() if image_id in closed_ids
+        )
+        logger.info("Routing load rebuilt: %s outstanding notifications", len(self._pending))
+
+    def set_outstanding(self, notifications: Iterable[Tuple[str, Optional[int], Optional[float]]]) -> None:
+        """Replace the outstanding notifications with (image_id, group_b_id, forwarded_at) tuples."""
+        now = time.time()
+        with self._lock:
+            self._pending.clear()
+            self._outstanding.clear()
+            for image_id, group_b_id, forwarded_at in notifications:
+                if group_b_id is None:
+                    continue
+                group_b_id = int(group_b_id)
+                self._pending[image_id] = (group_b_id, now if forwarded_at is None else forwarded_at)
+                self._outstanding[group_b_id] = self._outstanding.get(group_b_id, 0) + 1
+
+    def export_state(self) -> Dict:
+        """Plain-data copy of the tracked load, for state_snapshot."""
+        with self._lock:
+            return {'pending': dict(self._pending), 'ewma': dict(self._ewma)}
+
+    def restore_state(self, state: Mapping) -> None:
+        """Replace the tracked load with one from export_state()."""
+        with self._lock:
+            self._pending = dict(state['pending'])
+            self._ewma = dict(state['ewma'])
+            self._outstanding = {}
+            for group_b_id, _ in self._pending.values():
+                self._outstanding[group_b_id] = self._outstanding.get(group_b_id, 0) + 1
+
+    def stats(self, group_b_ids: Iterable[int]) -> Dict[int, GroupStats]:
+        """Current GroupStats for each of `group_b_ids`."""
+        with self._lock:
+            self._expire()
+            return {
+                group_b_id: GroupStats(
+                    self._outstanding.get(group_b_id, 0),
+                    self._ewma.get(group_b_id),
+                    self.weights.get(group_b_id, 1.0),
+                )
+                for group_b_id in group_b_ids
+            }
+
+    def _forget(self, image_id: str) -> Optional[Tuple[int, float]]:
+        entry = self._pending.pop(image_id, None)
+        if entry is not None:
+            self._outstanding[entry[0]] -= 1
+        return entry
+
+    def _expire(self) -> None:
+        cutoff = time.time() - self.stale_after
+        for image_id in [i for i, (_, at) in self._pending.items() if at < cutoff]:
+            self._forget(image_id)
+
+
+# --- strategies: (stats) -> sort key per group, lower is preferred ----------
+
+def _least_outstanding(stats: Mapping[int, GroupStats]) -> Dict[int, float]:
+    return {g: s.outstanding for g, s in stats.items()}
+
+
+def _ewma_latency(stats: Mapping[int, GroupStats]) -> Dict[int, float]:
+    known = [s.ewma_ack_s for s in stats.values() if s.ewma_ack_s is not None]
+    # Groups that have not answered yet are assumed to be average
+    default = sum(known) / len(known) if known else 1.0
+    return {g: (s.outstanding + 1) * (default if s.ewma_ack_s is None else s.ewma_ack_s) for g, s in stats.items()}
+
+
+def _weighted_capacity(stats: Mapping[int, GroupStats]) -> Dict[int, float]:
+    return {g: s.outstanding / s.weight if s.weight > 0 else float('inf') for g, s in stats.items()}
+
+
+STRATEGIES: Dict[str, Optional[Callable[[Mapping[int, GroupStats]], Dict[int, float]]]] = {
+    'least_outstanding': _least_outstanding,
+    'ewma_latency': _ewma_latency,
+    'weighted_capacity': _weighted_capacity,
+    'random': None,
+}
+
+
+class RoutingPolicy:
+    """Ranks Group Bs with one of STRATEGIES using a GroupBLoad."""
+
+    def __init__(self, load: GroupBLoad, strategy: str = DEFAULT_STRATEGY):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown routing strategy {strategy!r}, expected one of {sorted(STRATEGIES)}")
+        self.load = load
+        self.strategy = strategy
+
+    def rank(self, group_b_ids: Iterable[int]) -> List[int]:
+        """Group Bs in order of preference; empty for the random strategy."""
+        score = STRATEGIES[self.strategy]
+        if score is None:
+            return []
+        group_b_ids = list(group_b_ids)
+        # Shuffle first so ties do not always go to the same group
+        random.shuffle(group_b_ids)
+        scores = score(self.load.stats(group_b_ids))
+        return sorted(group_b_ids, key=scores.__getitem__)
+
+
+def parse_weights(spec: str) -> Dict[int, float]:
+    """Parse "chat_id:weight,chat_id:weight"."""
+    weights = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        chat_id, _, weight = item.rpartition(':')
+        weights[int(chat_id)] = float(weight)
+    return weights
+
+
+def policy_from_env() -> RoutingPolicy:
+    """RoutingPolicy configured by ROUTING_STRATEGY, ROUTING_WEIGHTS, ROUTING_EWMA_ALPHA and ROUTING_STALE_AFTER."""
+    load = GroupBLoad(
+        alpha=float(os.environ.get("ROUTING_EWMA_ALPHA", DEFAULT_EWMA_ALPHA)),
+        stale_after=float(os.environ.get("ROUTING_STALE_AFTER", DEFAULT_STALE_AFTER)),
+        weights=parse_weights(os.environ.get("ROUTING_WEIGHTS", "")),
+    )
+    return RoutingPolicy(load, os.environ.get("ROUTING_STRATEGY", DEFAULT_STRATEGY))
@@ -0,0 +1,65 @@
+"""
+Dict-like handler state kept in SQLite, for the multi-process worker mode.
+
+In worker mode the message for an image and the Group B answer to it can be
+handled by different processes, so forwarded_msgs, group_b_responses and
+pending_custom_amounts cannot live in one process's memory. SharedDict
+implements the dict operations the handlers use on top of db's
+shared_state table: every read goes to the database and every assignment
+or deletion is its own committed write, visible to all workers at once.
+Values must be JSON-serializable and are replaced as a whole; mutating a
+value read from a SharedDict does not change the stored copy.
+"""
+import json
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import db
+
+
+class SharedDict(MutableMapping):
+    """A MutableMapping stored in one namespace of the shared_state table."""
+
+    def __init__(self, namespace: str, key_type: Callable[[str], Any] = str):
+        self.namespace = namespace
+        self.key_type = key_type
+
+    def __getitem__(self, key) -> Any:
+        value = db.get_shared(self.namespace, str(key))
+        if value is None:
+            raise KeyError(key)
+        return json.loads(value)
+
+    def __setitem__(self, key, value) -> None:
+        db.set_shared(self.namespace, str(key), json.dumps(value))
+
+    def __delitem__(self, key) -> None:
+        if not db.delete_shared(self.namespace, str(key)):
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator:
+        return iter([self.key_type(key) for key, _ in db.get_shared_items(self.namespace)])
+
+    def __len__(self) -> int:
+        return db.count_shared(self.namespace)
+
+    # One query for the whole namespace instead of one lookup per key
+    def items(self) -> List[Tuple[Any, Any]]:
+        return [(self.key_type(key), json.loads(value)) for key, value in db.get_shared_items(self.namespace)]
+
+    def values(self) -> List[Any]:
+        return [value for _, value in self.items()]
+
+    def clear(self) -> None:
+        db.replace_shared(self.namespace, [])
+
+    def replace(self, data: Dict) -> None:
+        """Replace the whole namespace with `data` in one transaction."""
+        db.replace_shared(self.namespace, [(str(key), json.dumps(value)) for key, value in data.items()])
+
+    def to_dict(self) -> Dict:
+        """Plain dict copy of the namespace."""
+        return dict(self.items())
+
+    def __repr__(self) -> str:
+        return f"SharedDict({self.namespace!r})"
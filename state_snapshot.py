@@ -0,0 +1,89 @@
+"""
+Versioned binary snapshot of the bot's in-memory state.
+
+A snapshot is one pickle (protocol 5) preceded by a small header: a magic
+string, the format version and a CRC32 of the payload. Next to the state it
+stores a fingerprint of every source file the state was built from — the
+SQLite file change counter for databases, mtime and size for JSON files.
+read() returns the state only if the header, CRC, version and fingerprint
+all match, so a stale or damaged snapshot falls back to the normal load.
+"""
+import logging
+import os
+import pickle
+import struct
+import zlib
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"TLGSNAP\0"
+VERSION = 1
+_HEADER = struct.Struct(">8sII")  # magic, version, crc32 of the payload
+
+
+def _file_fingerprint(path: str) -> Optional[Tuple]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if path.endswith(".db"):
+        # Bytes 24-27 of the header count every committed write transaction; a WAL file
+        # holds commits that have not been checkpointed into the main file yet
+        with open(path, 'rb') as f:
+            header = f.read(100)
+        try:
+            wal = os.stat(path + "-wal")
+            wal_state = (wal.st_mtime_ns, wal.st_size)
+        except OSError:
+            wal_state = None
+        return header[24:28], stat.st_size, wal_state
+    return stat.st_mtime_ns, stat.st_size
+
+
+def fingerprint(paths: Iterable[str]) -> Dict[str, Optional[Tuple]]:
+    """Cheap change detector for each of `paths` (None for a missing file)."""
+    return {path: _file_fingerprint(path) for path in paths}
+
+
+def write(path: str, state: Dict[str, Any], sources: Iterable[str]) -> int:
+    """Write `state` with the fingerprint of `sources`; returns the snapshot size in bytes."""
+    # Fingerprint first: if a source changes while the state is pickled, the snapshot is simply stale
+    sources_fingerprint = fingerprint(sources)
+    payload = pickle.dumps({'fingerprint': sources_fingerprint, 'state': state}, protocol=5)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, zlib.crc32(payload)))
+        f.write(payload)
+    os.replace(tmp_path, path)
+    return _HEADER.size + len(payload)
+
+
+def read(path: str, sources: Iterable[str]) -> Optional[Dict[str, Any]]:
+    """The state stored in `path`, or None if it is missing, damaged, outdated or stale."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) < _HEADER.size:
+        logger.warning("State snapshot %s is truncated", path)
+        return None
+    magic, version, crc = _HEADER.unpack_from(data)
+    payload = memoryview(data)[_HEADER.size:]
+    if magic != MAGIC or version != VERSION:
+        logger.info("State snapshot %s has format %s, expected %s", path, version, VERSION)
+        return None
+    if zlib.crc32(payload) != crc:
+        logger.warning("State snapshot %s fails its checksum", path)
+        return None
+    try:
+        snapshot = pickle.loads(payload)
+    except Exception as e:
+        logger.warning("State snapshot %s cannot be read: %s", path, e)
+        return None
+    current = fingerprint(snapshot['fingerprint'])
+    if current != snapshot['fingerprint'] or set(current) != set(sources):
+        logger.info("State snapshot %s is older than its source files", path)
+        return None
+    return snapshot['state']
@@ -0,0 +1,322 @@
+"""
+Open/closed flag of every image in a named shared-memory segment.
+
+In worker mode every "is anything open?" check and every pick would be a
+SQLite round trip. A StatusBitmap keeps one bit per images rowid (set while
+the image is open), the same bits per Group B, the open count of each
+Group B and the totals in one multiprocessing.shared_memory segment. The
+main process creates it and rebuilds it from images.db; workers attach it
+by name. db.py applies every status change to the segment inside the
+SQLite write transaction that makes it (see db.use_status_bitmap), so the
+segment has one writer at a time. Readers take counts and pick rowids from
+it without touching the database; the claim itself is still a conditional
+UPDATE, so a stale bit can never hand out a closed image.
+
+Layout (little-endian):
+    header     magic, version counter, valid flag, capacity, max_groups, total, open, high rowid
+    groups     max_groups x (group_b_id, open count)
+    slots      one byte per rowid: 0 = no image, NO_GROUP = image without Group B, k = groups[k - 1]
+    bits       capacity bits, all open images
+    group bits max_groups x capacity bits, open images of each Group B
+
+The version counter is odd while a write is in progress (a sequence lock),
+so readers retry instead of seeing half-applied counts. If a writer dies
+midway, readers fall back to the database until the next write, which
+makes the counter even again. An invalid segment
+(a rowid beyond the capacity, more Group Bs than slots, a failed commit)
+is ignored by readers until the next rebuild.
+"""
+import logging
+import struct
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from typing import Iterable, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"IMGBITS1"
+HEADER = struct.Struct("<8sQIIIIII")
+HEADER_SIZE = 64
+GROUP = struct.Struct("<qI4x")
+NO_GROUP = 255
+MAX_GROUPS = NO_GROUP - 1
+
+DEFAULT_CAPACITY = 65536
+DEFAULT_MAX_GROUPS = 64
+
+# Byte offsets of the header fields after the magic
+_SEQ, _VALID, _CAPACITY, _MAX_GROUPS, _TOTAL, _OPEN, _HIGH = 8, 16, 20, 24, 28, 32, 36
+
+
+class StatusBitmap:
+    """Image status bits and counts in a shared-memory segment."""
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        if bytes(shm.buf[:len(MAGIC)]) != MAGIC:
+            shm.close()
+            raise ValueError(f"Shared memory {shm.name!r} is not a status bitmap")
+        self._shm = shm
+        self.owner = owner
+        self.name = shm.name
+        self.capacity = self._get(_CAPACITY)
+        self.max_groups = self._get(_MAX_GROUPS)
+        self._nbytes = self.capacity // 8
+        self._slots_at = HEADER_SIZE + self.max_groups * GROUP.size
+        self._bits_at = self._slots_at + self.capacity
+
+    @classmethod
+    def create(cls, name: Optional[str] = None, capacity: int = DEFAULT_CAPACITY,
+               max_groups: int = DEFAULT_MAX_GROUPS) -> "StatusBitmap":
+        """New, invalid (empty) segment; the creator unlinks it on close()."""
+        if not 0 < max_groups <= MAX_GROUPS:
+            raise ValueError(f"max_groups must be between 1 and {MAX_GROUPS}")
+        capacity = (capacity + 7) // 8 * 8
+        size = HEADER_SIZE + max_groups * GROUP.size + capacity + (1 + max_groups) * capacity // 8
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, 0, 0, capacity, max_groups, 0, 0, 0)
+        logger.info("Created status bitmap %s (%s images, %s Group Bs, %s KiB)",
+                    shm.name, capacity, max_groups, size // 1024)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "StatusBitmap":
+        """Attach the segment a parent process created (children share its resource tracker)."""
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+
+    def close(self) -> None:
+        """Detach; the creator also removes the segment."""
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+    # --- readers ------------------------------------------------------------
+
+    @property
+    def valid(self) -> bool:
+        return self._get(_VALID) == 1
+
+    @property
+    def version(self) -> int:
+        """Changes with every write; equal values mean nothing changed in between."""
+        return struct.unpack_from("<Q", self._shm.buf, _SEQ)[0]
+
+    @property
+    def high_rowid(self) -> int:
+        return self._get(_HIGH)
+
+    def counts(self) -> Optional[Tuple[int, int]]:
+        """(open, closed) image counts; None while the segment is invalid."""
+        counts = self._consistent(lambda: (self._get(_OPEN), self._get(_TOTAL)))
+        return None if counts is None else (counts[0], counts[1] - counts[0])
+
+    def open_count(self, group_b_id: Optional[int] = None) -> Optional[int]:
+        """Open images (of one Group B, if given); None while the segment is invalid."""
+        if group_b_id is None:
+            return self._consistent(lambda: self._get(_OPEN))
+        return self._consistent(lambda: self._group_open(self._find_group(int(group_b_id))))
+
+    def pick(self, start: int = 0, group_b_id: Optional[int] = None) -> Optional[int]:
+        """First open rowid at or after `start` (of one Group B, if given), wrapping around."""
+        if group_b_id is None:
+            at = self._bits_at
+        else:
+            slot = self._find_group(int(group_b_id))
+            if slot is None:
+                return None
+            at = self._group_bits_at(slot)
+        start = max(0, min(start, self.capacity - 1))
+        rowid = self._next_set_bit(at, start, self.capacity)
+        if rowid is None and start > 0:
+            rowid = self._next_set_bit(at, 0, start)
+        return rowid
+
+    # --- writers: only while holding the SQLite write lock --------------------
+
+    def set(self, rowid: int, is_open: bool, group_b_id: Optional[int] = None) -> None:
+        """Record that image `rowid` exists with this status and Group B."""
+        if not self.valid:
+            return
+        if not 0 < rowid < self.capacity:
+            self.invalidate(f"rowid {rowid} is beyond the capacity of {self.capacity}")
+            return
+        slot = self._slot_for(group_b_id)
+        if slot is None:
+            self.invalidate(f"more than {self.max_groups} Group Bs")
+            return
+        with self._writing():
+            if not self._remove(rowid):
+                self._add(_TOTAL, 1)
+            self._shm.buf[self._slots_at + rowid] = slot
+            if is_open:
+                self._set_open(rowid, slot, True)
+            if rowid > self._get(_HIGH):
+                self._put(_HIGH, rowid)
+
+    def remove(self, rowid: int) -> None:
+        """Record that image `rowid` was deleted."""
+        if not self.valid or not 0 < rowid < self.capacity:
+            return
+        with self._writing():
+            if self._remove(rowid):
+                self._shm.buf[self._slots_at + rowid] = 0
+                self._add(_TOTAL, -1)
+
+    def rebuild(self, rows: Iterable[Tuple[int, str, Optional[int]]]) -> bool:
+        """Replace everything with `rows` of (rowid, status, group_b_id); False if they do not fit."""
+        with self._writing():
+            buf = self._shm.buf
+            buf[HEADER_SIZE:self._slots_at] = bytes(self._slots_at - HEADER_SIZE)
+            for name in (_VALID, _TOTAL, _OPEN, _HIGH):
+                self._put(name, 0)
+            # Build in local buffers and copy them in once
+            slots = bytearray(self.capacity)
+            bits = [bytearray(self._nbytes) for _ in range(1 + self.max_groups)]
+            group_open = [0] * (1 + self.max_groups)
+            slot_of = {None: NO_GROUP}
+            total = opened = high = 0
+            for rowid, status, group_b_id in rows:
+                if not 0 < rowid < self.capacity:
+                    logger.error("Status bitmap disabled: rowid %s is beyond the capacity of %s", rowid,
+                                 self.capacity)
+                    return False
+                slot = slot_of.get(group_b_id)
+                if slot is None:
+                    slot = slot_of[group_b_id] = self._slot_for(group_b_id)
+                    if slot is None:
+                        logger.error("Status bitmap disabled: more than %s Group Bs", self.max_groups)
+                        return False
+                slots[rowid] = slot
+                if status == 'open':
+                    opened += 1
+                    byte, mask = rowid >> 3, 1 << (rowid & 7)
+                    bits[0][byte] |= mask
+                    if slot != NO_GROUP:
+                        bits[slot][byte] |= mask
+                        group_open[slot] += 1
+                total += 1
+                high = max(high, rowid)
+            buf[self._slots_at:self._bits_at] = slots
+            buf[self._bits_at:self._bits_at + len(bits) * self._nbytes] = b"".join(bits)
+            for slot in range(1, 1 + self.max_groups):
+                if group_open[slot]:
+                    self._put(self._group_open_at(slot), group_open[slot])
+            self._put(_OPEN, opened)
+            self._put(_TOTAL, total)
+            self._put(_HIGH, high)
+            self._put(_VALID, 1)
+        logger.debug("Status bitmap rebuilt: %s images, %s open", total, self._get(_OPEN))
+        return True
+
+    def invalidate(self, reason: str = "") -> None:
+        """Make readers fall back to the database until the next rebuild."""
+        if self.valid:
+            logger.warning("Status bitmap invalidated%s", f": {reason}" if reason else "")
+        with self._writing():
+            self._put(_VALID, 0)
+
+    # --- internals ------------------------------------------------------------
+
+    def _get(self, offset: int) -> int:
+        return struct.unpack_from("<I", self._shm.buf, offset)[0]
+
+    def _put(self, offset: int, value: int) -> None:
+        struct.pack_into("<I", self._shm.buf, offset, value)
+
+    def _add(self, offset: int, delta: int) -> None:
+        self._put(offset, self._get(offset) + delta)
+
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        # A writer that died midway left the counter odd; start from the next even value so it is even at rest again
+        seq = self.version
+        seq += seq & 1
+        struct.pack_into("<Q", self._shm.buf, _SEQ, seq + 1)
+        try:
+            yield
+        finally:
+            struct.pack_into("<Q", self._shm.buf, _SEQ, seq + 2)
+
+    def _consistent(self, read):
+        """read()'s value at a moment no write was in progress; None if invalid (or a writer died midway)."""
+        for _ in range(1000):
+            seq = self.version
+            if seq % 2:
+                continue
+            value = read() if self.valid else None
+            if self.version == seq:
+                return value
+        return None
+
+    def _group_bits_at(self, slot: int) -> int:
+        return self._bits_at + slot * self._nbytes
+
+    def _group_open_at(self, slot: int) -> int:
+        return HEADER_SIZE + (slot - 1) * GROUP.size + 8
+
+    def _group_open(self, slot: Optional[int]) -> int:
+        return 0 if slot is None else self._get(self._group_open_at(slot))
+
+    def _find_group(self, group_b_id: int) -> Optional[int]:
+        """Slot of `group_b_id`, or None if it has no images."""
+        table = bytes(self._shm.buf[HEADER_SIZE:HEADER_SIZE + self.max_groups * GROUP.size])
+        for index, (slot_group, _) in enumerate(GROUP.iter_unpack(table)):
+            if slot_group == group_b_id:
+                return index + 1
+            if slot_group == 0:
+                return None
+        return None
+
+    def _slot_for(self, group_b_id: Optional[int]) -> Optional[int]:
+        """Slot of `group_b_id`, taking a free one if needed; None if all are taken."""
+        if group_b_id is None:
+            return NO_GROUP
+        group_b_id = int(group_b_id)
+        slot = self._find_group(group_b_id)
+        if slot is not None:
+            return slot
+        for index in range(self.max_groups):
+            at = HEADER_SIZE + index * GROUP.size
+            if GROUP.unpack_from(self._shm.buf, at)[0] == 0:
+                GROUP.pack_into(self._shm.buf, at, group_b_id, 0)
+                return index + 1
+        return None
+
+    def _set_open(self, rowid: int, slot: int, is_open: bool) -> None:
+        buf = self._shm.buf
+        byte, mask = rowid >> 3, 1 << (rowid & 7)
+        places = [self._bits_at + byte]
+        if slot != NO_GROUP:
+            places.append(self._group_bits_at(slot) + byte)
+            self._add(self._group_open_at(slot), 1 if is_open else -1)
+        for at in places:
+            buf[at] = buf[at] | mask if is_open else buf[at] & ~mask
+        self._add(_OPEN, 1 if is_open else -1)
+
+    def _remove(self, rowid: int) -> bool:
+        """Clear the open bit of `rowid`; False if no image had that rowid."""
+        slot = self._shm.buf[self._slots_at + rowid]
+        if slot == 0:
+            return False
+        if self._shm.buf[self._bits_at + (rowid >> 3)] & (1 << (rowid & 7)):
+            self._set_open(rowid, slot, False)
+        return True
+
+    def _next_set_bit(self, at: int, start: int, end: int) -> Optional[int]:
+        """First set bit in [start, end) of the bit array at byte offset `at`."""
+        first = start >> 3
+        last = (end + 7) >> 3
+        chunk = bytes(self._shm.buf[at + first:at + last])
+        if not chunk:
+            return None
+        # Ignore the bits below `start` in its byte
+        head = chunk[0] & (0xFF << (start & 7)) & 0xFF
+        if head:
+            rowid = (first << 3) + (head & -head).bit_length() - 1
+            return rowid if rowid < end else None
+        rest = chunk[1:]
+        skipped = len(rest) - len(rest.lstrip(b"\0"))
+        if skipped == len(rest):
+            return None
+        byte = rest[skipped]
+        rowid = ((first + 1 + skipped) << 3) + (byte & -byte).bit_length() - 1
+        return rowid if rowid < end else None
@@ -0,0 +1,119 @@
+"""Setting images: ID allocation, photo deduplication (db.add_images) and albums (bot.set_album_images)."""
+import datetime
+import json
+
+import pytest
+from telegram import Chat, Message, PhotoSize, User
+
+import bot
+import config_store
+import db
+
+GROUP_B = -2
+ADMIN = 7
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'DB_FILE', str(tmp_path / "images.db"))
+
+
+def photo(unique_id: str) -> dict:
+    return {'number': 1, 'file_id': f"file_{unique_id}", 'file_unique_id': unique_id}
+
+
+def test_ids_stay_unique_and_increasing_across_calls():
+    first = db.add_images([photo('a'), photo('b')])
+    second = db.add_images([photo('c')])
+    assert first == [('img_1', True), ('img_2', True)]
+    assert second == [('img_3', True)]
+
+
+def test_ids_continue_after_legacy_images():
+    # Set before the counter existed, with the old "img_<count + 1>" scheme
+    assert db.add_image('img_41', 1, 'file_legacy')
+    assert db.add_images([photo('a')]) == [('img_42', True)]
+
+    # Deleting the newest image does not hand its ID out again
+    db.delete_images_by_number(1, None)
+    assert db.add_images([photo('b')]) == [('img_43', True)]
+
+
+def test_duplicate_photo_returns_the_stored_id():
+    assert db.add_images([photo('a')]) == [('img_1', True)]
+    assert db.add_images([photo('b'), photo('a')]) == [('img_2', True), ('img_1', False)]
+    # Twice in one batch, stored once
+    assert db.add_images([photo('c'), photo('c')]) == [('img_3', True), ('img_3', False)]
+    assert len(db.get_all_images()) == 3
+
+
+class RecordingBot:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, reply_to_message_id=None, **kwargs):
+        self.sent.append(text)
+
+
+@pytest.fixture
+def album(monkeypatch):
+    """Queue an album of `count` photos captioned `caption` in the Group B; returns its pending_albums key."""
+    monkeypatch.setattr(bot, 'CONFIG', config_store.ConfigStore(
+        config_store.ConfigSnapshot(
+            group_a_ids=frozenset([-1]),
+            group_b_ids=frozenset([GROUP_B]),
+            group_admins=config_store.freeze_admins({GROUP_B: [ADMIN]}),
+            global_admins=frozenset(),
+            forwarding_enabled=True,
+        ),
+        "group_a_ids.json", "group_b_ids.json", "group_admins.json", "bot_settings.json"
+    ))
+    monkeypatch.setattr(bot, 'pending_albums', {})
+    monkeypatch.setattr(bot, 'store_image_copy', lambda *args: False)
+
+    def make(count: int, caption: str):
+        key = (GROUP_B, "album_1")
+        messages = [
+            Message(10 + i, datetime.datetime.now(), Chat(GROUP_B, 'group'), from_user=User(ADMIN, 'admin', False),
+                    photo=[PhotoSize(f"file_{i}", f"unique_{i}", 100, 100)], media_group_id="album_1",
+                    caption=caption if i == 0 else None)
+            for i in range(count)
+        ]
+        bot.pending_albums[key] = {'messages': messages, 'timer': None}
+        return key
+
+    return make
+
+
+def numbers():
+    return sorted(image['number'] for image in db.get_all_images())
+
+
+def test_album_range_gives_each_photo_a_number(album):
+    sender = RecordingBot()
+    bot.set_album_images(sender, album(3, "设置群 12-14"))
+    assert numbers() == [12, 13, 14]
+    assert sender.sent == ["✅ 已设置3张图片为12-14群"]
+    image = db.get_images_by_number(12, GROUP_B)[0]
+    assert json.dumps(image['metadata']) == bot.group_image_metadata(GROUP_B)
+
+
+def test_album_single_number_for_every_photo(album):
+    sender = RecordingBot()
+    bot.set_album_images(sender, album(2, "设置群5"))
+    assert numbers() == [5, 5]
+
+
+def test_album_range_must_match_the_photo_count(album):
+    sender = RecordingBot()
+    bot.set_album_images(sender, album(3, "设置群 12-20"))
+    assert numbers() == []
+    assert sender.sent == ["相册有3张图片，但群号12-20对应9个群，请重新发送。"]
+
+
+def test_album_sent_again_is_skipped(album):
+    sender = RecordingBot()
+    bot.set_album_images(sender, album(2, "设置群 12-13"))
+    bot.set_album_images(sender, album(2, "设置群 12-13"))
+    assert numbers() == [12, 13]
+    assert sender.sent[-1] == "✅ 已设置0张图片为12-13群（2张已设置过，已跳过）"
@@ -0,0 +1,99 @@
+"""Configuration snapshots and their JSON files (config_store.py)."""
+import json
+
+import pytest
+
+import config_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return config_store.ConfigStore(
+        config_store.ConfigSnapshot(
+            group_a_ids=frozenset([-1]),
+            group_b_ids=frozenset([-2]),
+            group_admins=config_store.freeze_admins({}),
+            global_admins=frozenset([1]),
+            forwarding_enabled=True,
+        ),
+        "group_a_ids.json", "group_b_ids.json", "group_admins.json", "bot_settings.json"
+    )
+
+
+def add_group_b(group_b_id: int):
+    return lambda snapshot: snapshot._replace(group_b_ids=snapshot.group_b_ids | {group_b_id})
+
+
+def test_save_and_load(store):
+    store.modify(add_group_b(-3))
+    store.save()
+    with open("group_b_ids.json") as f:
+        assert sorted(json.load(f)) == [-3, -2]
+
+    with open("group_a_ids.json", 'w') as f:
+        json.dump([-5], f)
+    assert store.check_external_changes()
+    assert store.current.group_a_ids == frozenset([-5])
+    assert store.current.group_b_ids == frozenset([-3, -2])
+    assert not store.check_external_changes()
+
+
+def test_reload_keeps_a_change_made_while_reading(store, monkeypatch):
+    store.save()
+    read_files = store._read_files
+
+    def read_then_modify():
+        loaded = read_files()
+        # A handler changes the configuration after the files were read
+        store.modify(add_group_b(-3))
+        return loaded
+
+    monkeypatch.setattr(store, '_read_files', read_then_modify)
+    monkeypatch.setattr(store, '_ensure_thread', lambda: None)
+    store.load()
+    assert store.current.group_b_ids == frozenset([-3, -2])
+
+    # The pending save writes it out
+    store.flush()
+    with open("group_b_ids.json") as f:
+        assert sorted(json.load(f)) == [-3, -2]
+
+
+def test_reload_keeps_both_a_hand_edit_and_an_unsaved_change(store, monkeypatch):
+    store.save()
+    monkeypatch.setattr(store, '_ensure_thread', lambda: None)
+    store.modify(add_group_b(-3))
+
+    # Edited by hand before the change above was written
+    with open("group_a_ids.json", 'w') as f:
+        json.dump([-1, -5], f)
+    assert store.check_external_changes()
+    assert store.current.group_a_ids == frozenset([-1, -5])
+    assert store.current.group_b_ids == frozenset([-3, -2])
+
+    store.flush()
+    with open("group_a_ids.json") as f:
+        assert sorted(json.load(f)) == [-5, -1]
+    with open("group_b_ids.json") as f:
+        assert sorted(json.load(f)) == [-3, -2]
+
+
+def test_workers_sharing_the_files_keep_each_others_changes(store, monkeypatch):
+    store.save()
+    other = config_store.ConfigStore(store.current, *store.files.values())
+    other.load()
+    for worker in (store, other):
+        monkeypatch.setattr(worker, '_ensure_thread', lambda: None)
+
+    # Both change the configuration before either has seen the other's change
+    store.modify(add_group_b(-3))
+    other.modify(add_group_b(-4))
+    store.save()
+    other.save()
+    with open("group_b_ids.json") as f:
+        assert sorted(json.load(f)) == [-4, -3, -2]
+    assert other.current.group_b_ids == frozenset([-4, -3, -2])
+
+    assert store.check_external_changes()
+    assert store.current.group_b_ids == frozenset([-4, -3, -2])
@@ -0,0 +1,95 @@
+"""Group B generations: "重置群码" retires a pool, the purge backs it up and deletes it (db.py, bot.py)."""
+import glob
+import gzip
+import json
+
+import pytest
+
+import bot
+import db
+import image_backup
+import routing_policy
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(db, 'DB_FILE', str(tmp_path / "images.db"))
+    monkeypatch.setattr(image_backup, 'BACKUP_DIR', str(tmp_path / "backups"))
+    monkeypatch.setattr(bot, 'forwarded_msgs', {})
+    monkeypatch.setattr(bot, 'group_b_responses', {})
+    monkeypatch.setattr(bot, 'ROUTING', routing_policy.RoutingPolicy(routing_policy.GroupBLoad()))
+    return tmp_path
+
+
+def add(image_id: str, number: int, group_b_id: int):
+    assert db.add_image(image_id, number, f"file_{image_id}", metadata=json.dumps({'source_group_b_id': group_b_id}))
+
+
+def exported_ids():
+    ids = []
+    for path in sorted(glob.glob(f"{image_backup.BACKUP_DIR}/*.jsonl.gz")):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            ids.extend(json.loads(line)['image_id'] for line in f)
+    return ids
+
+
+def test_reset_retires_the_pool():
+    add('img_1', 100, -2)
+    add('img_2', 200, -3)
+    assert db.reset_group_b(-2) == 1
+    assert db.get_images_by_number(100, -2) == []
+    assert [image['image_id'] for image in db.get_images_by_number(200, -3)] == ['img_2']
+    assert db.get_stale_generations() == [(-2, 1)]
+
+
+def test_purge_backs_up_before_deleting():
+    add('img_1', 100, -2)
+    add('img_2', 101, -2)
+    add('img_3', 200, -3)
+    db.reset_group_b(-2)
+    add('img_4', 102, -2)
+
+    bot.purge_stale_generations()
+    assert exported_ids() == ['img_1', 'img_2']
+    assert sorted(image['image_id'] for image in db.get_all_images()) == ['img_3', 'img_4']
+    assert db.get_stale_generations() == []
+
+
+def test_purge_forgets_notifications_of_purged_images():
+    add('img_1', 100, -2)
+    add('img_2', 200, -3)
+    for image_id, group_b_id in (('img_1', -2), ('img_2', -3)):
+        bot.forwarded_msgs[image_id] = {'group_b_chat_id': group_b_id}
+        bot.ROUTING.load.dispatched(group_b_id, image_id)
+    db.reset_group_b(-2)
+
+    bot.purge_stale_generations()
+    assert list(bot.forwarded_msgs) == ['img_2']
+    stats = bot.ROUTING.load.stats([-2, -3])
+    assert (stats[-2].outstanding, stats[-3].outstanding) == (0, 1)
+
+
+def test_purge_leaves_images_a_later_reset_retired():
+    add('img_1', 100, -2)
+    db.reset_group_b(-2)
+    add('img_2', 101, -2)
+    db.reset_group_b(-2)
+
+    # Only what the first reset retired was in the caller's backup
+    assert db.purge_stale_images(-2, before=1) == ['img_1']
+    assert db.purge_stale_images(-2, before=1) == []
+    assert db.purge_stale_images(-2) == ['img_2']
+
+
+def test_import_overwrite_joins_the_current_generation():
+    add('img_1', 100, -3)
+    db.reset_group_b(-2)
+
+    # Moving an image to a Group B that was reset keeps it live there
+    moved = {'image_id': 'img_1', 'number': 101, 'file_id': 'file_img_1', 'metadata': {'source_group_b_id': -2}}
+    assert db.import_images([moved], overwrite=True) == 1
+    assert [image['image_id'] for image in db.get_images_by_number(101, -2)] == ['img_1']
+
+    db.reset_group_b(-2)
+    assert db.get_images_by_number(101, -2) == []
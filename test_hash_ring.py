@@ -0,0 +1,65 @@
+"""Consistent-hash ring over the Group B chats (hash_ring.py)."""
+import os
+import subprocess
+import sys
+
+import hash_ring
+
+KEYS = [f"img_{i}" for i in range(5000)]
+GROUPS = [-1001, -1002, -1003, -1004, -1005]
+
+
+def placement(ring):
+    return {key: ring.get(key) for key in KEYS}
+
+
+def test_empty_ring():
+    assert hash_ring.HashRing([]).get("img_1") is None
+
+
+def test_placement_does_not_depend_on_node_order():
+    assert placement(hash_ring.HashRing(GROUPS)) == placement(hash_ring.HashRing(reversed(GROUPS)))
+
+
+def test_placement_is_the_same_in_every_process():
+    # hash() is salted per process; the ring must not be
+    script = "import hash_ring; print([hash_ring.HashRing(%r).get('img_%%s' %% i) for i in range(50)])" % GROUPS
+    outputs = {
+        subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                       env=dict(os.environ, PYTHONHASHSEED=seed)).stdout
+        for seed in ("1", "2")
+    }
+    assert len(outputs) == 1
+    assert outputs.pop().strip() == str([hash_ring.HashRing(GROUPS).get(f"img_{i}") for i in range(50)])
+
+
+def test_keys_spread_over_all_nodes():
+    counts = {}
+    for owner in placement(hash_ring.HashRing(GROUPS)).values():
+        counts[owner] = counts.get(owner, 0) + 1
+    assert set(counts) == set(GROUPS)
+    assert min(counts.values()) > len(KEYS) / len(GROUPS) / 2
+
+
+def test_adding_a_node_only_moves_its_share():
+    before = placement(hash_ring.HashRing(GROUPS))
+    after = placement(hash_ring.HashRing(GROUPS + [-1006]))
+    moved = [key for key in KEYS if before[key] != after[key]]
+    # Every moved key goes to the new node, about 1/6 of them
+    assert {after[key] for key in moved} == {-1006}
+    assert len(moved) < len(KEYS) / 6 * 1.5
+
+
+def test_removing_a_node_only_moves_its_keys():
+    before = placement(hash_ring.HashRing(GROUPS))
+    after = placement(hash_ring.HashRing(GROUPS[1:]))
+    for key in KEYS:
+        if before[key] != GROUPS[0]:
+            assert after[key] == before[key]
+
+
+def test_ring_for_reuses_the_ring():
+    ring = hash_ring.ring_for(GROUPS)
+    assert hash_ring.ring_for(reversed(GROUPS)) is ring
+    assert hash_ring.ring_for(GROUPS[1:]) is not ring
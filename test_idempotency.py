@@ -0,0 +1,131 @@
+"""The persisted update offset and once-per-message handlers (idempotency.py)."""
+import datetime
+import threading
+
+import pytest
+from telegram import Chat, Message, Update, User
+
+import db
+import idempotency
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'DB_FILE', str(tmp_path / "images.db"))
+
+
+def make_update(update_id: int, chat_id: int = -100, message_id: int = 1) -> Update:
+    message = Message(message_id, datetime.datetime.now(), Chat(chat_id, 'group'),
+                      from_user=User(1, 'member', False), text="100")
+    return Update(update_id, message=message)
+
+
+class ManualDispatcher:
+    """Collects run_async jobs so the test decides when each one runs."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def run_async(self, func, *args, update=None, **kwargs):
+        self.jobs.append((func, args))
+
+    def run(self, index: int):
+        func, args = self.jobs[index]
+        return func(*args)
+
+
+def stored_offset():
+    value = db.get_state(idempotency.OFFSET_KEY)
+    return int(value) if value is not None else None
+
+
+def test_offset_is_saved_and_loaded():
+    offset = idempotency.UpdateOffset(interval=0)
+    offset.seen(make_update(5))
+    offset.seen(make_update(4))
+    assert stored_offset() == 5
+    assert idempotency.UpdateOffset().load() == 5
+
+
+def test_offset_waits_for_running_handlers():
+    offset = idempotency.UpdateOffset(interval=0)
+    dispatcher = ManualDispatcher()
+    handled = []
+    for update_id in (10, 11, 12):
+        update = make_update(update_id)
+        offset.run_async(dispatcher, lambda u, c: handled.append(u.update_id), update, None)
+        offset.seen(update)
+    # Nothing finished yet: a crash now must fetch update 10 again
+    assert offset.completed() == 9
+
+    dispatcher.run(1)
+    assert offset.completed() == 9
+    dispatcher.run(0)
+    assert offset.completed() == 11
+    assert stored_offset() == 11
+    dispatcher.run(2)
+    assert offset.completed() == 12
+    assert stored_offset() == 12
+    assert handled == [11, 10, 12]
+
+
+def test_failed_handler_releases_the_offset():
+    offset = idempotency.UpdateOffset(interval=0)
+    dispatcher = ManualDispatcher()
+
+    def fail(update, context):
+        raise RuntimeError("handler failed")
+
+    update = make_update(20)
+    offset.run_async(dispatcher, fail, update, None)
+    offset.seen(update)
+    with pytest.raises(RuntimeError):
+        dispatcher.run(0)
+    assert offset.completed() == 20
+
+
+def test_once_records_the_message_after_the_handler():
+    calls = []
+
+    def handler(update, context):
+        # Not recorded while it runs, so a crash here lets the redelivered message through
+        calls.append(db.is_message_handled(update.effective_message.chat_id, update.effective_message.message_id))
+
+    wrapped = idempotency.once(handler)
+    wrapped(make_update(1, message_id=7), None)
+    wrapped(make_update(2, message_id=7), None)
+    assert calls == [False]
+    assert db.is_message_handled(-100, 7)
+
+    # Another message in the same chat is handled normally
+    wrapped(make_update(3, message_id=8), None)
+    assert calls == [False, False]
+
+
+def test_once_skips_a_copy_that_is_being_handled():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def handler(update, context):
+        calls.append(update.update_id)
+        started.set()
+        release.wait(5)
+
+    wrapped = idempotency.once(handler)
+    first = threading.Thread(target=wrapped, args=(make_update(1, message_id=9), None))
+    first.start()
+    assert started.wait(5)
+    wrapped(make_update(2, message_id=9), None)
+    release.set()
+    first.join(5)
+    assert calls == [1]
+
+
+def test_once_records_a_message_whose_handler_failed():
+    def handler(update, context):
+        raise RuntimeError("handler failed")
+
+    with pytest.raises(RuntimeError):
+        idempotency.once(handler)(make_update(1, message_id=11), None)
+    assert db.is_message_handled(-100, 11)
@@ -0,0 +1,79 @@
+"""Reading legacy JSON backups in chunks and restoring backups (image_backup.py)."""
+import io
+import json
+import os
+
+import pytest
+
+import db
+import image_backup
+
+LEGACY_BACKUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images_backup_20250419_182423.json")
+
+# Strings with escapes and multi-byte characters, numbers of every shape, nesting
+AWKWARD = json.dumps([
+    {"image_id": "img_1", "number": 12345, "metadata": {"note": "逗号, ] 和 \"引号\" \\ é"}},
+    -1002648811668, 0.5, 1e-7, "", [], [[1, [2]], {}], True, None,
+    {"image_id": "img_2", "number": 7, "file_id": "AgAC" * 20},
+], ensure_ascii=False, indent=1)
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'DB_FILE', str(tmp_path / "images.db"))
+    monkeypatch.setattr(image_backup, 'BACKUP_DIR', str(tmp_path / "backups"))
+
+
+def parse(text: str, chunk_size: int) -> list:
+    return list(image_backup._iter_json_array(io.StringIO(text), chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 16, 1 << 16])
+def test_chunk_boundaries_anywhere(chunk_size):
+    with open(LEGACY_BACKUP, encoding='utf-8') as f:
+        legacy = f.read()
+    assert parse(legacy, chunk_size) == json.loads(legacy)
+    assert parse(AWKWARD, chunk_size) == json.loads(AWKWARD)
+
+
+@pytest.mark.parametrize("text", ["[]", " [ ] ", "[1]", "[\n1\n,\n2\n]"])
+def test_small_arrays(text):
+    assert parse(text, 1) == json.loads(text)
+
+
+def test_truncated_input_is_an_error():
+    # Every proper prefix is cut off somewhere: inside a string, a number, an object or between items
+    for end in range(len(AWKWARD)):
+        with pytest.raises(ValueError):
+            parse(AWKWARD[:end], 4)
+
+
+@pytest.mark.parametrize("text", ['{"image_id": "img_1"}', '[1 2]', '[1,]', '[{"a": 1}}'])
+def test_malformed_input_is_an_error(text):
+    with pytest.raises(ValueError):
+        parse(text, 3)
+
+
+def stored():
+    return sorted((image['image_id'], image['number'], image['file_id'], image['status'], json.dumps(image.get('metadata')))
+                  for image in db.get_all_images())
+
+
+def test_merge_then_restore_round_trip():
+    with open(LEGACY_BACKUP, encoding='utf-8') as f:
+        legacy = json.load(f)
+    assert image_backup.load([LEGACY_BACKUP]) == len(legacy)
+    # Merging again adds nothing
+    assert image_backup.load([LEGACY_BACKUP]) == 0
+    before = stored()
+    assert [image_id for image_id, *_ in before] == sorted(image['image_id'] for image in legacy)
+
+    path, count = image_backup.export()
+    assert count == len(legacy)
+
+    # Images changed after the export are put back by a restore
+    for image in legacy:
+        db.set_image_status(image['image_id'], 'closed')
+    assert image_backup.load([path]) == 0
+    assert image_backup.load([path], overwrite=True) == len(legacy)
+    assert stored() == before
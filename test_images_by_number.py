@@ -0,0 +1,65 @@
+"""Finding and deleting images by their number (db.get_images_by_number / db.delete_images_by_number)."""
+import json
+
+import pytest
+
+import db
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'DB_FILE', str(tmp_path / "images.db"))
+
+
+def add(image_id: str, number: int, group_b_id=None):
+    metadata = json.dumps({'source_group_b_id': group_b_id}) if group_b_id is not None else None
+    assert db.add_image(image_id, number, f"file_{image_id}", metadata=metadata)
+
+
+def ids(images):
+    return [image['image_id'] for image in images]
+
+
+def test_lookup_in_one_group_b():
+    add('img_1', 12, -2)
+    add('img_2', 12, -3)
+    add('img_3', 12)
+    add('img_4', 13, -2)
+    assert ids(db.get_images_by_number(12, -2)) == ['img_1']
+    assert ids(db.get_images_by_number(12, None)) == ['img_3']
+    assert db.get_images_by_number(99, -2) == []
+
+
+def test_lookup_in_any_group_b_oldest_first():
+    add('img_1', 12, -2)
+    add('img_2', 12)
+    add('img_3', 12, -3)
+    assert ids(db.get_images_by_number(12)) == ['img_1', 'img_2', 'img_3']
+    assert ids(db.get_images_by_number(12, db.ANY_GROUP_B, limit=1)) == ['img_1']
+
+
+def test_lookup_finds_images_of_a_dissolved_group_b():
+    # Dissolving a Group B removes the chat from the configuration but keeps its images
+    add('img_1', 12, -555)
+    assert db.get_images_by_number(12, -1002648811668) == []
+    assert ids(db.get_images_by_number(12, limit=1)) == ['img_1']
+
+
+def test_lookup_skips_retired_images():
+    add('img_1', 12, -2)
+    db.reset_group_b(-2)
+    assert db.get_images_by_number(12) == []
+
+
+def test_delete_only_touches_one_group_b():
+    add('img_1', 12, -2)
+    add('img_2', 12, -2)
+    add('img_3', 12, -3)
+    add('img_4', 12)
+    deleted = db.delete_images_by_number(12, -2)
+    assert ids(deleted) == ['img_1', 'img_2']
+    assert deleted[0]['metadata'] == {'source_group_b_id': -2}
+    assert ids(db.get_images_by_number(12)) == ['img_3', 'img_4']
+
+    assert ids(db.delete_images_by_number(12, None)) == ['img_4']
+    assert db.delete_images_by_number(12, -2) == []
@@ -0,0 +1,74 @@
+"""Active/standby election through the SQLite lease and its fencing tokens (leader_lease.py)."""
+import threading
+import time
+
+import pytest
+
+import db
+import leader_lease
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'DB_FILE', str(tmp_path / "images.db"))
+    # The fence is process-wide; leave none behind for other tests
+    monkeypatch.setattr(db, '_fence', None)
+
+
+def test_one_leader_at_a_time():
+    leader = leader_lease.Lease(60, holder="a")
+    standby = leader_lease.Lease(60, holder="b")
+    assert leader.try_acquire()
+    assert leader.token == 1
+    assert not standby.try_acquire()
+    assert leader.is_valid()
+
+    # Taking it again while still holding it keeps the token
+    assert leader.try_acquire()
+    assert leader.token == 1
+
+
+def test_release_hands_over_with_a_new_token():
+    leader = leader_lease.Lease(60, holder="a")
+    standby = leader_lease.Lease(60, holder="b")
+    assert leader.try_acquire()
+    leader.release()
+    assert standby.try_acquire()
+    assert standby.token == 2
+    assert db.get_lease(leader_lease.DEFAULT_NAME)['holder'] == "b"
+
+
+def test_expired_lease_is_taken_over():
+    leader = leader_lease.Lease(0.05, holder="a")
+    standby = leader_lease.Lease(60, holder="b")
+    assert leader.try_acquire()
+    time.sleep(0.1)
+    assert not leader.is_valid()
+    assert standby.try_acquire()
+    assert standby.token == 2
+
+
+def test_stale_leader_cannot_write():
+    leader = leader_lease.Lease(0.05, holder="a")
+    assert leader.try_acquire()
+    assert db.add_image('img_1', 100, 'file_1')
+
+    time.sleep(0.1)
+    # The standby takes over in another process; here only its lease row changes
+    assert db.acquire_lease(leader_lease.DEFAULT_NAME, "b", 60) == 2
+    assert not db.add_image('img_2', 101, 'file_2')
+    assert [image['image_id'] for image in db.get_all_images()] == ['img_1']
+
+
+def test_heartbeat_notices_the_takeover():
+    leader = leader_lease.Lease(0.3, holder="a")
+    assert leader.try_acquire()
+    lost = threading.Event()
+    leader.start_heartbeat(lost.set)
+
+    # A standby took the lease while this one was paused
+    db.release_lease(leader_lease.DEFAULT_NAME, "a", leader.token)
+    assert db.acquire_lease(leader_lease.DEFAULT_NAME, "b", 60) == 2
+    assert lost.wait(2)
+    assert leader.lost.is_set()
+    assert not leader.is_valid()
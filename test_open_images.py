@@ -0,0 +1,69 @@
+"""Handing out open images (db.select_open_image and the functions built on it)."""
+import json
+
+import pytest
+
+import db
+import status_bitmap
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'DB_FILE', str(tmp_path / "images.db"))
+
+
+def add(image_id: str, group_b_id: int, status: str = 'open'):
+    metadata = json.dumps({'source_group_b_id': group_b_id})
+    assert db.add_image(image_id, 1, f"file_{image_id}", status=status, metadata=metadata)
+
+
+def test_random_open_image_is_open_and_live():
+    add('img_1', -2, 'closed')
+    add('img_2', -2)
+    add('img_3', -3)
+    db.reset_group_b(-3)
+    for _ in range(20):
+        assert db.get_random_open_image()['image_id'] == 'img_2'
+
+    db.set_image_status('img_2', 'closed')
+    assert db.get_random_open_image() is None
+
+
+def test_random_open_image_reaches_every_open_image():
+    for i in range(10):
+        add(f"img_{i}", -2)
+    seen = {db.get_random_open_image()['image_id'] for _ in range(200)}
+    assert seen == {f"img_{i}" for i in range(10)}
+
+
+def test_random_open_image_by_group_b_falls_back():
+    add('img_1', -2)
+    add('img_2', -3, 'closed')
+    assert db.get_random_open_image_by_group_b(-2)['image_id'] == 'img_1'
+    assert db.get_random_open_image_by_group_b(-3)['image_id'] == 'img_1'
+    assert db.get_random_open_image_by_group_b(-3, fallback=False) is None
+
+
+def test_random_open_image_uses_the_bitmap():
+    add('img_1', -2)
+    bitmap = status_bitmap.StatusBitmap.create(capacity=64)
+    try:
+        db.use_status_bitmap(bitmap)
+        assert db.sync_status_bitmap()
+        assert db.get_random_open_image()['image_id'] == 'img_1'
+        # Closed through db, so the bitmap knows nothing is open without asking SQLite
+        db.set_image_status('img_1', 'closed')
+        assert bitmap.counts() == (0, 1)
+        assert db.get_random_open_image() is None
+    finally:
+        db.use_status_bitmap(None)
+        bitmap.close()
+
+
+def test_first_image_whatever_its_status():
+    assert db.get_first_image() is None
+    add('img_1', -2, 'closed')
+    add('img_2', -2)
+    assert db.get_first_image()['image_id'] == 'img_1'
+    db.reset_group_b(-2)
+    assert db.get_first_image() is None
@@ -0,0 +1,109 @@
+"""Load-aware ranking of the Group B pools (routing_policy.py)."""
+import pytest
+
+import routing_policy
+
+
+@pytest.fixture
+def load(monkeypatch):
+    # Notifications below are forwarded at t=0; keep them from expiring
+    monkeypatch.setattr(routing_policy.time, 'time', lambda: 50.0)
+    return routing_policy.GroupBLoad(alpha=0.5, stale_after=100.0)
+
+
+def rank(load, strategy, group_b_ids=(-1, -2, -3)):
+    return routing_policy.RoutingPolicy(load, strategy).rank(group_b_ids)
+
+
+def test_outstanding_follows_dispatch_and_ack(load):
+    load.dispatched(-1, 'img_1', at=0.0)
+    load.dispatched(-1, 'img_2', at=0.0)
+    load.dispatched(-2, 'img_3', at=0.0)
+    # Forwarding an image again moves it rather than counting it twice
+    load.dispatched(-2, 'img_2', at=0.0)
+    assert load.acknowledged('img_3', at=10.0) == 10.0
+    assert load.acknowledged('img_3', at=10.0) is None
+
+    stats = load.stats([-1, -2])
+    assert stats[-1].outstanding == 1
+    assert stats[-2].outstanding == 1
+    assert stats[-2].ewma_ack_s == 10.0
+    assert stats[-1].ewma_ack_s is None
+
+
+def test_forget_does_not_count_as_an_answer(load):
+    load.dispatched(-1, 'img_1', at=0.0)
+    assert load.forget('img_1')
+    assert not load.forget('img_1')
+    stats = load.stats([-1])[-1]
+    assert stats.outstanding == 0
+    assert stats.ewma_ack_s is None
+
+
+def test_ewma_moves_towards_new_latencies(load):
+    for image_id, latency in (('img_1', 10.0), ('img_2', 20.0), ('img_3', 20.0)):
+        load.dispatched(-1, image_id, at=0.0)
+        load.acknowledged(image_id, at=latency)
+    assert load.stats([-1])[-1].ewma_ack_s == 17.5
+
+
+def test_unanswered_notifications_expire(load, monkeypatch):
+    load.dispatched(-1, 'img_1', at=0.0)
+    load.dispatched(-1, 'img_2', at=150.0)
+    monkeypatch.setattr(routing_policy.time, 'time', lambda: 200.0)
+    assert load.stats([-1])[-1].outstanding == 1
+
+
+def test_least_outstanding(load):
+    for image_id, group_b_id in (('img_1', -1), ('img_2', -1), ('img_3', -3)):
+        load.dispatched(group_b_id, image_id)
+    assert rank(load, 'least_outstanding') == [-2, -3, -1]
+
+
+def test_ewma_latency_prefers_fast_groups(load):
+    for image_id, group_b_id, latency in (('img_1', -1, 60.0), ('img_2', -2, 5.0), ('img_3', -3, 20.0)):
+        load.dispatched(group_b_id, image_id, at=0.0)
+        load.acknowledged(image_id, at=latency)
+    # One request waiting on the fast group still beats the slow one
+    load.dispatched(-2, 'img_4')
+    assert rank(load, 'ewma_latency') == [-2, -3, -1]
+
+
+def test_weighted_capacity():
+    load = routing_policy.GroupBLoad(weights=routing_policy.parse_weights("-1:3, -2:1,-3:0"))
+    for i in range(3):
+        load.dispatched(-1, f"img_a{i}")
+    load.dispatched(-2, 'img_b')
+    load.dispatched(-2, 'img_c')
+    # 3/3 beats 2/1; weight 0 takes nothing
+    assert rank(load, 'weighted_capacity') == [-1, -2, -3]
+
+
+def test_random_has_no_preference(load):
+    assert rank(load, 'random') == []
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        routing_policy.RoutingPolicy(routing_policy.GroupBLoad(), 'fastest')
+
+
+def test_rebuild_counts_closed_images_only(load):
+    forwarded_msgs = {
+        'img_1': {'group_b_chat_id': -1},
+        'img_2': {'group_b_chat_id': -1},
+        'img_3': {'group_b_chat_id': -2},
+    }
+    load.rebuild(forwarded_msgs, ['img_1', 'img_3'])
+    stats = load.stats([-1, -2])
+    assert (stats[-1].outstanding, stats[-2].outstanding) == (1, 1)
+
+
+def test_state_round_trip(load):
+    load.dispatched(-1, 'img_1', at=0.0)
+    load.dispatched(-2, 'img_2', at=0.0)
+    load.acknowledged('img_2', at=4.0)
+
+    restored = routing_policy.GroupBLoad()
+    restored.restore_state(load.export_state())
+    assert restored.stats([-1, -2]) == load.stats([-1, -2])
@@ -0,0 +1,61 @@
+"""Warm start from the state snapshot (bot.save_state_snapshot / bot.restore_state_snapshot)."""
+import pytest
+
+import bot
+import config_store
+
+
+def make_config(global_admins):
+    return config_store.ConfigStore(
+        config_store.ConfigSnapshot(
+            group_a_ids=frozenset([-1]),
+            group_b_ids=frozenset([-2]),
+            group_admins=config_store.freeze_admins({-2: [7]}),
+            global_admins=frozenset(global_admins),
+            forwarding_enabled=True,
+        ),
+        "group_a_ids.json", "group_b_ids.json", "group_admins.json", "bot_settings.json"
+    )
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory, so the snapshot and its source files are the test's own."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, 'forwarded_msgs', {'img_1': {'group_b_chat_id': -2}})
+    monkeypatch.setattr(bot, 'group_b_responses', {})
+    monkeypatch.setattr(bot, 'pending_custom_amounts', {})
+    return tmp_path
+
+
+def test_restore_brings_back_state(workdir, monkeypatch):
+    monkeypatch.setattr(bot, 'CONFIG', make_config([1, 2]))
+    assert bot.save_state_snapshot()
+
+    monkeypatch.setattr(bot, 'forwarded_msgs', {})
+    monkeypatch.setattr(bot, 'CONFIG', make_config([1, 2]))
+    assert bot.restore_state_snapshot()
+    assert bot.forwarded_msgs == {'img_1': {'group_b_chat_id': -2}}
+    assert bot.CONFIG.current.group_admins[-2] == frozenset([7])
+
+
+def test_edited_global_admins_win_over_snapshot(workdir, monkeypatch):
+    # Saved while user 2 was a global admin
+    monkeypatch.setattr(bot, 'CONFIG', make_config([1, 2]))
+    assert bot.save_state_snapshot()
+
+    # Restarted after user 2 was removed from GLOBAL_ADMINS
+    monkeypatch.setattr(bot, 'CONFIG', make_config([1]))
+    assert bot.restore_state_snapshot()
+    assert bot.CONFIG.current.global_admins == frozenset([1])
+    assert not bot.is_global_admin(2)
+
+
+def test_stale_snapshot_is_ignored(workdir, monkeypatch):
+    monkeypatch.setattr(bot, 'CONFIG', make_config([1]))
+    assert bot.save_state_snapshot()
+
+    # A source file changed after the snapshot was written
+    with open(bot.FORWARDED_MSGS_FILE, 'w') as f:
+        f.write("{}")
+    assert not bot.restore_state_snapshot()
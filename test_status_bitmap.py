@@ -0,0 +1,77 @@
+"""Shared-memory image status bitmap (status_bitmap.py)."""
+import struct
+
+import pytest
+
+import status_bitmap
+
+
+@pytest.fixture
+def bitmap():
+    bitmap = status_bitmap.StatusBitmap.create(capacity=64, max_groups=4)
+    yield bitmap
+    bitmap.close()
+
+
+def kill_writer_midway(bitmap):
+    """Leave the sequence counter odd, as a process killed inside _writing() does."""
+    struct.pack_into("<Q", bitmap._shm.buf, status_bitmap._SEQ, bitmap.version + 1)
+
+
+def test_counts_and_picks(bitmap):
+    assert bitmap.counts() is None
+    assert bitmap.rebuild([(1, 'open', -10), (2, 'closed', -10), (5, 'open', -20), (7, 'open', None)])
+    assert bitmap.counts() == (3, 1)
+    assert bitmap.open_count(-10) == 1
+    assert bitmap.open_count(-20) == 1
+    assert bitmap.pick(2) == 5
+    assert bitmap.pick(6, -10) == 1
+
+    bitmap.set(2, True, -10)
+    bitmap.remove(5)
+    assert bitmap.counts() == (3, 0)
+    assert bitmap.open_count(-10) == 2
+    assert bitmap.open_count(-20) == 0
+    assert bitmap.pick(3, -20) is None
+
+
+def test_invalid_until_rebuilt(bitmap):
+    bitmap.rebuild([(1, 'open', None)])
+    bitmap.set(100, True)
+    assert not bitmap.valid
+    assert bitmap.counts() is None
+    assert bitmap.rebuild([(1, 'open', None)])
+    assert bitmap.counts() == (1, 0)
+
+
+def test_writes_stay_even_at_rest(bitmap):
+    bitmap.rebuild([(1, 'open', None)])
+    for _ in range(3):
+        bitmap.set(1, False)
+        assert bitmap.version % 2 == 0
+
+
+def test_rebuild_repairs_a_writer_that_died(bitmap):
+    bitmap.rebuild([(1, 'open', -10)])
+    kill_writer_midway(bitmap)
+    assert bitmap.version % 2 == 1
+    # Readers cannot trust the segment now
+    assert bitmap.counts() is None
+
+    assert bitmap.rebuild([(1, 'open', -10), (2, 'closed', -10)])
+    assert bitmap.version % 2 == 0
+    assert bitmap.counts() == (1, 1)
+
+
+def test_write_after_a_dead_writer_restores_parity(bitmap):
+    bitmap.rebuild([(1, 'open', None), (2, 'open', None)])
+    kill_writer_midway(bitmap)
+
+    bitmap.set(2, False)
+    assert bitmap.version % 2 == 0
+    assert bitmap.counts() == (1, 1)
+
+    # The write in progress is odd again, so readers retry rather than read a torn state
+    with bitmap._writing():
+        assert bitmap.version % 2 == 1
+        assert bitmap.counts() is None
@@ -0,0 +1,79 @@
+"""Group A requests waiting for an image (wait_queue.py)."""
+import pytest
+
+import wait_queue
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "wait_queue.json")
+
+
+def request(chat_id: int, message_id: int, queued_at: float) -> wait_queue.WaitingRequest:
+    return wait_queue.WaitingRequest(chat_id, message_id, 1, "100", queued_at)
+
+
+def drain(queue, now: float = 0.0):
+    served = []
+    while True:
+        waiting, _ = queue.pop_oldest(now)
+        if waiting is None:
+            return served
+        served.append((waiting.chat_id, waiting.message_id))
+
+
+def test_oldest_first_across_chats_fifo_within_each(path):
+    queue = wait_queue.WaitQueue(path, enabled=True)
+    assert queue.push(request(-1, 1, 1.0)) == 1
+    assert queue.push(request(-2, 2, 2.0)) == 1
+    assert queue.push(request(-1, 3, 3.0)) == 2
+    assert queue.push(request(-2, 4, 4.0)) == 2
+    assert len(queue) == 4
+    assert drain(queue, now=5.0) == [(-1, 1), (-2, 2), (-1, 3), (-2, 4)]
+
+
+def test_full_chat_queue_rejects(path):
+    queue = wait_queue.WaitQueue(path, enabled=True, max_length=2)
+    assert queue.push(request(-1, 1, 1.0)) == 1
+    assert queue.push(request(-1, 2, 2.0)) == 2
+    assert queue.push(request(-1, 3, 3.0)) is None
+    # Other chats have their own limit
+    assert queue.push(request(-2, 4, 4.0)) == 1
+
+
+def test_expired_requests_are_dropped(path):
+    queue = wait_queue.WaitQueue(path, enabled=True, max_wait=10.0)
+    queue.push(request(-1, 1, 0.0))
+    queue.push(request(-1, 2, 15.0))
+    waiting, expired = queue.pop_oldest(now=20.0)
+    assert waiting.message_id == 2
+    assert [r.message_id for r in expired] == [1]
+    assert len(queue) == 0
+
+
+def test_push_front_keeps_its_turn(path):
+    queue = wait_queue.WaitQueue(path, enabled=True)
+    queue.push(request(-1, 1, 1.0))
+    queue.push(request(-1, 2, 2.0))
+    waiting, _ = queue.pop_oldest(now=3.0)
+    # Serving it failed; it goes back ahead of the later one
+    queue.push_front(waiting)
+    assert drain(queue, now=3.0) == [(-1, 1), (-1, 2)]
+
+
+def test_queues_survive_a_restart(path):
+    queue = wait_queue.WaitQueue(path, enabled=True)
+    queue.push(request(-1, 1, 1.0))
+    queue.push(request(-2, 2, 2.0))
+    queue.push(request(-1, 3, 3.0))
+    queue.pop_oldest(now=4.0)
+
+    restarted = wait_queue.WaitQueue(path, enabled=True)
+    restarted.load()
+    assert restarted.export_state() == queue.export_state()
+    assert drain(restarted, now=4.0) == [(-2, 2), (-1, 3)]
+
+    # Emptied queues are saved too
+    restarted = wait_queue.WaitQueue(path, enabled=True)
+    restarted.load()
+    assert len(restarted) == 0
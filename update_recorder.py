@@ -0,0 +1,62 @@
+"""
+Optional recorder of incoming updates for replay.py.
+
+Every update is appended as one JSON line {"ts": arrival time, "update": ...}
+to a size-rotated file. Recordings contain user IDs, names and message texts,
+so keep them on the bot host and delete them when they are no longer needed.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import time
+from typing import Optional
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateRecorder:
+    """Writes updates to a rotating JSON-lines file through a dedicated logger."""
+
+    def __init__(self, path: str, max_bytes: int = 50 * 1024 * 1024, backup_count: int = 5):
+        self.path = path
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+
+        # Own logger so recordings never end up in (or depend on) the bot log
+        self._log = logging.getLogger(f"{__name__}.file")
+        self._log.handlers = [handler]
+        self._log.setLevel(logging.INFO)
+        self._log.propagate = False
+
+    def record(self, update: Update, context=None) -> None:
+        """Dispatcher callback: append the update with its arrival time."""
+        try:
+            line = json.dumps({'ts': time.time(), 'update': update.to_dict()}, ensure_ascii=False)
+        except Exception as e:
+            logger.warning("Could not serialise update %s: %s", getattr(update, 'update_id', None), e)
+            return
+        self._log.info(line)
+
+    def close(self) -> None:
+        for handler in self._log.handlers:
+            handler.close()
+
+
+def recorder_from_env() -> Optional[UpdateRecorder]:
+    """Build a recorder when UPDATE_RECORD_FILE is set, otherwise return None."""
+    path = os.environ.get("UPDATE_RECORD_FILE")
+    if not path:
+        return None
+    max_bytes = int(os.environ.get("UPDATE_RECORD_MAX_BYTES", str(50 * 1024 * 1024)))
+    backup_count = int(os.environ.get("UPDATE_RECORD_BACKUPS", "5"))
+    logger.info("Recording incoming updates to %s", path)
+    return UpdateRecorder(path, max_bytes=max_bytes, backup_count=backup_count)
+
+
+# Set up in bot.main(); None while recording is disabled
+RECORDER: Optional[UpdateRecorder] = None
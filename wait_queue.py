@@ -0,0 +1,125 @@
+"""
+Bounded FIFO of Group A requests that arrived while every image was closed.
+
+Each Group A chat has its own queue of at most `max_length` requests. When
+an image is reopened the bot pops the oldest request across all chats and
+serves it; requests older than `max_wait` seconds are dropped instead. The
+queues are written to a JSON file (temp file + rename) on every change so
+waiting requests survive a restart.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WaitingRequest(NamedTuple):
+    """A Group A request waiting for an image."""
+    chat_id: int
+    message_id: int
+    user_id: int
+    amount: str
+    queued_at: float
+
+
+class WaitQueue:
+    """Per-Group-A FIFO queues served oldest-first across all chats."""
+
+    def __init__(self, path: str, enabled: bool = False, max_length: int = 20, max_wait: float = 600.0,
+                 notify_position: bool = True):
+        self.path = path
+        self.enabled = enabled
+        self.max_length = max_length
+        self.max_wait = max_wait
+        self.notify_position = notify_position
+        self._lock = threading.Lock()
+        self._queues: Dict[int, Deque[WaitingRequest]] = {}
+
+    def push(self, request: WaitingRequest) -> Optional[int]:
+        """Queue `request`; returns its 1-based position in its chat's queue, or None if that queue is full."""
+        with self._lock:
+            queue = self._queues.setdefault(request.chat_id, deque())
+            if len(queue) >= self.max_length:
+                return None
+            queue.append(request)
+            self._save()
+            return len(queue)
+
+    def push_front(self, request: WaitingRequest) -> None:
+        """Put back a request that could not be served after all."""
+        with self._lock:
+            self._queues.setdefault(request.chat_id, deque()).appendleft(request)
+            self._save()
+
+    def pop_oldest(self, now: Optional[float] = None):
+        """Remove and return (oldest live request or None, requests dropped for waiting too long)."""
+        now = time.time() if now is None else now
+        expired: List[WaitingRequest] = []
+        with self._lock:
+            oldest = None
+            for queue in self._queues.values():
+                while queue and now - queue[0].queued_at > self.max_wait:
+                    expired.append(queue.popleft())
+                if queue and (oldest is None or queue[0].queued_at < oldest[0].queued_at):
+                    oldest = queue
+            request = oldest.popleft() if oldest is not None else None
+            if request is not None or expired:
+                self._save()
+        return request, expired
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def export_state(self) -> Dict[int, List[WaitingRequest]]:
+        """Copy of the queues, for state_snapshot."""
+        with self._lock:
+            return {chat_id: list(queue) for chat_id, queue in self._queues.items() if queue}
+
+    def restore_state(self, state: Dict[int, List[WaitingRequest]]) -> None:
+        """Replace the queues with ones from export_state()."""
+        with self._lock:
+            self._queues = {chat_id: deque(requests) for chat_id, requests in state.items()}
+
+    def load(self) -> None:
+        """Read the queues written by a previous run, if any."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            with self._lock:
+                self._queues = {
+                    int(chat_id): deque(WaitingRequest(*entry) for entry in entries)
+                    for chat_id, entries in data.items()
+                }
+            logger.info("Loaded %s waiting Group A requests from file", len(self))
+        except Exception as e:
+            logger.error("Error loading wait queue: %s", e)
+
+    def _save(self) -> None:
+        # Called with the lock held
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({str(chat_id): [list(r) for r in queue] for chat_id, queue in self._queues.items() if queue},
+                          f, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error("Error saving wait queue: %s", e)
+
+
+def queue_from_env(path: str) -> WaitQueue:
+    """WaitQueue configured by WAIT_QUEUE_ENABLED, WAIT_QUEUE_MAX, WAIT_QUEUE_MAX_WAIT and WAIT_QUEUE_NOTIFY."""
+    return WaitQueue(
+        path,
+        enabled=os.environ.get("WAIT_QUEUE_ENABLED", "0") == "1",
+        max_length=int(os.environ.get("WAIT_QUEUE_MAX", "20")),
+        max_wait=float(os.environ.get("WAIT_QUEUE_MAX_WAIT", "600")),
+        notify_position=os.environ.get("WAIT_QUEUE_NOTIFY", "1") == "1",
+    )
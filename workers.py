@@ -0,0 +1,115 @@
+"""
+Multi-process worker mode: one intake process, N handler processes sharded by chat.
+
+The intake process polls Telegram as usual, but its dispatcher only hands
+each update to WorkerPool.submit, which sends it (as the Bot API dict) to
+worker `stable_hash(chat_id) % N` over a multiprocessing queue. All updates
+of one chat therefore go to the same worker and stay in order. Each worker
+is a separate interpreter started with the "spawn" method, so handlers run
+on as many cores as there are workers instead of sharing one GIL.
+
+State the handlers share across chats lives in SQLite (WAL mode): images
+are claimed with a conditional UPDATE (db.select_open_image(claim=True)),
+messages are marked handled with INSERT OR IGNORE and the forwarded-message
+mappings are SharedDicts (shared_state.py).
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from typing import Callable, List, Optional, Sequence
+
+from telegram import Update
+
+from hash_ring import stable_hash
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 10000
+
+
+def shard_of(chat_id, shards: int) -> int:
+    """Worker index for `chat_id`; the same in every process and across restarts."""
+    return stable_hash(str(chat_id)) % shards
+
+
+def chat_id_of(update: Update) -> int:
+    """Chat an update belongs to; 0 for updates without a chat."""
+    chat = update.effective_chat
+    return chat.id if chat else 0
+
+
+class WorkerPool:
+    """N worker processes, each fed by its own queue."""
+
+    def __init__(self, processes: int, target: Callable, args: Sequence = (), queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.target = target
+        self.args = tuple(args)
+        self._context = multiprocessing.get_context("spawn")
+        self.inboxes = [self._context.Queue(queue_size) for _ in range(processes)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * processes
+        self.restarts = 0
+        self._stopping = threading.Event()
+
+    def __len__(self) -> int:
+        return len(self.inboxes)
+
+    def start(self, supervise_interval: float = 1.0) -> None:
+        """Start every worker, and a thread that restarts workers that die."""
+        for index in range(len(self)):
+            self._start_worker(index)
+        if supervise_interval > 0:
+            threading.Thread(target=self._supervise, args=(supervise_interval,), name="worker-pool",
+                             daemon=True).start()
+
+    def submit(self, update: Update, context=None) -> int:
+        """Send `update` to the worker for its chat (usable as a handler callback); returns the worker index."""
+        index = shard_of(chat_id_of(update), len(self))
+        self.inboxes[index].put(update.to_dict())
+        return index
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Let every worker finish its queued updates, then wait for it to exit."""
+        self._stopping.set()
+        for inbox in self.inboxes:
+            inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Worker %s did not stop in time, terminating it", index)
+                process.terminate()
+
+    def _start_worker(self, index: int) -> None:
+        process = self._context.Process(
+            target=self.target, args=(index, self.inboxes[index]) + self.args, name=f"worker-{index}", daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info("Started worker %s (pid %s)", index, process.pid)
+
+    def _supervise(self, interval: float) -> None:
+        while not self._stopping.wait(interval):
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive() and not self._stopping.is_set():
+                    logger.error("Worker %s exited with code %s, restarting it", index, process.exitcode)
+                    self.restarts += 1
+                    self._start_worker(index)
+
+
+def serve(inbox, dispatcher) -> None:
+    """Worker loop: feed the updates arriving in `inbox` to `dispatcher` until None arrives."""
+    thread = threading.Thread(target=dispatcher.start, name="dispatcher", daemon=True)
+    thread.start()
+    while True:
+        data = inbox.get()
+        if data is None:
+            break
+        dispatcher.update_queue.put(Update.de_json(data, dispatcher.bot))
+    # Dispatcher.stop() drops updates it has not taken yet
+    while not dispatcher.update_queue.empty():
+        time.sleep(0.05)
+    dispatcher.stop()
+    thread.join()